@@ -2,6 +2,7 @@ import os
 import sys
 
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class IntelligenceConfig(AppConfig):
@@ -10,7 +11,13 @@ class IntelligenceConfig(AppConfig):
     verbose_name = '智慧推薦'
 
     def ready(self):
-        # 只在 runserver 主程序啟動時啟用排程，避免重複推播。
+        import apps.intelligence.signals
+
+        # 只在 runserver 主程序啟動內嵌排程；正式環境以 manage.py run_scheduler 執行。
+        # 工作以資料庫租約協調，即使多個行程同時執行排程也不會重複推播。
+        if not settings.EMBEDDED_SCHEDULER_ENABLED:
+            return
+
         is_runserver = any(arg in ('runserver', 'runserver_plus') for arg in sys.argv)
         if not is_runserver:
             return
@@ -0,0 +1,48 @@
+"""
+排程租約的 fencing 檢查
+
+每次取得 SchedulerLease 時 fencing_token 加一。工作執行時間超過租約、租約到期
+並被其他行程取得後，原本的行程手上的 token 就不再相符。
+
+run_job 以 bind_lease 記下目前執行緒持有的（工作名稱、持有者、token），工作在
+寫入每一批結果前呼叫 ensure_lease_held()：已失去租約時拋出 LeaseLost 中止，
+不會與接手的行程同時寫入。不是由排程執行（例如管理指令）時不做任何檢查。
+"""
+import threading
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from .models import SchedulerLease
+
+_local = threading.local()
+
+
+class LeaseLost(Exception):
+    """排程租約已由其他行程取得。"""
+
+
+@contextmanager
+def bind_lease(job_name, owner, token):
+    previous = getattr(_local, 'lease', None)
+    _local.lease = (job_name, owner, token)
+    try:
+        yield
+    finally:
+        _local.lease = previous
+
+
+def lease_is_held(job_name, owner, token, now=None):
+    return SchedulerLease.objects.filter(
+        name=job_name,
+        owner=owner,
+        fencing_token=token,
+        expires_at__gt=now or timezone.now(),
+    ).exists()
+
+
+def ensure_lease_held():
+    """目前執行緒的排程租約已失效時拋出 LeaseLost（未由排程執行時不檢查）。"""
+    lease = getattr(_local, 'lease', None)
+    if lease is not None and not lease_is_held(*lease):
+        raise LeaseLost(f'{lease[0]} 的租約已由其他行程取得（owner={lease[1]}）')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.intelligence.services.product_similarity_service import (
+	DEFAULT_TOP_K,
+	SIMILARITY_METRICS,
+	rebuild_all_similarities,
+)
+
+
+class Command(BaseCommand):
+	help = '離線計算各店家商品相似度（Top-K 鄰居）並寫入 ProductSimilarity'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--store-id',
+			type=int,
+			action='append',
+			dest='store_ids',
+			help='只重建指定店家（可重複指定）',
+		)
+		parser.add_argument(
+			'--top-k',
+			type=int,
+			default=DEFAULT_TOP_K,
+			help='每個商品保留的相似商品數',
+		)
+		parser.add_argument(
+			'--metric',
+			choices=SIMILARITY_METRICS,
+			default='jaccard',
+			help='相似度指標',
+		)
+
+	def handle(self, *args, **options):
+		if options['top_k'] < 1:
+			raise CommandError('--top-k 必須至少為 1')
+
+		summary = rebuild_all_similarities(
+			top_k=options['top_k'],
+			metric=options['metric'],
+			store_ids=options['store_ids'],
+		)
+		self.stdout.write(self.style.SUCCESS('已重建商品相似度'))
+		self.stdout.write(
+			'stores={stores_count}, pairs={pairs_count}, elapsed={elapsed_seconds}s'.format(**summary)
+		)
@@ -1,16 +1,60 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from apps.intelligence.services.line_recommendation_push_service import LineRecommendationPushService
+from apps.intelligence.services.recommendation_batch_service import (
+	DEFAULT_ACTIVE_DAYS,
+	DEFAULT_CHUNK_SIZE,
+	DEFAULT_TTL_HOURS,
+	run_recommendation_batch,
+)
 
 
 class Command(BaseCommand):
-	help = '執行 LINE 個人化推薦推播（快速備案或完整版自動推播）'
+	help = '批次預先計算用戶推薦（店家、商品、LINE 推播內容），接著執行 LINE 個人化推播（--no-push 時只計算）'
 
 	def add_arguments(self, parser):
+		parser.add_argument(
+			'--user-id',
+			type=int,
+			action='append',
+			dest='user_ids',
+			help='只計算指定用戶（可重複指定）',
+		)
+		parser.add_argument(
+			'--chunk-size',
+			type=int,
+			default=DEFAULT_CHUNK_SIZE,
+			help='每個區塊的用戶數',
+		)
+		parser.add_argument(
+			'--workers',
+			type=int,
+			default=1,
+			help='平行計算的行程數',
+		)
+		parser.add_argument(
+			'--ttl-hours',
+			type=int,
+			default=DEFAULT_TTL_HOURS,
+			help='預先計算結果的有效時數',
+		)
+		parser.add_argument(
+			'--active-days',
+			type=int,
+			default=DEFAULT_ACTIVE_DAYS,
+			help='近幾天內有訂單的用戶視為活躍用戶',
+		)
+		parser.add_argument(
+			'--no-push',
+			'--precompute-only',
+			action='store_true',
+			dest='no_push',
+			help='只進行批次計算，不執行完整版自動推播',
+		)
 		parser.add_argument(
 			'--fallback-only',
 			action='store_true',
-			help='只執行快速備案（熱門店家推播）',
+			help='只執行快速備案（熱門店家推播），不進行批次計算',
 		)
 		parser.add_argument(
 			'--intro-message',
@@ -21,28 +65,44 @@ class Command(BaseCommand):
 		parser.add_argument(
 			'--force',
 			action='store_true',
-			help='忽略最小間隔與每週上限，強制執行完整版流程',
+			help='推播時忽略最小間隔與每週上限，強制執行完整版流程',
 		)
 
 	def handle(self, *args, **options):
-		service = LineRecommendationPushService()
-
 		try:
 			if options['fallback_only']:
-				summary = service.send_quick_fallback_popular_recommendation(
+				summary = LineRecommendationPushService().send_quick_fallback_popular_recommendation(
 					intro_message=options['intro_message']
 				)
 				self.stdout.write(self.style.SUCCESS('已執行快速備案推播'))
-			else:
-				summary = service.run_automated_personalized_recommendation(
-					force=options['force']
-				)
-				self.stdout.write(self.style.SUCCESS('已執行完整版自動推薦推播流程'))
+				self._write_push_summary(summary)
+				return
 
+			batch_summary = run_recommendation_batch(
+				user_ids=options['user_ids'],
+				chunk_size=options['chunk_size'],
+				workers=max(1, options['workers']),
+				ttl_hours=options['ttl_hours'],
+				active_days=options['active_days'],
+			)
+			self.stdout.write(self.style.SUCCESS('已完成推薦批次計算'))
 			self.stdout.write(
-				'mode={mode}, recipient={recipient_count}, success={success_count}, failure={failure_count}, skipped={skipped_count}'.format(
-					**summary
-				)
+				'users={users_count}, chunks={chunks_count}, rows={rows_count}, '
+				'expired_deleted={expired_deleted}, elapsed={elapsed_seconds}s'.format(**batch_summary)
 			)
+
+			if not options['no_push']:
+				summary = LineRecommendationPushService().run_automated_personalized_recommendation(
+					force=options['force']
+				)
+				self.stdout.write(self.style.SUCCESS('已執行完整版自動推薦推播流程'))
+				self._write_push_summary(summary)
 		except ValueError as exc:
 			raise CommandError(str(exc)) from exc
+
+	def _write_push_summary(self, summary):
+		self.stdout.write(
+			'mode={mode}, recipient={recipient_count}, success={success_count}, failure={failure_count}, skipped={skipped_count}'.format(
+				**summary
+			)
+		)
@@ -1,2 +1,77 @@
-# This is a placeholder for a Django management command.
-# You can write your staffing prediction logic here.
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.intelligence.services.demand_forecast_service import (
+	DEFAULT_HISTORY_WEEKS,
+	DEFAULT_HORIZON_HOURS,
+	benchmark_forecast,
+	run_demand_forecast,
+)
+
+
+class Command(BaseCommand):
+	help = '依歷史訂單預測各店家未來逐小時需求，並換算各職務建議排班人數'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--store-id',
+			type=int,
+			action='append',
+			dest='store_ids',
+			help='只預測指定店家（可重複指定）',
+		)
+		parser.add_argument(
+			'--history-weeks',
+			type=int,
+			default=DEFAULT_HISTORY_WEEKS,
+			help='使用的歷史週數',
+		)
+		parser.add_argument(
+			'--horizon-hours',
+			type=int,
+			default=DEFAULT_HORIZON_HOURS,
+			help='預測的小時數（預設 7 天）',
+		)
+		parser.add_argument(
+			'--backtest',
+			action='store_true',
+			help='保留最後一週回測並輸出 WAPE / MAE（與上週同時段基準比較）',
+		)
+		parser.add_argument(
+			'--dry-run',
+			action='store_true',
+			help='只計算不寫入資料表',
+		)
+		parser.add_argument(
+			'--benchmark-stores',
+			type=int,
+			default=0,
+			help='以指定店家數的模擬資料量測效能，不讀寫資料庫',
+		)
+
+	def handle(self, *args, **options):
+		if options['benchmark_stores'] < 0:
+			raise CommandError('--benchmark-stores 不可為負數')
+
+		if options['benchmark_stores']:
+			report = benchmark_forecast(
+				stores_count=options['benchmark_stores'],
+				weeks=max(options['history_weeks'], 2),
+			)
+			self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+			return
+
+		try:
+			summary = run_demand_forecast(
+				store_ids=options['store_ids'],
+				history_weeks=options['history_weeks'],
+				horizon_hours=options['horizon_hours'],
+				dry_run=options['dry_run'],
+				with_backtest=options['backtest'],
+			)
+		except ValueError as exc:
+			raise CommandError(str(exc)) from exc
+
+		self.stdout.write(self.style.SUCCESS('已完成需求與排班人力預測'))
+		self.stdout.write(json.dumps(summary, ensure_ascii=False, indent=2))
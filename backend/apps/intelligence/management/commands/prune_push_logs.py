@@ -0,0 +1,48 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.intelligence.models import PersonalizedRecommendationPushLog
+from apps.line_bot.models import StoreUserPushLog
+from apps.line_bot.services.log_writer import prune_push_logs
+
+
+class Command(BaseCommand):
+	help = '清理推播記錄：刪除超過保存期限的記錄，並提早移除舊的略過記錄'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--retention-days',
+			type=int,
+			default=settings.PUSH_LOG_RETENTION_DAYS,
+			help='記錄保存天數，超過即刪除',
+		)
+		parser.add_argument(
+			'--compact-after-days',
+			type=int,
+			default=settings.PUSH_LOG_COMPACT_AFTER_DAYS,
+			help='略過（skipped）記錄保存天數',
+		)
+		parser.add_argument(
+			'--dry-run',
+			action='store_true',
+			help='只計算會刪除的筆數',
+		)
+
+	def handle(self, *args, **options):
+		summary = {}
+		try:
+			for model in (PersonalizedRecommendationPushLog, StoreUserPushLog):
+				summary[model._meta.db_table] = prune_push_logs(
+					model,
+					retention_days=options['retention_days'],
+					compact_after_days=options['compact_after_days'],
+					dry_run=options['dry_run'],
+				)
+		except ValueError as exc:
+			raise CommandError(str(exc)) from exc
+
+		label = '預計刪除' if options['dry_run'] else '已清理'
+		self.stdout.write(self.style.SUCCESS(f'{label}推播記錄'))
+		self.stdout.write(json.dumps(summary, ensure_ascii=False, indent=2))
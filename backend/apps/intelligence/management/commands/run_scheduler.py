@@ -0,0 +1,89 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.intelligence.models import SchedulerRun
+from apps.intelligence.scheduler import build_owner_id, get_default_jobs, run_due_jobs, run_scheduler_loop
+
+
+class Command(BaseCommand):
+	help = '以資料庫租約執行推薦推播排程（可多個行程同時執行，每個工作同一時間只有一個行程執行）'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--job',
+			action='append',
+			dest='jobs',
+			help='只執行指定工作（可重複指定）',
+		)
+		parser.add_argument(
+			'--once',
+			action='store_true',
+			help='只檢查一輪到期工作後結束',
+		)
+		parser.add_argument(
+			'--poll-seconds',
+			type=int,
+			default=None,
+			help='檢查到期工作的間隔秒數',
+		)
+		parser.add_argument(
+			'--list',
+			action='store_true',
+			dest='list_jobs',
+			help='列出工作與最近一次執行結果',
+		)
+
+	def handle(self, *args, **options):
+		jobs = get_default_jobs()
+		if options['jobs']:
+			known = {job.name for job in jobs}
+			unknown = sorted(set(options['jobs']) - known)
+			if unknown:
+				raise CommandError(f'未知的工作：{", ".join(unknown)}（可用：{", ".join(sorted(known))}）')
+			jobs = [job for job in jobs if job.name in options['jobs']]
+
+		if options['poll_seconds'] is not None and options['poll_seconds'] < 1:
+			raise CommandError('--poll-seconds 必須至少為 1')
+
+		if options['list_jobs']:
+			self._list_jobs(jobs)
+			return
+
+		owner = build_owner_id()
+		if options['once']:
+			runs = run_due_jobs(jobs, owner)
+			self.stdout.write(json.dumps(
+				[{'job': run.job_name, 'status': run.status, 'duration_seconds': run.duration_seconds} for run in runs],
+				ensure_ascii=False,
+				indent=2,
+			))
+			return
+
+		stop_event = threading.Event()
+
+		def _stop(signum, frame):
+			self.stdout.write(f'收到訊號 {signum}，完成目前工作後結束')
+			stop_event.set()
+
+		signal.signal(signal.SIGTERM, _stop)
+		signal.signal(signal.SIGINT, _stop)
+
+		self.stdout.write(self.style.SUCCESS(f'排程已啟動：{owner}'))
+		run_scheduler_loop(jobs=jobs, owner=owner, stop_event=stop_event, poll_seconds=options['poll_seconds'])
+
+	def _list_jobs(self, jobs):
+		rows = []
+		for job in jobs:
+			last_run = SchedulerRun.objects.filter(job_name=job.name).order_by('-started_at').first()
+			rows.append({
+				'job': job.name,
+				'interval_seconds': job.interval_seconds,
+				'jitter_seconds': round(job.jitter_seconds, 1),
+				'last_status': last_run.status if last_run else None,
+				'last_started_at': last_run.started_at.isoformat() if last_run else None,
+				'last_duration_seconds': last_run.duration_seconds if last_run else None,
+			})
+		self.stdout.write(json.dumps(rows, ensure_ascii=False, indent=2))
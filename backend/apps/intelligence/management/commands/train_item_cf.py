@@ -0,0 +1,96 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.intelligence.ml_models.evaluation import evaluate_item_cf
+from apps.intelligence.ml_models.item_cf import (
+	DEFAULT_TOP_K,
+	build_interaction_matrix,
+	load_interactions,
+	prune_versions,
+	save_model,
+	train_item_cf,
+)
+
+
+class Command(BaseCommand):
+	help = '以訂單明細訓練 Item-based 協同過濾模型並輸出版本化產物'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--top-k',
+			type=int,
+			default=DEFAULT_TOP_K,
+			help='每個商品保留的鄰居數',
+		)
+		parser.add_argument(
+			'--min-support',
+			type=int,
+			default=1,
+			help='兩商品至少被幾位用戶共同購買才列入相似度',
+		)
+		parser.add_argument(
+			'--evaluate',
+			action='store_true',
+			help='執行 leave-one-out 離線評估（precision@k、訓練時間、記憶體）',
+		)
+		parser.add_argument(
+			'--k',
+			type=int,
+			default=10,
+			help='評估時的推薦數量 k',
+		)
+		parser.add_argument(
+			'--no-save',
+			action='store_true',
+			help='只訓練或評估，不寫入產物',
+		)
+		parser.add_argument(
+			'--keep',
+			type=int,
+			default=3,
+			help='保留的歷史版本數',
+		)
+
+	def handle(self, *args, **options):
+		if options['top_k'] < 1:
+			raise CommandError('--top-k 必須至少為 1')
+		if options['k'] < 1:
+			raise CommandError('--k 必須至少為 1')
+
+		started = time.perf_counter()
+		interactions = list(load_interactions())
+		self.stdout.write(
+			f'interactions={len(interactions)} loaded in {time.perf_counter() - started:.2f}s'
+		)
+
+		if options['evaluate']:
+			report = evaluate_item_cf(
+				interactions,
+				k=options['k'],
+				top_k=options['top_k'],
+				min_support=options['min_support'],
+			)
+			self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+
+		if options['no_save']:
+			return
+
+		matrix, _, product_ids = build_interaction_matrix(interactions)
+		model = train_item_cf(
+			matrix,
+			product_ids,
+			top_k=options['top_k'],
+			min_support=options['min_support'],
+		)
+		version = save_model(model)
+		removed = prune_versions(keep=max(options['keep'], 1))
+
+		self.stdout.write(self.style.SUCCESS(f'已輸出協同過濾模型 {version}'))
+		self.stdout.write(
+			'users={users_count}, products={products_count}, interactions={interactions_count}, '
+			'training={training_seconds}s'.format(**model.meta)
+		)
+		if removed:
+			self.stdout.write(f'removed versions: {", ".join(removed)}')
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('intelligence', '0006_rename_personalized_user_id_4a2669_idx_personalize_user_id_683c04_idx_and_more'),
+        ('products', '0012_productingredient'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='排名')),
+                ('score', models.FloatField(verbose_name='相似度')),
+                ('common_tags', models.JSONField(blank=True, default=list, verbose_name='共同標籤')),
+                ('computed_at', models.DateTimeField(verbose_name='計算時間')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='products.product', verbose_name='商品')),
+                ('similar_product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.product', verbose_name='相似商品')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_similarities', to='stores.store', verbose_name='店家')),
+            ],
+            options={
+                'verbose_name': '商品相似度',
+                'verbose_name_plural': '商品相似度',
+                'db_table': 'product_similarities',
+                'ordering': ['product', 'rank'],
+                'indexes': [models.Index(fields=['product', 'rank'], name='product_sim_product_3f54d7_idx')],
+                'unique_together': {('product', 'similar_product')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('intelligence', '0007_productsimilarity'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('stores', '推薦店家'), ('products', '推薦商品'), ('line_stores', 'LINE 個人化推薦店家'), ('store_profile', '店家內偏好輪廓')], max_length=20, verbose_name='推薦類型')),
+                ('items', models.JSONField(blank=True, default=list, verbose_name='推薦項目')),
+                ('context', models.JSONField(blank=True, default=dict, verbose_name='附加資訊')),
+                ('computed_at', models.DateTimeField(verbose_name='計算時間')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='過期時間')),
+                ('store', models.ForeignKey(blank=True, help_text='僅店家內偏好輪廓使用', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stores.store', verbose_name='店家')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='precomputed_recommendations', to=settings.AUTH_USER_MODEL, verbose_name='系統用戶')),
+            ],
+            options={
+                'verbose_name': '用戶預先計算推薦',
+                'verbose_name_plural': '用戶預先計算推薦',
+                'db_table': 'user_recommendations',
+                'ordering': ['user', 'kind'],
+                'indexes': [models.Index(fields=['user', 'kind', 'store'], name='user_recomm_user_id_bff05c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('intelligence', '0008_userrecommendation'),
+        ('schedules', '0012_jobrole_staffing_capacity'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemandForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('takeout', '外帶'), ('dine_in', '內用'), ('surplus', '惜福食品')], max_length=20, verbose_name='通路')),
+                ('forecast_for', models.DateTimeField(verbose_name='預測時段（整點開始）')),
+                ('expected_orders', models.FloatField(verbose_name='預測訂單數')),
+                ('smoothing_alpha', models.FloatField(verbose_name='平滑係數')),
+                ('generated_at', models.DateTimeField(verbose_name='產生時間')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='demand_forecasts', to='stores.store', verbose_name='店家')),
+            ],
+            options={
+                'verbose_name': '需求預測',
+                'verbose_name_plural': '需求預測',
+                'db_table': 'demand_forecasts',
+                'ordering': ['store', 'forecast_for', 'channel'],
+                'indexes': [models.Index(fields=['store', 'forecast_for'], name='demand_fore_store_i_d5d62c_idx')],
+                'unique_together': {('store', 'channel', 'forecast_for')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StaffingForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('forecast_for', models.DateTimeField(verbose_name='預測時段（整點開始）')),
+                ('expected_orders', models.FloatField(verbose_name='預測訂單數')),
+                ('required_staff', models.PositiveIntegerField(verbose_name='建議人數')),
+                ('generated_at', models.DateTimeField(verbose_name='產生時間')),
+                ('job_role', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staffing_forecasts', to='schedules.jobrole', verbose_name='職務')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staffing_forecasts', to='stores.store', verbose_name='店家')),
+            ],
+            options={
+                'verbose_name': '排班人力預測',
+                'verbose_name_plural': '排班人力預測',
+                'db_table': 'staffing_forecasts',
+                'ordering': ['store', 'forecast_for', 'job_role'],
+                'indexes': [models.Index(fields=['store', 'forecast_for'], name='staffing_fo_store_i_f2800e_idx')],
+                'unique_together': {('job_role', 'forecast_for')},
+            },
+        ),
+    ]
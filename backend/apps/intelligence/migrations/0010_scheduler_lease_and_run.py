@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('intelligence', '0009_demand_and_staffing_forecasts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='工作名稱')),
+                ('owner', models.CharField(blank=True, max_length=200, verbose_name='持有者')),
+                ('expires_at', models.DateTimeField(blank=True, null=True, verbose_name='租約到期時間')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='最後心跳時間')),
+                ('next_run_at', models.DateTimeField(db_index=True, verbose_name='下次執行時間')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新時間')),
+            ],
+            options={
+                'verbose_name': '排程租約',
+                'verbose_name_plural': '排程租約',
+                'db_table': 'scheduler_leases',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SchedulerRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_name', models.CharField(max_length=100, verbose_name='工作名稱')),
+                ('owner', models.CharField(max_length=200, verbose_name='執行者')),
+                ('status', models.CharField(choices=[('running', '執行中'), ('success', '成功'), ('failed', '失敗')], default='running', max_length=20, verbose_name='狀態')),
+                ('started_at', models.DateTimeField(verbose_name='開始時間')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='結束時間')),
+                ('duration_seconds', models.FloatField(blank=True, null=True, verbose_name='執行秒數')),
+                ('summary', models.JSONField(blank=True, default=dict, verbose_name='執行摘要')),
+                ('error_message', models.TextField(blank=True, verbose_name='錯誤訊息')),
+            ],
+            options={
+                'verbose_name': '排程執行記錄',
+                'verbose_name_plural': '排程執行記錄',
+                'db_table': 'scheduler_runs',
+                'ordering': ['-started_at'],
+                'indexes': [models.Index(fields=['job_name', 'started_at'], name='scheduler_r_job_nam_91a0c9_idx')],
+            },
+        ),
+    ]
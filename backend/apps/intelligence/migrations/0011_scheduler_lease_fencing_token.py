@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('intelligence', '0010_scheduler_lease_and_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedulerlease',
+            name='fencing_token',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='租約序號'),
+        ),
+    ]
@@ -0,0 +1,6 @@
+"""
+離線推薦模型
+
+模型於離線訓練後以版本化目錄保存於 settings.ML_MODELS_ROOT，
+線上僅以 memory-mapped 方式載入，不在請求中重新訓練。
+"""
@@ -0,0 +1,106 @@
+"""
+Item-based 協同過濾離線評估
+
+每位至少購買過兩種商品的用戶隨機保留一個商品作為測試集，其餘互動用於訓練，
+比較協同過濾與「熱門商品」基準的 precision@k / hit rate，
+並記錄訓練時間與記憶體用量。
+"""
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+from apps.intelligence.ml_models.item_cf import (
+    DEFAULT_TOP_K,
+    build_interaction_matrix,
+    train_item_cf,
+)
+
+
+def split_leave_one_out(interactions, seed=42):
+    """
+    依用戶切分訓練與測試資料
+
+    Returns:
+        (train_rows, test_items)：test_items 為 {user_id: held_out_product_id}
+    """
+    by_user = defaultdict(list)
+    for user_id, product_id, quantity in interactions:
+        by_user[user_id].append((product_id, quantity))
+
+    rng = np.random.default_rng(seed)
+    train_rows = []
+    test_items = {}
+    for user_id, items in by_user.items():
+        distinct = sorted({product_id for product_id, _ in items})
+        held_out = distinct[rng.integers(len(distinct))] if len(distinct) >= 2 else None
+        if held_out is not None:
+            test_items[user_id] = held_out
+        train_rows.extend(
+            (user_id, product_id, quantity)
+            for product_id, quantity in items
+            if product_id != held_out
+        )
+    return train_rows, test_items
+
+
+def _top_k(scores, k):
+    return [
+        product_id
+        for product_id, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+    ]
+
+
+def evaluate_item_cf(interactions, k=10, top_k=DEFAULT_TOP_K, min_support=1, seed=42):
+    """
+    執行離線評估
+
+    Returns:
+        dict: 評估指標（precision@k、hit_rate@k、基準值、訓練時間與記憶體）
+    """
+    train_rows, test_items = split_leave_one_out(interactions, seed=seed)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    matrix, user_ids, product_ids = build_interaction_matrix(train_rows)
+    model = train_item_cf(matrix, product_ids, top_k=top_k, min_support=min_support)
+    training_seconds = time.perf_counter() - started
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    history = defaultdict(set)
+    popularity = defaultdict(int)
+    for user_id, product_id, _ in train_rows:
+        history[user_id].add(product_id)
+        popularity[product_id] += 1
+
+    cf_hits = 0
+    popular_hits = 0
+    scoring_started = time.perf_counter()
+    for user_id, held_out in test_items.items():
+        seen = history[user_id]
+        recommended = _top_k(model.score(seen), k)
+        cf_hits += held_out in recommended
+
+        popular = _top_k({pid: count for pid, count in popularity.items() if pid not in seen}, k)
+        popular_hits += held_out in popular
+    scoring_seconds = time.perf_counter() - scoring_started
+
+    evaluated = len(test_items)
+    # leave-one-out 每位用戶只有一個正解，precision@k = hits / (users × k)
+    return {
+        'k': k,
+        'evaluated_users': evaluated,
+        'users_count': int(len(user_ids)),
+        'products_count': int(len(product_ids)),
+        'interactions_count': int(matrix.nnz),
+        'precision_at_k': round(cf_hits / (evaluated * k), 4) if evaluated else 0.0,
+        'hit_rate_at_k': round(cf_hits / evaluated, 4) if evaluated else 0.0,
+        'popular_precision_at_k': round(popular_hits / (evaluated * k), 4) if evaluated else 0.0,
+        'popular_hit_rate_at_k': round(popular_hits / evaluated, 4) if evaluated else 0.0,
+        'training_seconds': round(training_seconds, 3),
+        'scoring_ms_per_user': round(scoring_seconds * 1000 / evaluated, 3) if evaluated else 0.0,
+        'training_peak_memory_mb': round(peak_bytes / 1024 / 1024, 2),
+        'model_size_mb': round(model.nbytes / 1024 / 1024, 2),
+    }
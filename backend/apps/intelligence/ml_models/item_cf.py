@@ -0,0 +1,323 @@
+"""
+Item-based 協同過濾
+
+由訂單明細建立「用戶 × 商品」稀疏共購矩陣，計算商品兩兩之間的
+Cosine 相似度並只保留每個商品的 Top-K 鄰居。
+
+產物以版本化目錄保存：
+    <ML_MODELS_ROOT>/item_cf/<version>/
+        product_ids.npy   商品 ID（列索引 -> 商品 ID）
+        neighbors.npy     (n, K) 鄰居列索引，不足以 -1 補齊
+        scores.npy        (n, K) 相似度
+        meta.json         訓練參數與統計
+    <ML_MODELS_ROOT>/item_cf/LATEST   目前使用中的版本名稱
+
+線上以 np.load(mmap_mode='r') 載入，多個 worker 共用作業系統的頁面快取。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'item_cf'
+LATEST_POINTER = 'LATEST'
+DEFAULT_TOP_K = 50
+# 訂單狀態為已拒絕者不列入互動
+EXCLUDED_ORDER_STATUSES = ('rejected',)
+# 線上檢查 LATEST 是否更新的間隔
+SCORER_RELOAD_INTERVAL_SECONDS = 60
+
+_scorer_lock = threading.Lock()
+_scorer = None
+_scorer_version = None
+_scorer_checked_at = 0.0
+
+
+def get_artifacts_root() -> Path:
+    return Path(settings.ML_MODELS_ROOT) / MODEL_NAME
+
+
+def load_interactions():
+    """
+    讀取外帶與內用訂單明細的 (user_id, product_id, quantity)
+
+    只取必要欄位並以 iterator 串流，避免載入完整 model instance。
+    """
+    from apps.orders.models import DineInOrderItem, TakeoutOrderItem
+
+    for item_model in (TakeoutOrderItem, DineInOrderItem):
+        rows = (
+            item_model.objects.filter(order__user__isnull=False, product__isnull=False)
+            .exclude(order__status__in=EXCLUDED_ORDER_STATUSES)
+            .values_list('order__user_id', 'product_id', 'quantity')
+        )
+        yield from rows.iterator(chunk_size=5000)
+
+
+def build_interaction_matrix(interactions):
+    """
+    建立用戶 × 商品稀疏矩陣
+
+    同一用戶對同一商品的多筆購買會累加數量，再以 log1p 壓縮，
+    避免單一大量訂單主導相似度。
+
+    Returns:
+        (matrix, user_ids, product_ids)
+    """
+    user_index = {}
+    product_index = {}
+    rows, columns, values = [], [], []
+    for user_id, product_id, quantity in interactions:
+        rows.append(user_index.setdefault(user_id, len(user_index)))
+        columns.append(product_index.setdefault(product_id, len(product_index)))
+        values.append(max(quantity or 1, 1))
+
+    matrix = sparse.csr_matrix(
+        (np.asarray(values, dtype=np.float32), (rows, columns)),
+        shape=(len(user_index), len(product_index)),
+        dtype=np.float32,
+    )
+    # csr 建構時會將重複座標相加
+    matrix.data = np.log1p(matrix.data)
+
+    user_ids = np.fromiter(user_index.keys(), dtype=np.int64, count=len(user_index))
+    product_ids = np.fromiter(product_index.keys(), dtype=np.int64, count=len(product_index))
+    return matrix, user_ids, product_ids
+
+
+class ItemCFModel:
+    """訓練結果：商品 ID 與每個商品的 Top-K 鄰居。"""
+
+    def __init__(self, product_ids, neighbors, scores, meta=None):
+        self.product_ids = product_ids
+        self.neighbors = neighbors
+        self.scores = scores
+        self.meta = meta or {}
+        self.row_by_product_id = {
+            int(product_id): row for row, product_id in enumerate(self.product_ids)
+        }
+
+    @property
+    def nbytes(self):
+        return int(self.product_ids.nbytes + self.neighbors.nbytes + self.scores.nbytes)
+
+    def score(self, history_product_ids, exclude_ids=(), candidate_ids=None):
+        """
+        以用戶購買過的商品累加鄰居相似度
+
+        Args:
+            history_product_ids: 用戶購買過的商品 ID
+            exclude_ids: 不列入結果的商品 ID
+            candidate_ids: 只計算這些商品（None 表示不限制）
+
+        Returns:
+            dict: {product_id: score}
+        """
+        rows = [
+            self.row_by_product_id[product_id]
+            for product_id in set(history_product_ids)
+            if product_id in self.row_by_product_id
+        ]
+        if not rows:
+            return {}
+
+        neighbors = np.asarray(self.neighbors[rows]).ravel()
+        scores = np.asarray(self.scores[rows]).ravel()
+        valid = neighbors >= 0
+        neighbors = neighbors[valid]
+        scores = scores[valid]
+        if not len(neighbors):
+            return {}
+
+        totals = np.bincount(neighbors, weights=scores, minlength=len(self.product_ids))
+        touched = np.flatnonzero(totals)
+
+        exclude_ids = set(exclude_ids) | set(history_product_ids)
+        if candidate_ids is not None:
+            candidate_ids = set(candidate_ids)
+
+        results = {}
+        for row in touched:
+            product_id = int(self.product_ids[row])
+            if product_id in exclude_ids:
+                continue
+            if candidate_ids is not None and product_id not in candidate_ids:
+                continue
+            results[product_id] = float(totals[row])
+        return results
+
+
+def train_item_cf(matrix, product_ids, top_k=DEFAULT_TOP_K, min_support=1):
+    """
+    計算 Item-Item Cosine 相似度並保留 Top-K
+
+    Args:
+        matrix: 用戶 × 商品稀疏矩陣
+        product_ids: 欄索引對應的商品 ID
+        top_k: 每個商品保留的鄰居數
+        min_support: 兩商品至少被幾位用戶共同購買才列入
+
+    Returns:
+        ItemCFModel
+    """
+    started = time.perf_counter()
+    item_count = matrix.shape[1]
+    neighbors = np.full((item_count, top_k), -1, dtype=np.int32)
+    scores = np.zeros((item_count, top_k), dtype=np.float32)
+
+    if item_count and matrix.nnz:
+        item_user = matrix.T.tocsr()
+        norms = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1)).ravel())
+        inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        normalized = sparse.diags(inverse_norms.astype(np.float32)) @ item_user
+        similarity = (normalized @ normalized.T).tocsr()
+
+        if min_support > 1:
+            binary = item_user.copy()
+            binary.data[:] = 1
+            support = (binary @ binary.T).tocsr()
+            similarity = similarity.multiply(support >= min_support).tocsr()
+
+        similarity.setdiag(0)
+        similarity.eliminate_zeros()
+
+        indptr, indices, data = similarity.indptr, similarity.indices, similarity.data
+        for row in range(item_count):
+            start, end = indptr[row], indptr[row + 1]
+            if start == end:
+                continue
+            row_scores = data[start:end]
+            row_columns = indices[start:end]
+            k = min(top_k, end - start)
+            if k < end - start:
+                top = np.argpartition(-row_scores, k - 1)[:k]
+            else:
+                top = np.arange(end - start)
+            top = top[np.argsort(-row_scores[top], kind='stable')]
+            neighbors[row, :k] = row_columns[top]
+            scores[row, :k] = row_scores[top]
+
+    meta = {
+        'top_k': top_k,
+        'min_support': min_support,
+        'users_count': int(matrix.shape[0]),
+        'products_count': int(item_count),
+        'interactions_count': int(matrix.nnz),
+        'training_seconds': round(time.perf_counter() - started, 3),
+    }
+    return ItemCFModel(np.asarray(product_ids, dtype=np.int64), neighbors, scores, meta)
+
+
+def save_model(model, root=None):
+    """
+    寫入新版本目錄並切換 LATEST
+
+    LATEST 以暫存檔 + os.replace 原子更新，線上讀取不會看到寫到一半的版本。
+    """
+    root = Path(root) if root else get_artifacts_root()
+    version = timezone.now().strftime('%Y%m%d%H%M%S%f')
+    version_dir = root / version
+    version_dir.mkdir(parents=True, exist_ok=False)
+
+    np.save(version_dir / 'product_ids.npy', model.product_ids)
+    np.save(version_dir / 'neighbors.npy', model.neighbors)
+    np.save(version_dir / 'scores.npy', model.scores)
+    meta = dict(model.meta, version=version, created_at=timezone.now().isoformat())
+    (version_dir / 'meta.json').write_text(json.dumps(meta, ensure_ascii=False, indent=2))
+
+    pointer_tmp = root / f'{LATEST_POINTER}.tmp'
+    pointer_tmp.write_text(version)
+    os.replace(pointer_tmp, root / LATEST_POINTER)
+    return version
+
+
+def prune_versions(keep=3, root=None):
+    """只保留最新的幾個版本，回傳刪除的版本名稱。"""
+    import shutil
+
+    root = Path(root) if root else get_artifacts_root()
+    if not root.exists():
+        return []
+    current = read_latest_version(root)
+    versions = sorted((path for path in root.iterdir() if path.is_dir()), key=lambda path: path.name)
+    removed = []
+    for path in versions[:-keep] if keep else versions:
+        if path.name == current:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path.name)
+    return removed
+
+
+def read_latest_version(root=None):
+    root = Path(root) if root else get_artifacts_root()
+    try:
+        return (root / LATEST_POINTER).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_model(version=None, root=None):
+    """以 memory-mapped 方式載入指定版本（預設 LATEST）。"""
+    root = Path(root) if root else get_artifacts_root()
+    version = version or read_latest_version(root)
+    if not version:
+        return None
+
+    version_dir = root / version
+    meta_path = version_dir / 'meta.json'
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else {'version': version}
+    return ItemCFModel(
+        np.load(version_dir / 'product_ids.npy', mmap_mode='r'),
+        np.load(version_dir / 'neighbors.npy', mmap_mode='r'),
+        np.load(version_dir / 'scores.npy', mmap_mode='r'),
+        meta,
+    )
+
+
+def get_scorer():
+    """
+    取得行程內的模型（沒有訓練產物時返回 None）
+
+    每隔 SCORER_RELOAD_INTERVAL_SECONDS 檢查一次 LATEST，版本改變才重新載入。
+    """
+    global _scorer, _scorer_version, _scorer_checked_at
+
+    now = time.monotonic()
+    if now - _scorer_checked_at < SCORER_RELOAD_INTERVAL_SECONDS:
+        return _scorer
+
+    with _scorer_lock:
+        if now - _scorer_checked_at < SCORER_RELOAD_INTERVAL_SECONDS:
+            return _scorer
+        _scorer_checked_at = now
+
+        version = read_latest_version()
+        if version == _scorer_version:
+            return _scorer
+        try:
+            _scorer = load_model(version) if version else None
+            _scorer_version = version
+        except (OSError, ValueError) as exc:
+            logger.warning('[ItemCF] failed to load version %s: %s', version, exc)
+        return _scorer
+
+
+def reset_scorer():
+    """清除行程內模型（測試或重新訓練後立即生效用）。"""
+    global _scorer, _scorer_version, _scorer_checked_at
+
+    with _scorer_lock:
+        _scorer = None
+        _scorer_version = None
+        _scorer_checked_at = 0.0
@@ -1,5 +1,45 @@
+import threading
+import time
+import uuid
+
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction
+
+PLATFORM_SETTINGS_VERSION_CACHE_KEY = 'platform_settings_version'
+
+# 行程內的設定副本：(版本號, 載入時間, 欄位名稱, 欄位值)
+_settings_snapshot = None
+_settings_lock = threading.Lock()
+# 目前執行緒在尚未提交的交易中修改過設定，交易結束前一律讀資料庫
+_settings_local = threading.local()
+
+
+def _current_settings_version():
+    version = cache.get(PLATFORM_SETTINGS_VERSION_CACHE_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(PLATFORM_SETTINGS_VERSION_CACHE_KEY, version, None):
+            version = cache.get(PLATFORM_SETTINGS_VERSION_CACHE_KEY, version)
+    return version
+
+
+def _snapshot_is_fresh(snapshot, version, now):
+    return (
+        snapshot is not None
+        and snapshot[0] == version
+        and now - snapshot[1] < settings.PLATFORM_SETTINGS_CACHE_SECONDS
+    )
+
+
+def invalidate_platform_settings():
+    """通知所有行程在下次讀取時重新載入平台設定。"""
+    cache.set(PLATFORM_SETTINGS_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def _settings_committed():
+    _settings_local.dirty = False
+    invalidate_platform_settings()
 
 
 class PlatformSettings(models.Model):
@@ -132,9 +172,42 @@ class PlatformSettings(models.Model):
     def get_settings(cls):
         """
         取得或建立唯一的設定實例（單例模式）
+
+        設定快取在行程記憶體，以共用快取中的版本號判斷是否過期，一般讀取不查詢資料庫；
+        副本超過 PLATFORM_SETTINGS_CACHE_SECONDS 也會重新載入，版本號通知未送達
+        （例如未設定共用快取）時仍有過期上限。
+        每次回傳新的 instance，呼叫端可以修改後 save()。
         """
-        obj, created = cls.objects.get_or_create(pk=1)
-        return obj
+        global _settings_snapshot
+
+        if getattr(_settings_local, 'dirty', False):
+            if connection.in_atomic_block:
+                return cls.objects.get_or_create(pk=1)[0]
+            # 交易已結束（提交或回滾），重新載入
+            _settings_committed()
+
+        version = _current_settings_version()
+        now = time.monotonic()
+        snapshot = _settings_snapshot
+        if not _snapshot_is_fresh(snapshot, version, now):
+            with _settings_lock:
+                snapshot = _settings_snapshot
+                if not _snapshot_is_fresh(snapshot, version, now):
+                    obj = cls.objects.get_or_create(pk=1)[0]
+                    field_names = [field.attname for field in cls._meta.concrete_fields]
+                    snapshot = (version, now, field_names, [getattr(obj, name) for name in field_names])
+                    _settings_snapshot = snapshot
+        return cls.from_db(connection.alias, snapshot[2], list(snapshot[3]))
+
+    @classmethod
+    def clear_cache(cls):
+        """捨棄行程內的設定副本並通知其他行程重新載入。"""
+        global _settings_snapshot
+
+        with _settings_lock:
+            _settings_snapshot = None
+        _settings_local.dirty = False
+        invalidate_platform_settings()
     
     def has_ai_config(self):
         """檢查是否已設定 AI"""
@@ -152,6 +225,20 @@ class PlatformSettings(models.Model):
         # 強制使用 pk=1 確保單例
         self.pk = 1
         super().save(*args, **kwargs)
+        self._invalidate_cached_settings()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self._invalidate_cached_settings()
+        return result
+
+    @staticmethod
+    def _invalidate_cached_settings():
+        invalidate_platform_settings()
+        if connection.in_atomic_block:
+            # 提交前其他連線讀到的仍是舊值，提交後再更新一次版本號
+            _settings_local.dirty = True
+            transaction.on_commit(_settings_committed)
 
 
 class PersonalizedRecommendationPushLog(models.Model):
@@ -223,3 +310,233 @@ class PersonalizedRecommendationPushLog(models.Model):
         user_display = self.user.username if self.user_id else self.line_user_id
         return f"{user_display} - {self.push_type} - {self.status}"
 
+
+
+class ProductSimilarity(models.Model):
+    """同店家商品相似度（離線批次計算的 Top-K 鄰居）。"""
+
+    store = models.ForeignKey(
+        'stores.Store',
+        on_delete=models.CASCADE,
+        related_name='product_similarities',
+        verbose_name='店家'
+    )
+    product = models.ForeignKey(
+        'products.Product',
+        on_delete=models.CASCADE,
+        related_name='similarities',
+        verbose_name='商品'
+    )
+    similar_product = models.ForeignKey(
+        'products.Product',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='相似商品'
+    )
+    rank = models.PositiveSmallIntegerField(verbose_name='排名')
+    score = models.FloatField(verbose_name='相似度')
+    common_tags = models.JSONField(
+        default=list,
+        blank=True,
+        verbose_name='共同標籤'
+    )
+    computed_at = models.DateTimeField(verbose_name='計算時間')
+
+    class Meta:
+        db_table = 'product_similarities'
+        verbose_name = '商品相似度'
+        verbose_name_plural = '商品相似度'
+        ordering = ['product', 'rank']
+        unique_together = ['product', 'similar_product']
+        indexes = [
+            models.Index(fields=['product', 'rank']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.similar_product_id} ({self.score:.2f})"
+
+
+class UserRecommendation(models.Model):
+    """離線批次預先計算的用戶推薦結果，過期後改為即時計算。"""
+
+    KIND_CHOICES = [
+        ('stores', '推薦店家'),
+        ('products', '推薦商品'),
+        ('line_stores', 'LINE 個人化推薦店家'),
+        ('store_profile', '店家內偏好輪廓'),
+    ]
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='precomputed_recommendations',
+        verbose_name='系統用戶'
+    )
+    kind = models.CharField(
+        max_length=20,
+        choices=KIND_CHOICES,
+        verbose_name='推薦類型'
+    )
+    store = models.ForeignKey(
+        'stores.Store',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='店家',
+        help_text='僅店家內偏好輪廓使用'
+    )
+    items = models.JSONField(
+        default=list,
+        blank=True,
+        verbose_name='推薦項目'
+    )
+    context = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name='附加資訊'
+    )
+    computed_at = models.DateTimeField(verbose_name='計算時間')
+    expires_at = models.DateTimeField(db_index=True, verbose_name='過期時間')
+
+    class Meta:
+        db_table = 'user_recommendations'
+        verbose_name = '用戶預先計算推薦'
+        verbose_name_plural = '用戶預先計算推薦'
+        ordering = ['user', 'kind']
+        indexes = [
+            models.Index(fields=['user', 'kind', 'store']),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind} ({len(self.items)})"
+
+
+class DemandForecast(models.Model):
+    """店家各通路的逐小時訂單需求預測。"""
+
+    CHANNEL_CHOICES = [
+        ('takeout', '外帶'),
+        ('dine_in', '內用'),
+        ('surplus', '惜福食品'),
+    ]
+
+    store = models.ForeignKey(
+        'stores.Store',
+        on_delete=models.CASCADE,
+        related_name='demand_forecasts',
+        verbose_name='店家'
+    )
+    channel = models.CharField(
+        max_length=20,
+        choices=CHANNEL_CHOICES,
+        verbose_name='通路'
+    )
+    forecast_for = models.DateTimeField(verbose_name='預測時段（整點開始）')
+    expected_orders = models.FloatField(verbose_name='預測訂單數')
+    smoothing_alpha = models.FloatField(verbose_name='平滑係數')
+    generated_at = models.DateTimeField(verbose_name='產生時間')
+
+    class Meta:
+        db_table = 'demand_forecasts'
+        verbose_name = '需求預測'
+        verbose_name_plural = '需求預測'
+        ordering = ['store', 'forecast_for', 'channel']
+        unique_together = ['store', 'channel', 'forecast_for']
+        indexes = [
+            models.Index(fields=['store', 'forecast_for']),
+        ]
+
+    def __str__(self):
+        return f"{self.store_id} {self.channel} {self.forecast_for:%Y-%m-%d %H}:00 -> {self.expected_orders:.1f}"
+
+
+class StaffingForecast(models.Model):
+    """由需求預測換算的各職務逐小時建議人數。"""
+
+    store = models.ForeignKey(
+        'stores.Store',
+        on_delete=models.CASCADE,
+        related_name='staffing_forecasts',
+        verbose_name='店家'
+    )
+    job_role = models.ForeignKey(
+        'schedules.JobRole',
+        on_delete=models.CASCADE,
+        related_name='staffing_forecasts',
+        verbose_name='職務'
+    )
+    forecast_for = models.DateTimeField(verbose_name='預測時段（整點開始）')
+    expected_orders = models.FloatField(verbose_name='預測訂單數')
+    required_staff = models.PositiveIntegerField(verbose_name='建議人數')
+    generated_at = models.DateTimeField(verbose_name='產生時間')
+
+    class Meta:
+        db_table = 'staffing_forecasts'
+        verbose_name = '排班人力預測'
+        verbose_name_plural = '排班人力預測'
+        ordering = ['store', 'forecast_for', 'job_role']
+        unique_together = ['job_role', 'forecast_for']
+        indexes = [
+            models.Index(fields=['store', 'forecast_for']),
+        ]
+
+    def __str__(self):
+        return f"{self.job_role_id} {self.forecast_for:%Y-%m-%d %H}:00 -> {self.required_staff}"
+
+
+class SchedulerLease(models.Model):
+    """排程工作的資料庫租約，確保多個行程中同一時間只有一個執行該工作。"""
+
+    name = models.CharField(max_length=100, unique=True, verbose_name='工作名稱')
+    owner = models.CharField(max_length=200, blank=True, verbose_name='持有者')
+    expires_at = models.DateTimeField(null=True, blank=True, verbose_name='租約到期時間')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='最後心跳時間')
+    next_run_at = models.DateTimeField(db_index=True, verbose_name='下次執行時間')
+    fencing_token = models.PositiveBigIntegerField(default=0, verbose_name='租約序號')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新時間')
+
+    class Meta:
+        db_table = 'scheduler_leases'
+        verbose_name = '排程租約'
+        verbose_name_plural = '排程租約'
+        ordering = ['name']
+
+    def __str__(self):
+        return f"{self.name} ({self.owner or '未持有'})"
+
+
+class SchedulerRun(models.Model):
+    """排程工作執行記錄。"""
+
+    STATUS_CHOICES = [
+        ('running', '執行中'),
+        ('success', '成功'),
+        ('failed', '失敗'),
+    ]
+
+    job_name = models.CharField(max_length=100, verbose_name='工作名稱')
+    owner = models.CharField(max_length=200, verbose_name='執行者')
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='running',
+        verbose_name='狀態'
+    )
+    started_at = models.DateTimeField(verbose_name='開始時間')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='結束時間')
+    duration_seconds = models.FloatField(null=True, blank=True, verbose_name='執行秒數')
+    summary = models.JSONField(default=dict, blank=True, verbose_name='執行摘要')
+    error_message = models.TextField(blank=True, verbose_name='錯誤訊息')
+
+    class Meta:
+        db_table = 'scheduler_runs'
+        verbose_name = '排程執行記錄'
+        verbose_name_plural = '排程執行記錄'
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['job_name', 'started_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.job_name} - {self.status} ({self.started_at:%Y-%m-%d %H:%M:%S})"
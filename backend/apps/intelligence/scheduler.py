@@ -1,11 +1,43 @@
+"""
+推薦推播排程
+
+每個排程工作在 SchedulerLease 有一筆租約資料列，取得租約以條件式 UPDATE
+（到期或自己持有，且已到下次執行時間）完成，多個 gunicorn worker 或
+run_scheduler 行程同時執行時，每個工作在同一時間只會由一個行程執行。
+執行期間以心跳延長租約；行程中斷時租約到期後由其他行程接手。
+每次取得租約時 fencing_token 加一：工作分批寫入結果前以 ensure_lease_held()
+確認租約仍屬於自己（見 apps.intelligence.leases），結束時也再確認一次，
+失去租約的行程不會寫入結果或改動接手者的租約。
+每次執行都寫入 SchedulerRun（狀態、耗時、摘要）。
+"""
 import logging
 import os
+import random
+import socket
 import threading
+import time
+import uuid
+from datetime import timedelta
 
-from django.db import close_old_connections
+from django.conf import settings as django_settings
+from django.db import IntegrityError, close_old_connections, connection
+from django.db.models import F, Q
+from django.utils import timezone
 
-from apps.intelligence.models import PlatformSettings
+from apps.intelligence.leases import LeaseLost, bind_lease, lease_is_held
+from apps.intelligence.models import (
+    PersonalizedRecommendationPushLog,
+    PlatformSettings,
+    SchedulerLease,
+    SchedulerRun,
+)
 from apps.intelligence.services.line_recommendation_push_service import LineRecommendationPushService
+from apps.intelligence.services.product_similarity_service import rebuild_all_similarities
+from apps.line_bot.models import StoreUserPushLog
+from apps.line_bot.services.audience_segments import refresh_all_customer_features, refresh_stale_customer_features
+from apps.line_bot.services.broadcast_jobs import run_pending_broadcast_jobs
+from apps.line_bot.services.conversation_log import prune_conversation_logs
+from apps.line_bot.services.log_writer import prune_push_logs
 from apps.line_bot.services.store_recommendation_push_service import StoreRecommendationPushService
 
 logger = logging.getLogger(__name__)
@@ -16,58 +48,219 @@ _stop_event = threading.Event()
 
 
 def _get_interval_seconds():
-    raw = os.getenv('RECOMMENDATION_SCHEDULER_INTERVAL_SECONDS', '60')
-    try:
-        value = int(raw)
-    except ValueError:
-        value = 60
-    return max(10, value)
+    return max(10, django_settings.RECOMMENDATION_SCHEDULER_INTERVAL_SECONDS)
+
+
+def build_owner_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class ScheduledJob:
+    """
+    排程工作定義
+
+    Args:
+        name: 工作名稱（租約鍵）
+        func: 執行函式，回傳 dict 摘要
+        interval_seconds: 兩次執行的間隔
+        jitter_seconds: 每次排定下次執行時加上的隨機延遲上限，避免多個工作同時觸發
+    """
+
+    def __init__(self, name, func, interval_seconds, jitter_seconds=0):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+
+    def next_run_at(self, now):
+        jitter = random.uniform(0, self.jitter_seconds) if self.jitter_seconds else 0
+        return now + timedelta(seconds=self.interval_seconds + jitter)
+
 
+def run_personalized_recommendation_job():
+    settings = PlatformSettings.get_settings()
+    if not (
+        settings.is_line_bot_enabled
+        and settings.is_personalized_recommendation_enabled
+        and settings.has_line_bot_config()
+    ):
+        return {'detail': 'disabled'}
+    return LineRecommendationPushService().run_automated_personalized_recommendation(force=False)
 
-def _run_scheduler_loop():
+
+def run_store_recommendation_job():
+    settings = PlatformSettings.get_settings()
+    if not settings.is_line_bot_enabled:
+        return {'detail': 'disabled'}
+    return StoreRecommendationPushService().run_auto_cycle(force=False)
+
+
+def run_prune_history_job():
+    summary = {
+        model._meta.db_table: prune_push_logs(model)
+        for model in (PersonalizedRecommendationPushLog, StoreUserPushLog)
+    }
+    cutoff = timezone.now() - timedelta(days=django_settings.SCHEDULER_RUN_RETENTION_DAYS)
+    summary['conversation_logs'] = prune_conversation_logs()['total']
+    summary['scheduler_runs'], _ = SchedulerRun.objects.filter(started_at__lt=cutoff).delete()
+    return summary
+
+
+def get_default_jobs():
     interval_seconds = _get_interval_seconds()
-    logger.info('[RecommendationScheduler] started, interval=%ss', interval_seconds)
+    jitter_seconds = interval_seconds * django_settings.SCHEDULER_JITTER_RATIO
+    return [
+        ScheduledJob('personalized_recommendation_push', run_personalized_recommendation_job, interval_seconds, jitter_seconds),
+        ScheduledJob('store_recommendation_push', run_store_recommendation_job, interval_seconds, jitter_seconds),
+        ScheduledJob('broadcast_jobs', run_pending_broadcast_jobs, 30, 5),
+        ScheduledJob('refresh_customer_features', refresh_all_customer_features, 60 * 60, 5 * 60),
+        ScheduledJob('refresh_stale_customer_features', refresh_stale_customer_features, 60, 10),
+        # 新上架商品在重建前沒有離線結果，相似商品 API 會改用即時計算
+        ScheduledJob('build_product_similarity', rebuild_all_similarities, 6 * 60 * 60, 30 * 60),
+        ScheduledJob('prune_history', run_prune_history_job, 24 * 60 * 60, 60 * 60),
+    ]
+
+
+def try_acquire_lease(job_name, owner, lease_seconds, now=None):
+    """到期或由自己持有、且已到下次執行時間時取得租約；回傳 fencing token，未取得時回傳 None。"""
+    now = now or timezone.now()
+    try:
+        SchedulerLease.objects.get_or_create(name=job_name, defaults={'next_run_at': now})
+    except IntegrityError:
+        # 其他行程同時建立了同名租約
+        pass
+
+    acquired = SchedulerLease.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__lte=now) | Q(owner=owner),
+        name=job_name,
+        next_run_at__lte=now,
+    ).update(
+        owner=owner,
+        expires_at=now + timedelta(seconds=lease_seconds),
+        heartbeat_at=now,
+        fencing_token=F('fencing_token') + 1,
+        updated_at=now,
+    )
+    if acquired != 1:
+        return None
+    return SchedulerLease.objects.filter(name=job_name, owner=owner).values_list('fencing_token', flat=True).first()
 
-    while not _stop_event.is_set():
+
+def renew_lease(job_name, owner, lease_seconds, token):
+    """租約仍由自己（同一個 token）持有且尚未到期時延長；回傳是否成功。"""
+    now = timezone.now()
+    return SchedulerLease.objects.filter(
+        name=job_name,
+        owner=owner,
+        fencing_token=token,
+        expires_at__gt=now,
+    ).update(
+        expires_at=now + timedelta(seconds=lease_seconds),
+        heartbeat_at=now,
+        updated_at=now,
+    ) == 1
+
+
+def release_lease(job_name, owner, next_run_at, token):
+    now = timezone.now()
+    SchedulerLease.objects.filter(name=job_name, owner=owner, fencing_token=token).update(
+        owner='',
+        expires_at=None,
+        next_run_at=next_run_at,
+        updated_at=now,
+    )
+
+
+def _heartbeat_loop(job_name, owner, lease_seconds, token, done):
+    try:
+        while not done.wait(max(1, lease_seconds / 3)):
+            if not renew_lease(job_name, owner, lease_seconds, token):
+                logger.warning('[Scheduler] lost lease for %s (owner=%s)', job_name, owner)
+                return
+    finally:
+        connection.close()
+
+
+def run_job(job, owner, token, lease_seconds=None):
+    """
+    已取得租約（token 為 try_acquire_lease 的回傳值）後執行工作：心跳延長租約、
+    記錄執行結果，完成後釋放租約並排定下次執行。
+
+    工作期間租約被其他行程取得時（ensure_lease_held 拋出 LeaseLost，或結束時
+    確認已不再持有），記錄為失敗且不釋放、不改動租約。
+
+    Returns:
+        SchedulerRun
+    """
+    lease_seconds = lease_seconds or django_settings.SCHEDULER_LEASE_SECONDS
+    started = time.monotonic()
+    run = SchedulerRun.objects.create(job_name=job.name, owner=owner, started_at=timezone.now())
+
+    done = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat_loop,
+        args=(job.name, owner, lease_seconds, token, done),
+        name=f'scheduler-heartbeat-{job.name}',
+        daemon=True,
+    )
+    heartbeat.start()
+    try:
+        with bind_lease(job.name, owner, token):
+            summary = job.func() or {}
+        if not lease_is_held(job.name, owner, token):
+            raise LeaseLost(f'{job.name} 的租約已由其他行程取得（owner={owner}）')
+        run.status = 'success'
+        run.summary = summary
+    except LeaseLost as exc:
+        logger.warning('[Scheduler] job %s aborted: %s', job.name, exc)
+        run.status = 'failed'
+        run.error_message = str(exc)
+    except Exception as exc:
+        logger.exception('[Scheduler] job %s failed', job.name)
+        run.status = 'failed'
+        run.error_message = str(exc)
+    finally:
+        done.set()
+        heartbeat.join()
+
+    run.finished_at = timezone.now()
+    run.duration_seconds = round(time.monotonic() - started, 3)
+    run.save(update_fields=['status', 'summary', 'error_message', 'finished_at', 'duration_seconds'])
+    release_lease(job.name, owner, job.next_run_at(run.finished_at), token)
+    logger.info('[Scheduler] job %s %s in %ss', job.name, run.status, run.duration_seconds)
+    return run
+
+
+def run_due_jobs(jobs, owner, lease_seconds=None):
+    """執行所有到期且成功取得租約的工作，回傳本輪的 SchedulerRun 清單。"""
+    lease_seconds = lease_seconds or django_settings.SCHEDULER_LEASE_SECONDS
+    runs = []
+    for job in jobs:
         try:
             close_old_connections()
-
-            settings = PlatformSettings.get_settings()
-            if (
-                settings.is_line_bot_enabled
-                and settings.is_personalized_recommendation_enabled
-                and settings.has_line_bot_config()
-            ):
-                service = LineRecommendationPushService()
-                summary = service.run_automated_personalized_recommendation(force=False)
-                logger.info(
-                    '[RecommendationScheduler] cycle done: recipient=%s success=%s failure=%s skipped=%s',
-                    summary.get('recipient_count', 0),
-                    summary.get('success_count', 0),
-                    summary.get('failure_count', 0),
-                    summary.get('skipped_count', 0),
-                )
-
-            if settings.is_line_bot_enabled:
-                store_service = StoreRecommendationPushService()
-                store_summary = store_service.run_auto_cycle(force=False)
-                logger.info(
-                    '[StoreRecommendationScheduler] cycle done: stores=%s recipient=%s success=%s failure=%s skipped=%s',
-                    store_summary.get('stores_count', 0),
-                    store_summary.get('recipient_count', 0),
-                    store_summary.get('success_count', 0),
-                    store_summary.get('failure_count', 0),
-                    store_summary.get('skipped_count', 0),
-                )
+            token = try_acquire_lease(job.name, owner, lease_seconds)
+            if token is not None:
+                runs.append(run_job(job, owner, token, lease_seconds))
         except Exception as exc:
-            logger.warning('[RecommendationScheduler] cycle failed: %s', exc)
+            logger.warning('[Scheduler] failed to run %s: %s', job.name, exc)
         finally:
             close_old_connections()
+    return runs
+
+
+def run_scheduler_loop(jobs=None, owner=None, stop_event=None, poll_seconds=None):
+    jobs = jobs if jobs is not None else get_default_jobs()
+    owner = owner or build_owner_id()
+    stop_event = stop_event or _stop_event
+    poll_seconds = poll_seconds or django_settings.SCHEDULER_POLL_SECONDS
+    logger.info('[Scheduler] started owner=%s jobs=%s', owner, [job.name for job in jobs])
 
-        if _stop_event.wait(interval_seconds):
+    while not stop_event.is_set():
+        run_due_jobs(jobs, owner)
+        if stop_event.wait(poll_seconds):
             break
 
-    logger.info('[RecommendationScheduler] stopped')
+    logger.info('[Scheduler] stopped owner=%s', owner)
 
 
 def start_recommendation_scheduler():
@@ -79,7 +272,7 @@ def start_recommendation_scheduler():
 
         _stop_event.clear()
         _scheduler_thread = threading.Thread(
-            target=_run_scheduler_loop,
+            target=run_scheduler_loop,
             name='recommendation-scheduler',
             daemon=True,
         )
@@ -8,6 +8,7 @@ class RecommendedProductSerializer(serializers.Serializer):
     """推薦商品序列化器"""
     product = PublicProductSerializer(read_only=True)
     score = serializers.IntegerField(read_only=True)
+    cf_score = serializers.FloatField(read_only=True)
     matching_tags = serializers.ListField(
         child=serializers.CharField(),
         read_only=True
@@ -19,6 +20,8 @@ class RecommendedProductSerializer(serializers.Serializer):
         if obj.get('matching_tags'):
             tags_str = '、'.join(obj['matching_tags'][:3])
             return f"因為您喜歡「{tags_str}」"
+        if obj.get('cf_score'):
+            return "購買相同商品的顧客也喜歡"
         return "熱門推薦"
 
 
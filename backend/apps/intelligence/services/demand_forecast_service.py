@@ -0,0 +1,360 @@
+"""
+店家需求預測與排班人力換算
+
+1. 以單次彙總查詢讀取各店家、各通路的逐小時訂單數，組成 (序列數, 小時數) 矩陣。
+2. 每條序列切成 (週, 168 小時) 的星期 × 小時剖面，跨週做指數平滑；
+   平滑係數以一步預測誤差在候選值中逐序列挑選，全部以 NumPy 批次運算。
+3. 平滑後的剖面即為未來 7 天的逐小時預測，寫入 DemandForecast。
+4. 各店家通路加總後依 JobRole 的產能換算建議人數，寫入 StaffingForecast。
+"""
+import logging
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from apps.intelligence.models import DemandForecast, StaffingForecast
+from apps.orders.models import DineInOrder, TakeoutOrder
+from apps.schedules.models import JobRole
+from apps.surplus_food.models import SurplusFoodOrder
+
+logger = logging.getLogger(__name__)
+
+HOURS_PER_WEEK = 168
+DEFAULT_HISTORY_WEEKS = 8
+DEFAULT_HORIZON_HOURS = HOURS_PER_WEEK
+ALPHA_GRID = (0.1, 0.2, 0.3, 0.5, 0.7)
+# 預測值低於此門檻視為無需求（不寫入、不排班）
+DEMAND_EPSILON = 0.05
+FORECAST_RETENTION_DAYS = 30
+
+# 通路 -> (訂單模型, 不列入需求的訂單狀態)
+CHANNEL_SOURCES = {
+    'takeout': (TakeoutOrder, ('rejected',)),
+    'dine_in': (DineInOrder, ('rejected',)),
+    'surplus': (SurplusFoodOrder, ('rejected', 'cancelled', 'expired')),
+}
+
+
+def load_hourly_history(history_start, history_end, store_ids=None):
+    """
+    讀取逐小時訂單數
+
+    Returns:
+        (series_keys, history)：series_keys 為 [(store_id, channel), ...]，
+        history 為 (len(series_keys), 小時數) 的 float32 矩陣
+    """
+    hours = int((history_end - history_start).total_seconds() // 3600)
+    series_index = {}
+    rows, columns, counts = [], [], []
+
+    for channel, (order_model, excluded_statuses) in CHANNEL_SOURCES.items():
+        queryset = order_model.objects.filter(
+            created_at__gte=history_start,
+            created_at__lt=history_end,
+        ).exclude(status__in=excluded_statuses)
+        if store_ids:
+            queryset = queryset.filter(store_id__in=store_ids)
+
+        hourly = (
+            queryset.annotate(hour=TruncHour('created_at'))
+            .order_by()
+            .values('store_id', 'hour')
+            .annotate(order_count=Count('id'))
+            .values_list('store_id', 'hour', 'order_count')
+        )
+        for store_id, hour, order_count in hourly.iterator(chunk_size=5000):
+            column = int((hour - history_start).total_seconds() // 3600)
+            if not 0 <= column < hours:
+                continue
+            rows.append(series_index.setdefault((store_id, channel), len(series_index)))
+            columns.append(column)
+            counts.append(order_count)
+
+    history = np.zeros((len(series_index), hours), dtype=np.float32)
+    if counts:
+        np.add.at(history, (np.asarray(rows), np.asarray(columns)), np.asarray(counts, dtype=np.float32))
+    return list(series_index), history
+
+
+def fit_seasonal_profiles(history, alpha_grid=ALPHA_GRID):
+    """
+    以跨週指數平滑擬合星期 × 小時剖面
+
+    Args:
+        history: (S, W * 168) 矩陣，每列從同一個星期時刻開始
+        alpha_grid: 候選平滑係數
+
+    Returns:
+        (profiles, alphas)：(S, 168) 剖面與每條序列選用的平滑係數
+    """
+    series_count, hours = history.shape
+    weeks_count = hours // HOURS_PER_WEEK
+    if weeks_count < 1:
+        raise ValueError('歷史資料至少需要一週')
+
+    weeks = history[:, -weeks_count * HOURS_PER_WEEK:].reshape(series_count, weeks_count, HOURS_PER_WEEK)
+    if weeks_count == 1:
+        return weeks[:, 0].copy(), np.full(series_count, np.nan, dtype=np.float32)
+
+    best_error = np.full(series_count, np.inf)
+    best_profiles = np.zeros((series_count, HOURS_PER_WEEK), dtype=np.float32)
+    best_alphas = np.zeros(series_count, dtype=np.float32)
+
+    for alpha in alpha_grid:
+        profile = weeks[:, 0].copy()
+        error = np.zeros(series_count)
+        for week in range(1, weeks_count):
+            # 一步預測誤差：用前幾週的剖面預測本週
+            error += np.abs(weeks[:, week] - profile).sum(axis=1)
+            profile = alpha * weeks[:, week] + (1 - alpha) * profile
+
+        better = error < best_error
+        best_error[better] = error[better]
+        best_profiles[better] = profile[better]
+        best_alphas[better] = alpha
+
+    return best_profiles, best_alphas
+
+
+def forecast_from_profiles(profiles, horizon_hours=DEFAULT_HORIZON_HOURS):
+    """剖面從歷史起點的星期時刻開始，歷史長度為整週，因此預測直接從第 0 格延續。"""
+    slots = np.arange(horizon_hours) % HOURS_PER_WEEK
+    return profiles[:, slots]
+
+
+def _error_metrics(actual, predicted):
+    total = float(actual.sum())
+    absolute_error = np.abs(actual - predicted)
+    return {
+        'wape': round(float(absolute_error.sum()) / total, 4) if total else None,
+        'mae': round(float(absolute_error.mean()), 4),
+        'bias': round(float((predicted - actual).sum()) / total, 4) if total else None,
+    }
+
+
+def backtest(history, holdout_weeks=1, alpha_grid=ALPHA_GRID):
+    """
+    保留最後幾週作為測試集，比較平滑剖面與「上週同時段」基準
+
+    Returns:
+        dict: 模型與基準的 WAPE / MAE / Bias
+    """
+    holdout_hours = holdout_weeks * HOURS_PER_WEEK
+    if history.shape[1] < holdout_hours + HOURS_PER_WEEK:
+        raise ValueError('歷史資料不足以進行回測')
+
+    train = history[:, :-holdout_hours]
+    actual = history[:, -holdout_hours:]
+    train = train[:, train.shape[1] % HOURS_PER_WEEK:]
+
+    profiles, _ = fit_seasonal_profiles(train, alpha_grid=alpha_grid)
+    predicted = forecast_from_profiles(profiles, holdout_hours)
+    naive = np.tile(train[:, -HOURS_PER_WEEK:], (1, holdout_weeks))
+
+    return {
+        'series_count': int(history.shape[0]),
+        'holdout_weeks': holdout_weeks,
+        'model': _error_metrics(actual, predicted),
+        'seasonal_naive': _error_metrics(actual, naive),
+    }
+
+
+def compute_required_staff(expected_orders, capacities, min_staff):
+    """
+    將逐小時需求換算為各職務建議人數
+
+    Args:
+        expected_orders: (R, H) 每個職務所屬店家的預測訂單數
+        capacities: (R,) 每人每小時可處理訂單數
+        min_staff: (R,) 有需求時段的最少人數
+
+    Returns:
+        (R, H) int 矩陣
+    """
+    capacities = np.maximum(np.asarray(capacities, dtype=np.float32), 1.0)
+    required = np.ceil(expected_orders / capacities[:, None])
+    required = np.maximum(required, np.asarray(min_staff, dtype=np.float32)[:, None])
+    required[expected_orders < DEMAND_EPSILON] = 0
+    return required.astype(np.int32)
+
+
+def _save_demand_forecasts(series_keys, forecasts, alphas, forecast_start, generated_at):
+    store_ids = {store_id for store_id, _ in series_keys}
+    series_rows, hour_offsets = np.nonzero(forecasts >= DEMAND_EPSILON)
+    records = [
+        DemandForecast(
+            store_id=series_keys[row][0],
+            channel=series_keys[row][1],
+            forecast_for=forecast_start + timedelta(hours=int(offset)),
+            expected_orders=round(float(forecasts[row, offset]), 3),
+            smoothing_alpha=0.0 if np.isnan(alphas[row]) else float(alphas[row]),
+            generated_at=generated_at,
+        )
+        for row, offset in zip(series_rows, hour_offsets)
+    ]
+    with transaction.atomic():
+        DemandForecast.objects.filter(store_id__in=store_ids, forecast_for__gte=forecast_start).delete()
+        DemandForecast.objects.bulk_create(records, batch_size=2000)
+    return len(records)
+
+
+def _save_staffing_forecasts(series_keys, forecasts, forecast_start, generated_at):
+    store_rows = {}
+    for store_id, _ in series_keys:
+        store_rows.setdefault(store_id, len(store_rows))
+    store_totals = np.zeros((len(store_rows), forecasts.shape[1]), dtype=np.float32)
+    np.add.at(store_totals, [store_rows[store_id] for store_id, _ in series_keys], forecasts)
+
+    roles = list(
+        JobRole.objects.filter(store_id__in=store_rows)
+        .values_list('id', 'store_id', 'orders_per_staff_hour', 'min_staff')
+    )
+    if not roles:
+        return 0
+
+    role_ids, role_store_ids, capacities, min_staff = zip(*roles)
+    role_demand = store_totals[[store_rows[store_id] for store_id in role_store_ids]]
+    required = compute_required_staff(role_demand, capacities, min_staff)
+
+    role_rows, hour_offsets = np.nonzero(required)
+    records = [
+        StaffingForecast(
+            store_id=role_store_ids[row],
+            job_role_id=role_ids[row],
+            forecast_for=forecast_start + timedelta(hours=int(offset)),
+            expected_orders=round(float(role_demand[row, offset]), 3),
+            required_staff=int(required[row, offset]),
+            generated_at=generated_at,
+        )
+        for row, offset in zip(role_rows, hour_offsets)
+    ]
+    with transaction.atomic():
+        StaffingForecast.objects.filter(store_id__in=store_rows, forecast_for__gte=forecast_start).delete()
+        StaffingForecast.objects.bulk_create(records, batch_size=2000)
+    return len(records)
+
+
+def run_demand_forecast(
+    *,
+    store_ids=None,
+    history_weeks=DEFAULT_HISTORY_WEEKS,
+    horizon_hours=DEFAULT_HORIZON_HOURS,
+    dry_run=False,
+    with_backtest=False,
+):
+    """
+    產生未來逐小時需求與排班人力預測
+
+    Returns:
+        dict: 執行摘要（含各階段耗時，可選回測結果）
+    """
+    if history_weeks < 1:
+        raise ValueError('history_weeks 必須至少為 1')
+    if horizon_hours < 1:
+        raise ValueError('horizon_hours 必須至少為 1')
+
+    timings = {}
+    started = time.perf_counter()
+    # 預測從目前整點開始；歷史資料不含進行中的小時，並涵蓋完整週數
+    forecast_start = timezone.localtime().replace(minute=0, second=0, microsecond=0)
+    history_start = forecast_start - timedelta(weeks=history_weeks)
+
+    series_keys, history = load_hourly_history(history_start, forecast_start, store_ids=store_ids)
+    timings['load_seconds'] = round(time.perf_counter() - started, 3)
+
+    summary = {
+        'series_count': len(series_keys),
+        'stores_count': len({store_id for store_id, _ in series_keys}),
+        'forecast_start': forecast_start.isoformat(),
+        'demand_rows': 0,
+        'staffing_rows': 0,
+    }
+    if not series_keys:
+        summary['timings'] = timings
+        return summary
+
+    stage = time.perf_counter()
+    profiles, alphas = fit_seasonal_profiles(history)
+    forecasts = forecast_from_profiles(profiles, horizon_hours)
+    timings['fit_seconds'] = round(time.perf_counter() - stage, 3)
+
+    if with_backtest and history_weeks >= 2:
+        stage = time.perf_counter()
+        summary['backtest'] = backtest(history)
+        timings['backtest_seconds'] = round(time.perf_counter() - stage, 3)
+
+    if not dry_run:
+        stage = time.perf_counter()
+        generated_at = timezone.now()
+        summary['demand_rows'] = _save_demand_forecasts(series_keys, forecasts, alphas, forecast_start, generated_at)
+        summary['staffing_rows'] = _save_staffing_forecasts(series_keys, forecasts, forecast_start, generated_at)
+        retention_cutoff = forecast_start - timedelta(days=FORECAST_RETENTION_DAYS)
+        DemandForecast.objects.filter(forecast_for__lt=retention_cutoff).delete()
+        StaffingForecast.objects.filter(forecast_for__lt=retention_cutoff).delete()
+        timings['save_seconds'] = round(time.perf_counter() - stage, 3)
+
+    timings['total_seconds'] = round(time.perf_counter() - started, 3)
+    summary['timings'] = timings
+    logger.info(
+        '[DemandForecast] stores=%s series=%s demand_rows=%s staffing_rows=%s total=%ss',
+        summary['stores_count'],
+        summary['series_count'],
+        summary['demand_rows'],
+        summary['staffing_rows'],
+        timings['total_seconds'],
+    )
+    return summary
+
+
+def generate_synthetic_history(stores_count, weeks=DEFAULT_HISTORY_WEEKS, channels=len(CHANNEL_SOURCES), seed=42):
+    """產生具星期 × 小時季節性的 Poisson 模擬資料（僅供效能基準測試）。"""
+    rng = np.random.default_rng(seed)
+    hours = np.arange(HOURS_PER_WEEK) % 24
+    days = np.arange(HOURS_PER_WEEK) // 24
+    # 午餐與晚餐尖峰、週末加成
+    daily_shape = np.exp(-((hours - 12) ** 2) / 4) + 0.8 * np.exp(-((hours - 18.5) ** 2) / 5)
+    weekly_shape = daily_shape * np.where(days >= 5, 1.3, 1.0)
+
+    series_count = stores_count * channels
+    scale = rng.gamma(2.0, 2.0, size=(series_count, 1))
+    trend = 1 + rng.normal(0, 0.02, size=(series_count, 1)) * np.arange(weeks)[None, :]
+    rates = scale[:, :, None] * trend[:, :, None] * weekly_shape[None, None, :]
+    return rng.poisson(rates).reshape(series_count, weeks * HOURS_PER_WEEK).astype(np.float32)
+
+
+def benchmark_forecast(stores_count=2000, weeks=DEFAULT_HISTORY_WEEKS, seed=42):
+    """以模擬資料量測擬合、預測、回測與人力換算的耗時。"""
+    history = generate_synthetic_history(stores_count, weeks=weeks, seed=seed)
+
+    started = time.perf_counter()
+    profiles, _ = fit_seasonal_profiles(history)
+    forecasts = forecast_from_profiles(profiles)
+    fit_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    store_totals = forecasts.reshape(stores_count, -1, forecasts.shape[1]).sum(axis=1)
+    # 每家店假設三種職務
+    role_demand = np.repeat(store_totals, 3, axis=0)
+    compute_required_staff(role_demand, np.tile([8, 12, 20], stores_count), np.tile([1, 0, 0], stores_count))
+    staffing_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    accuracy = backtest(history)
+    backtest_seconds = time.perf_counter() - started
+
+    return {
+        'stores_count': stores_count,
+        'series_count': int(history.shape[0]),
+        'history_weeks': weeks,
+        'fit_forecast_seconds': round(fit_seconds, 3),
+        'staffing_seconds': round(staffing_seconds, 3),
+        'backtest_seconds': round(backtest_seconds, 3),
+        'history_mb': round(history.nbytes / 1024 / 1024, 2),
+        'backtest': accuracy,
+    }
@@ -1,19 +1,25 @@
 import logging
 from datetime import timedelta
-from collections import defaultdict
+from collections import Counter, defaultdict
 
-from django.db.models import Count
+from django.db.models import Count, Max, Q
 from django.utils import timezone
 
-from apps.intelligence.models import PlatformSettings, PersonalizedRecommendationPushLog
-from apps.intelligence.services.recommendation_service import RecommendationService
+from apps.intelligence.leases import ensure_lease_held
+from apps.intelligence.models import PlatformSettings, PersonalizedRecommendationPushLog, UserRecommendation
 from apps.line_bot.models import LineUserBinding
 from apps.line_bot.services.line_api import LineMessagingAPI
-from apps.orders.models import DineInOrder, TakeoutOrder
+from apps.line_bot.services.log_writer import BufferedLogWriter, flush_logs_after
+from apps.line_bot.services.push_dispatcher import PushDispatcher
+from apps.orders.models import DineInOrder, DineInOrderItem, TakeoutOrder, TakeoutOrderItem
 from apps.stores.models import Store
+from apps.surplus_food.models import SurplusFoodOrder
 
 logger = logging.getLogger(__name__)
 
+# 批次評估時每次查詢的用戶數，避免 IN 條件過長
+PERSONALIZATION_CHUNK_SIZE = 2000
+
 
 class LineRecommendationPushService:
     """平台個人化推薦推播服務（快速備案 + 完整版自動推播）。"""
@@ -22,6 +28,7 @@ class LineRecommendationPushService:
         self.settings = PlatformSettings.get_settings()
         self.line_api = LineMessagingAPI()
         self.line_api.channel_access_token = self.settings.line_bot_channel_access_token
+        self.log_writer = BufferedLogWriter(PersonalizedRecommendationPushLog)
 
     def _ensure_line_bot_ready(self):
         if not self.settings.has_line_bot_config():
@@ -35,34 +42,108 @@ class LineRecommendationPushService:
             .order_by('-surplus_completed_revenue_total', '-surplus_completed_order_count_total', '-created_at')[:limit]
         )
 
-    def _get_personalized_recommended_stores(self, user, limit=5):
-        from apps.orders.models import DineInOrder, TakeoutOrder
-        from apps.surplus_food.models import SurplusFoodOrder
-
-        store_scores = {}
-
-        takeout_stats = TakeoutOrder.objects.filter(user=user).exclude(status='rejected').values('store_id').annotate(order_count=Count('id'))
-        dinein_stats = DineInOrder.objects.filter(user=user).exclude(status='rejected').values('store_id').annotate(order_count=Count('id'))
-        surplus_stats = SurplusFoodOrder.objects.filter(user=user).exclude(status__in=['rejected', 'cancelled', 'expired']).values('store_id').annotate(order_count=Count('id'))
-
-        for row in takeout_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-        for row in dinein_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-        for row in surplus_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-
-        if not store_scores:
-            return []
-
-        ranked_store_ids = [
-            store_id
-            for store_id, _ in sorted(store_scores.items(), key=lambda item: item[1], reverse=True)
-        ]
+    @staticmethod
+    def build_personalized_contents(user_ids, store_limit=5, label_limit=6):
+        """
+        一次計算多位用戶的個人化推薦店家與興趣標籤
+
+        每種訂單只查詢一次分組彙總，其餘在記憶體中組裝，
+        排序規則與逐一查詢時相同（依訂單數排序，標籤依序為食物標籤、餐廳類型、地區）。
+
+        Returns:
+            dict: {user_id: (store_ids, labels)}
+        """
+        store_scores = defaultdict(lambda: defaultdict(int))
+        cuisine_scores = defaultdict(lambda: defaultdict(int))
+        region_scores = defaultdict(lambda: defaultdict(int))
+        tag_counters = defaultdict(Counter)
+
+        for order_model in (TakeoutOrder, DineInOrder):
+            rows = (
+                order_model.objects.filter(user_id__in=user_ids)
+                .exclude(status='rejected')
+                .order_by()
+                .values('user_id', 'store_id', 'store__cuisine_type', 'store__region')
+                .annotate(order_count=Count('id'))
+            )
+            for row in rows:
+                user_id = row['user_id']
+                order_count = int(row['order_count'] or 0)
+                store_scores[user_id][row['store_id']] += order_count
+                if row['store__cuisine_type']:
+                    cuisine_scores[user_id][row['store__cuisine_type']] += order_count
+                if row['store__region']:
+                    region_scores[user_id][row['store__region']] += order_count
+
+        surplus_rows = (
+            SurplusFoodOrder.objects.filter(user_id__in=user_ids)
+            .exclude(status__in=['rejected', 'cancelled', 'expired'])
+            .order_by()
+            .values('user_id', 'store_id')
+            .annotate(order_count=Count('id'))
+        )
+        for row in surplus_rows:
+            store_scores[row['user_id']][row['store_id']] += row['order_count']
+
+        # 食物標籤（與 RecommendationService.get_user_favorite_tags 相同：依購買數量加權，前 3 名）
+        for item_model in (TakeoutOrderItem, DineInOrderItem):
+            rows = item_model.objects.filter(
+                order__user_id__in=user_ids,
+                product__isnull=False,
+            ).values_list('order__user_id', 'product__food_tags', 'quantity')
+            for user_id, food_tags, quantity in rows.iterator(chunk_size=5000):
+                for tag in food_tags or []:
+                    tag_counters[user_id][tag] += quantity
+
+        published_store_ids = set(
+            Store.objects.filter(
+                id__in={store_id for scores in store_scores.values() for store_id in scores},
+                is_published=True,
+            ).values_list('id', flat=True)
+        )
+        cuisine_choices = dict(Store.CUISINE_TYPE_CHOICES)
 
-        stores = Store.objects.filter(id__in=ranked_store_ids, is_published=True)
-        store_by_id = {store.id: store for store in stores}
-        return [store_by_id[store_id] for store_id in ranked_store_ids if store_id in store_by_id][:limit]
+        contents = {}
+        for user_id in user_ids:
+            ranked_store_ids = [
+                store_id
+                for store_id, _ in sorted(store_scores[user_id].items(), key=lambda item: item[1], reverse=True)
+                if store_id in published_store_ids
+            ][:store_limit]
+
+            labels = []
+            candidates = [tag for tag, _ in tag_counters[user_id].most_common(3)]
+            candidates += [
+                f"{cuisine_choices.get(code, code)}餐廳"
+                for code, _ in sorted(cuisine_scores[user_id].items(), key=lambda item: item[1], reverse=True)[:2]
+            ]
+            candidates += [
+                region
+                for region, _ in sorted(region_scores[user_id].items(), key=lambda item: item[1], reverse=True)[:2]
+            ]
+            for label in candidates:
+                if label and label not in labels:
+                    labels.append(label)
+
+            contents[user_id] = (ranked_store_ids, labels[:label_limit])
+        return contents
+
+    @staticmethod
+    def _get_personalized_recommended_stores(user, limit=5):
+        store_ids, _ = LineRecommendationPushService.build_personalized_contents(
+            [user.id],
+            store_limit=limit,
+        )[user.id]
+        store_by_id = Store.objects.in_bulk(store_ids)
+        return [store_by_id[store_id] for store_id in store_ids if store_id in store_by_id]
+
+    @staticmethod
+    def _get_user_personalization_labels(user, limit=6):
+        _, labels = LineRecommendationPushService.build_personalized_contents(
+            [user.id],
+            label_limit=limit,
+        )[user.id]
+        return labels
 
     def _build_recommendation_message(self, title, intro, stores, include_popularity_metrics=False):
         if not stores:
@@ -81,86 +162,14 @@ class LineRecommendationPushService:
 
         return "\n".join(lines)
 
-    def _get_user_personalization_labels(self, user, limit=6):
-        labels = []
-        seen = set()
-
-        # 1) 食物標籤（從歷史點餐偏好）
-        favorite_tags = RecommendationService.get_user_favorite_tags(user, limit=3)
-        for item in favorite_tags:
-            tag = (item or {}).get('tag')
-            if tag and tag not in seen:
-                labels.append(tag)
-                seen.add(tag)
-
-        # 2) 餐廳類型（從歷史訂單店家）
-        cuisine_score = defaultdict(int)
-        for row in (
-            TakeoutOrder.objects.filter(user=user)
-            .exclude(status='rejected')
-            .values('store__cuisine_type')
-            .annotate(order_count=Count('id'))
-        ):
-            cuisine_code = row.get('store__cuisine_type')
-            if cuisine_code:
-                cuisine_score[cuisine_code] += int(row.get('order_count') or 0)
-
-        for row in (
-            DineInOrder.objects.filter(user=user)
-            .exclude(status='rejected')
-            .values('store__cuisine_type')
-            .annotate(order_count=Count('id'))
-        ):
-            cuisine_code = row.get('store__cuisine_type')
-            if cuisine_code:
-                cuisine_score[cuisine_code] += int(row.get('order_count') or 0)
-
-        cuisine_choices = dict(Store.CUISINE_TYPE_CHOICES)
-        sorted_cuisines = sorted(cuisine_score.items(), key=lambda item: item[1], reverse=True)
-        for cuisine_code, _ in sorted_cuisines[:2]:
-            cuisine_name = cuisine_choices.get(cuisine_code, cuisine_code)
-            label = f"{cuisine_name}餐廳"
-            if label not in seen:
-                labels.append(label)
-                seen.add(label)
-
-        # 3) 地區（從歷史訂單店家）
-        region_score = defaultdict(int)
-        for row in (
-            TakeoutOrder.objects.filter(user=user)
-            .exclude(status='rejected')
-            .values('store__region')
-            .annotate(order_count=Count('id'))
-        ):
-            region = row.get('store__region')
-            if region:
-                region_score[region] += int(row.get('order_count') or 0)
-
-        for row in (
-            DineInOrder.objects.filter(user=user)
-            .exclude(status='rejected')
-            .values('store__region')
-            .annotate(order_count=Count('id'))
-        ):
-            region = row.get('store__region')
-            if region:
-                region_score[region] += int(row.get('order_count') or 0)
-
-        sorted_regions = sorted(region_score.items(), key=lambda item: item[1], reverse=True)
-        for region, _ in sorted_regions[:2]:
-            if region not in seen:
-                labels.append(region)
-                seen.add(region)
-
-        return labels[:limit]
-
-    def _build_personalized_intro(self, user):
-        labels = self._get_user_personalization_labels(user, limit=6)
+    def _build_personalized_intro(self, user, labels=None):
+        if labels is None:
+            labels = self._get_user_personalization_labels(user, limit=6)
         label_text = '、'.join(labels) if labels else '美食探索'
         return f"我們發現您你最近對「{label_text}」特別感興趣！我們為你在 DINEVERSE 中找到了幾家符合您喜好的餐廳。找時間去試試看吧！"
 
     def _log(self, *, binding, push_type, status, reason='', error_message='', store_ids=None):
-        PersonalizedRecommendationPushLog.objects.create(
+        self.log_writer.add(
             user=binding.user if binding and binding.user_id else None,
             line_user_id=binding.line_user_id if binding else '',
             push_type=push_type,
@@ -170,7 +179,43 @@ class LineRecommendationPushService:
             recommended_store_ids=store_ids or [],
         )
 
-    def _is_personalized_eligible(self, binding, now, force=False):
+    def _get_dispatcher(self):
+        return PushDispatcher(self.settings.line_bot_channel_access_token)
+
+    @staticmethod
+    def _failure_reason(result):
+        return 'line_push_exception' if result.status_code is None else 'line_push_failed'
+
+    def _load_personalized_push_stats(self, now):
+        """
+        一次彙總所有用戶的最近成功推播時間與近 7 天成功次數
+
+        只需看「最小間隔」與「7 天」兩者中較長的時間窗，更早的記錄不影響判斷。
+
+        Returns:
+            dict: {user_id: (last_success_at, weekly_count)}
+        """
+        interval_minutes = max(0, int(self.settings.personalized_recommendation_min_interval_minutes or 0))
+        window_start = now - timedelta(days=7)
+        since = min(window_start, now - timedelta(minutes=interval_minutes))
+
+        rows = (
+            PersonalizedRecommendationPushLog.objects.filter(
+                user_id__isnull=False,
+                push_type='personalized',
+                status='success',
+                created_at__gte=since,
+            )
+            .order_by()
+            .values('user_id')
+            .annotate(
+                last_success_at=Max('created_at'),
+                weekly_count=Count('id', filter=Q(created_at__gte=window_start)),
+            )
+        )
+        return {row['user_id']: (row['last_success_at'], row['weekly_count']) for row in rows}
+
+    def _is_personalized_eligible(self, binding, now, push_stats, force=False):
         if force:
             return True, ''
 
@@ -184,33 +229,57 @@ class LineRecommendationPushService:
         if weekly_limit == 0:
             return False, 'weekly_limit_zero'
 
+        last_success_at, weekly_personalized_count = push_stats.get(binding.user_id, (None, 0))
         interval_minutes = max(0, int(self.settings.personalized_recommendation_min_interval_minutes or 0))
-        if interval_minutes > 0:
-            last_personalized = PersonalizedRecommendationPushLog.objects.filter(
-                user=binding.user,
-                push_type='personalized',
-                status='success',
-            ).order_by('-created_at').first()
-            if last_personalized and now - last_personalized.created_at < timedelta(minutes=interval_minutes):
-                return False, 'min_interval_not_reached'
+        if interval_minutes > 0 and last_success_at and now - last_success_at < timedelta(minutes=interval_minutes):
+            return False, 'min_interval_not_reached'
 
-        window_start = now - timedelta(days=7)
-        weekly_personalized_count = PersonalizedRecommendationPushLog.objects.filter(
-            user=binding.user,
-            push_type='personalized',
-            status='success',
-            created_at__gte=window_start,
-        ).count()
         if weekly_personalized_count >= weekly_limit:
             return False, 'weekly_limit_reached'
 
         return True, ''
 
+    def load_personalized_contents(self, user_ids, now):
+        """
+        取得可推播用戶的個人化內容：優先使用預先計算結果，其餘分批以分組查詢計算
+
+        Returns:
+            dict: {user_id: (stores, labels)}
+        """
+        contents = {}
+        for start in range(0, len(user_ids), PERSONALIZATION_CHUNK_SIZE):
+            chunk = user_ids[start:start + PERSONALIZATION_CHUNK_SIZE]
+            store_ids_by_user = {}
+
+            for row in UserRecommendation.objects.filter(
+                user_id__in=chunk,
+                kind='line_stores',
+                expires_at__gt=now,
+            ).only('user_id', 'items', 'context'):
+                store_ids_by_user[row.user_id] = (
+                    [item['id'] for item in row.items],
+                    row.context.get('labels', []),
+                )
+
+            missing = [user_id for user_id in chunk if user_id not in store_ids_by_user]
+            if missing:
+                store_ids_by_user.update(self.build_personalized_contents(missing))
+
+            store_by_id = Store.objects.filter(
+                id__in={store_id for store_ids, _ in store_ids_by_user.values() for store_id in store_ids},
+                is_published=True,
+            ).in_bulk()
+            for user_id, (store_ids, labels) in store_ids_by_user.items():
+                stores = [store_by_id[store_id] for store_id in store_ids if store_id in store_by_id][:5]
+                contents[user_id] = (stores, labels)
+        return contents
+
+    @flush_logs_after
     def send_quick_fallback_popular_recommendation(self, intro_message='以下是本週熱門店家推薦，AI 功能異常時可先使用此備案。'):
         """快速版：只送熱門店家（不依賴個人化推薦判斷）。"""
         self._ensure_line_bot_ready()
 
-        bindings = LineUserBinding.objects.filter(is_active=True, current_mode='customer')
+        bindings = list(LineUserBinding.objects.filter(is_active=True, current_mode='customer'))
         popular_stores = self._get_popular_recommended_stores(limit=5)
         if not popular_stores:
             return {
@@ -234,6 +303,7 @@ class LineRecommendationPushService:
         failure_count = 0
         skipped_count = 0
 
+        jobs = []
         for binding in bindings:
             if not binding.notify_personalized_recommendation:
                 skipped_count += 1
@@ -244,52 +314,48 @@ class LineRecommendationPushService:
                     reason='user_personalized_disabled',
                 )
                 continue
+            jobs.append((binding, binding.line_user_id, [message]))
 
-            try:
-                result = self.line_api.push_message(binding.line_user_id, [message])
-                if result:
-                    success_count += 1
-                    self._log(
-                        binding=binding,
-                        push_type='fallback',
-                        status='success',
-                        reason='quick_fallback_popular',
-                        store_ids=[store.id for store in popular_stores],
-                    )
-                else:
-                    failure_count += 1
-                    self._log(
-                        binding=binding,
-                        push_type='fallback',
-                        status='failed',
-                        reason='line_push_failed',
-                        store_ids=[store.id for store in popular_stores],
-                    )
-            except Exception as exc:
+        results, throughput = self._get_dispatcher().dispatch(jobs)
+        store_ids = [store.id for store in popular_stores]
+        for result in results:
+            if result.success:
+                success_count += 1
+                self._log(
+                    binding=result.key,
+                    push_type='fallback',
+                    status='success',
+                    reason='quick_fallback_popular',
+                    store_ids=store_ids,
+                )
+            else:
                 failure_count += 1
                 self._log(
-                    binding=binding,
+                    binding=result.key,
                     push_type='fallback',
                     status='failed',
-                    reason='line_push_exception',
-                    error_message=str(exc),
-                    store_ids=[store.id for store in popular_stores],
+                    reason=self._failure_reason(result),
+                    error_message=result.error,
+                    store_ids=store_ids,
                 )
-                logger.warning('Quick fallback push failed for %s: %s', binding.line_user_id, exc)
 
         return {
             'mode': 'quick_fallback',
-            'recipient_count': bindings.count(),
+            'recipient_count': len(bindings),
             'success_count': success_count,
             'failure_count': failure_count,
             'skipped_count': skipped_count,
+            'throughput': throughput,
         }
 
+    @flush_logs_after
     def run_automated_personalized_recommendation(self, *, force=False):
         """完整版：依最小間隔 + 每週上限，自動送個人化 + 熱門推薦。"""
         self._ensure_line_bot_ready()
 
-        bindings = LineUserBinding.objects.filter(is_active=True, current_mode='customer').select_related('user')
+        bindings = list(
+            LineUserBinding.objects.filter(is_active=True, current_mode='customer').select_related('user')
+        )
         now = timezone.now()
         popular_stores = self._get_popular_recommended_stores(limit=5)
 
@@ -297,8 +363,11 @@ class LineRecommendationPushService:
         failure_count = 0
         skipped_count = 0
 
+        # 1) 以一次彙總判斷所有綁定的推播資格
+        push_stats = {} if force else self._load_personalized_push_stats(now)
+        eligible_bindings = []
         for binding in bindings:
-            eligible, reason = self._is_personalized_eligible(binding, now, force=force)
+            eligible, reason = self._is_personalized_eligible(binding, now, push_stats, force=force)
             if not eligible:
                 skipped_count += 1
                 self._log(
@@ -308,11 +377,21 @@ class LineRecommendationPushService:
                     reason=reason,
                 )
                 continue
+            eligible_bindings.append(binding)
+
+        # 2) 分組查詢取得個人化店家與標籤，之後只在記憶體中組裝訊息
+        personalized_contents = self.load_personalized_contents(
+            [binding.user_id for binding in eligible_bindings],
+            now,
+        )
 
-            personalized_stores = self._get_personalized_recommended_stores(binding.user, limit=5)
+        jobs = []
+        contexts = {}
+        for binding in eligible_bindings:
+            personalized_stores, labels = personalized_contents.get(binding.user_id, ([], []))
             personalized_text = self._build_recommendation_message(
                 title='🎯 個人化推薦店家',
-                intro=self._build_personalized_intro(binding.user),
+                intro=self._build_personalized_intro(binding.user, labels=labels),
                 stores=personalized_stores,
                 include_popularity_metrics=False,
             )
@@ -343,71 +422,45 @@ class LineRecommendationPushService:
                 )
                 continue
 
-            try:
-                result = self.line_api.push_message(binding.line_user_id, messages[:5])
-                if result:
-                    success_count += 1
-                    if 'personalized' in sent_types:
-                        self._log(
-                            binding=binding,
-                            push_type='personalized',
-                            status='success',
-                            reason='auto_cycle',
-                            store_ids=[store.id for store in personalized_stores],
-                        )
-                    if 'popular' in sent_types:
-                        self._log(
-                            binding=binding,
-                            push_type='popular',
-                            status='success',
-                            reason='auto_cycle',
-                            store_ids=[store.id for store in popular_stores],
-                        )
-                else:
-                    failure_count += 1
-                    if 'personalized' in sent_types:
-                        self._log(
-                            binding=binding,
-                            push_type='personalized',
-                            status='failed',
-                            reason='line_push_failed',
-                            store_ids=[store.id for store in personalized_stores],
-                        )
-                    if 'popular' in sent_types:
-                        self._log(
-                            binding=binding,
-                            push_type='popular',
-                            status='failed',
-                            reason='line_push_failed',
-                            store_ids=[store.id for store in popular_stores],
-                        )
-            except Exception as exc:
+            contexts[binding.id] = (sent_types, personalized_stores)
+            jobs.append((binding, binding.line_user_id, messages[:5]))
+
+        ensure_lease_held()
+        results, throughput = self._get_dispatcher().dispatch(jobs)
+        for result in results:
+            binding = result.key
+            sent_types, personalized_stores = contexts[binding.id]
+            if result.success:
+                success_count += 1
+                status, reason, error_message = 'success', 'auto_cycle', ''
+            else:
                 failure_count += 1
-                if 'personalized' in sent_types:
-                    self._log(
-                        binding=binding,
-                        push_type='personalized',
-                        status='failed',
-                        reason='line_push_exception',
-                        error_message=str(exc),
-                        store_ids=[store.id for store in personalized_stores],
-                    )
-                if 'popular' in sent_types:
-                    self._log(
-                        binding=binding,
-                        push_type='popular',
-                        status='failed',
-                        reason='line_push_exception',
-                        error_message=str(exc),
-                        store_ids=[store.id for store in popular_stores],
-                    )
-                logger.warning('Auto recommendation push failed for %s: %s', binding.line_user_id, exc)
+                status, reason, error_message = 'failed', self._failure_reason(result), result.error
+            if 'personalized' in sent_types:
+                self._log(
+                    binding=binding,
+                    push_type='personalized',
+                    status=status,
+                    reason=reason,
+                    error_message=error_message,
+                    store_ids=[store.id for store in personalized_stores],
+                )
+            if 'popular' in sent_types:
+                self._log(
+                    binding=binding,
+                    push_type='popular',
+                    status=status,
+                    reason=reason,
+                    error_message=error_message,
+                    store_ids=[store.id for store in popular_stores],
+                )
 
         return {
             'mode': 'full_auto',
-            'recipient_count': bindings.count(),
+            'recipient_count': len(bindings),
             'success_count': success_count,
             'failure_count': failure_count,
             'skipped_count': skipped_count,
             'force': force,
+            'throughput': throughput,
         }
@@ -0,0 +1,201 @@
+"""
+商品相似度離線計算服務
+
+每個店家建立「商品 × 標籤」稀疏特徵矩陣，以向量化運算一次算出所有
+商品兩兩之間的 Jaccard / Cosine 相似度，取 Top-K 鄰居寫入 ProductSimilarity。
+線上查詢只需讀取預先計算的結果。
+"""
+import logging
+import time
+
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+from django.utils import timezone
+
+from apps.intelligence.leases import ensure_lease_held
+from apps.intelligence.models import ProductSimilarity
+from apps.intelligence.services.recommendation_service import invalidate_similar_products_cache
+from apps.intelligence.services.tag_index import normalize_tag
+from apps.products.models import Product
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_METRICS = ('jaccard', 'cosine')
+DEFAULT_TOP_K = 10
+# 單次處理的商品列數，避免大型店家產生過大的稠密矩陣
+ROW_BLOCK_SIZE = 1024
+
+
+def _build_feature_matrix(product_tags):
+    """
+    建立二元特徵矩陣
+
+    商品除了自身標籤外，也擁有「被自身標籤包含的其他詞彙標籤」，
+    讓「素食便當」與「素食」這類包含關係也能產生交集。
+    """
+    vocabulary = sorted({tag for tags in product_tags for tag in tags})
+    column_by_tag = {tag: column for column, tag in enumerate(vocabulary)}
+    # 每個詞彙只展開一次：自身欄位加上被它包含的其他詞彙欄位
+    expanded = {
+        tag: [column_by_tag[other] for other in vocabulary if other in tag]
+        for tag in vocabulary
+    }
+
+    row_chunks, column_chunks = [], []
+    for row, tags in enumerate(product_tags):
+        columns = np.unique([column for tag in tags for column in expanded[tag]])
+        row_chunks.append(np.full(len(columns), row, dtype=np.int64))
+        column_chunks.append(columns.astype(np.int64))
+
+    shape = (len(product_tags), len(vocabulary))
+    if not row_chunks:
+        return sparse.csr_matrix(shape, dtype=np.float32)
+
+    matrix = sparse.lil_matrix(shape, dtype=np.float32)
+    matrix[np.concatenate(row_chunks), np.concatenate(column_chunks)] = 1
+    return matrix.tocsr()
+
+
+def _common_tags(source_tags, candidate_tags):
+    common = []
+    for candidate_tag in candidate_tags:
+        for source_tag in source_tags:
+            if source_tag in candidate_tag or candidate_tag in source_tag:
+                common.append(candidate_tag)
+                break
+    return common
+
+
+def compute_top_k_neighbors(product_rows, top_k=DEFAULT_TOP_K, metric='jaccard'):
+    """
+    計算單一店家所有商品的 Top-K 相似商品
+
+    Args:
+        product_rows: [(product_id, food_tags), ...]
+        top_k: 每個商品保留的鄰居數
+        metric: 'jaccard' 或 'cosine'
+
+    Returns:
+        dict: {product_id: [(neighbor_id, score, common_tags), ...]}
+    """
+    if metric not in SIMILARITY_METRICS:
+        raise ValueError(f'不支援的相似度指標: {metric}')
+
+    product_ids = []
+    product_tags = []
+    for product_id, food_tags in product_rows:
+        tags = tuple(dict.fromkeys(
+            normalized for normalized in (normalize_tag(tag) for tag in (food_tags or [])) if normalized
+        ))
+        if tags:
+            product_ids.append(product_id)
+            product_tags.append(tags)
+
+    if len(product_ids) < 2:
+        return {}
+
+    matrix = _build_feature_matrix(product_tags)
+    matrix_t = matrix.T.tocsc()
+    sizes = np.asarray(matrix.sum(axis=1), dtype=np.float32).ravel()
+    count = len(product_ids)
+    k = min(top_k, count - 1)
+
+    neighbors = {}
+    for start in range(0, count, ROW_BLOCK_SIZE):
+        end = min(start + ROW_BLOCK_SIZE, count)
+        intersection = (matrix[start:end] @ matrix_t).toarray()
+
+        if metric == 'jaccard':
+            denominator = sizes[start:end, None] + sizes[None, :] - intersection
+        else:
+            denominator = np.sqrt(sizes[start:end, None] * sizes[None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(denominator > 0, intersection / denominator, 0.0)
+
+        # 排除自己
+        block_rows = np.arange(end - start)
+        scores[block_rows, block_rows + start] = 0.0
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for offset in range(end - start):
+            row = start + offset
+            items = []
+            for column, score in zip(top[offset], top_scores[offset]):
+                if score <= 0:
+                    break
+                items.append((
+                    product_ids[column],
+                    float(score),
+                    _common_tags(product_tags[row], product_tags[column]),
+                ))
+            if items:
+                neighbors[product_ids[row]] = items
+
+    return neighbors
+
+
+def rebuild_store_similarities(store_id, top_k=DEFAULT_TOP_K, metric='jaccard'):
+    """重新計算單一店家的商品相似度並整批覆寫。"""
+    product_rows = list(
+        Product.objects.filter(store_id=store_id, is_available=True)
+        .values_list('id', 'food_tags')
+    )
+    neighbors = compute_top_k_neighbors(product_rows, top_k=top_k, metric=metric)
+
+    computed_at = timezone.now()
+    records = [
+        ProductSimilarity(
+            store_id=store_id,
+            product_id=product_id,
+            similar_product_id=neighbor_id,
+            rank=rank,
+            score=score,
+            common_tags=common_tags,
+            computed_at=computed_at,
+        )
+        for product_id, items in neighbors.items()
+        for rank, (neighbor_id, score, common_tags) in enumerate(items, start=1)
+    ]
+
+    with transaction.atomic():
+        existing = ProductSimilarity.objects.filter(store_id=store_id)
+        stale_ids = set(existing.values_list('product_id', flat=True))
+        existing.delete()
+        ProductSimilarity.objects.bulk_create(records, batch_size=1000)
+
+    stale_ids.update(product_id for product_id, _ in product_rows)
+    transaction.on_commit(lambda: invalidate_similar_products_cache(stale_ids))
+    return len(records)
+
+
+def rebuild_all_similarities(top_k=DEFAULT_TOP_K, metric='jaccard', store_ids=None):
+    """逐店家重建相似度，回傳執行摘要。"""
+    started = time.monotonic()
+    if store_ids is None:
+        store_ids = list(
+            Product.objects.filter(is_available=True)
+            .values_list('store_id', flat=True)
+            .distinct()
+        )
+
+    summary = {'stores_count': 0, 'pairs_count': 0}
+    for store_id in store_ids:
+        ensure_lease_held()
+        summary['pairs_count'] += rebuild_store_similarities(store_id, top_k=top_k, metric=metric)
+        summary['stores_count'] += 1
+
+    summary['elapsed_seconds'] = round(time.monotonic() - started, 3)
+    logger.info(
+        '[ProductSimilarity] rebuilt: stores=%s pairs=%s elapsed=%ss',
+        summary['stores_count'],
+        summary['pairs_count'],
+        summary['elapsed_seconds'],
+    )
+    return summary
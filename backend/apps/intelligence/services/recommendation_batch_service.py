@@ -0,0 +1,259 @@
+"""
+用戶推薦批次預先計算
+
+將活躍用戶切成多個區塊，以行程池平行計算推薦店家、推薦商品、
+LINE 個人化推播內容與店家內偏好輪廓，整批寫入 UserRecommendation。
+API 與 LINE 推播服務讀取預先計算結果，過期或缺少時才即時計算。
+"""
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.utils import timezone
+
+from apps.intelligence.leases import ensure_lease_held
+from apps.intelligence.models import UserRecommendation
+from apps.intelligence.services.recommendation_service import (
+    PRECOMPUTED_LINE_STORE_LIMIT,
+    PRECOMPUTED_PRODUCT_LIMIT,
+    PRECOMPUTED_STORE_LIMIT,
+    RecommendationService,
+)
+from apps.line_bot.models import LineUserBinding
+from apps.orders.models import DineInOrder, DineInOrderItem, TakeoutOrder, TakeoutOrderItem
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_TTL_HOURS = 24
+DEFAULT_ACTIVE_DAYS = 180
+# 與 StoreRecommendationPushService 新品推薦使用的偏好輪廓長度一致
+STORE_PROFILE_LIMIT = 4
+
+
+def get_active_user_ids(active_days=DEFAULT_ACTIVE_DAYS):
+    """近期有有效訂單或已綁定 LINE 的啟用用戶。"""
+    since = timezone.now() - timedelta(days=active_days)
+    user_ids = set()
+    for order_model in (TakeoutOrder, DineInOrder):
+        user_ids.update(
+            order_model.objects.filter(user__isnull=False, created_at__gte=since)
+            .exclude(status='rejected')
+            .values_list('user_id', flat=True)
+            .distinct()
+        )
+    user_ids.update(
+        LineUserBinding.objects.filter(is_active=True, current_mode='customer')
+        .values_list('user_id', flat=True)
+    )
+    return sorted(
+        get_user_model().objects.filter(id__in=user_ids, is_active=True).values_list('id', flat=True)
+    )
+
+
+def compute_store_profiles(user_ids, limit=STORE_PROFILE_LIMIT, store_id=None):
+    """
+    一次查詢計算區塊內所有用戶在各店家的偏好輪廓（標籤與分類）
+
+    Args:
+        store_id: 只計算指定店家（None 表示所有店家）
+
+    Returns:
+        dict: {(user_id, store_id): (top_tags, top_category_ids, top_category_names)}
+    """
+    tag_score = defaultdict(lambda: defaultdict(int))
+    category_score = defaultdict(lambda: defaultdict(int))
+    category_names = {}
+
+    for item_model in (TakeoutOrderItem, DineInOrderItem):
+        rows = item_model.objects.filter(
+            order__user_id__in=user_ids,
+            product_id__isnull=False,
+        )
+        if store_id is not None:
+            rows = rows.filter(order__store_id=store_id)
+        rows = rows.values_list(
+            'order__user_id',
+            'order__store_id',
+            'product__food_tags',
+            'product__category_id',
+            'product__category__name',
+            'quantity',
+        )
+        for user_id, order_store_id, food_tags, category_id, category_name, quantity in rows.iterator(chunk_size=2000):
+            key = (user_id, order_store_id)
+            qty = int(quantity or 1)
+            for tag in food_tags or []:
+                tag_score[key][tag] += qty
+            if category_id:
+                category_score[key][category_id] += qty
+                category_names[category_id] = category_name or '未分類'
+
+    profiles = {}
+    for key in set(tag_score) | set(category_score):
+        top_tags = [
+            tag for tag, _ in sorted(tag_score[key].items(), key=lambda item: item[1], reverse=True)[:limit]
+        ]
+        top_category_ids = [
+            cid for cid, _ in sorted(category_score[key].items(), key=lambda item: item[1], reverse=True)[:limit]
+        ]
+        profiles[key] = (
+            top_tags,
+            top_category_ids,
+            [category_names.get(cid, '未分類') for cid in top_category_ids],
+        )
+    return profiles
+
+
+def compute_user_chunk(user_ids):
+    """
+    計算單一區塊的推薦結果（可在子行程中執行）
+
+    Returns:
+        list: 可直接建立 UserRecommendation 的欄位字典
+    """
+    from apps.intelligence.services.line_recommendation_push_service import LineRecommendationPushService
+
+    users = list(get_user_model().objects.filter(id__in=user_ids))
+    user_ids = [user.id for user in users]
+
+    rows = []
+    # LINE 個人化推播內容以分組查詢一次算完整個區塊
+    line_contents = LineRecommendationPushService.build_personalized_contents(
+        user_ids,
+        store_limit=PRECOMPUTED_LINE_STORE_LIMIT,
+    )
+    for user_id, (store_ids, labels) in line_contents.items():
+        rows.append({
+            'user_id': user_id,
+            'kind': 'line_stores',
+            'items': [{'id': store_id} for store_id in store_ids],
+            'context': {'labels': labels},
+        })
+
+    for user in users:
+        stores = RecommendationService.get_store_recommendations_for_user(user, limit=PRECOMPUTED_STORE_LIMIT)
+        rows.append({
+            'user_id': user.id,
+            'kind': 'stores',
+            'items': [{'id': store.id} for store in stores],
+        })
+
+        products = RecommendationService.get_recommended_products_by_tags(user, limit=PRECOMPUTED_PRODUCT_LIMIT)
+        rows.append({
+            'user_id': user.id,
+            'kind': 'products',
+            'items': [
+                {
+                    'id': item['product'].id,
+                    'score': item['score'],
+                    'cf_score': item.get('cf_score', 0.0),
+                    'matching_tags': item['matching_tags'],
+                }
+                for item in products
+            ],
+        })
+
+    for (user_id, store_id), (top_tags, top_category_ids, top_category_names) in compute_store_profiles(user_ids).items():
+        rows.append({
+            'user_id': user_id,
+            'kind': 'store_profile',
+            'store_id': store_id,
+            'items': top_tags,
+            'context': {'category_ids': top_category_ids, 'category_names': top_category_names},
+        })
+    return rows
+
+
+def write_user_chunk(user_ids, rows, ttl_hours=DEFAULT_TTL_HOURS):
+    """以區塊為單位覆寫（刪除後整批建立），回傳寫入筆數。"""
+    computed_at = timezone.now()
+    expires_at = computed_at + timedelta(hours=ttl_hours)
+    records = [
+        UserRecommendation(
+            user_id=row['user_id'],
+            kind=row['kind'],
+            store_id=row.get('store_id'),
+            items=row['items'],
+            context=row.get('context', {}),
+            computed_at=computed_at,
+            expires_at=expires_at,
+        )
+        for row in rows
+    ]
+    with transaction.atomic():
+        UserRecommendation.objects.filter(user_id__in=user_ids).delete()
+        UserRecommendation.objects.bulk_create(records, batch_size=1000)
+    return len(records)
+
+
+def _init_worker():
+    # fork 後不可沿用父行程的資料庫連線
+    connections.close_all()
+
+
+def _can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def run_recommendation_batch(
+    *,
+    user_ids=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    workers=1,
+    ttl_hours=DEFAULT_TTL_HOURS,
+    active_days=DEFAULT_ACTIVE_DAYS,
+):
+    """
+    執行整批預先計算
+
+    workers > 1 時以 fork 行程池平行計算，寫入一律由主行程進行，
+    避免多個行程同時持有寫入交易。
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size 必須至少為 1')
+    if ttl_hours <= 0:
+        raise ValueError('ttl_hours 必須大於 0')
+
+    started = time.monotonic()
+    if user_ids is None:
+        user_ids = get_active_user_ids(active_days=active_days)
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+    summary = {'users_count': len(user_ids), 'chunks_count': len(chunks), 'rows_count': 0}
+    if workers > 1 and len(chunks) > 1 and _can_fork():
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+        ) as executor:
+            for chunk, rows in zip(chunks, executor.map(compute_user_chunk, chunks)):
+                ensure_lease_held()
+                summary['rows_count'] += write_user_chunk(chunk, rows, ttl_hours=ttl_hours)
+    else:
+        for chunk in chunks:
+            rows = compute_user_chunk(chunk)
+            ensure_lease_held()
+            summary['rows_count'] += write_user_chunk(chunk, rows, ttl_hours=ttl_hours)
+
+    summary['expired_deleted'], _ = UserRecommendation.objects.filter(expires_at__lte=timezone.now()).delete()
+    summary['elapsed_seconds'] = round(time.monotonic() - started, 3)
+    logger.info(
+        '[UserRecommendation] batch done: users=%s chunks=%s rows=%s elapsed=%ss',
+        summary['users_count'],
+        summary['chunks_count'],
+        summary['rows_count'],
+        summary['elapsed_seconds'],
+    )
+    return summary
+
+
+def invalidate_user_recommendations(user_id):
+    """用戶產生新訂單後清除其預先計算結果，改以即時計算直到下次批次。"""
+    UserRecommendation.objects.filter(user_id=user_id).delete()
@@ -1,12 +1,34 @@
-from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, OuterRef, Subquery
+from django.utils import timezone
 from apps.products.models import Product
+from apps.intelligence.models import ProductSimilarity, UserRecommendation
 from apps.orders.models import TakeoutOrderItem, DineInOrderItem
 from apps.stores.models import Store, StoreImage
+from apps.intelligence.ml_models.item_cf import get_scorer
+from apps.intelligence.services.tag_index import get_tag_index
 from collections import Counter
 import logging
 
 logger = logging.getLogger(__name__)
 
+SIMILAR_PRODUCTS_CACHE_KEY = 'intelligence:similar_products:{product_id}'
+SIMILAR_PRODUCTS_CACHE_TTL_SECONDS = 600
+# 每個商品離線保留的鄰居數上限（與 build_product_similarity 預設一致）
+PRECOMPUTED_SIMILAR_PRODUCTS_LIMIT = 10
+# generate_recommendations 批次為每位用戶保留的推薦數量
+PRECOMPUTED_STORE_LIMIT = 10
+PRECOMPUTED_PRODUCT_LIMIT = 20
+PRECOMPUTED_LINE_STORE_LIMIT = 5
+
+
+def invalidate_similar_products_cache(product_ids):
+    cache.delete_many([
+        SIMILAR_PRODUCTS_CACHE_KEY.format(product_id=product_id)
+        for product_id in product_ids
+    ])
+
 
 def _published_store_base_queryset():
     first_image = StoreImage.objects.filter(
@@ -81,12 +103,6 @@ class RecommendationService:
         # 提取標籤名稱
         favorite_tags = [item['tag'] for item in favorite_tag_data]
         
-        # 找出包含這些標籤的商品
-        query = Product.objects.filter(is_available=True)
-        
-        if store:
-            query = query.filter(store=store)
-        
         # 排除用戶已訂購過的商品
         ordered_product_ids = set()
         ordered_product_ids.update(
@@ -102,36 +118,74 @@ class RecommendationService:
             ).values_list('product_id', flat=True)
         )
         
-        # 計算每個商品與用戶喜好的匹配度
-        recommended_products = []
+        # 透過標籤倒排索引取得候選商品與匹配度（包含匹配）
+        tag_index = get_tag_index()
+        store_id = store.id if store else None
+        matches = tag_index.match_products(
+            favorite_tags,
+            store_id=store_id,
+            exclude_ids=ordered_product_ids,
+        )
+        cf_scores = RecommendationService._get_item_cf_scores(
+            ordered_product_ids,
+            tag_index,
+            store_id=store_id,
+        )
+        weight = getattr(settings, 'ITEM_CF_BLEND_WEIGHT', 0.0)
+        
+        # 混合分數 = 標籤匹配數 + 權重 × 正規化後的協同過濾分數
+        blended = {
+            product_id: matches.get(product_id, (0, []))[0] + weight * cf_scores.get(product_id, 0.0)
+            for product_id in set(matches) | set(cf_scores)
+        }
+        ranked = sorted(
+            blended.items(),
+            key=lambda item: (item[1], item[0]),
+            reverse=True,
+        )[:limit]
         
-        for product in query.exclude(id__in=ordered_product_ids):
-            if not product.food_tags:
+        products = Product.objects.filter(
+            id__in=[product_id for product_id, _ in ranked],
+            is_available=True,
+        )
+        product_by_id = {product.id: product for product in products}
+        
+        results = []
+        for product_id, _ in ranked:
+            if product_id not in product_by_id:
                 continue
-            
-            # 計算標籤匹配度（改為包含匹配）
-            matching_tags = []
-            match_score = 0
-            
-            for product_tag in product.food_tags:
-                for favorite_tag in favorite_tags:
-                    # 如果商品標籤包含喜好標籤，或喜好標籤包含商品標籤
-                    if favorite_tag in product_tag or product_tag in favorite_tag:
-                        matching_tags.append(product_tag)
-                        match_score += 1
-                        break  # 避免同一個商品標籤重複計分
-            
-            if match_score > 0:
-                recommended_products.append({
-                    'product': product,
-                    'score': match_score,
-                    'matching_tags': matching_tags  # 已經是列表，不需要轉換
-                })
+            score, matching_tags = matches.get(product_id, (0, []))
+            results.append({
+                'product': product_by_id[product_id],
+                'score': score,
+                'cf_score': round(cf_scores.get(product_id, 0.0), 4),
+                'matching_tags': matching_tags,
+            })
+        return results
+    
+    @staticmethod
+    def _get_item_cf_scores(history_product_ids, tag_index, store_id=None):
+        """
+        以離線協同過濾模型為用戶打分（正規化至 0~1）
+        沒有模型或權重為 0 時返回空字典
+        """
+        if not history_product_ids or getattr(settings, 'ITEM_CF_BLEND_WEIGHT', 0.0) <= 0:
+            return {}
+        scorer = get_scorer()
+        if scorer is None:
+            return {}
         
-        # 按匹配度排序
-        recommended_products.sort(key=lambda x: x['score'], reverse=True)
+        # 只保留目前可售（在索引中）且符合店家條件的商品
+        if store_id is not None:
+            candidate_ids = tag_index.store_product_ids.get(store_id, set())
+        else:
+            candidate_ids = tag_index.product_store.keys()
+        scores = scorer.score(history_product_ids, candidate_ids=candidate_ids)
+        if not scores:
+            return {}
         
-        return recommended_products[:limit]
+        top_score = max(scores.values())
+        return {product_id: score / top_score for product_id, score in scores.items()}
     
     @staticmethod
     def get_popular_products(store=None, limit=10):
@@ -159,38 +213,131 @@ class RecommendationService:
         if not product.food_tags:
             return []
         
-        similar_products = []
+        similar = get_tag_index().similar_products(
+            product.id,
+            product.food_tags,
+            product.store_id,
+            limit=limit,
+        )
+        products = Product.objects.filter(
+            id__in=[product_id for product_id, _, _ in similar],
+            is_available=True,
+        )
+        product_by_id = {p.id: p for p in products}
         
-        for p in Product.objects.filter(
-            store=product.store,
-            is_available=True
-        ).exclude(id=product.id):
-            if not p.food_tags:
-                continue
-            
-            # 計算標籤重疊度（改為包含匹配）
-            common_tags = []
-            for p_tag in p.food_tags:
-                for prod_tag in product.food_tags:
-                    # 如果標籤互相包含
-                    if prod_tag in p_tag or p_tag in prod_tag:
-                        common_tags.append(p_tag)
-                        break
-            
-            if common_tags:
-                # 計算相似度：共同標籤數 / 所有標籤數
-                all_tags = set(product.food_tags + p.food_tags)
-                similarity = len(common_tags) / len(all_tags)
-                similar_products.append({
-                    'product': p,
-                    'similarity': similarity,
-                    'common_tags': common_tags
-                })
+        return [
+            {
+                'product': product_by_id[product_id],
+                'similarity': similarity,
+                'common_tags': common_tags,
+            }
+            for product_id, similarity, common_tags in similar
+            if product_id in product_by_id
+        ]
+    
+    @staticmethod
+    def get_precomputed_similar_products(product_id, limit=5):
+        """
+        讀取離線計算的相似商品（鄰居清單快取優先，再以一次查詢取得仍上架的商品）
+        返回 None 表示此商品尚未有預先計算結果（或鄰居皆已下架）
+        """
+        cache_key = SIMILAR_PRODUCTS_CACHE_KEY.format(product_id=product_id)
+        # 快取只保存商品 ID 與分數，商品本身每次重新讀取，上下架與價格變更立即反映
+        rows = cache.get(cache_key)
+        if rows is None:
+            rows = list(
+                ProductSimilarity.objects.filter(
+                    product_id=product_id,
+                    product__is_available=True,
+                ).order_by('rank').values_list('similar_product_id', 'score', 'common_tags')[:PRECOMPUTED_SIMILAR_PRODUCTS_LIMIT]
+            )
+            cache.set(cache_key, rows, SIMILAR_PRODUCTS_CACHE_TTL_SECONDS)
         
-        # 按相似度排序
-        similar_products.sort(key=lambda x: x['similarity'], reverse=True)
+        if not rows:
+            return None
+        product_by_id = Product.objects.filter(
+            id__in=[similar_product_id for similar_product_id, _, _ in rows],
+            is_available=True,
+        ).in_bulk()
+        similar = [
+            {
+                'product': product_by_id[similar_product_id],
+                'similarity': score,
+                'common_tags': common_tags,
+            }
+            for similar_product_id, score, common_tags in rows
+            if similar_product_id in product_by_id
+        ]
+        return similar[:limit] or None
+    
+    @staticmethod
+    def _get_precomputed_row(user_id, kind, store_id=None):
+        return UserRecommendation.objects.filter(
+            user_id=user_id,
+            kind=kind,
+            store_id=store_id,
+            expires_at__gt=timezone.now(),
+        ).order_by('-computed_at').first()
+    
+    @staticmethod
+    def get_precomputed_recommended_products(user, limit=10):
+        """
+        讀取批次預先計算的推薦商品
+        返回 None 表示沒有有效結果（尚未計算、已過期或 limit 超出預先計算數量）
+        """
+        if limit > PRECOMPUTED_PRODUCT_LIMIT:
+            return None
+        row = RecommendationService._get_precomputed_row(user.id, 'products')
+        if row is None:
+            return None
         
-        return similar_products[:limit]
+        items = row.items[:limit]
+        products = Product.objects.filter(
+            id__in=[item['id'] for item in items],
+            is_available=True,
+        )
+        product_by_id = {product.id: product for product in products}
+        return [
+            {
+                'product': product_by_id[item['id']],
+                'score': item.get('score', 0),
+                'cf_score': item.get('cf_score', 0.0),
+                'matching_tags': item.get('matching_tags', []),
+            }
+            for item in items
+            if item['id'] in product_by_id
+        ]
+    
+    @staticmethod
+    def get_precomputed_recommended_stores(user, limit=5):
+        """讀取批次預先計算的推薦店家，返回 None 表示需即時計算。"""
+        if limit > PRECOMPUTED_STORE_LIMIT:
+            return None
+        row = RecommendationService._get_precomputed_row(user.id, 'stores')
+        if row is None:
+            return None
+        
+        store_ids = [item['id'] for item in row.items[:limit]]
+        store_by_id = {
+            store.id: store
+            for store in _published_store_base_queryset().filter(id__in=store_ids)
+        }
+        return [store_by_id[store_id] for store_id in store_ids if store_id in store_by_id]
+    
+    @staticmethod
+    def get_precomputed_store_profile(user_id, store_id):
+        """
+        讀取用戶在指定店家的偏好輪廓
+        返回 (top_tags, top_category_ids, top_category_names)，皆依偏好程度排序；沒有有效結果時返回 None
+        """
+        row = RecommendationService._get_precomputed_row(user_id, 'store_profile', store_id=store_id)
+        if row is None:
+            return None
+        return (
+            list(row.items),
+            list(row.context.get('category_ids', [])),
+            list(row.context.get('category_names', [])),
+        )
     
     @staticmethod
     def get_store_recommendations_for_user(user, limit=5, selected_tags=None):
@@ -214,71 +361,18 @@ class RecommendationService:
         # 如果用戶選擇了特定標籤，使用選擇的標籤；否則使用所有喜好標籤
         if selected_tags and len(selected_tags) > 0:
             favorite_tags = selected_tags
-            logger.warning(f"[推薦服務] 使用用戶選擇的標籤: {favorite_tags}")
         else:
             # 提取標籤名稱
             favorite_tags = [item['tag'] for item in favorite_tag_data]
-            logger.warning(f"[推薦服務] 用戶喜好標籤: {favorite_tags}")
-        print(f"[推薦服務] 用戶喜好標籤: {favorite_tags}", flush=True)
         
-        # 找出有相關商品的店家並計算匹配度
-        stores_with_score = []
-        all_stores = _published_store_base_queryset().prefetch_related(
-            Prefetch(
-                'products',
-                queryset=Product.objects.filter(is_available=True).only('id', 'store_id', 'name', 'food_tags'),
-                to_attr='available_products',
-            )
-        )
-        
-        all_stores = list(all_stores)
-        logger.warning(f"[推薦服務] 總共 {len(all_stores)} 間已發布的店家")
-        
-        for store in all_stores:
-            matching_products = getattr(store, 'available_products', [])
-            
-            total_score = 0
-            product_count = len(matching_products)
-            
-            logger.warning(f"[店家] {store.name} - 商品數: {product_count}")
-            print(f"\n[店家] {store.name} - 商品數: {product_count}", flush=True)
-            
-            for product in matching_products:
-                if product.food_tags:
-                    # 只記錄一次商品信息
-                    logger.warning(f"  商品: {product.name}, food_tags: {product.food_tags}, 類型: {type(product.food_tags)}")
-                    print(f"  商品: {product.name}, food_tags: {product.food_tags}, 類型: {type(product.food_tags)}", flush=True)
-                    
-                    # 改為包含匹配：檢查商品標籤中是否包含用戶喜好標籤的字段
-                    matched_in_this_product = set()  # 記錄已匹配的喜好標籤，避免重複計分
-                    for product_tag in product.food_tags:
-                        for favorite_tag in favorite_tags:
-                            # 如果商品標籤包含喜好標籤（例如："素食便當" 包含 "素食"）
-                            if favorite_tag in product_tag and favorite_tag not in matched_in_this_product:
-                                logger.warning(f"    ✓ 匹配標籤: '{product_tag}' 包含 '{favorite_tag}'")
-                                print(f"    ✓ 匹配標籤: '{product_tag}' 包含 '{favorite_tag}'", flush=True)
-                                total_score += 1
-                                matched_in_this_product.add(favorite_tag)
-                                break  # 避免同一個商品標籤重複計分
-            
-            logger.warning(f"  最終分數: {total_score}")
-            print(f"  最終分數: {total_score}", flush=True)
-            
-            # 所有店家都加入列表，但有匹配的店家分數更高
-            stores_with_score.append({
-                'store': store,
-                'score': total_score,
-                'product_count': product_count
-            })
-        
-        # 按分數排序（分數高的優先），分數相同則按商品數量排序
-        stores_with_score.sort(key=lambda x: (x['score'], x['product_count']), reverse=True)
+        # 透過標籤倒排索引計算店家匹配度（分數相同則按商品數量排序）
+        ranked = get_tag_index().rank_stores(favorite_tags, limit=limit)
+        logger.debug('[推薦服務] 喜好標籤=%s 排序結果=%s', favorite_tags, ranked)
         
-        logger.warning(f"[排序結果]")
-        print(f"\n[排序結果]", flush=True)
-        for item in stores_with_score[:limit]:
-            logger.warning(f"  {item['store'].name}: 分數={item['score']}, 商品數={item['product_count']}")
-            print(f"  {item['store'].name}: 分數={item['score']}, 商品數={item['product_count']}", flush=True)
+        stores = _published_store_base_queryset().filter(
+            id__in=[store_id for store_id, _, _ in ranked]
+        )
+        store_by_id = {store.id: store for store in stores}
         
         # 返回前 limit 個店家（包含有匹配和無匹配的）
-        return [item['store'] for item in stores_with_score[:limit]]
+        return [store_by_id[store_id] for store_id, _, _ in ranked if store_id in store_by_id]
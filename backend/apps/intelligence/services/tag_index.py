@@ -0,0 +1,262 @@
+"""
+食物標籤倒排索引
+
+將可售商品的食物標籤預先展開成子字串（n-gram），建立
+「標籤片段 -> 商品 ID」與「完整標籤 -> 商品 ID」兩份索引，
+讓推薦查詢只需少量字典查找即可取得候選商品，不必每次掃描所有店家與商品。
+
+索引以行程內快取保存，並以共享 cache 中的版本號判斷是否需要重建；
+商品或店家異動時由 signals 呼叫 invalidate_tag_index() 讓各行程重建。
+"""
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+TAG_INDEX_VERSION_CACHE_KEY = 'intelligence:tag_index:version'
+# 保險機制：即使遺漏失效通知，索引最多使用這麼久就會重建。
+TAG_INDEX_MAX_AGE_SECONDS = 600
+
+_index_lock = threading.Lock()
+_index = None
+_index_version = None
+_index_built_at = 0.0
+
+
+def normalize_tag(tag) -> str:
+    """標籤正規化：去除空白並轉小寫。"""
+    return re.sub(r'\s+', '', str(tag or '')).lower()
+
+
+def iter_substrings(text: str):
+    """列出字串所有不重複的連續子字串（含本身）。"""
+    seen = set()
+    length = len(text)
+    for start in range(length):
+        for end in range(start + 1, length + 1):
+            fragment = text[start:end]
+            if fragment not in seen:
+                seen.add(fragment)
+                yield fragment
+
+
+class TagIndex:
+    """
+    商品標籤倒排索引
+
+    Args:
+        product_rows: 可迭代的 (product_id, store_id, food_tags)
+        published_store_ids: 已上架店家 ID（包含沒有可售商品的店家）
+    """
+
+    def __init__(self, product_rows, published_store_ids=()):
+        self.product_store = {}
+        self.product_tags = {}
+        self.store_product_ids = defaultdict(set)
+        # 標籤片段 -> 擁有「包含此片段之標籤」的商品
+        self.fragment_index = defaultdict(set)
+        # 完整標籤 -> 擁有此標籤的商品
+        self.exact_index = defaultdict(set)
+
+        for product_id, store_id, food_tags in product_rows:
+            tags = tuple(
+                normalized
+                for normalized in (normalize_tag(tag) for tag in (food_tags or []))
+                if normalized
+            )
+            self.product_store[product_id] = store_id
+            self.product_tags[product_id] = tags
+            self.store_product_ids[store_id].add(product_id)
+
+            for tag in tags:
+                self.exact_index[tag].add(product_id)
+                for fragment in iter_substrings(tag):
+                    self.fragment_index[fragment].add(product_id)
+
+        self.published_store_ids = set(published_store_ids)
+        # 未匹配任何標籤時的補位順序：商品數多者優先
+        self.stores_by_product_count = sorted(
+            self.published_store_ids,
+            key=lambda store_id: len(self.store_product_ids.get(store_id, ())),
+            reverse=True,
+        )
+
+    def _candidates(self, tags, bidirectional):
+        """取得可能與任一標籤匹配的候選商品。"""
+        candidates = set()
+        for tag in tags:
+            candidates |= self.fragment_index.get(tag, set())
+            if bidirectional:
+                for fragment in iter_substrings(tag):
+                    candidates |= self.exact_index.get(fragment, set())
+        return candidates
+
+    def match_products(self, favorite_tags, store_id=None, exclude_ids=()):
+        """
+        以包含匹配（雙向）計算商品與喜好標籤的匹配度
+
+        Returns:
+            dict: {product_id: (score, matching_tags)}
+        """
+        favorites = [tag for tag in (normalize_tag(tag) for tag in favorite_tags) if tag]
+        if not favorites:
+            return {}
+
+        exclude_ids = set(exclude_ids)
+        results = {}
+        for product_id in self._candidates(favorites, bidirectional=True):
+            if product_id in exclude_ids:
+                continue
+            if store_id is not None and self.product_store.get(product_id) != store_id:
+                continue
+
+            matching_tags = []
+            for product_tag in self.product_tags.get(product_id, ()):
+                for favorite_tag in favorites:
+                    if favorite_tag in product_tag or product_tag in favorite_tag:
+                        matching_tags.append(product_tag)
+                        break
+            if matching_tags:
+                results[product_id] = (len(matching_tags), matching_tags)
+        return results
+
+    def rank_stores(self, favorite_tags, limit=5):
+        """
+        依喜好標籤為已上架店家排序
+
+        商品標籤包含喜好標籤即計分，同一商品的同一喜好標籤只計一次；
+        分數相同時以可售商品數排序，匹配不足時以商品數多的店家補位。
+
+        Returns:
+            list: [(store_id, score, product_count), ...]
+        """
+        favorites = [tag for tag in (normalize_tag(tag) for tag in favorite_tags) if tag]
+        store_scores = defaultdict(int)
+
+        for product_id in self._candidates(favorites, bidirectional=False):
+            store_id = self.product_store.get(product_id)
+            if store_id not in self.published_store_ids:
+                continue
+
+            matched = set()
+            for product_tag in self.product_tags.get(product_id, ()):
+                for favorite_tag in favorites:
+                    if favorite_tag in product_tag and favorite_tag not in matched:
+                        matched.add(favorite_tag)
+                        break
+            if matched:
+                store_scores[store_id] += len(matched)
+
+        ranked = sorted(
+            (
+                (store_id, score, len(self.store_product_ids.get(store_id, ())))
+                for store_id, score in store_scores.items()
+            ),
+            key=lambda item: (item[1], item[2]),
+            reverse=True,
+        )[:limit]
+
+        if len(ranked) < limit:
+            for store_id in self.stores_by_product_count:
+                if store_id in store_scores:
+                    continue
+                ranked.append((store_id, 0, len(self.store_product_ids.get(store_id, ()))))
+                if len(ranked) >= limit:
+                    break
+
+        return ranked
+
+    def similar_products(self, product_id, food_tags, store_id, limit=5):
+        """
+        找出同店家中標籤互相包含的商品
+
+        Returns:
+            list: [(product_id, similarity, common_tags), ...]
+        """
+        source_tags = [tag for tag in (normalize_tag(tag) for tag in (food_tags or [])) if tag]
+        if not source_tags:
+            return []
+
+        similar = []
+        for candidate_id in self._candidates(source_tags, bidirectional=True):
+            if candidate_id == product_id or self.product_store.get(candidate_id) != store_id:
+                continue
+
+            candidate_tags = self.product_tags.get(candidate_id, ())
+            common_tags = []
+            for candidate_tag in candidate_tags:
+                for source_tag in source_tags:
+                    if source_tag in candidate_tag or candidate_tag in source_tag:
+                        common_tags.append(candidate_tag)
+                        break
+            if common_tags:
+                all_tags = set(source_tags) | set(candidate_tags)
+                similar.append((candidate_id, len(common_tags) / len(all_tags), common_tags))
+
+        similar.sort(key=lambda item: (item[1], item[0]), reverse=True)
+        return similar[:limit]
+
+
+def build_tag_index() -> TagIndex:
+    """從資料庫建立索引（只讀取必要欄位）。"""
+    from apps.products.models import Product
+    from apps.stores.models import Store
+
+    started = time.monotonic()
+    product_rows = Product.objects.filter(is_available=True).values_list('id', 'store_id', 'food_tags')
+    published_store_ids = Store.objects.filter(is_published=True).values_list('id', flat=True)
+    index = TagIndex(product_rows.iterator(chunk_size=2000), published_store_ids)
+    logger.info(
+        '[TagIndex] built: products=%s fragments=%s stores=%s elapsed=%.1fms',
+        len(index.product_tags),
+        len(index.fragment_index),
+        len(index.published_store_ids),
+        (time.monotonic() - started) * 1000,
+    )
+    return index
+
+
+def _current_version():
+    version = cache.get(TAG_INDEX_VERSION_CACHE_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(TAG_INDEX_VERSION_CACHE_KEY, version, None):
+            version = cache.get(TAG_INDEX_VERSION_CACHE_KEY, version)
+    return version
+
+
+def get_tag_index() -> TagIndex:
+    """取得目前的索引，版本變更或逾時才重建。"""
+    global _index, _index_version, _index_built_at
+
+    version = _current_version()
+    is_fresh = (
+        _index is not None
+        and _index_version == version
+        and time.monotonic() - _index_built_at < TAG_INDEX_MAX_AGE_SECONDS
+    )
+    if is_fresh:
+        return _index
+
+    with _index_lock:
+        if (
+            _index is not None
+            and _index_version == version
+            and time.monotonic() - _index_built_at < TAG_INDEX_MAX_AGE_SECONDS
+        ):
+            return _index
+        _index = build_tag_index()
+        _index_version = version
+        _index_built_at = time.monotonic()
+        return _index
+
+
+def invalidate_tag_index():
+    """通知所有行程在下次查詢時重建索引。"""
+    cache.set(TAG_INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
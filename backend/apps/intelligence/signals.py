@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.orders.models import DineInOrder, TakeoutOrder
+from apps.products.models import Product
+from apps.stores.models import Store
+
+from .services.recommendation_batch_service import invalidate_user_recommendations
+from .services.tag_index import invalidate_tag_index
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed_invalidate_tag_index(sender, instance, **kwargs):
+    """商品新增、修改、刪除後重建標籤索引（交易提交後才通知）。"""
+    transaction.on_commit(invalidate_tag_index)
+
+
+@receiver(post_save, sender=Store)
+@receiver(post_delete, sender=Store)
+def store_changed_invalidate_tag_index(sender, instance, **kwargs):
+    """店家上下架會影響推薦範圍，同樣需要重建索引。"""
+    transaction.on_commit(invalidate_tag_index)
+
+
+@receiver(post_save, sender=TakeoutOrder)
+@receiver(post_save, sender=DineInOrder)
+def order_created_invalidate_user_recommendations(sender, instance, created, **kwargs):
+    """新訂單會改變用戶偏好，清除預先計算結果直到下次批次。"""
+    if not created or not instance.user_id:
+        return
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_user_recommendations(user_id))
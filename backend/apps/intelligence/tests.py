@@ -0,0 +1,419 @@
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import numpy as np
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from apps.intelligence.ml_models.evaluation import evaluate_item_cf
+from apps.intelligence.ml_models.item_cf import (
+    build_interaction_matrix,
+    load_model,
+    save_model,
+    train_item_cf,
+)
+from apps.intelligence.models import (
+    PersonalizedRecommendationPushLog,
+    PlatformSettings,
+    SchedulerLease,
+    SchedulerRun,
+    UserRecommendation,
+)
+from apps.intelligence.leases import ensure_lease_held
+from apps.intelligence.scheduler import ScheduledJob, run_due_jobs, try_acquire_lease
+from apps.intelligence.services.demand_forecast_service import (
+    HOURS_PER_WEEK,
+    backtest,
+    compute_required_staff,
+    fit_seasonal_profiles,
+    forecast_from_profiles,
+)
+from apps.intelligence.services.line_recommendation_push_service import LineRecommendationPushService
+from apps.intelligence.services.product_similarity_service import compute_top_k_neighbors, rebuild_store_similarities
+from apps.intelligence.services.recommendation_batch_service import run_recommendation_batch
+from apps.intelligence.services.recommendation_service import RecommendationService
+from apps.intelligence.services.tag_index import TagIndex
+from apps.orders.models import TakeoutOrder, TakeoutOrderItem
+from apps.products.models import Product
+from apps.stores.models import Store
+from apps.users.models import Merchant, User
+
+
+class TagIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = TagIndex(
+            [
+                (1, 10, ['素食便當', '健康']),
+                (2, 10, ['素食']),
+                (3, 10, ['辣', '牛肉']),
+                (4, 20, ['重辣', '雞肉']),
+                (5, 20, []),
+            ],
+            published_store_ids=[10, 20, 30],
+        )
+
+    def test_match_products_uses_containment_in_both_directions(self):
+        matches = self.index.match_products(['素食便當'])
+
+        self.assertEqual(matches[1], (1, ['素食便當']))
+        # 商品標籤「素食」被喜好標籤「素食便當」包含
+        self.assertEqual(matches[2], (1, ['素食']))
+        self.assertNotIn(3, matches)
+
+    def test_match_products_filters_store_and_excluded_ids(self):
+        matches = self.index.match_products(['辣'], store_id=20, exclude_ids=[3])
+
+        self.assertEqual(set(matches), {4})
+
+    def test_rank_stores_scores_matches_and_fills_with_remaining_stores(self):
+        ranked = self.index.rank_stores(['辣', '素食'], limit=3)
+
+        self.assertEqual(ranked[0], (10, 3, 3))
+        self.assertEqual(ranked[1], (20, 1, 2))
+        # 沒有可售商品的已上架店家仍會補位
+        self.assertEqual(ranked[2], (30, 0, 0))
+
+    def test_similar_products_stay_within_store(self):
+        similar = self.index.similar_products(2, ['素食'], store_id=10)
+
+        self.assertEqual(len(similar), 1)
+        product_id, similarity, common_tags = similar[0]
+        self.assertEqual(product_id, 1)
+        self.assertAlmostEqual(similarity, 1 / 3)
+        self.assertEqual(common_tags, ['素食便當'])
+
+
+class ProductSimilarityComputationTests(SimpleTestCase):
+    def test_jaccard_neighbors_include_containment_matches(self):
+        neighbors = compute_top_k_neighbors(
+            [
+                (1, ['素食便當']),
+                (2, ['素食']),
+                (3, ['辣', '牛肉']),
+                (4, ['牛肉']),
+            ],
+            top_k=2,
+        )
+
+        self.assertEqual(neighbors[2], [(1, 0.5, ['素食便當'])])
+        self.assertEqual(neighbors[4], [(3, 0.5, ['牛肉'])])
+        self.assertNotIn(1, [neighbor_id for neighbor_id, _, _ in neighbors[3]])
+
+    def test_rejects_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            compute_top_k_neighbors([(1, ['辣']), (2, ['辣'])], metric='euclidean')
+
+
+class ItemCFTests(SimpleTestCase):
+    interactions = [
+        # 用戶 1、2 都買了 10 與 11，用戶 3 買了 10 與 12
+        (1, 10, 1), (1, 11, 2),
+        (2, 10, 1), (2, 11, 1),
+        (3, 10, 1), (3, 12, 1),
+        (4, 13, 1),
+    ]
+
+    def test_co_purchased_products_rank_first(self):
+        matrix, _, product_ids = build_interaction_matrix(self.interactions)
+        model = train_item_cf(matrix, product_ids, top_k=2)
+
+        scores = model.score([10])
+
+        self.assertEqual(max(scores, key=scores.get), 11)
+        self.assertIn(12, scores)
+        self.assertNotIn(10, scores)
+        self.assertNotIn(13, scores)
+
+    def test_saved_artifacts_load_memory_mapped(self):
+        matrix, _, product_ids = build_interaction_matrix(self.interactions)
+        model = train_item_cf(matrix, product_ids, top_k=2)
+
+        with tempfile.TemporaryDirectory() as root:
+            version = save_model(model, root=root)
+            loaded = load_model(root=root)
+
+            self.assertEqual(loaded.meta['version'], version)
+            self.assertEqual(loaded.score([10], candidate_ids=[12]), {12: model.score([10])[12]})
+            del loaded
+
+    def test_evaluation_reports_metrics(self):
+        report = evaluate_item_cf(self.interactions, k=2, top_k=2)
+
+        self.assertEqual(report['evaluated_users'], 3)
+        for key in ('precision_at_k', 'training_seconds', 'training_peak_memory_mb'):
+            self.assertIn(key, report)
+
+
+class UserRecommendationBatchTests(TestCase):
+    def setUp(self):
+        merchant_user = User.objects.create_user(
+            email='merchant@example.com',
+            password='password',
+            firebase_uid='merchant-test-uid',
+            username='Merchant',
+            user_type='merchant',
+        )
+        merchant = Merchant.objects.create(
+            user=merchant_user,
+            company_account='12345678',
+            plan='basic',
+        )
+        self.store = Store.objects.create(
+            merchant=merchant,
+            name='Test Store',
+            cuisine_type='other',
+            address='Test Address',
+            phone='0212345678',
+            is_published=True,
+        )
+        self.customer = User.objects.create_user(
+            email='customer@example.com',
+            password='password',
+            firebase_uid='customer-test-uid',
+            username='Customer',
+        )
+        ordered, self.spicy_beef, _ = [
+            Product.objects.create(
+                merchant=merchant,
+                store=self.store,
+                name=name,
+                price=Decimal('100'),
+                food_tags=tags,
+            )
+            for name, tags in (('辣味雞飯', ['辣']), ('麻辣牛肉麵', ['麻辣', '牛肉']), ('甜點', ['甜']))
+        ]
+        order = TakeoutOrder.objects.create(
+            store=self.store,
+            user=self.customer,
+            customer_name='Customer',
+            customer_phone='0912345678',
+            pickup_at=timezone.now(),
+            payment_method='cash',
+            pickup_number='T0001',
+        )
+        TakeoutOrderItem.objects.create(order=order, product=ordered, quantity=2)
+
+    def test_batch_results_are_served_until_next_order(self):
+        summary = run_recommendation_batch(user_ids=[self.customer.id])
+
+        self.assertEqual(summary['users_count'], 1)
+        products = RecommendationService.get_precomputed_recommended_products(self.customer, limit=5)
+        self.assertEqual([item['product'] for item in products], [self.spicy_beef])
+        self.assertEqual(products[0]['matching_tags'], ['麻辣'])
+        self.assertEqual(
+            RecommendationService.get_precomputed_store_profile(self.customer.id, self.store.id)[0],
+            ['辣'],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TakeoutOrder.objects.create(
+                store=self.store,
+                user=self.customer,
+                customer_name='Customer',
+                customer_phone='0912345678',
+                pickup_at=timezone.now(),
+                payment_method='cash',
+                pickup_number='T0002',
+            )
+        self.assertIsNone(RecommendationService.get_precomputed_recommended_products(self.customer, limit=5))
+
+    def test_personalized_contents_are_built_in_bulk(self):
+        contents = LineRecommendationPushService.build_personalized_contents([self.customer.id])
+
+        store_ids, labels = contents[self.customer.id]
+        self.assertEqual(store_ids, [self.store.id])
+        self.assertEqual(labels[0], '辣')
+
+    def test_eligibility_uses_aggregated_push_stats(self):
+        platform_settings = PlatformSettings.get_settings()
+        platform_settings.is_personalized_recommendation_enabled = True
+        platform_settings.personalized_recommendation_min_interval_minutes = 60
+        platform_settings.personalized_recommendation_weekly_limit = 2
+        platform_settings.save()
+        PersonalizedRecommendationPushLog.objects.create(
+            user=self.customer,
+            line_user_id='U-customer',
+            push_type='personalized',
+            status='success',
+        )
+
+        service = LineRecommendationPushService()
+        now = timezone.now()
+        push_stats = service._load_personalized_push_stats(now)
+        binding = SimpleNamespace(user_id=self.customer.id, notify_personalized_recommendation=True)
+
+        self.assertEqual(push_stats[self.customer.id][1], 1)
+        self.assertEqual(
+            service._is_personalized_eligible(binding, now, push_stats),
+            (False, 'min_interval_not_reached'),
+        )
+        self.assertEqual(
+            service._is_personalized_eligible(binding, now + timedelta(hours=2), push_stats),
+            (True, ''),
+        )
+
+    def test_expired_rows_are_ignored(self):
+        run_recommendation_batch(user_ids=[self.customer.id])
+        UserRecommendation.objects.update(expires_at=timezone.now())
+
+        self.assertIsNone(RecommendationService.get_precomputed_recommended_stores(self.customer, limit=5))
+
+    def test_cached_similar_products_are_reloaded(self):
+        cache.clear()
+        hotpot = Product.objects.create(
+            merchant=self.store.merchant,
+            store=self.store,
+            name='麻辣鍋',
+            price=Decimal('300'),
+            food_tags=['麻辣'],
+        )
+        rebuild_store_similarities(self.store.id)
+
+        similar = RecommendationService.get_precomputed_similar_products(self.spicy_beef.id)
+        self.assertEqual(similar[0]['product'], hotpot)
+
+        Product.objects.filter(id=hotpot.id).update(price=Decimal('350'))
+        similar = RecommendationService.get_precomputed_similar_products(self.spicy_beef.id)
+        self.assertEqual(similar[0]['product'].price, Decimal('350'))
+
+        Product.objects.filter(id=hotpot.id).update(is_available=False)
+        similar = RecommendationService.get_precomputed_similar_products(self.spicy_beef.id)
+        self.assertNotIn(hotpot, [item['product'] for item in similar])
+
+
+class DemandForecastTests(SimpleTestCase):
+    def test_profiles_follow_weekly_seasonality(self):
+        week = np.zeros(HOURS_PER_WEEK, dtype=np.float32)
+        week[12] = 10  # 週一中午
+        week[24 * 5 + 18] = 20  # 週六晚餐
+        history = np.tile(week, (2, 4))
+        history[1] *= 2
+
+        profiles, alphas = fit_seasonal_profiles(history)
+        forecasts = forecast_from_profiles(profiles, horizon_hours=HOURS_PER_WEEK + 24)
+
+        np.testing.assert_allclose(forecasts[0, :HOURS_PER_WEEK], week)
+        np.testing.assert_allclose(forecasts[1, HOURS_PER_WEEK + 12], 20)
+        self.assertEqual(len(alphas), 2)
+
+    def test_backtest_reports_model_and_baseline(self):
+        history = np.tile(np.arange(HOURS_PER_WEEK, dtype=np.float32) % 5, (3, 3))
+
+        report = backtest(history)
+
+        self.assertEqual(report['model']['wape'], 0.0)
+        self.assertIn('seasonal_naive', report)
+
+    def test_required_staff_uses_capacity_and_minimum(self):
+        expected = np.array([[0.0, 3.0, 25.0], [0.0, 3.0, 25.0]], dtype=np.float32)
+
+        required = compute_required_staff(expected, capacities=[10, 20], min_staff=[2, 0])
+
+        np.testing.assert_array_equal(required, [[0, 2, 3], [0, 1, 2]])
+
+
+
+class SchedulerLeaseTests(TestCase):
+    def test_only_one_owner_runs_a_due_job(self):
+        calls = []
+        job = ScheduledJob('test_job', lambda: calls.append(1) or {'ok': True}, interval_seconds=600)
+
+        now = timezone.now()
+        self.assertTrue(try_acquire_lease(job.name, 'worker-a', 300, now=now))
+        self.assertFalse(try_acquire_lease(job.name, 'worker-b', 300, now=now))
+
+        # 租約到期（持有者中斷）後其他行程可以接手
+        self.assertTrue(try_acquire_lease(job.name, 'worker-b', 300, now=now + timedelta(seconds=301)))
+
+    def test_run_records_history_and_schedules_next_run(self):
+        calls = []
+        job = ScheduledJob('test_job', lambda: calls.append(1) or {'sent': 3}, interval_seconds=600, jitter_seconds=60)
+
+        runs = run_due_jobs([job], 'worker-a')
+        self.assertEqual(run_due_jobs([job], 'worker-b'), [])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(runs[0].status, 'success')
+        self.assertEqual(runs[0].summary, {'sent': 3})
+        self.assertIsNotNone(runs[0].duration_seconds)
+
+        lease = SchedulerLease.objects.get(name='test_job')
+        self.assertEqual(lease.owner, '')
+        delay = (lease.next_run_at - runs[0].finished_at).total_seconds()
+        self.assertTrue(600 <= delay <= 660)
+
+    def test_worker_that_lost_its_lease_stops_writing(self):
+        writes = []
+
+        def long_job():
+            # 租約在執行中到期並由其他行程取得
+            SchedulerLease.objects.filter(name='test_job').update(
+                expires_at=timezone.now() - timedelta(seconds=1),
+            )
+            self.assertTrue(try_acquire_lease('test_job', 'worker-b', 300))
+            ensure_lease_held()
+            writes.append(1)
+            return {'written': 1}
+
+        job = ScheduledJob('test_job', long_job, interval_seconds=600)
+        runs = run_due_jobs([job], 'worker-a')
+
+        self.assertEqual(writes, [])
+        self.assertEqual(runs[0].status, 'failed')
+        self.assertIn('worker-a', runs[0].error_message)
+        lease = SchedulerLease.objects.get(name='test_job')
+        self.assertEqual((lease.owner, lease.fencing_token), ('worker-b', 2))
+
+    def test_failed_job_is_recorded_and_released(self):
+        def broken():
+            raise RuntimeError('boom')
+
+        job = ScheduledJob('broken_job', broken, interval_seconds=60)
+
+        run_due_jobs([job], 'worker-a')
+
+        run = SchedulerRun.objects.get(job_name='broken_job')
+        self.assertEqual(run.status, 'failed')
+        self.assertEqual(run.error_message, 'boom')
+        self.assertEqual(SchedulerLease.objects.get(name='broken_job').owner, '')
+
+
+class PlatformSettingsCacheTests(TestCase):
+    def setUp(self):
+        PlatformSettings.objects.get_or_create(pk=1)
+        PlatformSettings.clear_cache()
+
+    def test_reads_are_served_from_process_copy(self):
+        first = PlatformSettings.get_settings()
+        with self.assertNumQueries(0):
+            second = PlatformSettings.get_settings()
+
+        self.assertIsNot(first, second)
+        second.line_bot_welcome_message = 'changed locally'
+        self.assertEqual(PlatformSettings.get_settings().line_bot_welcome_message, first.line_bot_welcome_message)
+
+    def test_save_invalidates_cached_copy(self):
+        platform_settings = PlatformSettings.get_settings()
+        with self.captureOnCommitCallbacks(execute=True):
+            platform_settings.line_bot_welcome_message = '歡迎光臨'
+            platform_settings.save()
+            # 提交前同一執行緒直接讀資料庫，看得到尚未提交的修改
+            self.assertEqual(PlatformSettings.get_settings().line_bot_welcome_message, '歡迎光臨')
+
+        # 提交後重新載入一次，之後由行程內副本提供
+        with self.assertNumQueries(1):
+            PlatformSettings.get_settings()
+        with self.assertNumQueries(0):
+            self.assertEqual(PlatformSettings.get_settings().line_bot_welcome_message, '歡迎光臨')
+
+    def test_process_copy_is_reloaded_after_max_age(self):
+        PlatformSettings.get_settings()
+        # 其他行程直接修改資料庫、版本號通知未送達（例如沒有共用快取）
+        PlatformSettings.objects.filter(pk=1).update(line_bot_welcome_message='其他行程的修改')
+        self.assertNotEqual(PlatformSettings.get_settings().line_bot_welcome_message, '其他行程的修改')
+
+        with override_settings(PLATFORM_SETTINGS_CACHE_SECONDS=0):
+            self.assertEqual(PlatformSettings.get_settings().line_bot_welcome_message, '其他行程的修改')
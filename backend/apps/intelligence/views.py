@@ -17,6 +17,7 @@ from .serializers import (
 from .models import PlatformSettings
 from apps.stores.models import Store
 from apps.orders.models import TakeoutOrder, DineInOrder
+from apps.users.middleware import get_request_store
 import logging
 
 
@@ -64,12 +65,19 @@ class RecommendationViewSet(viewsets.ViewSet):
                     'detail': '店家不存在'
                 }, status=status.HTTP_404_NOT_FOUND)
         
-        # 獲取推薦
-        recommendations = RecommendationService.get_recommended_products_by_tags(
-            user=request.user,
-            store=store,
-            limit=limit
-        )
+        # 獲取推薦（全平台推薦優先讀取批次預先計算結果）
+        recommendations = None
+        if store is None:
+            recommendations = RecommendationService.get_precomputed_recommended_products(
+                request.user,
+                limit=limit
+            )
+        if recommendations is None:
+            recommendations = RecommendationService.get_recommended_products_by_tags(
+                user=request.user,
+                store=store,
+                limit=limit
+            )
         
         serializer = RecommendedProductSerializer(recommendations, many=True)
         return Response(serializer.data)
@@ -83,12 +91,8 @@ class RecommendationViewSet(viewsets.ViewSet):
         - limit: 返回數量（預設5）
         - tags: 可選，用戶選擇的標籤（逗號分隔，例如：tags=素食,辣）
         """
-        logger.warning(f"=== 推薦店家 API 被調用 ===")
-        logger.warning(f"用戶: {request.user}, 已認證: {request.user.is_authenticated}")
-        
         if not request.user.is_authenticated:
             # 未登入用戶返回熱門店家
-            logger.warning("用戶未登入，返回熱門店家")
             stores = Store.objects.filter(
                 is_published=True
             ).order_by('-created_at')[:5]
@@ -104,19 +108,20 @@ class RecommendationViewSet(viewsets.ViewSet):
         selected_tags = None
         if selected_tags_str:
             selected_tags = [tag.strip() for tag in selected_tags_str.split(',') if tag.strip()]
-            logger.warning(f"用戶選擇的標籤: {selected_tags}")
         
-        logger.warning(f"開始為用戶 {request.user.username} 生成推薦，limit={limit}")
-        
-        stores = RecommendationService.get_store_recommendations_for_user(
-            user=request.user,
-            limit=limit,
-            selected_tags=selected_tags
-        )
-        
-        logger.warning(f"推薦服務返回 {len(stores)} 間店家")
-        for store in stores:
-            logger.warning(f"  - {store.name}")
+        # 未指定標籤時優先讀取批次預先計算結果
+        stores = None
+        if not selected_tags:
+            stores = RecommendationService.get_precomputed_recommended_stores(
+                request.user,
+                limit=limit
+            )
+        if stores is None:
+            stores = RecommendationService.get_store_recommendations_for_user(
+                user=request.user,
+                limit=limit,
+                selected_tags=selected_tags
+            )
         
         from apps.stores.serializers import PublishedStoreSerializer
         serializer = PublishedStoreSerializer(stores, many=True)
@@ -161,17 +166,20 @@ class RecommendationViewSet(viewsets.ViewSet):
         """
         from apps.products.models import Product
         
-        try:
-            product = Product.objects.get(id=pk, is_available=True)
-        except Product.DoesNotExist:
-            return Response({
-                'detail': '商品不存在'
-            }, status=status.HTTP_404_NOT_FOUND)
-        
-        similar = RecommendationService.get_similar_products(
-            product=product,
-            limit=5
-        )
+        # 優先讀取離線計算結果，尚未計算時才即時以標籤索引計算
+        similar = RecommendationService.get_precomputed_similar_products(pk, limit=5)
+        if similar is None:
+            try:
+                product = Product.objects.get(id=pk, is_available=True)
+            except Product.DoesNotExist:
+                return Response({
+                    'detail': '商品不存在'
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            similar = RecommendationService.get_similar_products(
+                product=product,
+                limit=5
+            )
         
         # 轉換格式以符合序列化器
         formatted_similar = [{
@@ -411,12 +419,7 @@ class FinancialAnalysisViewSet(viewsets.ViewSet):
     
     def _get_store(self, request):
         """取得當前用戶的店家"""
-        try:
-            from apps.users.models import Merchant
-            merchant = Merchant.objects.get(user=request.user)
-            return merchant.store
-        except:
-            return None
+        return get_request_store(request)
     
     @action(detail=False, methods=['get'], url_path='sales-summary')
     def sales_summary(self, request):
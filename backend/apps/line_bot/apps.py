@@ -5,3 +5,6 @@ class LineBotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.line_bot'
     verbose_name = 'LINE BOT 餐廳助手'
+
+    def ready(self):
+        import apps.line_bot.signals
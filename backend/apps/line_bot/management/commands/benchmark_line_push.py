@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.line_bot.services.line_api import AsyncLineMessagingAPI, LineMessagingAPI, line_api_metrics
+from apps.line_bot.services.push_dispatcher import PushDispatcher, TokenBucket
+
+BENCHMARK_TOKEN = 'benchmark-channel-token'
+BENCHMARK_MODES = ['unpooled', 'pooled', 'async', 'dispatch', 'grouped']
+
+
+class MockLineHandler(BaseHTTPRequestHandler):
+	"""模擬 LINE Messaging API：所有 POST 回傳 200 與空 JSON。"""
+
+	protocol_version = 'HTTP/1.1'
+	# 標頭與內容分兩次寫出，關閉 Nagle 避免與 delayed ACK 互相等待而拉長 keep-alive 連線的延遲
+	disable_nagle_algorithm = True
+	latency_seconds = 0.0
+
+	def do_POST(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		self.rfile.read(length)
+		if self.latency_seconds:
+			time.sleep(self.latency_seconds)
+		body = b'{}'
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class MockLineServer(ThreadingHTTPServer):
+	daemon_threads = True
+	# 未使用連線池時每次推播都會建立新連線，需要較大的 listen backlog
+	request_queue_size = 1024
+
+
+def start_mock_server(latency_seconds):
+	handler = type('BenchmarkLineHandler', (MockLineHandler,), {'latency_seconds': latency_seconds})
+	server = MockLineServer(('127.0.0.1', 0), handler)
+	threading.Thread(target=server.serve_forever, name='mock-line-server', daemon=True).start()
+	return server
+
+
+class Command(BaseCommand):
+	help = (
+		'以本機模擬 LINE 伺服器量測推播吞吐量（每次新建連線 vs 共用連線池 vs 非同步，'
+		'以及大量推播實際使用的 PushDispatcher 逐一 push 與 multicast 合併）'
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--pushes', type=int, default=2000, help='每種模式送出的推播數')
+		parser.add_argument('--concurrency', type=int, default=16, help='並行請求數')
+		parser.add_argument('--latency-ms', type=int, default=0, help='模擬伺服器每個請求的延遲（毫秒）')
+		parser.add_argument(
+			'--mode',
+			action='append',
+			dest='modes',
+			choices=BENCHMARK_MODES,
+			help='只量測指定模式（可重複指定，預設全部）',
+		)
+
+	def handle(self, *args, **options):
+		if options['pushes'] < 1 or options['concurrency'] < 1:
+			raise CommandError('--pushes 與 --concurrency 必須至少為 1')
+
+		server = start_mock_server(options['latency_ms'] / 1000)
+		base_url = f'http://127.0.0.1:{server.server_address[1]}/v2/bot'
+		messages = [LineMessagingAPI.create_text_message('benchmark')]
+		modes = options['modes'] or BENCHMARK_MODES
+		results = {}
+
+		try:
+			for mode in modes:
+				line_api_metrics.reset()
+				runner = getattr(self, f'_run_{mode}')
+				started = time.monotonic()
+				outcome = runner(base_url, messages, options['pushes'], options['concurrency'])
+				if outcome is None:
+					continue
+				succeeded, metrics = outcome
+				elapsed = time.monotonic() - started
+				results[mode] = {
+					'pushes': options['pushes'],
+					'succeeded': succeeded,
+					'seconds': round(elapsed, 3),
+					'pushes_per_second': round(options['pushes'] / elapsed, 1),
+					'metrics': metrics or line_api_metrics.snapshot().get('push'),
+				}
+		finally:
+			server.shutdown()
+			server.server_close()
+
+		self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+
+	def _run_unpooled(self, base_url, messages, pushes, concurrency):
+		"""改版前的做法：每次推播以 requests.post 建立新連線。"""
+		def push(index):
+			try:
+				response = requests.post(
+					f'{base_url}/message/push',
+					headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {BENCHMARK_TOKEN}'},
+					data=json.dumps({'to': f'U{index}', 'messages': messages}),
+				)
+			except requests.RequestException:
+				return False
+			return response.status_code == 200
+
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			return sum(executor.map(push, range(pushes))), None
+
+	def _run_pooled(self, base_url, messages, pushes, concurrency):
+		line_api = LineMessagingAPI()
+		line_api.channel_access_token = BENCHMARK_TOKEN
+		line_api.api_base_url = base_url
+
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			return sum(executor.map(lambda index: line_api.push_message(f'U{index}', messages), range(pushes))), None
+
+	def _run_async(self, base_url, messages, pushes, concurrency):
+		try:
+			line_api = AsyncLineMessagingAPI()
+		except ImportError as exc:
+			self.stderr.write(f'略過 async 模式：{exc}')
+			return None
+		line_api.channel_access_token = BENCHMARK_TOKEN
+		line_api.api_base_url = base_url
+
+		async def run():
+			semaphore = asyncio.Semaphore(concurrency)
+
+			async def push(index):
+				async with semaphore:
+					return await line_api.push_message(f'U{index}', messages)
+
+			async with line_api:
+				return sum(await asyncio.gather(*(push(index) for index in range(pushes))))
+
+		return asyncio.run(run()), None
+
+	def _dispatcher(self, base_url, concurrency):
+		# 不限流，只量測 HTTP 與派送本身的吞吐量
+		return PushDispatcher(
+			BENCHMARK_TOKEN,
+			max_workers=concurrency,
+			bucket=TokenBucket(1_000_000),
+			api_base_url=base_url,
+		)
+
+	def _run_dispatch(self, base_url, messages, pushes, concurrency):
+		"""PushDispatcher.dispatch：每位收件者一次 push。"""
+		jobs = [(index, f'U{index}', messages) for index in range(pushes)]
+		results, metrics = self._dispatcher(base_url, concurrency).dispatch(jobs)
+		return sum(result.success for result in results), metrics
+
+	def _run_grouped(self, base_url, messages, pushes, concurrency):
+		"""PushDispatcher.dispatch_grouped：內容相同的收件者合併為 multicast。"""
+		jobs = [(index, f'U{index}', messages) for index in range(pushes)]
+		results, metrics = self._dispatcher(base_url, concurrency).dispatch_grouped(jobs)
+		return sum(result.success for result in results), metrics
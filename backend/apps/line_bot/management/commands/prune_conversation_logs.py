@@ -0,0 +1,36 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.line_bot.services.conversation_log import prune_conversation_logs
+
+
+class Command(BaseCommand):
+	help = '清理 LINE BOT 對話記錄：依月份分段刪除超過保存期限的記錄'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--retention-days',
+			type=int,
+			default=settings.CONVERSATION_LOG_RETENTION_DAYS,
+			help='記錄保存天數，超過即刪除',
+		)
+		parser.add_argument(
+			'--dry-run',
+			action='store_true',
+			help='只計算每個月份會刪除的筆數',
+		)
+
+	def handle(self, *args, **options):
+		try:
+			summary = prune_conversation_logs(
+				retention_days=options['retention_days'],
+				dry_run=options['dry_run'],
+			)
+		except ValueError as exc:
+			raise CommandError(str(exc)) from exc
+
+		label = '預計刪除' if options['dry_run'] else '已清理'
+		self.stdout.write(self.style.SUCCESS(f'{label}對話記錄 {summary["total"]} 筆'))
+		self.stdout.write(json.dumps(summary, ensure_ascii=False, indent=2))
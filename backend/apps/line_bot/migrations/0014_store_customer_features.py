@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line_bot', '0013_broadcastmessage_coupon'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreCustomerFeature',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_order_at', models.DateTimeField(blank=True, null=True, verbose_name='最近下單時間')),
+                ('order_count', models.PositiveIntegerField(default=0, verbose_name='訂單數')),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='累計消費金額')),
+                ('refreshed_at', models.DateTimeField(verbose_name='更新時間')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='customer_features', to='stores.store', verbose_name='店家')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='store_customer_features', to=settings.AUTH_USER_MODEL, verbose_name='顧客')),
+            ],
+            options={
+                'verbose_name': '店家顧客特徵',
+                'verbose_name_plural': '店家顧客特徵',
+                'db_table': 'store_customer_features',
+                'indexes': [models.Index(fields=['store', 'last_order_at'], name='store_custo_store_i_a9456e_idx'), models.Index(fields=['store', 'total_spent'], name='store_custo_store_i_8e0874_idx')],
+                'unique_together': {('store', 'user')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StoreCustomerTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(max_length=100, verbose_name='食物標籤')),
+                ('weight', models.PositiveIntegerField(default=0, verbose_name='購買數量')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stores.store', verbose_name='店家')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='顧客')),
+            ],
+            options={
+                'verbose_name': '店家顧客標籤',
+                'verbose_name_plural': '店家顧客標籤',
+                'db_table': 'store_customer_tags',
+                'indexes': [models.Index(fields=['store', 'tag'], name='store_custo_store_i_4b85ea_idx')],
+                'unique_together': {('store', 'user', 'tag')},
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line_bot', '0014_store_customer_features'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='broadcastmessage',
+            name='status',
+            field=models.CharField(choices=[('draft', '草稿'), ('scheduled', '已排程'), ('sending', '發送中'), ('sent', '已發送'), ('cancelled', '已取消'), ('failed', '發送失敗')], default='draft', max_length=20, verbose_name='狀態'),
+        ),
+        migrations.AlterField(
+            model_name='platformbroadcast',
+            name='status',
+            field=models.CharField(choices=[('draft', '草稿'), ('scheduled', '已排程'), ('sending', '發送中'), ('sent', '已發送'), ('cancelled', '已取消'), ('failed', '發送失敗')], default='draft', max_length=20, verbose_name='狀態'),
+        ),
+        migrations.CreateModel(
+            name='BroadcastJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', '等待中'), ('running', '發送中'), ('completed', '已完成'), ('cancelled', '已取消'), ('failed', '失敗')], db_index=True, default='queued', max_length=20, verbose_name='狀態')),
+                ('total_count', models.IntegerField(default=0, verbose_name='目標人數')),
+                ('success_count', models.IntegerField(default=0, verbose_name='成功發送數')),
+                ('failure_count', models.IntegerField(default=0, verbose_name='失敗發送數')),
+                ('batches_done', models.IntegerField(default=0, verbose_name='已完成批次')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='要求取消')),
+                ('worker', models.CharField(blank=True, max_length=200, verbose_name='執行者')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='最後心跳時間')),
+                ('error_message', models.TextField(blank=True, verbose_name='錯誤訊息')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='建立時間')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始時間')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完成時間')),
+                ('broadcast_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='line_bot.broadcastmessage', verbose_name='店家推播')),
+                ('platform_broadcast', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='line_bot.platformbroadcast', verbose_name='平台推播')),
+            ],
+            options={
+                'verbose_name': '推播發送工作',
+                'verbose_name_plural': '推播發送工作',
+                'db_table': 'broadcast_jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BroadcastDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_user_id', models.CharField(max_length=255, verbose_name='LINE User ID')),
+                ('status', models.CharField(choices=[('pending', '待發送'), ('sent', '已發送'), ('failed', '發送失敗')], default='pending', max_length=20, verbose_name='狀態')),
+                ('error_message', models.CharField(blank=True, max_length=255, verbose_name='錯誤訊息')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='處理時間')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='line_bot.broadcastjob', verbose_name='推播工作')),
+            ],
+            options={
+                'verbose_name': '推播收件記錄',
+                'verbose_name_plural': '推播收件記錄',
+                'db_table': 'broadcast_deliveries',
+                'indexes': [models.Index(fields=['job', 'status', 'id'], name='broadcast_d_job_id_8bedeb_idx')],
+                'unique_together': {('job', 'line_user_id')},
+            },
+        ),
+    ]
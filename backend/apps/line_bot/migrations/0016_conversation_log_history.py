@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line_bot', '0015_broadcast_jobs'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversationlog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='建立時間'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationlog',
+            index=models.Index(fields=['store', 'line_user_id', '-created_at'], name='conv_logs_history_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line_bot', '0016_conversation_log_history'),
+        ('stores', '0020_store_search_document'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreCustomerFeatureRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested_at', models.DateTimeField(verbose_name='標記時間')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stores.store', verbose_name='店家')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='顧客')),
+            ],
+            options={
+                'verbose_name': '待更新顧客特徵',
+                'verbose_name_plural': '待更新顧客特徵',
+                'db_table': 'store_customer_feature_refreshes',
+                'unique_together': {('store', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line_bot', '0017_store_customer_feature_refresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcastdelivery',
+            name='retryable',
+            field=models.BooleanField(default=False, verbose_name='可重送'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from apps.stores.models import Store
 
 
@@ -327,7 +328,8 @@ class ConversationLog(models.Model):
         verbose_name='AI 模型',
         help_text='例如：gpt-4, gemini-pro'
     )
-    created_at = models.DateTimeField(auto_now_add=True, verbose_name='建立時間')
+    # 對話記錄延後批次寫入，建立時間在收到訊息時就填入
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='建立時間')
 
     class Meta:
         db_table = 'conversation_logs'
@@ -337,6 +339,8 @@ class ConversationLog(models.Model):
         indexes = [
             models.Index(fields=['line_user_id', '-created_at']),
             models.Index(fields=['store', '-created_at']),
+            # 載入用戶在某店家的近期對話歷史
+            models.Index(fields=['store', 'line_user_id', '-created_at'], name='conv_logs_history_idx'),
         ]
 
     def __str__(self):
@@ -359,7 +363,9 @@ class BroadcastMessage(models.Model):
     STATUS_CHOICES = [
         ('draft', '草稿'),
         ('scheduled', '已排程'),
+        ('sending', '發送中'),
         ('sent', '已發送'),
+        ('cancelled', '已取消'),
         ('failed', '發送失敗'),
     ]
 
@@ -600,7 +606,9 @@ class PlatformBroadcast(models.Model):
     STATUS_CHOICES = [
         ('draft', '草稿'),
         ('scheduled', '已排程'),
+        ('sending', '發送中'),
         ('sent', '已發送'),
+        ('cancelled', '已取消'),
         ('failed', '發送失敗'),
     ]
 
@@ -701,3 +709,201 @@ class PlatformBroadcast(models.Model):
 
     def __str__(self):
         return f"[{self.get_broadcast_type_display()}] {self.title}"
+
+
+class StoreCustomerFeature(models.Model):
+    """店家顧客特徵（由訂單彙總），供推播受眾篩選以單一查詢完成。"""
+
+    store = models.ForeignKey(
+        Store,
+        on_delete=models.CASCADE,
+        related_name='customer_features',
+        verbose_name='店家'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='store_customer_features',
+        verbose_name='顧客'
+    )
+    last_order_at = models.DateTimeField(null=True, blank=True, verbose_name='最近下單時間')
+    order_count = models.PositiveIntegerField(default=0, verbose_name='訂單數')
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='累計消費金額')
+    refreshed_at = models.DateTimeField(verbose_name='更新時間')
+
+    class Meta:
+        db_table = 'store_customer_features'
+        verbose_name = '店家顧客特徵'
+        verbose_name_plural = '店家顧客特徵'
+        unique_together = ['store', 'user']
+        indexes = [
+            models.Index(fields=['store', 'last_order_at']),
+            models.Index(fields=['store', 'total_spent']),
+        ]
+
+    def __str__(self):
+        return f"{self.store_id} - {self.user_id} ({self.order_count})"
+
+
+class StoreCustomerTag(models.Model):
+    """顧客在店家購買過的食物標籤與次數（每個標籤一列，方便以 IN 條件篩選）。"""
+
+    store = models.ForeignKey(
+        Store,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='店家'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='顧客'
+    )
+    tag = models.CharField(max_length=100, verbose_name='食物標籤')
+    weight = models.PositiveIntegerField(default=0, verbose_name='購買數量')
+
+    class Meta:
+        db_table = 'store_customer_tags'
+        verbose_name = '店家顧客標籤'
+        verbose_name_plural = '店家顧客標籤'
+        unique_together = ['store', 'user', 'tag']
+        indexes = [
+            models.Index(fields=['store', 'tag']),
+        ]
+
+    def __str__(self):
+        return f"{self.store_id} - {self.user_id} - {self.tag}"
+
+
+class StoreCustomerFeatureRefresh(models.Model):
+    """待更新的顧客特徵（下單時標記，由排程批次重建後刪除）。"""
+
+    store = models.ForeignKey(
+        Store,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='店家'
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='顧客'
+    )
+    requested_at = models.DateTimeField(verbose_name='標記時間')
+
+    class Meta:
+        db_table = 'store_customer_feature_refreshes'
+        verbose_name = '待更新顧客特徵'
+        verbose_name_plural = '待更新顧客特徵'
+        unique_together = ['store', 'user']
+
+    def __str__(self):
+        return f"{self.store_id} - {self.user_id}"
+
+
+class BroadcastJob(models.Model):
+    """
+    推播發送工作
+    記錄一次店家推播或平台推播的背景發送進度，支援取消與中斷後續傳
+    """
+    STATUS_CHOICES = [
+        ('queued', '等待中'),
+        ('running', '發送中'),
+        ('completed', '已完成'),
+        ('cancelled', '已取消'),
+        ('failed', '失敗'),
+    ]
+
+    broadcast_message = models.ForeignKey(
+        BroadcastMessage,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='jobs',
+        verbose_name='店家推播'
+    )
+    platform_broadcast = models.ForeignKey(
+        PlatformBroadcast,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='jobs',
+        verbose_name='平台推播'
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='queued',
+        db_index=True,
+        verbose_name='狀態'
+    )
+    total_count = models.IntegerField(default=0, verbose_name='目標人數')
+    success_count = models.IntegerField(default=0, verbose_name='成功發送數')
+    failure_count = models.IntegerField(default=0, verbose_name='失敗發送數')
+    batches_done = models.IntegerField(default=0, verbose_name='已完成批次')
+    cancel_requested = models.BooleanField(default=False, verbose_name='要求取消')
+    worker = models.CharField(max_length=200, blank=True, verbose_name='執行者')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='最後心跳時間')
+    error_message = models.TextField(blank=True, verbose_name='錯誤訊息')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='建立時間')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='開始時間')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='完成時間')
+
+    class Meta:
+        db_table = 'broadcast_jobs'
+        verbose_name = '推播發送工作'
+        verbose_name_plural = '推播發送工作'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        broadcast = self.broadcast_message or self.platform_broadcast
+        return f"{broadcast} - {self.status} ({self.success_count + self.failure_count}/{self.total_count})"
+
+    @property
+    def broadcast(self):
+        return self.broadcast_message or self.platform_broadcast
+
+    @property
+    def processed_count(self):
+        return self.success_count + self.failure_count
+
+
+class BroadcastDelivery(models.Model):
+    """推播工作中每位收件者的發送狀態（批次完成時寫入，作為續傳檢查點）。"""
+
+    STATUS_CHOICES = [
+        ('pending', '待發送'),
+        ('sent', '已發送'),
+        ('failed', '發送失敗'),
+    ]
+
+    job = models.ForeignKey(
+        BroadcastJob,
+        on_delete=models.CASCADE,
+        related_name='deliveries',
+        verbose_name='推播工作'
+    )
+    line_user_id = models.CharField(max_length=255, verbose_name='LINE User ID')
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='pending',
+        verbose_name='狀態'
+    )
+    error_message = models.CharField(max_length=255, blank=True, verbose_name='錯誤訊息')
+    retryable = models.BooleanField(default=False, verbose_name='可重送')
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name='處理時間')
+
+    class Meta:
+        db_table = 'broadcast_deliveries'
+        verbose_name = '推播收件記錄'
+        verbose_name_plural = '推播收件記錄'
+        unique_together = ['job', 'line_user_id']
+        indexes = [
+            models.Index(fields=['job', 'status', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.job_id} - {self.line_user_id} - {self.status}"
@@ -0,0 +1,120 @@
+"""
+AI 回覆快取
+
+顧客常重複詢問相同的問題，每次都呼叫 AI 供應商既慢又有成本。
+問題先正規化（全半形、大小寫、空白與標點、句尾語助詞、開頭客套語）後取雜湊，
+以「店家 + 店家資料版本 + 問題雜湊」為鍵快取 AI 回覆：
+- 店家資料（菜單、時段等）變更時版本號改變，舊回覆自然失效
+- 依賴上下文的追問（「那…呢」「這個…」）與過長的訊息不快取
+- AI 服務錯誤時的預設回覆不快取
+
+命中率記錄在行程內的 answer_cache_metrics。
+"""
+import hashlib
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+
+ANSWER_CACHE_PREFIX = 'line_bot_answer'
+
+# 正規化後超過此長度的訊息多半是具體情境描述，不快取
+MAX_CACHEABLE_QUESTION_LENGTH = 40
+MIN_CACHEABLE_QUESTION_LENGTH = 2
+
+LEADING_PHRASES = ('請問一下', '請問', '想請問', '想問', '你好', '您好', '哈囉', '嗨')
+TRAILING_PARTICLES = '嗎呢啊呀吧喔哦耶唷嘛啦'
+FOLLOW_UP_PREFIXES = ('那', '還有', '這個', '那個', '它', '他', '她', '這', '剛剛', '剛才', '上面')
+
+_PUNCTUATION_RE = re.compile(r'[\s\W_]+', re.UNICODE)
+
+
+def normalize_question(message):
+    """正規化問題文字；回傳空字串表示不適合快取。"""
+    text = unicodedata.normalize('NFKC', message or '').lower()
+    text = _PUNCTUATION_RE.sub('', text)
+
+    stripped = True
+    while stripped:
+        stripped = False
+        for phrase in LEADING_PHRASES:
+            if text.startswith(phrase) and len(text) > len(phrase):
+                text = text[len(phrase):]
+                stripped = True
+    text = text.rstrip(TRAILING_PARTICLES)
+
+    if not (MIN_CACHEABLE_QUESTION_LENGTH <= len(text) <= MAX_CACHEABLE_QUESTION_LENGTH):
+        return ''
+    if text.startswith(FOLLOW_UP_PREFIXES):
+        return ''
+    return text
+
+
+def question_fingerprint(message):
+    normalized = normalize_question(message)
+    if not normalized:
+        return ''
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class AnswerCacheMetrics:
+    """行程內的命中統計（執行緒安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.skipped = 0
+            self.stored = 0
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'skipped': self.skipped,
+                'stored': self.stored,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+answer_cache_metrics = AnswerCacheMetrics()
+
+
+def _cache_key(store_id, context_version, fingerprint):
+    return f'{ANSWER_CACHE_PREFIX}:{store_id}:{context_version}:{fingerprint}'
+
+
+def get_cached_answer(store_id, context_version, message):
+    """回傳快取的回覆，沒有時回傳 None。"""
+    fingerprint = question_fingerprint(message)
+    if not fingerprint:
+        answer_cache_metrics.incr('skipped')
+        return None
+    answer = cache.get(_cache_key(store_id, context_version, fingerprint))
+    answer_cache_metrics.incr('hits' if answer is not None else 'misses')
+    return answer
+
+
+def store_answer(store_id, context_version, message, answer):
+    fingerprint = question_fingerprint(message)
+    if not fingerprint or not answer:
+        return False
+    cache.set(
+        _cache_key(store_id, context_version, fingerprint),
+        answer,
+        settings.LINE_BOT_ANSWER_CACHE_SECONDS,
+    )
+    answer_cache_metrics.incr('stored')
+    return True
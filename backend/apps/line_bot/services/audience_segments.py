@@ -0,0 +1,240 @@
+"""
+店家推播受眾篩選
+
+StoreCustomerFeature / StoreCustomerTag 由訂單彙總每位會員在店家的
+最近下單時間、訂單數、消費金額與購買過的食物標籤。篩選條件（食物標籤、
+閒置天數、會員等級、消費金額）組成單一 SQL 查詢，以 EXISTS 子查詢對應特徵表，
+不必逐位顧客查詢訂單。
+
+特徵表由排程每小時整批重建。顧客下新訂單時只在 StoreCustomerFeatureRefresh
+標記該顧客（一次 INSERT，不在請求中重建），由排程每分鐘批次更新被標記的顧客。
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from apps.intelligence.leases import ensure_lease_held
+from apps.line_bot.models import LineUserBinding, StoreCustomerFeature, StoreCustomerFeatureRefresh, StoreCustomerTag
+from apps.loyalty.models import CustomerLoyaltyAccount
+from apps.orders.models import DineInOrder, DineInOrderItem, TakeoutOrder, TakeoutOrderItem
+
+logger = logging.getLogger(__name__)
+
+# 消費金額不計入已拒絕的訂單
+EXCLUDED_SPEND_STATUSES = ('rejected',)
+STREAM_CHUNK_SIZE = 2000
+
+
+def refresh_store_customer_features(store_id, user_ids=None):
+    """
+    重建店家的顧客特徵（預設整個店家，指定 user_ids 時只更新這些顧客）
+
+    Returns:
+        int: 寫入的特徵列數
+    """
+    members = CustomerLoyaltyAccount.objects.filter(store_id=store_id)
+    if user_ids is not None:
+        members = members.filter(user_id__in=user_ids)
+    member_ids = list(members.values_list('user_id', flat=True))
+
+    last_order_at = {}
+    order_count = defaultdict(int)
+    for order_model in (TakeoutOrder, DineInOrder):
+        rows = (
+            order_model.objects.filter(store_id=store_id, user_id__in=member_ids)
+            .values('user_id')
+            .annotate(last_at=Max('created_at'), count=Count('id'))
+        )
+        for row in rows:
+            user_id = row['user_id']
+            order_count[user_id] += row['count']
+            if user_id not in last_order_at or row['last_at'] > last_order_at[user_id]:
+                last_order_at[user_id] = row['last_at']
+
+    total_spent = defaultdict(Decimal)
+    tag_weight = defaultdict(lambda: defaultdict(int))
+    for item_model in (TakeoutOrderItem, DineInOrderItem):
+        rows = item_model.objects.filter(
+            order__store_id=store_id,
+            order__user_id__in=member_ids,
+        ).values_list('order__user_id', 'order__status', 'product__food_tags', 'quantity', 'unit_price')
+        for user_id, status, food_tags, quantity, unit_price in rows.iterator(chunk_size=STREAM_CHUNK_SIZE):
+            quantity = int(quantity or 1)
+            if status not in EXCLUDED_SPEND_STATUSES:
+                total_spent[user_id] += (unit_price or Decimal('0')) * quantity
+            for tag in food_tags or []:
+                tag_weight[user_id][tag] += quantity
+
+    now = timezone.now()
+    features = [
+        StoreCustomerFeature(
+            store_id=store_id,
+            user_id=user_id,
+            last_order_at=last_order_at.get(user_id),
+            order_count=order_count.get(user_id, 0),
+            total_spent=total_spent.get(user_id, Decimal('0')),
+            refreshed_at=now,
+        )
+        for user_id in member_ids
+    ]
+    tags = [
+        StoreCustomerTag(store_id=store_id, user_id=user_id, tag=tag[:100], weight=weight)
+        for user_id, weights in tag_weight.items()
+        for tag, weight in weights.items()
+    ]
+
+    with transaction.atomic():
+        stale_features = StoreCustomerFeature.objects.filter(store_id=store_id)
+        stale_tags = StoreCustomerTag.objects.filter(store_id=store_id)
+        if user_ids is not None:
+            stale_features = stale_features.filter(user_id__in=user_ids)
+            stale_tags = stale_tags.filter(user_id__in=user_ids)
+        stale_features.delete()
+        stale_tags.delete()
+        StoreCustomerFeature.objects.bulk_create(features, batch_size=1000)
+        StoreCustomerTag.objects.bulk_create(tags, batch_size=1000, ignore_conflicts=True)
+    return len(features)
+
+
+def refresh_all_customer_features():
+    """重建所有有會員的店家，回傳摘要。"""
+    store_ids = list(
+        CustomerLoyaltyAccount.objects.values_list('store_id', flat=True).distinct().order_by('store_id')
+    )
+    rows_count = 0
+    for store_id in store_ids:
+        ensure_lease_held()
+        rows_count += refresh_store_customer_features(store_id)
+    # 已無會員的店家不會出現在上面，清掉殘留特徵
+    StoreCustomerFeature.objects.exclude(store_id__in=store_ids).delete()
+    StoreCustomerTag.objects.exclude(store_id__in=store_ids).delete()
+    return {'stores_count': len(store_ids), 'rows_count': rows_count}
+
+
+def mark_customer_features_stale(store_id, user_id):
+    """標記顧客特徵待更新（已標記時更新標記時間，避免排程刪除處理中的舊標記時遺漏）。"""
+    StoreCustomerFeatureRefresh.objects.bulk_create(
+        [StoreCustomerFeatureRefresh(store_id=store_id, user_id=user_id, requested_at=timezone.now())],
+        update_conflicts=True,
+        unique_fields=['store', 'user'],
+        update_fields=['requested_at'],
+    )
+
+
+def refresh_stale_customer_features(limit=5000):
+    """依店家批次重建被標記的顧客特徵，回傳摘要。"""
+    pending = list(
+        StoreCustomerFeatureRefresh.objects.order_by('requested_at')
+        .values_list('id', 'store_id', 'user_id', 'requested_at')[:limit]
+    )
+    users_by_store = defaultdict(list)
+    for _, store_id, user_id, _ in pending:
+        users_by_store[store_id].append(user_id)
+
+    rows_count = 0
+    for store_id, user_ids in users_by_store.items():
+        ensure_lease_held()
+        rows_count += refresh_store_customer_features(store_id, user_ids=user_ids)
+
+    # 處理期間再次被標記（requested_at 已更新）的顧客保留到下一輪
+    processed = Q()
+    for refresh_id, _, _, requested_at in pending:
+        processed |= Q(id=refresh_id, requested_at=requested_at)
+    if pending:
+        StoreCustomerFeatureRefresh.objects.filter(processed).delete()
+    return {'stores_count': len(users_by_store), 'users_count': len(pending), 'rows_count': rows_count}
+
+
+def ensure_store_customer_features(store):
+    """店家從未建立過特徵時即時建立一次（之後交由排程與訂單訊號維護）。"""
+    if not StoreCustomerFeature.objects.filter(store=store).exists():
+        refresh_store_customer_features(store.id)
+
+
+def build_segment_queryset(
+    store,
+    *,
+    food_tags=(),
+    days_inactive=0,
+    level_ids=(),
+    min_spent=None,
+    require_personalized=True,
+):
+    """
+    依篩選條件組出受眾查詢（CustomerLoyaltyAccount，附 line_user_id 欄位）
+
+    Args:
+        food_tags: 曾購買任一標籤的商品
+        days_inactive: 超過此天數未在店家下單（從未下單也算）
+        level_ids: 目前會員等級
+        min_spent: 累計消費金額下限
+        require_personalized: 只包含未關閉個人化推薦通知的用戶
+    """
+    bindings = LineUserBinding.objects.filter(
+        user_id=OuterRef('user_id'),
+        is_active=True,
+    )
+    if require_personalized:
+        bindings = bindings.filter(notify_personalized_recommendation=True)
+
+    accounts = (
+        CustomerLoyaltyAccount.objects.filter(store=store)
+        .annotate(line_user_id=Subquery(bindings.order_by('-id').values('line_user_id')[:1]))
+        .filter(line_user_id__isnull=False)
+    )
+
+    if level_ids:
+        accounts = accounts.filter(current_level_id__in=level_ids)
+
+    if days_inactive > 0:
+        cutoff = timezone.now() - timedelta(days=days_inactive)
+        accounts = accounts.exclude(Exists(StoreCustomerFeature.objects.filter(
+            store=store,
+            user_id=OuterRef('user_id'),
+            last_order_at__gt=cutoff,
+        )))
+
+    if min_spent is not None:
+        accounts = accounts.filter(Exists(StoreCustomerFeature.objects.filter(
+            store=store,
+            user_id=OuterRef('user_id'),
+            total_spent__gte=min_spent,
+        )))
+
+    if food_tags:
+        accounts = accounts.filter(Exists(StoreCustomerTag.objects.filter(
+            store=store,
+            user_id=OuterRef('user_id'),
+            tag__in=list(food_tags),
+        )))
+
+    return accounts.order_by('id')
+
+
+def iter_segment_line_user_ids(segment, chunk_size=STREAM_CHUNK_SIZE):
+    """以伺服器端游標逐批讀取目標 LINE User ID。"""
+    return segment.values_list('line_user_id', flat=True).iterator(chunk_size=chunk_size)
+
+
+def preview_segment(segment, limit=20):
+    """前幾位目標用戶的預覽資料。"""
+    rows = list(segment.values('user_id', 'line_user_id', 'user__username', 'total_points')[:limit])
+    display_names = dict(
+        LineUserBinding.objects.filter(
+            line_user_id__in=[row['line_user_id'] for row in rows],
+        ).values_list('line_user_id', 'display_name')
+    )
+    return [
+        {
+            'line_user_id': row['line_user_id'],
+            'display_name': display_names.get(row['line_user_id'], ''),
+            'username': row['user__username'],
+            'total_points': row['total_points'],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,513 @@
+"""
+推播背景發送工作
+
+店家推播與平台推播建立 BroadcastJob 後，收件者逐一寫入 BroadcastDelivery（pending）。
+執行時每次取一批 pending 收件者組訊息、送出，並在同一交易中寫回每位收件者的狀態
+與工作計數，作為檢查點：行程中斷後重新執行只會處理仍為 pending 的收件者，
+已送達的用戶不會再收到一次。
+
+- 取消：設定 cancel_requested，執行中的工作在下一批開始前停止
+- 續傳：取消或失敗的工作可重新排入佇列（暫時性失敗的收件者會重新發送）；心跳逾時的執行中工作由排程接手
+- 接手：心跳與檢查點只在 worker 仍為自己時寫入，工作被其他行程接手後原本的
+  迴圈立即停止，不會兩邊同時發送或重複計數
+- 重送：X-Line-Retry-Key 由（工作, 收件者）導出，寫回檢查點前中斷而重送
+  仍為 pending 的收件者時，LINE 會回 409 而不會重複送達
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from apps.line_bot.models import (
+    BroadcastDelivery,
+    BroadcastJob,
+    LineUserBinding,
+    StoreLineBotConfig,
+)
+from apps.line_bot.services.line_api import LineMessagingAPI
+from apps.line_bot.services.push_dispatcher import PushDispatcher
+from apps.stores.models import Store
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_INSERT_BATCH_SIZE = 1000
+
+
+def _worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+class StoreBroadcastComposer:
+    """店家推播：所有收件者內容相同。"""
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        bot_config = StoreLineBotConfig.objects.get(store=broadcast.store, is_active=True)
+        self.line_api = LineMessagingAPI(bot_config)
+        self.channel_access_token = self.line_api.channel_access_token
+        self.messages = self._build_messages()
+
+    def _build_messages(self):
+        broadcast = self.broadcast
+        line_api = self.line_api
+
+        # 準備訊息（包含標題和內容）
+        full_message = f"📢 {broadcast.title}\n\n{broadcast.message_content}"
+        messages = [line_api.create_text_message(full_message)]
+
+        if broadcast.image_url:
+            messages.insert(0, line_api.create_image_message(broadcast.image_url))
+
+        if broadcast.coupon_id:
+            coupon = broadcast.coupon
+            coupon_summary = (
+                f"優惠券：{coupon.title}\n"
+                f"折抵方式：{coupon.get_discount_type_display()} {coupon.discount_value}\n"
+                f"最低消費：NT$ {coupon.min_order_amount}\n"
+                f"到期時間：{coupon.expires_at.strftime('%Y-%m-%d %H:%M')}"
+            )
+            if coupon.max_discount_amount:
+                coupon_summary += f"\n最高折抵：NT$ {coupon.max_discount_amount}"
+
+            messages.append(line_api.create_text_message(coupon_summary))
+            messages.append(
+                line_api.create_template_buttons(
+                    alt_text=f"{coupon.title} 領券通知",
+                    title='立即領券',
+                    text='點擊下方按鈕，將優惠券存入個人資料的優惠券存放處。',
+                    actions=[
+                        {
+                            'type': 'postback',
+                            'label': '領取優惠券',
+                            'data': f'action=claim_platform_coupon&token={coupon.claim_token}',
+                            'displayText': '我要領取這張優惠券',
+                        }
+                    ],
+                )
+            )
+        return messages[:5]
+
+    def jobs_for(self, line_user_ids):
+        return [(line_user_id, line_user_id, self.messages) for line_user_id in line_user_ids]
+
+
+def get_popular_recommended_stores(limit=5):
+    """熱門店家：依惜福品累積捐款金額與完成訂單數排序。"""
+    return list(
+        Store.objects.filter(is_published=True)
+        .order_by('-surplus_completed_revenue_total', '-surplus_completed_order_count_total', '-created_at')[:limit]
+    )
+
+
+def build_recommendation_message(title, intro, stores, include_popularity_metrics=False):
+    if not stores:
+        return None
+
+    lines = [title, '', intro]
+    for store in stores:
+        if include_popularity_metrics:
+            donation_amount = float(store.surplus_completed_revenue_total or 0) * 0.6
+            completed_orders = store.surplus_completed_order_count_total or 0
+            lines.append(
+                f"• {store.name}（捐款 NT$ {donation_amount:,.0f} / 完成單 {completed_orders}）"
+            )
+        else:
+            lines.append(f"• {store.name}")
+
+    return "\n".join(lines)
+
+
+class PlatformBroadcastComposer:
+    """平台推播：共用訊息只組一次，店家推薦類型另加每位用戶的個人化推薦。"""
+
+    def __init__(self, broadcast):
+        from apps.intelligence.models import PlatformSettings
+
+        self.broadcast = broadcast
+        self.platform_settings = PlatformSettings.get_settings()
+        self.line_api = LineMessagingAPI()
+        self.line_api.channel_access_token = self.platform_settings.line_bot_channel_access_token
+        self.channel_access_token = self.line_api.channel_access_token
+
+        self.selected_stores = list(broadcast.recommended_stores.all())
+        self.shared_messages = self._build_shared_messages()
+        self.fallback_messages = self._build_fallback_messages()
+        self.personalized = (
+            broadcast.broadcast_type == 'store_recommendation'
+            and self.platform_settings.is_personalized_recommendation_enabled
+        )
+
+    def _build_shared_messages(self):
+        broadcast = self.broadcast
+        line_api = self.line_api
+        coupon = broadcast.coupon
+        messages = []
+
+        if broadcast.broadcast_type == 'store_recommendation':
+            popular_stores = self.selected_stores or get_popular_recommended_stores(limit=5)
+            popular_message = build_recommendation_message(
+                title='🔥 熱門店家推薦',
+                intro='以下是目前高捐款金額與高訂單量的熱門店家：',
+                stores=popular_stores,
+                include_popularity_metrics=True,
+            )
+            if popular_message:
+                messages.append(line_api.create_text_message(popular_message))
+        elif broadcast.broadcast_type == 'promotion':
+            promotion_message = f"🎁 {broadcast.title}\n\n{broadcast.message_content}"
+            if coupon:
+                promotion_message += (
+                    f"\n\n優惠券代碼：{coupon.code}"
+                    f"\n優惠內容：{coupon.get_discount_type_display()} {coupon.discount_value}"
+                    f"\n最低消費：NT$ {coupon.min_order_amount}"
+                    f"\n使用期限：{coupon.expires_at.strftime('%Y-%m-%d %H:%M')}"
+                )
+                if coupon.max_discount_amount:
+                    promotion_message += f"\n最高折抵：NT$ {coupon.max_discount_amount}"
+            messages.append(line_api.create_text_message(promotion_message))
+
+            if coupon:
+                button_title = coupon.title[:40]
+                button_text = '點擊下方按鈕即可直接領取，優惠券會自動存入 DineVerse 個人資料。'
+                messages.append(
+                    line_api.create_template_buttons(
+                        alt_text=f"{coupon.title} 領券按鈕",
+                        title=button_title,
+                        text=button_text[:60],
+                        actions=[
+                            {
+                                'type': 'postback',
+                                'label': '立即領券',
+                                'data': f"action=claim_platform_coupon&token={coupon.claim_token}",
+                                'displayText': '我要領取這張優惠券',
+                            }
+                        ],
+                    )
+                )
+        return messages
+
+    def _build_fallback_messages(self):
+        broadcast = self.broadcast
+        fallback_message = f"📢 {broadcast.title}\n\n{broadcast.message_content}"
+        if self.selected_stores:
+            fallback_message += "\n\n🏪 推薦店家："
+            for store in self.selected_stores[:5]:
+                fallback_message += f"\n• {store.name}"
+        return [self.line_api.create_text_message(fallback_message)]
+
+    def _load_personalized_stores(self, line_user_ids):
+        from apps.intelligence.services.line_recommendation_push_service import LineRecommendationPushService
+
+        bindings = LineUserBinding.objects.filter(
+            line_user_id__in=line_user_ids,
+            is_active=True,
+            notify_personalized_recommendation=True,
+        ).values_list('line_user_id', 'user_id')
+        user_id_by_line_user = dict(bindings)
+        contents = LineRecommendationPushService().load_personalized_contents(
+            list(user_id_by_line_user.values()),
+            timezone.now(),
+        )
+        return {
+            line_user_id: contents.get(user_id, ([], []))[0]
+            for line_user_id, user_id in user_id_by_line_user.items()
+        }
+
+    def jobs_for(self, line_user_ids):
+        personalized_stores = self._load_personalized_stores(line_user_ids) if self.personalized else {}
+        intro = self.broadcast.message_content or '根據你的訂單行為，我們推薦以下店家：'
+
+        jobs = []
+        for line_user_id in line_user_ids:
+            messages = []
+            personalized_message = build_recommendation_message(
+                title='🎯 個人化推薦店家',
+                intro=intro,
+                stores=personalized_stores.get(line_user_id, []),
+                include_popularity_metrics=False,
+            )
+            if personalized_message:
+                messages.append(self.line_api.create_text_message(personalized_message))
+            messages.extend(self.shared_messages)
+            jobs.append((line_user_id, line_user_id, (messages or self.fallback_messages)[:5]))
+        return jobs
+
+
+def _get_composer(job):
+    if job.broadcast_message_id:
+        return StoreBroadcastComposer(job.broadcast_message)
+    return PlatformBroadcastComposer(job.platform_broadcast)
+
+
+def create_broadcast_job(line_user_ids, *, broadcast_message=None, platform_broadcast=None):
+    """建立發送工作與所有收件者的待發送記錄，並將推播標記為發送中。"""
+    broadcast = broadcast_message or platform_broadcast
+    line_user_ids = list(dict.fromkeys(line_user_ids))
+    with transaction.atomic():
+        job = BroadcastJob.objects.create(
+            broadcast_message=broadcast_message,
+            platform_broadcast=platform_broadcast,
+            total_count=len(line_user_ids),
+        )
+        BroadcastDelivery.objects.bulk_create(
+            [BroadcastDelivery(job=job, line_user_id=line_user_id) for line_user_id in line_user_ids],
+            batch_size=DELIVERY_INSERT_BATCH_SIZE,
+        )
+        broadcast.status = 'sending'
+        broadcast.recipient_count = len(line_user_ids)
+        broadcast.success_count = 0
+        broadcast.failure_count = 0
+        broadcast.save(update_fields=['status', 'recipient_count', 'success_count', 'failure_count', 'updated_at'])
+    return job
+
+
+def _claim_job(job_id, worker):
+    """排隊中或心跳逾時的工作才可被取得，避免兩個行程同時發送同一工作。"""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.BROADCAST_JOB_STALE_SECONDS)
+    claimed = BroadcastJob.objects.filter(
+        Q(status='queued') | Q(status='running', heartbeat_at__lt=stale_before),
+        id=job_id,
+        cancel_requested=False,
+    ).update(status='running', worker=worker, heartbeat_at=now, error_message='')
+    if claimed:
+        BroadcastJob.objects.filter(id=job_id, started_at__isnull=True).update(started_at=now)
+    return claimed == 1
+
+
+def _checkpoint(job, results, worker):
+    """
+    寫回一批收件者的發送結果與工作計數（同一交易）
+
+    Returns:
+        bool: 工作已被其他 worker 接手時回傳 False，不寫入任何結果
+    """
+    now = timezone.now()
+    sent_ids = [result.to for result in results if result.success]
+    failed = [result for result in results if not result.success]
+    with transaction.atomic():
+        owned = BroadcastJob.objects.filter(id=job.id, worker=worker, status='running').update(
+            success_count=F('success_count') + len(sent_ids),
+            failure_count=F('failure_count') + len(failed),
+            batches_done=F('batches_done') + 1,
+            heartbeat_at=now,
+        )
+        if not owned:
+            return False
+        if sent_ids:
+            job.deliveries.filter(line_user_id__in=sent_ids).update(status='sent', processed_at=now)
+        for (error, retryable), recipients in _group_failures(failed).items():
+            job.deliveries.filter(line_user_id__in=recipients).update(
+                status='failed',
+                error_message=error[:255],
+                retryable=retryable,
+                processed_at=now,
+            )
+    return True
+
+
+def _heartbeat(job, worker):
+    """
+    開始下一批前更新心跳並確認工作狀態
+
+    Returns:
+        'owned'、'cancel'（要求取消）或 'lost'（已被其他 worker 接手或已結束）
+    """
+    updated = BroadcastJob.objects.filter(
+        id=job.id,
+        worker=worker,
+        status='running',
+        cancel_requested=False,
+    ).update(heartbeat_at=timezone.now())
+    if updated:
+        return 'owned'
+    if BroadcastJob.objects.filter(id=job.id, worker=worker, status='running', cancel_requested=True).exists():
+        return 'cancel'
+    return 'lost'
+
+
+def _group_failures(failed):
+    grouped = {}
+    for result in failed:
+        grouped.setdefault((result.error or 'line_push_failed', result.retryable), []).append(result.to)
+    return grouped
+
+
+def _finalize(job, status, error_message='', worker=None):
+    now = timezone.now()
+    jobs = BroadcastJob.objects.filter(id=job.id)
+    if worker is not None:
+        jobs = jobs.filter(worker=worker, status='running')
+    updated = jobs.update(status=status, finished_at=now, error_message=error_message)
+    job.refresh_from_db()
+    if not updated:
+        # 工作已由其他 worker 接手，狀態交給目前的 worker 決定
+        return job
+
+    broadcast = job.broadcast
+    broadcast.status = {'completed': 'sent', 'cancelled': 'cancelled'}.get(status, 'failed')
+    broadcast.success_count = job.success_count
+    broadcast.failure_count = job.failure_count
+    if status == 'completed':
+        broadcast.sent_at = now
+    broadcast.save(update_fields=['status', 'success_count', 'failure_count', 'sent_at', 'updated_at'])
+    return job
+
+
+def run_broadcast_job(job_id, *, worker=None, batch_size=None):
+    """
+    執行（或續傳）發送工作
+
+    Returns:
+        BroadcastJob，工作無法取得時返回 None
+    """
+    worker = worker or _worker_id()
+    batch_size = batch_size or settings.BROADCAST_JOB_BATCH_SIZE
+    if not _claim_job(job_id, worker):
+        return None
+
+    job = BroadcastJob.objects.select_related('broadcast_message__store', 'platform_broadcast').get(id=job_id)
+    try:
+        composer = _get_composer(job)
+        dispatcher = PushDispatcher(composer.channel_access_token)
+        retry_key_prefix = f'broadcast-job:{job.id}'
+        while True:
+            state = _heartbeat(job, worker)
+            if state == 'cancel':
+                return _finalize(job, 'cancelled', worker=worker)
+            if state == 'lost':
+                return _release(job, worker)
+
+            line_user_ids = list(
+                job.deliveries.filter(status='pending').order_by('id').values_list('line_user_id', flat=True)[:batch_size]
+            )
+            if not line_user_ids:
+                return _finalize(job, 'completed', worker=worker)
+
+            results, _ = dispatcher.dispatch_grouped(
+                composer.jobs_for(line_user_ids),
+                retry_key_prefix=retry_key_prefix,
+            )
+            if not _checkpoint(job, results, worker):
+                return _release(job, worker)
+    except Exception as exc:
+        logger.exception('[BroadcastJob] job %s failed', job_id)
+        return _finalize(job, 'failed', error_message=str(exc), worker=worker)
+
+
+def _release(job, worker):
+    logger.warning('[BroadcastJob] job %s was taken over by another worker, %s stops', job.id, worker)
+    job.refresh_from_db()
+    return job
+
+
+def _run_in_thread(job_id):
+    try:
+        run_broadcast_job(job_id)
+    finally:
+        connection.close()
+
+
+def start_broadcast_job(job_id):
+    """交易提交後在背景執行緒開始發送（排程的 broadcast_jobs 工作會接手中斷的工作）。"""
+    transaction.on_commit(lambda: threading.Thread(
+        target=_run_in_thread,
+        args=(job_id,),
+        name=f'broadcast-job-{job_id}',
+        daemon=True,
+    ).start())
+
+
+def request_cancel(job):
+    """要求取消：尚未開始的工作直接取消，執行中的工作在下一批前停止。"""
+    BroadcastJob.objects.filter(id=job.id, status__in=['queued', 'running']).update(cancel_requested=True)
+    if BroadcastJob.objects.filter(id=job.id, status='queued').exists():
+        return _finalize(job, 'cancelled')
+    job.refresh_from_db()
+    return job
+
+
+def resume_job(job):
+    """
+    重新排入取消或失敗的工作（已完成但有暫時性失敗的工作也可以）
+
+    待發送的收件者與暫時性失敗（429、5xx、連線錯誤）的收件者會重新發送，
+    其他失敗（例如用戶已封鎖）維持失敗；失敗數依重新排入後的收件狀態重新計算。
+    """
+    retryable_failures = job.deliveries.filter(status='failed', retryable=True)
+    if job.status not in ('cancelled', 'failed') and not (job.status == 'completed' and retryable_failures.exists()):
+        raise ValueError('只有已取消、失敗或有暫時性發送失敗的工作可以續傳')
+    with transaction.atomic():
+        retryable_failures.update(
+            status='pending',
+            error_message='',
+            retryable=False,
+            processed_at=None,
+        )
+        BroadcastJob.objects.filter(id=job.id).update(
+            status='queued',
+            cancel_requested=False,
+            finished_at=None,
+            failure_count=job.deliveries.filter(status='failed').count(),
+        )
+    broadcast = job.broadcast
+    broadcast.status = 'sending'
+    broadcast.save(update_fields=['status', 'updated_at'])
+    job.refresh_from_db()
+    return job
+
+
+def run_pending_broadcast_jobs():
+    """排程用：執行排隊中與心跳逾時（行程中斷）的工作。"""
+    stale_before = timezone.now() - timedelta(seconds=settings.BROADCAST_JOB_STALE_SECONDS)
+    job_ids = list(
+        BroadcastJob.objects.filter(
+            Q(status='queued') | Q(status='running', heartbeat_at__lt=stale_before),
+            cancel_requested=False,
+        ).order_by('created_at').values_list('id', flat=True)
+    )
+    summary = {'jobs': len(job_ids), 'completed': 0}
+    for job_id in job_ids:
+        close_old_connections()
+        job = run_broadcast_job(job_id)
+        if job and job.status == 'completed':
+            summary['completed'] += 1
+    return summary
+
+
+def serialize_job(job):
+    if job is None:
+        return None
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'total_count': job.total_count,
+        'success_count': job.success_count,
+        'failure_count': job.failure_count,
+        'processed_count': job.processed_count,
+        'progress_percent': round(job.processed_count * 100 / job.total_count, 1) if job.total_count else 100.0,
+        'batches_done': job.batches_done,
+        'cancel_requested': job.cancel_requested,
+        'error_message': job.error_message,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
+
+
+def execute_broadcast_job(job):
+    """
+    小型推播直接在目前請求中執行完畢，大型推播改由背景執行緒發送
+
+    Returns:
+        (job, finished)：finished 表示已在本次呼叫中處理完畢
+    """
+    if job.total_count <= settings.BROADCAST_INLINE_MAX_RECIPIENTS:
+        return run_broadcast_job(job.id) or job, True
+    start_broadcast_job(job.id)
+    return job, False
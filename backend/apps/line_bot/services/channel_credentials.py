@@ -0,0 +1,140 @@
+"""
+LINE Channel 憑證登錄
+
+店家專屬 webhook 的每個事件都需要店家的 StoreLineBotConfig（Channel Secret、
+Access Token、AI 與歡迎訊息設定）。設定保存在行程記憶體，以快取中的版本號判斷
+是否過期：StoreLineBotConfig 或 Store 變更時由 signals 更新版本號，所有行程
+在下一次取用時重新載入；另設保存秒數上限，避免以 queryset.update 直接修改
+資料時一直使用舊設定。
+
+取得的 bot_config（含 store）由多個執行緒共用，只能讀取不可修改。
+
+簽名驗證以 Channel Secret 預先建立 HMAC 物件，每次驗證只複製後計算，
+不必重新處理金鑰。
+"""
+import base64
+import functools
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.line_bot.models import StoreLineBotConfig
+
+CREDENTIALS_VERSION_CACHE_PREFIX = 'line_bot_credentials_version'
+# 平台 webhook 沒有平台 Channel Secret 時改用第一個啟用店家的設定
+FALLBACK_KEY = 'fallback'
+
+
+@functools.lru_cache(maxsize=256)
+def _signing_template(channel_secret):
+    return hmac.new(channel_secret.encode('utf-8'), digestmod=hashlib.sha256)
+
+
+def compute_signature(request_body, channel_secret):
+    mac = _signing_template(channel_secret).copy()
+    mac.update(request_body)
+    return base64.b64encode(mac.digest()).decode('utf-8')
+
+
+def verify_channel_signature(request_body, signature, channel_secret):
+    """驗證 X-Line-Signature；channel_secret 為空時一律視為無效。"""
+    if not channel_secret or not signature:
+        return False
+    expected_signature = compute_signature(request_body, channel_secret)
+    return hmac.compare_digest(signature.encode('utf-8'), expected_signature.encode('utf-8'))
+
+
+class ChannelCredentials:
+    """
+    單一店家 LINE Channel 的設定
+
+    Args:
+        bot_config: StoreLineBotConfig（已載入 store）
+    """
+
+    __slots__ = ('store_id', 'bot_config', 'channel_secret', 'channel_access_token', 'is_active')
+
+    def __init__(self, bot_config):
+        self.store_id = bot_config.store_id
+        self.bot_config = bot_config
+        self.channel_secret = bot_config.line_channel_secret or ''
+        self.channel_access_token = bot_config.line_channel_access_token or ''
+        self.is_active = bot_config.is_active
+
+    def verify_signature(self, request_body, signature):
+        return verify_channel_signature(request_body, signature, self.channel_secret)
+
+
+_entries = {}
+_entries_lock = threading.Lock()
+
+
+def _version_key(key):
+    return f'{CREDENTIALS_VERSION_CACHE_PREFIX}:{key}'
+
+
+def _current_version(key):
+    cache_key = _version_key(key)
+    version = cache.get(cache_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(cache_key, version, None):
+            version = cache.get(cache_key, version)
+    return version
+
+
+def _load(key):
+    queryset = StoreLineBotConfig.objects.select_related('store')
+    if key == FALLBACK_KEY:
+        bot_config = queryset.filter(is_active=True).first()
+    else:
+        bot_config = queryset.filter(store_id=key).first()
+    return ChannelCredentials(bot_config) if bot_config else None
+
+
+def _get(key):
+    version = _current_version(key)
+    now = time.monotonic()
+    cached = _entries.get(key)
+    if cached and cached[0] == version and cached[1] > now:
+        return cached[2]
+
+    with _entries_lock:
+        cached = _entries.get(key)
+        if cached and cached[0] == version and cached[1] > now:
+            return cached[2]
+        credentials = _load(key)
+        _entries[key] = (version, now + settings.LINE_CHANNEL_CREDENTIALS_CACHE_SECONDS, credentials)
+        return credentials
+
+
+def get_store_credentials(store_id):
+    """取得店家的 Channel 設定（不論是否啟用），沒有設定時回傳 None。"""
+    return _get(int(store_id))
+
+
+def get_active_bot_config(store_id):
+    """取得店家啟用中的 StoreLineBotConfig，沒有或未啟用時回傳 None。"""
+    credentials = get_store_credentials(store_id)
+    if credentials and credentials.is_active:
+        return credentials.bot_config
+    return None
+
+
+def get_fallback_credentials():
+    """第一個啟用的店家設定，沒有時回傳 None。"""
+    return _get(FALLBACK_KEY)
+
+
+def invalidate_store_credentials(store_id):
+    """通知所有行程在下次取用時重新載入此店家（與備用）的設定。"""
+    cache.set_many({
+        _version_key(int(store_id)): uuid.uuid4().hex,
+        _version_key(FALLBACK_KEY): uuid.uuid4().hex,
+    }, None)
+
@@ -0,0 +1,232 @@
+"""
+LINE BOT 對話記錄與近期對話歷史
+
+每則訊息會產生用戶訊息與 BOT 回覆兩筆 ConversationLog，逐筆 INSERT 會拖慢
+webhook 工作執行緒。ConversationLogWriter 先在記憶體累積，由背景執行緒定期
+（或累積達批次大小時）以 bulk_create 寫入；created_at 在收到訊息時就已填入，
+延後寫入不影響排序。
+
+AI 回覆需要的最近對話保存在共用快取的環狀緩衝（每位用戶每家店最多
+CONVERSATION_HISTORY_SIZE 則），不必在每則訊息都查詢對話記錄；
+快取不存在時才從資料庫載入。各行程共用同一份緩衝需要共用快取（REDIS_URL），
+未設定時 CONVERSATION_HISTORY_CACHE_SECONDS 預設縮短為 10 分鐘。
+
+prune_conversation_logs 負責保存期限：以月為單位分段刪除超過
+CONVERSATION_LOG_RETENTION_DAYS 的記錄，每段再依主鍵分批刪除。
+"""
+import atexit
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.line_bot.models import ConversationLog
+from apps.line_bot.services.log_writer import delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_PREFIX = 'line_bot_history'
+
+
+class ConversationLogWriter:
+    """
+    對話記錄的背景批次寫入
+
+    Args:
+        flush_interval: 背景寫入的間隔秒數
+        batch_size: 累積筆數達到此值時提早寫入
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None):
+        self.flush_interval = flush_interval or settings.CONVERSATION_LOG_FLUSH_SECONDS
+        self.batch_size = batch_size or settings.CONVERSATION_LOG_BATCH_SIZE
+        self.buffer = []
+        self.written_count = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, records):
+        with self._lock:
+            self.buffer.extend(records)
+            should_wake = len(self.buffer) >= self.batch_size
+        self._ensure_thread()
+        if should_wake:
+            self._wake.set()
+
+    def flush(self):
+        """寫入目前累積的記錄，回傳本次寫入筆數；失敗時記錄放回緩衝等下次重試。"""
+        with self._lock:
+            records, self.buffer = self.buffer, []
+        if not records:
+            return 0
+        try:
+            ConversationLog.objects.bulk_create(records, batch_size=self.batch_size)
+        except Exception:
+            logger.exception('[ConversationLog] failed to write %s records', len(records))
+            with self._lock:
+                self.buffer[:0] = records
+            return 0
+        self.written_count += len(records)
+        return len(records)
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._flush_loop, name='conversation-log-writer', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_conversation_log_writer():
+    global _log_writer
+
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = ConversationLogWriter()
+            atexit.register(_log_writer.flush)
+        return _log_writer
+
+
+def history_cache_key(store_id, line_user_id):
+    return f'{HISTORY_CACHE_PREFIX}:{store_id}:{line_user_id}'
+
+
+def _load_history(store_id, line_user_id):
+    recent_logs = ConversationLog.objects.filter(
+        store_id=store_id,
+        line_user_id=line_user_id,
+    ).order_by('-created_at', '-id').values_list('sender_type', 'message_content')[:settings.CONVERSATION_HISTORY_SIZE]
+    return [
+        {
+            'role': 'assistant' if sender_type == 'bot' else 'user',
+            'content': content,
+        }
+        for sender_type, content in reversed(recent_logs)
+    ]
+
+
+def get_recent_history(store_id, line_user_id):
+    """
+    取得用戶與店家最近的對話（由舊到新，AI 對話歷史格式）
+
+    Returns:
+        list: [{'role': 'user' | 'assistant', 'content': str}, ...]
+    """
+    key = history_cache_key(store_id, line_user_id)
+    history = cache.get(key)
+    if history is None:
+        history = _load_history(store_id, line_user_id)
+        cache.set(key, history, settings.CONVERSATION_HISTORY_CACHE_SECONDS)
+    return history
+
+
+def append_history(store_id, line_user_id, entries):
+    """將新的對話加入環狀緩衝，只保留最近 CONVERSATION_HISTORY_SIZE 則。"""
+    history = get_recent_history(store_id, line_user_id) + list(entries)
+    history = history[-settings.CONVERSATION_HISTORY_SIZE:]
+    cache.set(history_cache_key(store_id, line_user_id), history, settings.CONVERSATION_HISTORY_CACHE_SECONDS)
+    return history
+
+
+def log_conversation(store, line_user_id, user_message, reply, *, reply_token='',
+                     matched_faq_id=None, used_ai=False, ai_model=None):
+    """
+    記錄一輪對話（用戶訊息與 BOT 回覆）並更新近期對話歷史
+
+    CONVERSATION_LOG_ASYNC_ENABLED=False 時直接寫入資料庫。
+    """
+    now = timezone.now()
+    records = [
+        ConversationLog(
+            store=store,
+            line_user_id=line_user_id,
+            sender_type='user',
+            message_type='text',
+            message_content=user_message,
+            reply_token=reply_token,
+            created_at=now,
+        ),
+        ConversationLog(
+            store=store,
+            line_user_id=line_user_id,
+            sender_type='bot',
+            message_type='text',
+            message_content=reply,
+            matched_faq_id=matched_faq_id,
+            used_ai=used_ai,
+            ai_model=ai_model,
+            created_at=now,
+        ),
+    ]
+    # 先更新快取再寫入記錄：快取不存在時從資料庫載入，不會重複加入這一輪對話
+    append_history(store.id, line_user_id, [
+        {'role': 'user', 'content': user_message},
+        {'role': 'assistant', 'content': reply},
+    ])
+
+    if settings.CONVERSATION_LOG_ASYNC_ENABLED:
+        get_conversation_log_writer().add(records)
+    else:
+        ConversationLog.objects.bulk_create(records)
+    return records
+
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def prune_conversation_logs(*, retention_days=None, dry_run=False, now=None):
+    """
+    刪除超過保存期限的對話記錄
+
+    以月為單位分段（最舊的月份先處理），每段依主鍵分批刪除，
+    避免單一查詢掃描或鎖住整張表。
+
+    Returns:
+        dict: {'YYYY-MM': 刪除筆數, ..., 'total': 總筆數}
+    """
+    retention_days = settings.CONVERSATION_LOG_RETENTION_DAYS if retention_days is None else retention_days
+    if retention_days < 1:
+        raise ValueError('retention_days 必須至少為 1')
+
+    cutoff = (now or timezone.now()) - timedelta(days=retention_days)
+    expired = ConversationLog.objects.filter(created_at__lt=cutoff)
+    oldest = expired.order_by('created_at').values_list('created_at', flat=True).first()
+
+    summary = {}
+    total = 0
+    segment_start = _month_start(oldest) if oldest else cutoff
+    while segment_start < cutoff:
+        next_month = (segment_start + timedelta(days=32)).replace(day=1)
+        segment = expired.filter(created_at__gte=segment_start, created_at__lt=min(next_month, cutoff))
+        count = segment.count() if dry_run else delete_in_batches(segment)
+        if count:
+            summary[segment_start.strftime('%Y-%m')] = count
+            total += count
+        segment_start = next_month
+
+    summary['total'] = total
+    if not dry_run:
+        logger.info('[ConversationLog] pruned %s records older than %s days', total, retention_days)
+    return summary
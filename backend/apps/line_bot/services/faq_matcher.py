@@ -0,0 +1,268 @@
+"""
+FAQ 關鍵字比對索引與使用次數計數
+
+每個店家的啟用 FAQ（關鍵字與問題）編譯成一個 Aho-Corasick 自動機，
+比對一則訊息只需掃過訊息一次，耗時與 FAQ 數量無關。索引保存在行程記憶體，
+以快取中的版本號判斷是否過期：StoreFAQ 變更時由 signals 更新版本號，
+所有行程在下一次比對時重建該店家的索引。索引另有保存秒數上限
+（LINE_BOT_FAQ_INDEX_CACHE_SECONDS），版本號通知未送達時也不會一直使用舊的 FAQ。
+
+FAQ 使用次數先累積在記憶體，由背景執行緒定期（或累積達門檻時）以
+F() 運算式批次寫回，請求處理過程中不會寫入資料庫。
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import F
+
+from apps.line_bot.models import StoreFAQ
+
+logger = logging.getLogger(__name__)
+
+FAQ_INDEX_VERSION_CACHE_PREFIX = 'line_bot_faq_index_version'
+# 用戶訊息包含 FAQ 問題全文時額外加的分數
+QUESTION_MATCH_SCORE = 2
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick 多字串比對
+
+    Args:
+        patterns: 字串清單（已轉小寫、非空字串）
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            self._add(pattern, pattern_id)
+        self._build_fail_links()
+
+    def _add(self, pattern, pattern_id):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(pattern_id)
+
+    def _build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                candidate = self.goto[fallback].get(char, 0)
+                # 第一層狀態的 fail 指回根節點
+                self.fail[next_state] = candidate if candidate != next_state else 0
+                # 接上後綴狀態的輸出，比對時不必再沿 fail 鏈查找
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """回傳 text 中出現過的 pattern id 集合。"""
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found.update(self.output[state])
+        return found
+
+
+class FAQIndex:
+    """單一店家的 FAQ 比對索引。"""
+
+    def __init__(self, faqs):
+        # 依 -priority、-created_at 排序，同分時取排在前面的 FAQ
+        self.faqs = list(faqs)
+        self.base_scores = [0] * len(self.faqs)
+        weights_by_pattern = defaultdict(lambda: defaultdict(int))
+
+        for position, faq in enumerate(self.faqs):
+            for keyword in faq.keywords or []:
+                keyword = str(keyword).lower()
+                if keyword:
+                    weights_by_pattern[keyword][position] += 1
+                else:
+                    # 空字串關鍵字必定「包含」在訊息中
+                    self.base_scores[position] += 1
+            question = (faq.question or '').lower()
+            if question:
+                weights_by_pattern[question][position] += QUESTION_MATCH_SCORE
+            else:
+                self.base_scores[position] += QUESTION_MATCH_SCORE
+
+        patterns = list(weights_by_pattern)
+        self.pattern_weights = [dict(weights_by_pattern[pattern]) for pattern in patterns]
+        self.automaton = KeywordAutomaton(patterns)
+
+    def best_match(self, message):
+        scores = list(self.base_scores)
+        for pattern_id in self.automaton.find(message.lower()):
+            for position, weight in self.pattern_weights[pattern_id].items():
+                scores[position] += weight
+
+        best_position = None
+        best_score = 0
+        for position, score in enumerate(scores):
+            if score > best_score:
+                best_position, best_score = position, score
+        return self.faqs[best_position] if best_position is not None else None
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _version_key(store_id):
+    return f'{FAQ_INDEX_VERSION_CACHE_PREFIX}:{store_id}'
+
+
+def _current_version(store_id):
+    key = _version_key(store_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def build_faq_index(store_id):
+    faqs = StoreFAQ.objects.filter(store_id=store_id, is_active=True).only(
+        'id', 'store_id', 'question', 'answer', 'keywords', 'priority',
+    ).order_by('-priority', '-created_at')
+    return FAQIndex(faqs)
+
+
+def _is_fresh(cached, version, now):
+    return (
+        cached is not None
+        and cached[0] == version
+        and now - cached[1] < settings.LINE_BOT_FAQ_INDEX_CACHE_SECONDS
+    )
+
+
+def get_faq_index(store_id):
+    """取得店家目前的 FAQ 索引，版本變更或超過保存秒數時重建。"""
+    version = _current_version(store_id)
+    now = time.monotonic()
+    cached = _indexes.get(store_id)
+    if _is_fresh(cached, version, now):
+        return cached[2]
+
+    with _indexes_lock:
+        cached = _indexes.get(store_id)
+        if _is_fresh(cached, version, now):
+            return cached[2]
+        index = build_faq_index(store_id)
+        _indexes[store_id] = (version, now, index)
+        return index
+
+
+def invalidate_faq_index(store_id):
+    """通知所有行程在下次比對時重建此店家的索引。"""
+    cache.set(_version_key(store_id), uuid.uuid4().hex, None)
+
+
+class FAQUsageCounter:
+    """
+    FAQ 使用次數的記憶體計數器
+
+    Args:
+        flush_interval: 背景寫回的間隔秒數
+        flush_threshold: 累積次數達到此值時提早寫回
+    """
+
+    def __init__(self, flush_interval=None, flush_threshold=None):
+        self.flush_interval = flush_interval or settings.FAQ_USAGE_FLUSH_SECONDS
+        self.flush_threshold = flush_threshold or settings.FAQ_USAGE_FLUSH_THRESHOLD
+        self.pending = defaultdict(int)
+        self.pending_total = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, faq_id):
+        with self._lock:
+            self.pending[faq_id] += 1
+            self.pending_total += 1
+            should_wake = self.pending_total >= self.flush_threshold
+        self._ensure_thread()
+        if should_wake:
+            self._wake.set()
+
+    def flush(self):
+        """寫回累積的次數；相同增量的 FAQ 合併成一次 UPDATE。回傳寫回的總次數。"""
+        with self._lock:
+            pending, self.pending = self.pending, defaultdict(int)
+            self.pending_total = 0
+        if not pending:
+            return 0
+
+        ids_by_increment = defaultdict(list)
+        for faq_id, increment in pending.items():
+            ids_by_increment[increment].append(faq_id)
+        try:
+            for increment, faq_ids in ids_by_increment.items():
+                StoreFAQ.objects.filter(id__in=faq_ids).update(usage_count=F('usage_count') + increment)
+        except Exception:
+            logger.exception('[FAQ] failed to flush usage counts')
+            with self._lock:
+                for faq_id, increment in pending.items():
+                    self.pending[faq_id] += increment
+                    self.pending_total += increment
+            return 0
+        return sum(pending.values())
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._flush_loop, name='faq-usage-flusher', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+_usage_counter = None
+_usage_counter_lock = threading.Lock()
+
+
+def get_usage_counter():
+    global _usage_counter
+
+    with _usage_counter_lock:
+        if _usage_counter is None:
+            _usage_counter = FAQUsageCounter()
+            atexit.register(_usage_counter.flush)
+        return _usage_counter
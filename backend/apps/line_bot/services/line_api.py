@@ -1,14 +1,110 @@
-import os
+"""
+LINE Messaging API 服務
+
+同步版本以同頻道共用的 keep-alive 連線池（push_dispatcher.get_line_session）送出請求，
+每次請求都有連線與讀取逾時，並在可安全重送時有限次數重試：
+- push / multicast / broadcast 帶 X-Line-Retry-Key，重送時 LINE 回 409 表示已接受過，視為成功
+- reply 的 reply token 只能使用一次，只在請求確定未送達（連線逾時）或被限流（429）時重試
+- 取得用戶資料為 GET，可直接重試
+
+各端點的請求數、成功 / 失敗、重試、逾時與延遲記錄在行程內的 line_api_metrics。
+AsyncLineMessagingAPI 為 asyncio 版本（需要選用套件 httpx）。
+"""
+import asyncio
 import json
-import requests
+import os
+import logging
+import random
+import threading
+import time
+import uuid
 from typing import List, Dict, Optional
 
+import requests
+from django.conf import settings
 
-class LineMessagingAPI:
-    """
-    LINE Messaging API 服務類別
-    支援多店家配置
-    """
+from apps.line_bot.services.push_dispatcher import (
+    MAX_RETRY_AFTER_SECONDS,
+    RETRYABLE_STATUS_CODES,
+    get_line_session,
+    parse_retry_after,
+)
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE_SECONDS = 0.3
+
+
+class LineAPIMetrics:
+    """行程內各端點的請求統計（執行緒安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def record(self, endpoint, *, success, attempts, elapsed, timed_out=False):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0,
+                'success': 0,
+                'failure': 0,
+                'retries': 0,
+                'timeouts': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+            })
+            stats['requests'] += 1
+            stats['success' if success else 'failure'] += 1
+            stats['retries'] += max(0, attempts - 1)
+            stats['timeouts'] += int(timed_out)
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    **stats,
+                    'avg_ms': round(stats['total_seconds'] * 1000 / stats['requests'], 2) if stats['requests'] else 0.0,
+                }
+                for endpoint, stats in self._endpoints.items()
+            }
+
+
+line_api_metrics = LineAPIMetrics()
+
+
+def _timeout():
+    return (settings.LINE_API_CONNECT_TIMEOUT_SECONDS, settings.LINE_API_READ_TIMEOUT_SECONDS)
+
+
+def _backoff(attempt):
+    return BACKOFF_BASE_SECONDS * (2 ** (attempt - 1)) * (1 + random.random() * 0.25)
+
+
+def _retry_delay(status_code, headers, attempt, idempotent):
+    """回應需要重試時回傳等待秒數，否則回傳 None。"""
+    if status_code == 429:
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        return _backoff(attempt) if retry_after is None else retry_after
+    if idempotent and status_code in RETRYABLE_STATUS_CODES:
+        return _backoff(attempt)
+    return None
+
+
+def _is_success(response):
+    if response.status_code == 200:
+        return True
+    # 相同 retry key 的請求先前已被接受
+    return response.status_code == 409 and bool(response.headers.get('X-Line-Accepted-Request-Id'))
+
+
+class _LineAPIBase:
+    """設定讀取、請求標頭與訊息格式（同步與非同步版本共用）。"""
     
     def __init__(self, config=None):
         """
@@ -26,14 +122,134 @@ class LineMessagingAPI:
             self.channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
             self.channel_secret = os.getenv('LINE_CHANNEL_SECRET')
         
-        self.api_base_url = 'https://api.line.me/v2/bot'
+        self.api_base_url = settings.LINE_API_BASE_URL
+        self.max_retries = settings.LINE_API_MAX_RETRIES
         
-    def _get_headers(self) -> Dict[str, str]:
+    def _get_headers(self, retry_key: Optional[str] = None) -> Dict[str, str]:
         """取得 API 請求標頭"""
-        return {
+        headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.channel_access_token}'
         }
+        if retry_key:
+            headers['X-Line-Retry-Key'] = retry_key
+        return headers
+    
+    @staticmethod
+    def create_text_message(text: str) -> Dict:
+        """建立文字訊息"""
+        return {
+            'type': 'text',
+            'text': text
+        }
+    
+    @staticmethod
+    def create_image_message(original_url: str, preview_url: str = None) -> Dict:
+        """建立圖片訊息"""
+        return {
+            'type': 'image',
+            'originalContentUrl': original_url,
+            'previewImageUrl': preview_url or original_url
+        }
+    
+    @staticmethod
+    def create_flex_message(alt_text: str, contents: Dict) -> Dict:
+        """建立 Flex Message（複雜排版訊息）"""
+        return {
+            'type': 'flex',
+            'altText': alt_text,
+            'contents': contents
+        }
+    
+    @staticmethod
+    def create_template_buttons(alt_text: str, title: str, text: str, actions: List[Dict]) -> Dict:
+        """建立按鈕模板訊息"""
+        return {
+            'type': 'template',
+            'altText': alt_text,
+            'template': {
+                'type': 'buttons',
+                'title': title,
+                'text': text,
+                'actions': actions
+            }
+        }
+
+
+class LineMessagingAPI(_LineAPIBase):
+    """
+    LINE Messaging API 服務類別
+    支援多店家配置
+    """
+
+    def __init__(self, config=None, session=None):
+        super().__init__(config)
+        self._session = session
+
+    @property
+    def session(self):
+        # channel_access_token 可能在建立後才設定，連線池於請求時才依 token 取得
+        return self._session or get_line_session(self.channel_access_token)
+
+    def _request(self, method: str, endpoint: str, path: str, payload: Optional[Dict] = None,
+                 idempotent: bool = True, retry_key: Optional[str] = None):
+        """
+        送出請求並在可安全重送時重試
+
+        Returns:
+            requests.Response，連線失敗時返回 None
+        """
+        url = f'{self.api_base_url}{path}'
+        data = json.dumps(payload) if payload is not None else None
+        started = time.monotonic()
+        attempts = 0
+        timed_out = False
+        response = None
+
+        while True:
+            attempts += 1
+            delay = None
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers=self._get_headers(retry_key),
+                    data=data,
+                    timeout=_timeout(),
+                )
+            except requests.RequestException as exc:
+                response = None
+                timed_out = timed_out or isinstance(exc, requests.Timeout)
+                # 連線逾時代表請求未送出；其他錯誤只有可重送的請求才重試
+                if idempotent or isinstance(exc, requests.ConnectTimeout):
+                    delay = _backoff(attempts)
+                logger.warning('[LINE API] %s attempt %s failed: %s', endpoint, attempts, exc)
+            else:
+                if _is_success(response):
+                    break
+                delay = _retry_delay(response.status_code, response.headers, attempts, idempotent)
+
+            if delay is None or delay > MAX_RETRY_AFTER_SECONDS or attempts > self.max_retries:
+                break
+            time.sleep(delay)
+
+        success = response is not None and _is_success(response)
+        line_api_metrics.record(
+            endpoint,
+            success=success,
+            attempts=attempts,
+            elapsed=time.monotonic() - started,
+            timed_out=timed_out,
+        )
+        if response is not None and not success:
+            logger.warning(
+                '[LINE API] %s failed: status=%s attempts=%s response=%s',
+                endpoint,
+                response.status_code,
+                attempts,
+                response.text[:200],
+            )
+        return response
     
     def reply_message(self, reply_token: str, messages: List[Dict]) -> bool:
         """
@@ -46,25 +262,12 @@ class LineMessagingAPI:
         Returns:
             bool: 是否成功發送
         """
-        url = f'{self.api_base_url}/message/reply'
-        
         payload = {
             'replyToken': reply_token,
             'messages': messages
         }
-        
-        try:
-            response = requests.post(
-                url,
-                headers=self._get_headers(),
-                data=json.dumps(payload)
-            )
-            if response.status_code != 200:
-                print(f"[LINE API] Reply failed: status={response.status_code}, response={response.text}")
-            return response.status_code == 200
-        except Exception as e:
-            print(f"Reply message error: {e}")
-            return False
+        response = self._request('POST', 'reply', '/message/reply', payload, idempotent=False)
+        return response is not None and response.status_code == 200
     
     def push_message(self, to: str, messages: List[Dict]) -> bool:
         """
@@ -77,32 +280,18 @@ class LineMessagingAPI:
         Returns:
             bool: 是否成功發送
         """
-        url = f'{self.api_base_url}/message/push'
-        
+        if not self.channel_access_token:
+            logger.warning('[LINE API] Push skipped: missing channel access token')
+            return False
+
         payload = {
             'to': to,
             'messages': messages
         }
-        
-        try:
-            if not self.channel_access_token:
-                print("[LINE API] Push skipped: missing channel access token")
-                return False
-            token_preview = f"{self.channel_access_token[:20]}..." if len(self.channel_access_token) > 20 else self.channel_access_token
-            print(f"[LINE API] Sending push to {to}, token: {token_preview}")
-            response = requests.post(
-                url,
-                headers=self._get_headers(),
-                data=json.dumps(payload)
-            )
-            if response.status_code != 200:
-                print(f"[LINE API] Push failed: status={response.status_code}, response={response.text}")
-            else:
-                print(f"[LINE API] Push success to {to}")
-            return response.status_code == 200
-        except Exception as e:
-            print(f"Push message error: {e}")
-            return False
+        response = self._request('POST', 'push', '/message/push', payload, retry_key=str(uuid.uuid4()))
+        success = response is not None and _is_success(response)
+        logger.debug('[LINE API] Push to %s success=%s', to, success)
+        return success
     
     def multicast_message(self, to: List[str], messages: List[Dict]) -> Dict:
         """
@@ -115,30 +304,22 @@ class LineMessagingAPI:
         Returns:
             dict: 發送結果
         """
-        url = f'{self.api_base_url}/message/multicast'
-        
         payload = {
             'to': to,
             'messages': messages
         }
-        
-        try:
-            response = requests.post(
-                url,
-                headers=self._get_headers(),
-                data=json.dumps(payload)
-            )
-            return {
-                'success': response.status_code == 200,
-                'status_code': response.status_code,
-                'response': response.json() if response.status_code == 200 else None
-            }
-        except Exception as e:
-            print(f"Multicast message error: {e}")
+        response = self._request('POST', 'multicast', '/message/multicast', payload, retry_key=str(uuid.uuid4()))
+        if response is None:
             return {
                 'success': False,
-                'error': str(e)
+                'error': 'connection_failed'
             }
+        success = _is_success(response)
+        return {
+            'success': success,
+            'status_code': response.status_code,
+            'response': response.json() if response.status_code == 200 and response.content else None
+        }
     
     def broadcast_message(self, messages: List[Dict]) -> bool:
         """
@@ -150,22 +331,11 @@ class LineMessagingAPI:
         Returns:
             bool: 是否成功發送
         """
-        url = f'{self.api_base_url}/message/broadcast'
-        
         payload = {
             'messages': messages
         }
-        
-        try:
-            response = requests.post(
-                url,
-                headers=self._get_headers(),
-                data=json.dumps(payload)
-            )
-            return response.status_code == 200
-        except Exception as e:
-            print(f"Broadcast message error: {e}")
-            return False
+        response = self._request('POST', 'broadcast', '/message/broadcast', payload, retry_key=str(uuid.uuid4()))
+        return response is not None and _is_success(response)
     
     def get_profile(self, user_id: str) -> Optional[Dict]:
         """
@@ -177,53 +347,104 @@ class LineMessagingAPI:
         Returns:
             dict: 用戶資料
         """
-        url = f'{self.api_base_url}/profile/{user_id}'
-        
-        try:
-            response = requests.get(url, headers=self._get_headers())
-            if response.status_code == 200:
-                return response.json()
-            return None
-        except Exception as e:
-            print(f"Get profile error: {e}")
-            return None
-    
-    @staticmethod
-    def create_text_message(text: str) -> Dict:
-        """建立文字訊息"""
-        return {
-            'type': 'text',
-            'text': text
-        }
-    
-    @staticmethod
-    def create_image_message(original_url: str, preview_url: str = None) -> Dict:
-        """建立圖片訊息"""
-        return {
-            'type': 'image',
-            'originalContentUrl': original_url,
-            'previewImageUrl': preview_url or original_url
-        }
-    
-    @staticmethod
-    def create_flex_message(alt_text: str, contents: Dict) -> Dict:
-        """建立 Flex Message（複雜排版訊息）"""
-        return {
-            'type': 'flex',
-            'altText': alt_text,
-            'contents': contents
-        }
-    
-    @staticmethod
-    def create_template_buttons(alt_text: str, title: str, text: str, actions: List[Dict]) -> Dict:
-        """建立按鈕模板訊息"""
-        return {
-            'type': 'template',
-            'altText': alt_text,
-            'template': {
-                'type': 'buttons',
-                'title': title,
-                'text': text,
-                'actions': actions
-            }
-        }
+        response = self._request('GET', 'profile', f'/profile/{user_id}')
+        if response is not None and response.status_code == 200:
+            return response.json()
+        return None
+
+
+class AsyncLineMessagingAPI(_LineAPIBase):
+    """
+    asyncio 版本的 LINE Messaging API（需要 httpx）
+
+    同一個實例共用一個 httpx.AsyncClient 連線池，使用完畢請呼叫 aclose()
+    或以 async with 使用。重試規則與同步版本相同。
+    """
+
+    def __init__(self, config=None, client=None):
+        super().__init__(config)
+        if client is None:
+            try:
+                import httpx
+            except ImportError as exc:
+                raise ImportError('AsyncLineMessagingAPI 需要安裝 httpx（pip install httpx）') from exc
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(settings.LINE_API_READ_TIMEOUT_SECONDS, connect=settings.LINE_API_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(max_connections=settings.LINE_API_POOL_SIZE),
+            )
+        self.client = client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _request(self, method, endpoint, path, payload=None, idempotent=True, retry_key=None):
+        import httpx
+
+        url = f'{self.api_base_url}{path}'
+        started = time.monotonic()
+        attempts = 0
+        timed_out = False
+        response = None
+
+        while True:
+            attempts += 1
+            delay = None
+            try:
+                response = await self.client.request(
+                    method,
+                    url,
+                    headers=self._get_headers(retry_key),
+                    content=json.dumps(payload) if payload is not None else None,
+                )
+            except httpx.HTTPError as exc:
+                response = None
+                timed_out = timed_out or isinstance(exc, httpx.TimeoutException)
+                if idempotent or isinstance(exc, httpx.ConnectTimeout):
+                    delay = _backoff(attempts)
+                logger.warning('[LINE API] %s attempt %s failed: %s', endpoint, attempts, exc)
+            else:
+                if _is_success(response):
+                    break
+                delay = _retry_delay(response.status_code, response.headers, attempts, idempotent)
+
+            if delay is None or delay > MAX_RETRY_AFTER_SECONDS or attempts > self.max_retries:
+                break
+            await asyncio.sleep(delay)
+
+        line_api_metrics.record(
+            endpoint,
+            success=response is not None and _is_success(response),
+            attempts=attempts,
+            elapsed=time.monotonic() - started,
+            timed_out=timed_out,
+        )
+        return response
+
+    async def reply_message(self, reply_token: str, messages: List[Dict]) -> bool:
+        response = await self._request(
+            'POST', 'reply', '/message/reply', {'replyToken': reply_token, 'messages': messages}, idempotent=False,
+        )
+        return response is not None and response.status_code == 200
+
+    async def push_message(self, to: str, messages: List[Dict]) -> bool:
+        if not self.channel_access_token:
+            logger.warning('[LINE API] Push skipped: missing channel access token')
+            return False
+        response = await self._request(
+            'POST', 'push', '/message/push', {'to': to, 'messages': messages}, retry_key=str(uuid.uuid4()),
+        )
+        return response is not None and _is_success(response)
+
+    async def multicast_message(self, to: List[str], messages: List[Dict]) -> Dict:
+        response = await self._request(
+            'POST', 'multicast', '/message/multicast', {'to': to, 'messages': messages}, retry_key=str(uuid.uuid4()),
+        )
+        if response is None:
+            return {'success': False, 'error': 'connection_failed'}
+        return {'success': _is_success(response), 'status_code': response.status_code}
@@ -0,0 +1,125 @@
+"""
+推播記錄批次寫入與保存期限
+
+推播週期中每位用戶、每種推播類型都會產生一筆記錄，逐筆 INSERT 會讓
+整個週期被資料庫往返時間拖慢。BufferedLogWriter 先在記憶體累積，
+達到批次大小或週期結束時以 bulk_create 一次寫入。
+
+prune_push_logs 負責保存期限：
+- 超過 compact_after_days 的略過（skipped）記錄刪除，它們只用於當下稽核
+- 超過 retention_days 的記錄全部刪除
+頻率控管只需要最近 7 天的成功記錄，因此保存期限不得短於 MIN_RETENTION_DAYS。
+"""
+import functools
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 週推播上限以 7 天成功記錄計算，保存期限至少要涵蓋這段時間
+MIN_RETENTION_DAYS = 8
+DELETE_BATCH_SIZE = 5000
+
+
+class BufferedLogWriter:
+    """
+    累積 model instance 並分批 bulk_create
+
+    Args:
+        model: 記錄 model（PersonalizedRecommendationPushLog、StoreUserPushLog）
+        batch_size: 每批寫入筆數，達到即自動寫入
+    """
+
+    def __init__(self, model, batch_size=None):
+        self.model = model
+        self.batch_size = batch_size or settings.PUSH_LOG_BULK_BATCH_SIZE
+        self.buffer = []
+        self.written_count = 0
+
+    def add(self, **fields):
+        self.buffer.append(self.model(**fields))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """寫入目前累積的記錄，回傳本次寫入筆數。"""
+        if not self.buffer:
+            return 0
+        records, self.buffer = self.buffer, []
+        # created_at 為 auto_now_add，bulk_create 會在寫入前補上
+        self.model.objects.bulk_create(records, batch_size=self.batch_size)
+        self.written_count += len(records)
+        return len(records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.flush()
+        return False
+
+
+def flush_logs_after(method):
+    """服務方法結束時（含提前返回與例外）寫入 self.log_writer 累積的記錄。"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.log_writer.flush()
+
+    return wrapper
+
+
+def delete_in_batches(queryset, batch_size=DELETE_BATCH_SIZE):
+    """以主鍵分批刪除，避免單一交易鎖住大量資料列。"""
+    deleted = 0
+    model = queryset.model
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        count, _ = model.objects.filter(pk__in=ids).delete()
+        deleted += count
+
+
+def prune_push_logs(model, *, retention_days=None, compact_after_days=None, dry_run=False, now=None):
+    """
+    依保存期限清理推播記錄
+
+    Returns:
+        dict: {'compacted': 刪除的舊略過記錄數, 'expired': 刪除的過期記錄數}
+    """
+    retention_days = settings.PUSH_LOG_RETENTION_DAYS if retention_days is None else retention_days
+    compact_after_days = settings.PUSH_LOG_COMPACT_AFTER_DAYS if compact_after_days is None else compact_after_days
+    if retention_days < MIN_RETENTION_DAYS:
+        raise ValueError(f'retention_days 不可小於 {MIN_RETENTION_DAYS} 天（頻率控管需要最近 7 天的記錄）')
+    if compact_after_days < 1:
+        raise ValueError('compact_after_days 必須至少為 1')
+
+    now = now or timezone.now()
+    expired = model.objects.filter(created_at__lt=now - timedelta(days=retention_days))
+    compacted = model.objects.filter(
+        status='skipped',
+        created_at__lt=now - timedelta(days=compact_after_days),
+        created_at__gte=now - timedelta(days=retention_days),
+    )
+
+    if dry_run:
+        return {'compacted': compacted.count(), 'expired': expired.count()}
+
+    summary = {
+        'compacted': delete_in_batches(compacted),
+        'expired': delete_in_batches(expired),
+    }
+    logger.info(
+        '[PushLog] pruned %s: compacted=%s expired=%s',
+        model._meta.db_table,
+        summary['compacted'],
+        summary['expired'],
+    )
+    return summary
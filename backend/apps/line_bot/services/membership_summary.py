@@ -0,0 +1,81 @@
+"""
+LINE BOT 會員等級查詢
+
+店家的會員等級設定很少變動，整理成依門檻排序的等級階梯保存在行程記憶體，
+以快取中的版本號判斷是否過期（MembershipLevel 變更時由 signals 更新版本號）。
+查詢會員等級時只需一次查詢取得會員帳戶（含目前等級），下一級由階梯二分搜尋，
+不再為每則訊息查詢等級表。
+"""
+import bisect
+import threading
+import uuid
+
+from django.core.cache import cache
+
+from apps.loyalty.models import CustomerLoyaltyAccount, MembershipLevel
+
+LEVEL_LADDER_VERSION_CACHE_PREFIX = 'line_bot_membership_levels_version'
+
+
+class LevelLadder:
+    """依 (threshold_points, rank) 排序的啟用等級。"""
+
+    def __init__(self, levels):
+        self.levels = [(level.threshold_points, level.name) for level in levels]
+        self.thresholds = [threshold for threshold, _ in self.levels]
+
+    def next_level(self, total_points):
+        """回傳門檻高於 total_points 的第一個等級 (threshold_points, name)，沒有時回傳 None。"""
+        position = bisect.bisect_right(self.thresholds, total_points)
+        return self.levels[position] if position < len(self.levels) else None
+
+
+_ladders = {}
+_ladders_lock = threading.Lock()
+
+
+def _version_key(store_id):
+    return f'{LEVEL_LADDER_VERSION_CACHE_PREFIX}:{store_id}'
+
+
+def _current_version(store_id):
+    key = _version_key(store_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def get_level_ladder(store_id):
+    """取得店家目前的等級階梯，版本變更時重建。"""
+    version = _current_version(store_id)
+    cached = _ladders.get(store_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with _ladders_lock:
+        cached = _ladders.get(store_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        levels = MembershipLevel.objects.filter(store_id=store_id, active=True).only(
+            'threshold_points', 'name',
+        ).order_by('threshold_points', 'rank')
+        ladder = LevelLadder(levels)
+        _ladders[store_id] = (version, ladder)
+        return ladder
+
+
+def invalidate_level_ladder(store_id):
+    """通知所有行程在下次查詢時重建此店家的等級階梯。"""
+    cache.set(_version_key(store_id), uuid.uuid4().hex, None)
+
+
+def find_loyalty_account(store_id, line_user_id):
+    """以綁定的 LINE 帳號取得店家會員帳戶（含目前等級），沒有時回傳 None。"""
+    return CustomerLoyaltyAccount.objects.filter(
+        store_id=store_id,
+        user__line_binding__line_user_id=line_user_id,
+        user__line_binding__is_active=True,
+    ).select_related('current_level').first()
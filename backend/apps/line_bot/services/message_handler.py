@@ -3,13 +3,16 @@ import re
 import requests
 from typing import List, Dict, Optional
 from django.conf import settings
-from apps.line_bot.models import StoreFAQ, ConversationLog
+from apps.line_bot.models import StoreFAQ
+from apps.line_bot.services.answer_cache import get_cached_answer, store_answer
+from apps.line_bot.services.conversation_log import get_recent_history
+from apps.line_bot.services.faq_matcher import get_faq_index, get_usage_counter
 
 
 class FAQMatcher:
     """
     FAQ 匹配服務
-    使用關鍵字匹配找到最適合的 FAQ
+    使用店家的關鍵字比對索引找到最適合的 FAQ
     """
     
     @staticmethod
@@ -17,6 +20,9 @@ class FAQMatcher:
         """
         尋找最佳匹配的 FAQ
         
+        分數為訊息中出現的關鍵字數量，訊息包含問題全文時額外加分；
+        同分時取優先順序較高的 FAQ。
+        
         Args:
             store_id: 店家 ID
             user_message: 用戶訊息
@@ -24,39 +30,11 @@ class FAQMatcher:
         Returns:
             StoreFAQ: 最佳匹配的 FAQ，若無則返回 None
         """
-        # 取得該店家所有啟用的 FAQ
-        faqs = StoreFAQ.objects.filter(
-            store_id=store_id,
-            is_active=True
-        ).order_by('-priority')
-        
-        user_message_lower = user_message.lower()
-        best_match = None
-        max_match_count = 0
-        
-        for faq in faqs:
-            # 計算匹配到的關鍵字數量
-            match_count = sum(
-                1 for keyword in faq.keywords
-                if keyword.lower() in user_message_lower
-            )
-            
-            # 如果問題本身也包含在用戶訊息中，額外加分
-            if faq.question.lower() in user_message_lower:
-                match_count += 2
-            
-            if match_count > max_match_count:
-                max_match_count = match_count
-                best_match = faq
-        
-        # 如果至少匹配到一個關鍵字才返回
-        if max_match_count > 0 and best_match:
-            # 增加使用次數
-            best_match.usage_count += 1
-            best_match.save(update_fields=['usage_count'])
-            return best_match
-        
-        return None
+        best_match = get_faq_index(store_id).best_match(user_message)
+        if best_match:
+            # 使用次數由背景批次寫回
+            get_usage_counter().record(best_match.id)
+        return best_match
 
 
 class AIReplyService:
@@ -65,6 +43,9 @@ class AIReplyService:
     支援 Google Gemini、OpenAI GPT 和 Groq
     優先使用平台 AI 設定，若無則使用店家設定（保持向後相容）
     """
+
+    UNAVAILABLE_REPLY = "抱歉，AI 服務暫時無法使用。"
+    ERROR_REPLY = "抱歉，我現在無法回答這個問題。請稍後再試，或直接聯繫店家。"
     
     def __init__(self, store_config=None):
         """
@@ -313,7 +294,7 @@ class AIReplyService:
         elif self.provider == 'groq':
             return self._generate_groq_reply(user_message, store_info, conversation_history)
         else:
-            return "抱歉，AI 服務暫時無法使用。"
+            return self.UNAVAILABLE_REPLY
     
     def _generate_gemini_reply(
         self,
@@ -382,11 +363,11 @@ class AIReplyService:
                     return reply.strip()
             
             print(f"Gemini API error: {response.status_code} - {response.text}")
-            return "抱歉，我現在無法回答這個問題。請稍後再試，或直接聯繫店家。"
+            return self.ERROR_REPLY
             
         except Exception as e:
             print(f"Gemini reply error: {e}")
-            return "抱歉，我現在無法回答這個問題。請稍後再試，或直接聯繫店家。"
+            return self.ERROR_REPLY
     
     def _generate_openai_reply(
         self,
@@ -435,7 +416,7 @@ class AIReplyService:
             
         except Exception as e:
             print(f"OpenAI reply error: {e}")
-            return "抱歉，我現在無法回答這個問題。請稍後再試，或直接聯繫店家。"
+            return self.ERROR_REPLY
     
     def _generate_groq_reply(
         self,
@@ -489,11 +470,11 @@ class AIReplyService:
             
         except Exception as e:
             print(f"Groq reply error: {e}")
-            return "抱歉，我現在無法回答這個問題。請稍後再試，或直接聯繫店家。"
+            return self.ERROR_REPLY
     
     def _create_system_prompt(self, store_info: Dict) -> str:
         """
-        建立系統提示詞
+        建立系統提示詞（store_info 已附預先產生的提示詞時直接使用）
         
         Args:
             store_info: 店家資訊（包含菜單資料）
@@ -501,6 +482,13 @@ class AIReplyService:
         Returns:
             str: 系統提示詞
         """
+        if store_info.get('system_prompt'):
+            return store_info['system_prompt']
+        return self.render_system_prompt(store_info, self.store_config, self.max_prompt_chars)
+
+    @classmethod
+    def render_system_prompt(cls, store_info: Dict, store_config=None, max_prompt_chars: int = 3600) -> str:
+        """依店家資訊與店家自訂提示詞產生系統提示詞（不需要 AI 設定，可預先產生後快取）。"""
         store_name = store_info.get('name', '餐廳')
         
         # 建立菜單文字
@@ -514,7 +502,7 @@ class AIReplyService:
                 for product in category_data.get('products', []):
                     product_line = f"- {product['name']} ${product['price']}"
                     if product.get('description'):
-                        product_line += f" ({self._truncate_text(product['description'], 60)})"
+                        product_line += f" ({cls._truncate_text(product['description'], 60)})"
                     menu_lines.append(product_line)
                     # 加入規格資訊
                     if product.get('specifications'):
@@ -522,11 +510,11 @@ class AIReplyService:
                             menu_lines.append(f"  └ {spec}")
             menu_text = "\n".join(menu_lines)
 
-        fixed_holidays = self._format_fixed_holidays(store_info)
-        opening_hours_text = self._format_opening_hours(store_info.get('opening_hours'))
+        fixed_holidays = cls._format_fixed_holidays(store_info)
+        opening_hours_text = cls._format_opening_hours(store_info.get('opening_hours'))
         reservation_context = dict(store_info.get('reservation', {}) or {})
         reservation_context['fixed_holidays'] = fixed_holidays
-        reservation_info_text = self._format_reservation_info(reservation_context)
+        reservation_info_text = cls._format_reservation_info(reservation_context)
         website = store_info.get('website') or '未提供'
         line_friend_url = store_info.get('line_friend_url') or '未提供'
         
@@ -550,7 +538,7 @@ class AIReplyService:
 
         # 如果有菜單資料，加入提示詞
         if menu_text:
-            menu_text = self._truncate_text(menu_text, 1400)
+            menu_text = cls._truncate_text(menu_text, 1400)
             base_prompt += f"""
 
 菜單資訊：{menu_text}"""
@@ -567,13 +555,13 @@ class AIReplyService:
 7. 對於電話、營業時間、訂位規則，僅能引用上述資料，不可自行猜測或改寫"""
 
         # 如果店家有自訂提示詞，附加在後面
-        if self.store_config and self.store_config.custom_system_prompt:
+        if store_config and store_config.custom_system_prompt:
             base_prompt += f"""
 
 店家額外指示：
-        {self._truncate_text(self.store_config.custom_system_prompt, 400)}"""
+        {cls._truncate_text(store_config.custom_system_prompt, 400)}"""
 
-        return self._truncate_text(base_prompt, self.max_prompt_chars)
+        return cls._truncate_text(base_prompt, max_prompt_chars)
 
 
 class MessageHandler:
@@ -642,25 +630,33 @@ class MessageHandler:
         else:
             # 使用 AI 生成回覆（如果已啟用）
             if self.ai_service and getattr(self.config, 'enable_ai_reply', True):
-                # 取得最近的對話歷史
-                recent_logs = ConversationLog.objects.filter(
-                    line_user_id=line_user_id,
-                    store_id=store_id
-                ).order_by('-created_at')[:10]
-                
-                conversation_history = [
-                    {
-                        "role": "assistant" if log.sender_type == "bot" else "user",
-                        "content": log.message_content
+                # 相同問題（同一版本的店家資料）直接使用先前的 AI 回覆
+                context_version = store_info.get('context_version')
+                cached_reply = get_cached_answer(store_id, context_version, message) if context_version else None
+                if cached_reply:
+                    return {
+                        'reply': cached_reply,
+                        'used_ai': True,
+                        'matched_faq_id': None,
+                        'ai_model': self.ai_service.model,
+                        'cache_hit': True,
                     }
-                    for log in reversed(recent_logs)
-                ]
+
+                # 取得最近的對話歷史（共用快取中的環狀緩衝，不存在時才查詢資料庫）
+                conversation_history = get_recent_history(store_id, line_user_id)
                 
                 ai_reply = self.ai_service.generate_reply(
                     user_message=message,
                     store_info=store_info,
                     conversation_history=conversation_history
                 )
+                # 參考了此用戶對話歷史的回覆只適用於這段對話，不放入跨用戶共用的回覆快取
+                if (
+                    context_version
+                    and not conversation_history
+                    and ai_reply not in (AIReplyService.UNAVAILABLE_REPLY, AIReplyService.ERROR_REPLY)
+                ):
+                    store_answer(store_id, context_version, message, ai_reply)
                 
                 return {
                     'reply': ai_reply,
@@ -677,40 +673,54 @@ class MessageHandler:
                     'ai_model': None
                 }
 
-    def _build_direct_fact_reply(self, message: str, store_info: Dict) -> Optional[str]:
-        """針對電話、營業時間、訂位資訊提供一致且可驗證的固定回覆。"""
-        normalized = re.sub(r'\s+', '', (message or '').lower())
+    # 依序檢查的固定回覆類型與觸發關鍵字
+    FACT_KEYWORDS = (
+        ('phone', ['電話', '聯絡', '客服', '電話號碼', '打給', '電話幾號']),
+        ('hours', ['營業時間', '幾點開', '幾點關', '開到幾點', '營業日', '休息日', '休息時間']),
+        ('reservation', ['訂位', '定位', '預約', '可訂位', '訂位資訊', '時段', '訂位時間', '幾人', '人數上限']),
+        # 「位置」多指座位、「在哪」也用於詢問訂單或餐點，只採用明確詢問店址的用語
+        ('address', ['地址', '店址', '店在哪', '餐廳在哪', '門市在哪', '怎麼去', '怎麼走']),
+        ('vegetarian', ['素食', '吃素', '全素', '蛋奶素', '有素']),
+    )
 
-        phone_keywords = ['電話', '聯絡', '客服', '電話號碼', '打給', '電話幾號']
-        hours_keywords = ['營業時間', '幾點開', '幾點關', '開到幾點', '營業日', '休息日', '休息時間']
-        reservation_keywords = ['訂位', '定位', '預約', '可訂位', '訂位資訊', '時段', '訂位時間', '幾人', '人數上限']
-
-        asks_phone = any(keyword in normalized for keyword in phone_keywords)
-        asks_hours = any(keyword in normalized for keyword in hours_keywords)
-        asks_reservation = any(keyword in normalized for keyword in reservation_keywords)
-
-        if not (asks_phone or asks_hours or asks_reservation):
-            return None
+    @staticmethod
+    def build_fact_answers(store_info: Dict) -> Dict[str, str]:
+        """
+        預先產生各類固定回覆（由 store_context 建立店家資料時一併快取）
 
+        素食回覆需要 store_info['vegetarian_items']，沒有標示素食的餐點時不提供。
+        """
         store_name = store_info.get('name', '本店')
-        reply_parts = []
+        fixed_holidays = AIReplyService._format_fixed_holidays(store_info)
+        reservation_context = dict(store_info.get('reservation', {}) or {})
+        reservation_context['fixed_holidays'] = fixed_holidays
+        opening_text = AIReplyService._format_opening_hours(store_info.get('opening_hours'))
 
-        if asks_phone:
-            phone = store_info.get('phone') or '未提供'
-            reply_parts.append(f"{store_name} 聯絡電話：{phone}")
+        answers = {
+            'phone': f"{store_name} 聯絡電話：{store_info.get('phone') or '未提供'}",
+            'hours': f"營業時間：\n{opening_text}\n固定休息日：{fixed_holidays}",
+            'reservation': f"訂位資訊：\n{AIReplyService._format_reservation_info(reservation_context)}",
+            'address': f"{store_name} 地址：{store_info.get('address') or '未提供'}",
+        }
+        vegetarian_items = store_info.get('vegetarian_items')
+        if vegetarian_items:
+            answers['vegetarian'] = '有的！標示為素食的餐點：\n' + '\n'.join(f"• {name}" for name in vegetarian_items)
+        return answers
 
-        if asks_hours:
-            opening_text = AIReplyService._format_opening_hours(store_info.get('opening_hours'))
-            fixed_holidays = AIReplyService._format_fixed_holidays(store_info)
-            reply_parts.append(f"營業時間：\n{opening_text}\n固定休息日：{fixed_holidays}")
+    def _build_direct_fact_reply(self, message: str, store_info: Dict) -> Optional[str]:
+        """針對電話、營業時間、訂位、地址與素食資訊提供一致且可驗證的固定回覆。"""
+        normalized = re.sub(r'\s+', '', (message or '').lower())
 
-        if asks_reservation:
-            reservation_context = dict(store_info.get('reservation', {}) or {})
-            reservation_context['fixed_holidays'] = AIReplyService._format_fixed_holidays(store_info)
-            reservation_text = AIReplyService._format_reservation_info(reservation_context)
-            reply_parts.append(f"訂位資訊：\n{reservation_text}")
+        intents = [
+            intent for intent, keywords in self.FACT_KEYWORDS
+            if any(keyword in normalized for keyword in keywords)
+        ]
+        if not intents:
+            return None
 
-        return '\n\n'.join(reply_parts)
+        answers = store_info.get('fact_answers') or self.build_fact_answers(store_info)
+        reply_parts = [answers[intent] for intent in intents if answers.get(intent)]
+        return '\n\n'.join(reply_parts) or None
     
     def get_store_context_menu(self, store_info: Dict) -> str:
         """
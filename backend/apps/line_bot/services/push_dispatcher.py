@@ -0,0 +1,509 @@
+"""
+LINE 推播派送器
+
+將大量 push 請求交給有上限的執行緒池並行送出：
+- 同一個頻道（channel access token）共用 token bucket，避免超過 LINE 的每秒請求上限
+- 429 依 Retry-After 等待後重試，5xx 與連線錯誤以指數退避重試
+- 每則推播固定一個 X-Line-Retry-Key，重試時 LINE 會回 409 表示已接受過，視為成功，不會重複送達
+- 回報送出數、重試數、被限流次數與每秒吞吐量
+- dispatch_grouped 將內容相同的收件者合併為 multicast（每次最多 500 人）
+
+資料庫寫入（推播記錄）一律由呼叫端在主執行緒處理，worker 只負責 HTTP。
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 相對於 settings.LINE_API_BASE_URL 的路徑（測試與壓測時可指向模擬伺服器）
+PUSH_PATH = '/message/push'
+MULTICAST_PATH = '/message/multicast'
+MULTICAST_MAX_RECIPIENTS = 500
+# 超過此等待時間的 Retry-After 不再重試，避免卡住整個推播週期
+MAX_RETRY_AFTER_SECONDS = 60
+BACKOFF_BASE_SECONDS = 0.5
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+# 以 uuid5 由工作識別碼導出 X-Line-Retry-Key（LINE 要求 UUID 格式）
+RETRY_KEY_NAMESPACE = uuid.UUID('6f1b4d8e-3c2a-5e7f-9a10-2b4c6d8e0f12')
+
+_registry_lock = threading.Lock()
+_channel_buckets = {}
+_channel_sessions = {}
+_dispatchers = {}
+
+
+class TokenBucket:
+    """執行緒安全的 token bucket，rate 為每秒補充數量。"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，必要時等待；回傳等待秒數。"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
+
+
+def _channel_key(channel_access_token):
+    return hashlib.sha256((channel_access_token or '').encode()).hexdigest()[:16]
+
+
+def get_line_session(channel_access_token):
+    """
+    同一頻道在行程內共用的 keep-alive 連線池
+
+    推播派送器與 LineMessagingAPI 共用，避免每次請求都重新建立 TLS 連線。
+    """
+    key = _channel_key(channel_access_token)
+    with _registry_lock:
+        session = _channel_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max(settings.LINE_API_POOL_SIZE, settings.LINE_PUSH_MAX_WORKERS),
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _channel_sessions[key] = session
+        return session
+
+
+def get_channel_bucket(channel_access_token):
+    """同一頻道在行程內共用同一個限流器。"""
+    key = _channel_key(channel_access_token)
+    with _registry_lock:
+        bucket = _channel_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(settings.LINE_PUSH_RATE_PER_SECOND)
+            _channel_buckets[key] = bucket
+        return bucket
+
+
+class PushResult:
+    """單一推播的結果。key 為呼叫端自訂的對應資料（例如 LineUserBinding）。"""
+
+    __slots__ = ('key', 'to', 'success', 'status_code', 'attempts', 'error', 'retry_key')
+
+    def __init__(self, key, to, retry_key):
+        self.key = key
+        self.to = to
+        self.retry_key = retry_key
+        self.success = False
+        self.status_code = None
+        self.attempts = 0
+        self.error = ''
+
+    @property
+    def retryable(self):
+        """暫時性失敗（連線錯誤、未設定權杖、429、5xx），稍後重送可能成功。"""
+        if self.success:
+            return False
+        return self.status_code is None or self.status_code == 429 or self.status_code in RETRYABLE_STATUS_CODES
+
+    def __repr__(self):
+        return f"<PushResult to={self.to} success={self.success} status={self.status_code} attempts={self.attempts}>"
+
+
+class PushMetrics:
+    """派送統計（執行緒安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.total = 0
+        self.success = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.http_requests = 0
+        self.throttle_wait_seconds = 0.0
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def as_dict(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            'total': self.total,
+            'success': self.success,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'http_requests': self.http_requests,
+            'throttle_wait_seconds': round(self.throttle_wait_seconds, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_second': round(self.total / elapsed, 2) if elapsed > 0 else None,
+        }
+
+
+def merge_metrics(summaries):
+    """合併多次 dispatch 的統計（PushMetrics.as_dict 格式）。"""
+    merged = {
+        'total': 0,
+        'success': 0,
+        'failed': 0,
+        'retried': 0,
+        'rate_limited': 0,
+        'http_requests': 0,
+        'throttle_wait_seconds': 0.0,
+        'elapsed_seconds': 0.0,
+    }
+    for summary in summaries:
+        for field in merged:
+            merged[field] += summary.get(field) or 0
+    merged['throttle_wait_seconds'] = round(merged['throttle_wait_seconds'], 3)
+    merged['elapsed_seconds'] = round(merged['elapsed_seconds'], 3)
+    elapsed = merged['elapsed_seconds']
+    merged['throughput_per_second'] = round(merged['total'] / elapsed, 2) if elapsed > 0 else None
+    return merged
+
+
+def message_fingerprint(messages):
+    """訊息內容的雜湊，內容相同的收件者可合併為一次 multicast。"""
+    return hashlib.sha256(
+        json.dumps(messages, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class PushDispatcher:
+    """
+    單一頻道的推播派送器
+
+    Args:
+        channel_access_token: 頻道存取權杖
+        max_workers: 並行 HTTP 請求數
+        max_retries: 單則推播最多重試次數
+        timeout: 單次請求逾時（秒）
+        session: 可注入的 requests.Session（預設同頻道共用連線池）
+        bucket: 可注入的 TokenBucket（預設同頻道共用）
+        api_base_url: API 位址（預設 settings.LINE_API_BASE_URL）
+    """
+
+    def __init__(
+        self,
+        channel_access_token,
+        *,
+        max_workers=None,
+        max_retries=None,
+        timeout=None,
+        session=None,
+        bucket=None,
+        sleep=time.sleep,
+        api_base_url=None,
+    ):
+        self.channel_access_token = channel_access_token
+        self.api_base_url = (api_base_url or settings.LINE_API_BASE_URL).rstrip('/')
+        self.push_url = f'{self.api_base_url}{PUSH_PATH}'
+        self.multicast_url = f'{self.api_base_url}{MULTICAST_PATH}'
+        self.max_workers = max_workers or settings.LINE_PUSH_MAX_WORKERS
+        self.max_retries = settings.LINE_PUSH_MAX_RETRIES if max_retries is None else max_retries
+        self.timeout = timeout or settings.LINE_PUSH_TIMEOUT_SECONDS
+        self.bucket = bucket or get_channel_bucket(channel_access_token)
+        self._sleep = sleep
+        self._background = None
+        self._background_lock = threading.Lock()
+
+        self.session = session or get_line_session(channel_access_token)
+
+    def _headers(self, retry_key):
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.channel_access_token}',
+            'X-Line-Retry-Key': retry_key,
+        }
+
+    def _backoff(self, attempt):
+        return BACKOFF_BASE_SECONDS * (2 ** (attempt - 1)) * (1 + random.random() * 0.25)
+
+    def _post(self, url, body, result, metrics):
+        """送出請求並依回應重試，結果寫入 result。"""
+        payload = json.dumps(body)
+        while result.attempts <= self.max_retries:
+            if result.attempts and metrics is not None:
+                metrics.incr('retried')
+            result.attempts += 1
+
+            waited = self.bucket.acquire()
+            if waited and metrics is not None:
+                metrics.incr('throttle_wait_seconds', waited)
+            if metrics is not None:
+                metrics.incr('http_requests')
+
+            delay = None
+            try:
+                response = self.session.post(
+                    url,
+                    headers=self._headers(result.retry_key),
+                    data=payload,
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as exc:
+                result.status_code = None
+                result.error = str(exc)
+                delay = self._backoff(result.attempts)
+            else:
+                result.status_code = response.status_code
+                if response.status_code == 200:
+                    result.success = True
+                    result.error = ''
+                    break
+                if response.status_code == 409 and response.headers.get('X-Line-Accepted-Request-Id'):
+                    # 相同 retry key 的請求先前已被接受
+                    result.success = True
+                    result.error = ''
+                    break
+                result.error = f'status={response.status_code} {response.text[:200]}'
+                if response.status_code == 429:
+                    if metrics is not None:
+                        metrics.incr('rate_limited')
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    delay = self._backoff(result.attempts) if retry_after is None else retry_after
+                elif response.status_code in RETRYABLE_STATUS_CODES:
+                    delay = self._backoff(result.attempts)
+
+            if delay is None or delay > MAX_RETRY_AFTER_SECONDS or result.attempts > self.max_retries:
+                break
+            self._sleep(delay)
+
+    def send(self, to, messages, *, key=None, retry_key=None, metrics=None):
+        """同步送出單則推播（含限流與重試）。"""
+        result = PushResult(key, to, retry_key or str(uuid.uuid4()))
+        if metrics is not None:
+            metrics.incr('total')
+
+        if not self.channel_access_token:
+            result.error = 'missing_channel_access_token'
+        else:
+            self._post(self.push_url, {'to': to, 'messages': messages}, result, metrics)
+
+        if metrics is not None:
+            metrics.incr('success' if result.success else 'failed')
+        if not result.success:
+            logger.warning('[LINE Push] failed to=%s attempts=%s error=%s', to, result.attempts, result.error)
+        return result
+
+    def send_multicast(self, recipients, messages, *, keys=None, retry_key=None, metrics=None):
+        """
+        以 multicast 一次送給多位用戶（最多 MULTICAST_MAX_RECIPIENTS 人）
+
+        Returns:
+            list: 每位收件者一個 PushResult（共用同一次請求的結果）
+        """
+        recipients = list(recipients)
+        if len(recipients) > MULTICAST_MAX_RECIPIENTS:
+            raise ValueError(f'multicast 每次最多 {MULTICAST_MAX_RECIPIENTS} 人')
+        keys = list(keys) if keys is not None else [None] * len(recipients)
+
+        shared = PushResult(None, recipients, retry_key or str(uuid.uuid4()))
+        if metrics is not None:
+            metrics.incr('total', len(recipients))
+
+        if not self.channel_access_token:
+            shared.error = 'missing_channel_access_token'
+        else:
+            self._post(self.multicast_url, {'to': recipients, 'messages': messages}, shared, metrics)
+
+        if metrics is not None:
+            metrics.incr('success' if shared.success else 'failed', len(recipients))
+        if not shared.success:
+            logger.warning(
+                '[LINE Push] multicast failed recipients=%s attempts=%s error=%s',
+                len(recipients),
+                shared.attempts,
+                shared.error,
+            )
+
+        results = []
+        for key, to in zip(keys, recipients):
+            result = PushResult(key, to, shared.retry_key)
+            result.success = shared.success
+            result.status_code = shared.status_code
+            result.attempts = shared.attempts
+            result.error = shared.error
+            results.append(result)
+        return results
+
+    def dispatch(self, jobs):
+        """
+        並行送出多則推播
+
+        Args:
+            jobs: 可迭代的 (key, to, messages)
+
+        Returns:
+            (results, metrics)：results 與 jobs 順序相同
+        """
+        jobs = list(jobs)
+        metrics = PushMetrics()
+        if not jobs:
+            metrics.finished_at = metrics.started_at
+            return [], metrics.as_dict()
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as executor:
+            results = list(executor.map(
+                lambda job: self.send(job[1], job[2], key=job[0], metrics=metrics),
+                jobs,
+            ))
+        metrics.finished_at = time.monotonic()
+        summary = metrics.as_dict()
+        logger.info(
+            '[LINE Push] dispatched total=%s success=%s failed=%s retried=%s rate_limited=%s throughput=%s/s',
+            summary['total'],
+            summary['success'],
+            summary['failed'],
+            summary['retried'],
+            summary['rate_limited'],
+            summary['throughput_per_second'],
+        )
+        return results, summary
+
+    def dispatch_grouped(self, jobs, *, retry_key_prefix=None):
+        """
+        依訊息內容分組後送出：內容相同的收件者以 multicast（每批 500 人）送出，
+        只有一位收件者的內容才逐一 push。
+
+        Args:
+            jobs: 可迭代的 (key, to, messages)
+            retry_key_prefix: 指定時 X-Line-Retry-Key 由 (prefix, key) 導出而非隨機產生，
+                中斷後重送相同的收件者（multicast 為相同的一組收件者）時 LINE 會回 409，
+                不會重複送達
+
+        Returns:
+            (results, metrics)：results 與 jobs 順序相同
+        """
+        jobs = list(jobs)
+        groups = {}
+        for index, (key, to, messages) in enumerate(jobs):
+            groups.setdefault(message_fingerprint(messages), (messages, []))[1].append(index)
+
+        tasks = []
+        for messages, indexes in groups.values():
+            if len(indexes) == 1:
+                tasks.append(('push', messages, indexes))
+                continue
+            for start in range(0, len(indexes), MULTICAST_MAX_RECIPIENTS):
+                tasks.append(('multicast', messages, indexes[start:start + MULTICAST_MAX_RECIPIENTS]))
+
+        metrics = PushMetrics()
+        results = [None] * len(jobs)
+
+        def run(task):
+            mode, messages, indexes = task
+            keys = [jobs[index][0] for index in indexes]
+            retry_key = derive_retry_key(retry_key_prefix, keys) if retry_key_prefix else None
+            if mode == 'push':
+                key, to, _ = jobs[indexes[0]]
+                return indexes, [self.send(to, messages, key=key, retry_key=retry_key, metrics=metrics)]
+            return indexes, self.send_multicast(
+                [jobs[index][1] for index in indexes],
+                messages,
+                keys=keys,
+                retry_key=retry_key,
+                metrics=metrics,
+            )
+
+        if tasks:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(tasks))) as executor:
+                for indexes, task_results in executor.map(run, tasks):
+                    for index, result in zip(indexes, task_results):
+                        results[index] = result
+        metrics.finished_at = time.monotonic()
+        summary = metrics.as_dict()
+        summary['multicast_groups'] = sum(1 for mode, _, _ in tasks if mode == 'multicast')
+        logger.info(
+            '[LINE Push] grouped dispatch recipients=%s http_requests=%s multicast_groups=%s success=%s failed=%s',
+            summary['total'],
+            summary['http_requests'],
+            summary['multicast_groups'],
+            summary['success'],
+            summary['failed'],
+        )
+        return results, summary
+
+    def submit(self, to, messages, *, key=None):
+        """
+        在背景執行緒送出（不阻塞呼叫端），回傳 Future
+
+        通知類呼叫端不會檢查 Future，送出時的例外由 done callback 記錄；
+        推播失敗（非例外）已在 send 中記錄。
+        """
+        with self._background_lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='line-push',
+                )
+        future = self._background.submit(self.send, to, messages, key=key)
+        future.add_done_callback(lambda done: _log_background_failure(done, to))
+        return future
+
+
+def _log_background_failure(future, to):
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error('[LINE Push] background push to=%s raised', to, exc_info=exc)
+
+
+def derive_retry_key(prefix, keys):
+    """由 prefix 與收件者 key 導出固定的 retry key（同一組輸入永遠相同）。"""
+    name = f"{prefix}:{','.join(sorted(str(key) for key in keys))}"
+    return str(uuid.uuid5(RETRY_KEY_NAMESPACE, name))
+
+
+def get_push_dispatcher(channel_access_token):
+    """取得行程內共用的派送器（同頻道共用連線池、限流器與背景執行緒）。"""
+    key = _channel_key(channel_access_token)
+    with _registry_lock:
+        dispatcher = _dispatchers.get(key)
+    if dispatcher is None:
+        dispatcher = PushDispatcher(channel_access_token)
+        with _registry_lock:
+            dispatcher = _dispatchers.setdefault(key, dispatcher)
+    return dispatcher
@@ -0,0 +1,217 @@
+"""
+LINE BOT 回覆用的店家資料
+
+AI 回覆需要店家基本資訊、訂位時段與菜單（含規格）。這份資料只在商品、分類、
+規格、時段、店家或 BOT 設定變更時才會改變，因此整份組好後連同預先產生的
+系統提示詞與固定回覆（電話、營業時間、訂位、地址、素食）快取起來，收到訊息時
+直接取用；相關 model 變更時由 signals 清除快取（其他行程要收到清除需要共用
+快取，未設定 REDIS_URL 時保存秒數預設縮短為 5 分鐘）。每次建立都會產生新的
+context_version，AI 回覆快取以它區分店家資料版本。
+
+建立時菜單以固定數量的查詢取得（分類、商品、規格群組、規格選項各一次），
+不會隨分類與商品數增加。
+"""
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from apps.products.models import Product, ProductCategory, ProductSpecification, SpecificationGroup
+from apps.reservations.models import TimeSlot
+
+logger = logging.getLogger(__name__)
+
+STORE_CONTEXT_CACHE_PREFIX = 'line_bot_store_context'
+
+MAX_MENU_CATEGORIES = 6
+MAX_PRODUCTS_PER_CATEGORY = 8
+MAX_SPEC_GROUPS_PER_PRODUCT = 3
+MAX_SPEC_OPTIONS_PER_GROUP = 6
+MAX_DESCRIPTION_LENGTH = 80
+MAX_RESERVATION_SLOTS = 20
+MAX_VEGETARIAN_ITEMS = 8
+# 「素食」「全素」「蛋奶素」等食物標籤
+VEGETARIAN_TAG_MARKER = '素'
+
+DAY_ORDER = {
+    'monday': 0,
+    'tuesday': 1,
+    'wednesday': 2,
+    'thursday': 3,
+    'friday': 4,
+    'saturday': 5,
+    'sunday': 6,
+}
+
+
+def store_context_cache_key(store_id):
+    return f'{STORE_CONTEXT_CACHE_PREFIX}:{store_id}'
+
+
+def _build_reservation_slots(store):
+    active_slots = list(TimeSlot.objects.filter(store=store, is_active=True))
+    active_slots.sort(key=lambda slot: (DAY_ORDER.get(slot.day_of_week, 99), slot.start_time))
+    return [
+        {
+            'day': slot.get_day_of_week_display(),
+            'start_time': slot.start_time.strftime('%H:%M'),
+            'end_time': slot.end_time.strftime('%H:%M') if slot.end_time else '',
+            'max_party_size': slot.max_party_size,
+            'max_capacity': slot.max_capacity,
+        }
+        for slot in active_slots[:MAX_RESERVATION_SLOTS]
+    ]
+
+
+def _format_option(option):
+    if option.price_adjustment > 0:
+        return f"{option.name}(+${option.price_adjustment})"
+    if option.price_adjustment < 0:
+        return f"{option.name}(-${abs(option.price_adjustment)})"
+    return option.name
+
+
+def _product_info(product, include_specs):
+    description = (product.description or '').strip()
+    if len(description) > MAX_DESCRIPTION_LENGTH:
+        description = f"{description[:MAX_DESCRIPTION_LENGTH]}..."
+
+    product_info = {
+        'name': product.name,
+        'price': float(product.price),
+        'description': description,
+    }
+    if include_specs:
+        specs = []
+        for group in product.active_spec_groups[:MAX_SPEC_GROUPS_PER_PRODUCT]:
+            options = [_format_option(option) for option in group.active_options[:MAX_SPEC_OPTIONS_PER_GROUP]]
+            if options:
+                specs.append(f"{group.name}: {', '.join(options)}")
+        if specs:
+            product_info['specifications'] = specs
+    return product_info
+
+
+def _build_menu(store):
+    categories = list(
+        ProductCategory.objects.filter(store=store, is_active=True).order_by('display_order')[:MAX_MENU_CATEGORIES]
+    )
+    category_ids = [category.id for category in categories]
+
+    # 先只取主鍵決定每個分類要放入的商品，再載入這些商品與規格
+    selected_ids = {category_id: [] for category_id in category_ids}
+    selected_ids[None] = []
+    # 同一次查詢也收集標示素食的餐點（不限於菜單摘要中的分類）
+    vegetarian_items = []
+    product_rows = Product.objects.filter(
+        store=store,
+        is_available=True,
+    ).order_by('id').values_list('id', 'category_id', 'name', 'food_tags')
+    for product_id, category_id, name, food_tags in product_rows:
+        if len(vegetarian_items) < MAX_VEGETARIAN_ITEMS and any(
+            VEGETARIAN_TAG_MARKER in str(tag) for tag in food_tags or []
+        ):
+            vegetarian_items.append(name)
+        ids = selected_ids.get(category_id)
+        if ids is not None and len(ids) < MAX_PRODUCTS_PER_CATEGORY:
+            ids.append(product_id)
+
+    product_ids = [product_id for ids in selected_ids.values() for product_id in ids]
+    products = Product.objects.filter(id__in=product_ids).prefetch_related(
+        Prefetch(
+            'specification_groups',
+            queryset=SpecificationGroup.objects.filter(is_active=True).order_by('display_order').prefetch_related(
+                Prefetch(
+                    'options',
+                    queryset=ProductSpecification.objects.filter(is_active=True).order_by('display_order'),
+                    to_attr='active_options',
+                )
+            ),
+            to_attr='active_spec_groups',
+        )
+    )
+    products_by_id = {product.id: product for product in products}
+
+    menu_data = []
+    for category in categories:
+        category_products = [
+            _product_info(products_by_id[product_id], include_specs=True)
+            for product_id in selected_ids[category.id]
+        ]
+        if category_products:
+            menu_data.append({'category': category.name, 'products': category_products})
+
+    # 也加入沒有分類的產品
+    if selected_ids[None]:
+        menu_data.append({
+            'category': '其他',
+            'products': [
+                _product_info(products_by_id[product_id], include_specs=False)
+                for product_id in selected_ids[None]
+            ],
+        })
+    return menu_data, vegetarian_items
+
+
+def build_store_context(store, bot_config=None):
+    """
+    組出 AI 回覆用的店家資料（store_info 格式），並附上預先產生的系統提示詞
+
+    Args:
+        store: Store
+        bot_config: StoreLineBotConfig（用於店家自訂提示詞）
+    """
+    from apps.line_bot.services.message_handler import AIReplyService, MessageHandler
+
+    try:
+        reservation_slots = _build_reservation_slots(store)
+    except Exception as exc:
+        logger.warning('[StoreContext] failed to load reservation slots for store %s: %s', store.id, exc)
+        reservation_slots = []
+
+    store_info = {
+        'id': store.id,
+        'name': store.name,
+        'cuisine_type': store.get_cuisine_type_display(),
+        'address': store.address,
+        'phone': store.phone,
+        'opening_hours': store.opening_hours,
+        'description': store.description,
+        'fixed_holidays': store.fixed_holidays,
+        'website': store.website,
+        'line_friend_url': store.line_friend_url,
+        'reservation': {
+            'enabled': store.enable_reservation,
+            'fixed_holidays': store.fixed_holidays,
+            'time_slots': reservation_slots,
+            'contact_phone': store.phone,
+        },
+    }
+
+    try:
+        store_info['menu'], store_info['vegetarian_items'] = _build_menu(store)
+    except Exception as exc:
+        logger.warning('[StoreContext] failed to load menu for store %s: %s', store.id, exc)
+        store_info['menu'], store_info['vegetarian_items'] = [], []
+
+    store_info['system_prompt'] = AIReplyService.render_system_prompt(store_info, bot_config)
+    store_info['fact_answers'] = MessageHandler.build_fact_answers(store_info)
+    # AI 回覆快取以此版本區分，店家資料重建後舊回覆不再使用
+    store_info['context_version'] = uuid.uuid4().hex
+    return store_info
+
+
+def get_store_context(store, bot_config=None):
+    """取得快取的店家資料，不存在時建立並寫入快取。"""
+    key = store_context_cache_key(store.id)
+    store_info = cache.get(key)
+    if store_info is None:
+        store_info = build_store_context(store, bot_config)
+        cache.set(key, store_info, settings.LINE_BOT_STORE_CONTEXT_CACHE_SECONDS)
+    return store_info
+
+
+def invalidate_store_context(store_id):
+    cache.delete(store_context_cache_key(store_id))
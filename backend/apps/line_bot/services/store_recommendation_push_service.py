@@ -1,19 +1,41 @@
+"""
+店家熱門推薦與新品推薦自動推播
+
+每個週期以集合查詢取代逐店、逐用戶查詢：
+1. 一次查詢取得所有啟用店家的（店家、LINE 綁定）組合，並以子查詢附上
+   最近一次成功推播時間與近 7 天成功次數，以 iterator 逐批讀取
+2. 一次彙總取得各店家的熱門商品
+3. 每批用戶一次讀取店家內偏好輪廓（預先計算結果，缺少時分組計算）與候選新品
+
+用戶依店家分批（RECIPIENT_CHUNK_SIZE）組訊息並交給 PushDispatcher 的工作執行緒派送，
+記憶體用量只與批次大小有關，不隨會員總數增加。
+"""
 import logging
 from collections import defaultdict
 from datetime import timedelta
 
-from django.db.models import Count, Sum
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from apps.intelligence.models import PlatformSettings
+from apps.intelligence.leases import ensure_lease_held
+from apps.intelligence.models import PlatformSettings, UserRecommendation
+from apps.intelligence.services.recommendation_batch_service import STORE_PROFILE_LIMIT, compute_store_profiles
 from apps.line_bot.models import LineUserBinding, StoreLineBotConfig, StoreUserPushLog
 from apps.line_bot.services.line_api import LineMessagingAPI
+from apps.line_bot.services.log_writer import BufferedLogWriter, flush_logs_after
+from apps.line_bot.services.push_dispatcher import PushDispatcher, merge_metrics
 from apps.loyalty.models import CustomerLoyaltyAccount
 from apps.orders.models import DineInOrderItem, TakeoutOrderItem
 from apps.products.models import Product
 
 logger = logging.getLogger(__name__)
 
+# 每批組訊息與派送的用戶數
+RECIPIENT_CHUNK_SIZE = 500
+# 每批候選新品數（依建立時間由新到舊）
+NEW_PRODUCT_CANDIDATE_LIMIT = 80
+
 
 class StoreRecommendationPushService:
     """店家對用戶的熱門推薦與新品推薦自動推播服務。"""
@@ -21,6 +43,7 @@ class StoreRecommendationPushService:
     def __init__(self):
         self.platform_settings = PlatformSettings.get_settings()
         self.now = timezone.now()
+        self.log_writer = BufferedLogWriter(StoreUserPushLog)
 
     def _get_effective_frequency(self, config):
         platform_interval = max(1, int(self.platform_settings.personalized_recommendation_min_interval_minutes or 4320))
@@ -36,23 +59,77 @@ class StoreRecommendationPushService:
         weekly_limit = platform_weekly_limit if weekly_limit is None else max(0, int(weekly_limit))
         return interval, weekly_limit
 
-    def _get_store_bindings(self, store):
-        accounts = CustomerLoyaltyAccount.objects.filter(store=store).select_related('user')
-        user_ids = [account.user_id for account in accounts]
-        bindings = {
-            b.user_id: b
-            for b in LineUserBinding.objects.filter(
-                user_id__in=user_ids,
-                is_active=True,
-                current_mode='customer',
-            ).select_related('user')
-        }
-        return [bindings[account.user_id] for account in accounts if account.user_id in bindings]
+    def _recipient_rows(self, store_ids):
+        """
+        所有店家的會員 LINE 綁定，附上熱門推薦與新品推薦的最近推播資訊
+
+        Returns:
+            QuerySet: named values_list，依店家排序
+        """
+        window_start = self.now - timedelta(days=7)
+        success_logs = StoreUserPushLog.objects.filter(
+            store_id=OuterRef('store_id'),
+            user_id=OuterRef('user_id'),
+            status='success',
+        )
+        return (
+            CustomerLoyaltyAccount.objects.filter(
+                store_id__in=store_ids,
+                user__line_binding__is_active=True,
+                user__line_binding__current_mode='customer',
+            )
+            .annotate(
+                last_popular_at=Subquery(
+                    success_logs.filter(push_type='store_popular').order_by('-created_at').values('created_at')[:1]
+                ),
+                weekly_popular_count=Coalesce(
+                    Subquery(
+                        success_logs.filter(push_type='store_popular', created_at__gte=window_start)
+                        .order_by()
+                        .values('store_id')
+                        .annotate(total=Count('id'))
+                        .values('total')[:1],
+                        output_field=IntegerField(),
+                    ),
+                    Value(0),
+                ),
+                last_new_product_at=Subquery(
+                    success_logs.filter(push_type='store_new_product').order_by('-created_at').values('created_at')[:1]
+                ),
+            )
+            .order_by('store_id', 'id')
+            .values_list(
+                'store_id',
+                'user_id',
+                'user__line_binding__id',
+                'user__line_binding__line_user_id',
+                'user__line_binding__notify_personalized_recommendation',
+                'last_popular_at',
+                'weekly_popular_count',
+                'last_new_product_at',
+                named=True,
+            )
+        )
+
+    def _iter_recipient_chunks(self, store_ids):
+        """依店家切出最多 RECIPIENT_CHUNK_SIZE 人的批次：(store_id, rows)；排程租約失效時停止。"""
+        chunk = []
+        chunk_store_id = None
+        for row in self._recipient_rows(store_ids).iterator(chunk_size=RECIPIENT_CHUNK_SIZE):
+            if chunk and (row.store_id != chunk_store_id or len(chunk) >= RECIPIENT_CHUNK_SIZE):
+                ensure_lease_held()
+                yield chunk_store_id, chunk
+                chunk = []
+            chunk_store_id = row.store_id
+            chunk.append(row)
+        if chunk:
+            ensure_lease_held()
+            yield chunk_store_id, chunk
 
     def _log(self, *, store, binding, push_type, status, reason='', error_message='', product_ids=None):
-        StoreUserPushLog.objects.create(
+        self.log_writer.add(
             store=store,
-            user=binding.user if binding and binding.user_id else None,
+            user_id=binding.user_id if binding else None,
             line_user_id=binding.line_user_id if binding else '',
             push_type=push_type,
             status=status,
@@ -61,63 +138,54 @@ class StoreRecommendationPushService:
             product_ids=product_ids or [],
         )
 
-    def _is_popular_eligible(self, *, store, binding, interval_minutes, weekly_limit, force=False):
+    def _is_popular_eligible(self, recipient, *, interval_minutes, weekly_limit, force=False):
         if force:
             return True, ''
 
         if weekly_limit == 0:
             return False, 'weekly_limit_zero'
 
-        last_success = StoreUserPushLog.objects.filter(
-            store=store,
-            user=binding.user,
-            push_type='store_popular',
-            status='success',
-        ).order_by('-created_at').first()
-        if last_success and self.now - last_success.created_at < timedelta(minutes=interval_minutes):
+        last_success_at = recipient.last_popular_at
+        if last_success_at and self.now - last_success_at < timedelta(minutes=interval_minutes):
             return False, 'min_interval_not_reached'
 
-        window_start = self.now - timedelta(days=7)
-        weekly_count = StoreUserPushLog.objects.filter(
-            store=store,
-            user=binding.user,
-            push_type='store_popular',
-            status='success',
-            created_at__gte=window_start,
-        ).count()
-        if weekly_count >= weekly_limit:
+        if recipient.weekly_popular_count >= weekly_limit:
             return False, 'weekly_limit_reached'
 
         return True, ''
 
-    def _get_store_popular_products(self, store, limit=3):
-        product_scores = defaultdict(int)
-
-        for row in (
-            TakeoutOrderItem.objects.filter(order__store=store)
-            .exclude(order__status='rejected')
-            .filter(product_id__isnull=False)
-            .values('product_id')
-            .annotate(total_qty=Sum('quantity'))
-        ):
-            product_scores[row['product_id']] += int(row['total_qty'] or 0)
-
-        for row in (
-            DineInOrderItem.objects.filter(order__store=store)
-            .exclude(order__status='rejected')
-            .filter(product_id__isnull=False)
-            .values('product_id')
-            .annotate(total_qty=Sum('quantity'))
-        ):
-            product_scores[row['product_id']] += int(row['total_qty'] or 0)
+    def _get_popular_products_by_store(self, store_ids, limit=3):
+        """一次彙總所有店家的熱銷商品：{store_id: [Product, ...]}。"""
+        product_scores = defaultdict(lambda: defaultdict(int))
+
+        for item_model in (TakeoutOrderItem, DineInOrderItem):
+            rows = (
+                item_model.objects.filter(order__store_id__in=store_ids, product_id__isnull=False)
+                .exclude(order__status='rejected')
+                .order_by()
+                .values('order__store_id', 'product_id')
+                .annotate(total_qty=Sum('quantity'))
+            )
+            for row in rows:
+                product_scores[row['order__store_id']][row['product_id']] += int(row['total_qty'] or 0)
 
         if not product_scores:
-            return []
+            return {}
 
-        ranked_ids = [pid for pid, _ in sorted(product_scores.items(), key=lambda item: item[1], reverse=True)]
-        products = Product.objects.filter(id__in=ranked_ids, store=store, is_available=True).select_related('category')
-        by_id = {p.id: p for p in products}
-        return [by_id[pid] for pid in ranked_ids if pid in by_id][:limit]
+        products = Product.objects.filter(
+            id__in={product_id for scores in product_scores.values() for product_id in scores},
+            store_id__in=store_ids,
+            is_available=True,
+        ).select_related('category')
+        by_id = {product.id: product for product in products}
+
+        popular = {}
+        for store_id, scores in product_scores.items():
+            ranked_ids = [pid for pid, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
+            popular[store_id] = [
+                by_id[pid] for pid in ranked_ids if pid in by_id and by_id[pid].store_id == store_id
+            ][:limit]
+        return popular
 
     def _build_store_popular_message(self, store, products):
         if not products:
@@ -132,63 +200,64 @@ class StoreRecommendationPushService:
             lines.append(f"• {product.name}")
         return '\n'.join(lines)
 
-    def _get_user_preference_profile(self, user, store, limit=4):
-        tag_score = defaultdict(int)
-        category_score = defaultdict(int)
-        category_names = {}
-
-        takeout_items = TakeoutOrderItem.objects.filter(
-            order__user=user,
-            order__store=store,
-            product_id__isnull=False,
-        ).select_related('product__category')
-
-        dinein_items = DineInOrderItem.objects.filter(
-            order__user=user,
-            order__store=store,
-            product_id__isnull=False,
-        ).select_related('product__category')
-
-        for item in list(takeout_items) + list(dinein_items):
-            qty = int(item.quantity or 1)
-            product = item.product
-            if not product:
-                continue
-
-            if product.food_tags:
-                for tag in product.food_tags:
-                    tag_score[tag] += qty
-
-            if product.category_id:
-                category_score[product.category_id] += qty
-                category_names[product.category_id] = product.category.name if product.category else '未分類'
-
-        top_tags = [tag for tag, _ in sorted(tag_score.items(), key=lambda item: item[1], reverse=True)[:limit]]
-        top_category_ids = [cid for cid, _ in sorted(category_score.items(), key=lambda item: item[1], reverse=True)[:limit]]
-        top_category_names = [category_names.get(cid, '未分類') for cid in top_category_ids]
+    def _load_preference_profiles(self, store_id, user_ids, limit=STORE_PROFILE_LIMIT):
+        """
+        一批用戶在店家內的偏好輪廓：優先使用 generate_recommendations 預先計算的結果，
+        其餘以分組查詢一次計算
+
+        Returns:
+            dict: {user_id: (top_tags, top_category_ids, top_category_names)}
+        """
+        profiles = {}
+        # 依計算時間排序，同一用戶有多筆時以最新的為準
+        for row in UserRecommendation.objects.filter(
+            user_id__in=user_ids,
+            kind='store_profile',
+            store_id=store_id,
+            expires_at__gt=self.now,
+        ).order_by('computed_at').only('user_id', 'items', 'context'):
+            profiles[row.user_id] = (
+                list(row.items)[:limit],
+                list(row.context.get('category_ids', []))[:limit],
+                list(row.context.get('category_names', []))[:limit],
+            )
 
-        return top_tags, set(top_category_ids), top_category_names
+        missing = [user_id for user_id in user_ids if user_id not in profiles]
+        if missing:
+            computed = compute_store_profiles(missing, limit=limit, store_id=store_id)
+            for user_id in missing:
+                profiles[user_id] = computed.get((user_id, store_id), ([], [], []))
+        return profiles
+
+    def _get_new_product_candidates(self, store_id, since_dt):
+        return list(
+            Product.objects.filter(
+                store_id=store_id,
+                is_available=True,
+                created_at__gte=since_dt,
+            ).select_related('category').order_by('-created_at')[:NEW_PRODUCT_CANDIDATE_LIMIT]
+        )
 
-    def _get_last_new_product_success_log(self, store, binding):
-        return StoreUserPushLog.objects.filter(
-            store=store,
-            user=binding.user,
-            push_type='store_new_product',
-            status='success',
-        ).order_by('-created_at').first()
+    @staticmethod
+    def _match_new_products(candidates, top_tags, top_category_ids, since_dt, limit=3):
+        """
+        從候選新品中挑出符合偏好的商品
 
-    def _get_matching_new_products(self, store, top_tags, top_category_ids, since_dt, limit=3):
+        candidates 依建立時間由新到舊排列，取的是最早 since 起的最新商品，
+        因此每位用戶自己 since_dt 之後的最新商品必定是其中的前段。
+        """
         if not top_tags and not top_category_ids:
             return []
 
-        candidates = Product.objects.filter(
-            store=store,
-            is_available=True,
-            created_at__gte=since_dt,
-        ).select_related('category').order_by('-created_at')[:80]
-
         matched = []
+        in_window = 0
         for product in candidates:
+            if product.created_at < since_dt:
+                break
+            in_window += 1
+            if in_window > NEW_PRODUCT_CANDIDATE_LIMIT:
+                break
+
             product_tags = product.food_tags or []
             tag_match = any(
                 (fav in ptag) or (ptag in fav)
@@ -199,8 +268,10 @@ class StoreRecommendationPushService:
 
             if tag_match or category_match:
                 matched.append(product)
+                if len(matched) >= limit:
+                    break
 
-        return matched[:limit]
+        return matched
 
     def _build_new_product_message(self, store, products, labels):
         if not products:
@@ -217,6 +288,138 @@ class StoreRecommendationPushService:
             lines.append(f"• {product.name}（{category_name}）")
         return '\n'.join(lines)
 
+    def _build_chunk_jobs(self, store_context, recipients, summary, force):
+        """
+        組出一批用戶的推播訊息
+
+        Returns:
+            tuple: (jobs, contexts) 供 PushDispatcher 派送與記錄結果
+        """
+        config = store_context['config']
+        store = config.store
+        line_api = store_context['line_api']
+        popular_text = store_context['popular_text']
+
+        active = [row for row in recipients if row.user__line_binding__notify_personalized_recommendation]
+        profiles = {}
+        candidates = []
+        default_since = self.now - timedelta(hours=24)
+        if config.enable_new_product_recommendation_push and active:
+            profiles = self._load_preference_profiles(store.id, [row.user_id for row in active])
+            earliest_since = min(row.last_new_product_at or default_since for row in active)
+            candidates = self._get_new_product_candidates(store.id, earliest_since)
+
+        jobs = []
+        contexts = {}
+        for row in recipients:
+            binding = LineUserBinding(
+                id=row.user__line_binding__id,
+                user_id=row.user_id,
+                line_user_id=row.user__line_binding__line_user_id,
+            )
+            # 使用者在個人資料關閉個人化推薦後，不接收店家通知。
+            if not row.user__line_binding__notify_personalized_recommendation:
+                summary['skipped_count'] += 1
+                self._log(
+                    store=store,
+                    binding=binding,
+                    push_type='store_popular',
+                    status='skipped',
+                    reason='user_personalized_disabled',
+                )
+                continue
+
+            messages = []
+            sent_types = []
+            sent_new_product_ids = []
+
+            if config.enable_popular_recommendation_push and popular_text:
+                eligible, reason = self._is_popular_eligible(
+                    row,
+                    interval_minutes=store_context['interval_minutes'],
+                    weekly_limit=store_context['weekly_limit'],
+                    force=force,
+                )
+                if eligible:
+                    messages.append(line_api.create_text_message(popular_text))
+                    sent_types.append('store_popular')
+                else:
+                    summary['skipped_count'] += 1
+                    self._log(
+                        store=store,
+                        binding=binding,
+                        push_type='store_popular',
+                        status='skipped',
+                        reason=reason,
+                    )
+
+            if config.enable_new_product_recommendation_push:
+                top_tags, top_category_ids, top_category_names = profiles.get(row.user_id, ([], [], []))
+                new_products = self._match_new_products(
+                    candidates,
+                    top_tags,
+                    set(top_category_ids),
+                    row.last_new_product_at or default_since,
+                    limit=3,
+                )
+                label_basis = top_tags[:2] + top_category_names[:2]
+                new_product_text = self._build_new_product_message(store, new_products, label_basis)
+                if new_product_text:
+                    messages.append(line_api.create_text_message(new_product_text))
+                    sent_types.append('store_new_product')
+                    sent_new_product_ids = [product.id for product in new_products]
+                else:
+                    summary['skipped_count'] += 1
+                    self._log(
+                        store=store,
+                        binding=binding,
+                        push_type='store_new_product',
+                        status='skipped',
+                        reason='no_similar_new_products',
+                    )
+
+            if not messages:
+                continue
+
+            contexts[binding.id] = (sent_types, sent_new_product_ids)
+            jobs.append((binding, binding.line_user_id, messages[:5]))
+        return jobs, contexts
+
+    def _record_results(self, store, results, contexts, summary):
+        for result in results:
+            binding = result.key
+            sent_types, sent_new_product_ids = contexts[binding.id]
+            if result.success:
+                summary['success_count'] += 1
+                for push_type in sent_types:
+                    product_ids = []
+                    if push_type == 'store_new_product':
+                        product_ids = sent_new_product_ids
+                    self._log(
+                        store=store,
+                        binding=binding,
+                        push_type=push_type,
+                        status='success',
+                        reason='auto_cycle',
+                        product_ids=product_ids,
+                    )
+                    if push_type == 'store_popular':
+                        summary['popular_success_count'] += 1
+                    if push_type == 'store_new_product':
+                        summary['new_product_success_count'] += 1
+            else:
+                summary['failure_count'] += 1
+                for push_type in sent_types:
+                    self._log(
+                        store=store,
+                        binding=binding,
+                        push_type=push_type,
+                        status='failed',
+                        reason='line_push_exception' if result.status_code is None else 'line_push_failed',
+                        error_message=result.error,
+                    )
+
+    @flush_logs_after
     def run_auto_cycle(self, *, force=False):
         summary = {
             'stores_count': 0,
@@ -226,140 +429,51 @@ class StoreRecommendationPushService:
             'skipped_count': 0,
             'popular_success_count': 0,
             'new_product_success_count': 0,
+            'throughput': [],
         }
 
         if not self.platform_settings.is_line_bot_enabled:
             summary['detail'] = 'platform_line_bot_disabled'
             return summary
 
-        configs = StoreLineBotConfig.objects.filter(is_active=True).select_related('store')
-        summary['stores_count'] = configs.count()
+        configs = list(StoreLineBotConfig.objects.filter(is_active=True).select_related('store'))
+        summary['stores_count'] = len(configs)
 
+        store_contexts = {}
         for config in configs:
             if not config.has_line_config():
                 continue
-
             interval_minutes, weekly_limit = self._get_effective_frequency(config)
-            line_api = LineMessagingAPI(config)
-            bindings = self._get_store_bindings(config.store)
-            summary['recipient_count'] += len(bindings)
-
-            popular_products = self._get_store_popular_products(config.store, limit=3)
-            popular_text = self._build_store_popular_message(config.store, popular_products)
+            store_contexts[config.store_id] = {
+                'config': config,
+                'line_api': LineMessagingAPI(config),
+                'interval_minutes': interval_minutes,
+                'weekly_limit': weekly_limit,
+            }
+        if not store_contexts:
+            return summary
 
-            for binding in bindings:
-                # 使用者在個人資料關閉個人化推薦後，不接收店家通知。
-                if not binding.notify_personalized_recommendation:
-                    summary['skipped_count'] += 1
-                    self._log(
-                        store=config.store,
-                        binding=binding,
-                        push_type='store_popular',
-                        status='skipped',
-                        reason='user_personalized_disabled',
-                    )
-                    continue
+        popular_by_store = self._get_popular_products_by_store(list(store_contexts), limit=3)
+        for store_id, store_context in store_contexts.items():
+            store_context['popular_text'] = self._build_store_popular_message(
+                store_context['config'].store,
+                popular_by_store.get(store_id, []),
+            )
 
-                messages = []
-                sent_types = []
-                sent_new_product_ids = []
+        throughput_by_store = {}
+        for store_id, recipients in self._iter_recipient_chunks(list(store_contexts)):
+            store_context = store_contexts[store_id]
+            summary['recipient_count'] += len(recipients)
+            jobs, contexts = self._build_chunk_jobs(store_context, recipients, summary, force)
 
-                if config.enable_popular_recommendation_push and popular_text:
-                    eligible, reason = self._is_popular_eligible(
-                        store=config.store,
-                        binding=binding,
-                        interval_minutes=interval_minutes,
-                        weekly_limit=weekly_limit,
-                        force=force,
-                    )
-                    if eligible:
-                        messages.append(line_api.create_text_message(popular_text))
-                        sent_types.append('store_popular')
-                    else:
-                        summary['skipped_count'] += 1
-                        self._log(
-                            store=config.store,
-                            binding=binding,
-                            push_type='store_popular',
-                            status='skipped',
-                            reason=reason,
-                        )
-
-                if config.enable_new_product_recommendation_push:
-                    top_tags, top_category_ids, top_category_names = self._get_user_preference_profile(binding.user, config.store)
-                    last_new_product_log = self._get_last_new_product_success_log(config.store, binding)
-                    if last_new_product_log:
-                        since_dt = last_new_product_log.created_at
-                    else:
-                        since_dt = self.now - timedelta(hours=24)
-
-                    new_products = self._get_matching_new_products(
-                        config.store,
-                        top_tags,
-                        top_category_ids,
-                        since_dt,
-                        limit=3,
-                    )
-                    label_basis = top_tags[:2] + top_category_names[:2]
-                    new_product_text = self._build_new_product_message(config.store, new_products, label_basis)
-                    if new_product_text:
-                        messages.append(line_api.create_text_message(new_product_text))
-                        sent_types.append('store_new_product')
-                        sent_new_product_ids = [product.id for product in new_products]
-                    else:
-                        summary['skipped_count'] += 1
-                        self._log(
-                            store=config.store,
-                            binding=binding,
-                            push_type='store_new_product',
-                            status='skipped',
-                            reason='no_similar_new_products',
-                        )
-
-                if not messages:
-                    continue
-
-                try:
-                    result = line_api.push_message(binding.line_user_id, messages[:5])
-                    if result:
-                        summary['success_count'] += 1
-                        for push_type in sent_types:
-                            product_ids = []
-                            if push_type == 'store_new_product':
-                                product_ids = sent_new_product_ids
-                            self._log(
-                                store=config.store,
-                                binding=binding,
-                                push_type=push_type,
-                                status='success',
-                                reason='auto_cycle',
-                                product_ids=product_ids,
-                            )
-                            if push_type == 'store_popular':
-                                summary['popular_success_count'] += 1
-                            if push_type == 'store_new_product':
-                                summary['new_product_success_count'] += 1
-                    else:
-                        summary['failure_count'] += 1
-                        for push_type in sent_types:
-                            self._log(
-                                store=config.store,
-                                binding=binding,
-                                push_type=push_type,
-                                status='failed',
-                                reason='line_push_failed',
-                            )
-                except Exception as exc:
-                    summary['failure_count'] += 1
-                    for push_type in sent_types:
-                        self._log(
-                            store=config.store,
-                            binding=binding,
-                            push_type=push_type,
-                            status='failed',
-                            reason='line_push_exception',
-                            error_message=str(exc),
-                        )
-                    logger.warning('Store auto recommendation push failed for %s: %s', binding.line_user_id, exc)
+            dispatcher = store_context.setdefault(
+                'dispatcher',
+                PushDispatcher(store_context['line_api'].channel_access_token),
+            )
+            results, throughput = dispatcher.dispatch(jobs)
+            self._record_results(store_context['config'].store, results, contexts, summary)
+            throughput_by_store.setdefault(store_id, []).append(throughput)
 
+        for store_id, chunks in throughput_by_store.items():
+            summary['throughput'].append({'store_id': store_id, **merge_metrics(chunks)})
         return summary
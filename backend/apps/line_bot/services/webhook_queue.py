@@ -0,0 +1,187 @@
+"""
+LINE Webhook 事件非同步處理
+
+Webhook 端點只負責驗證簽名、去除重複事件後放入佇列並立即回傳 200，
+FAQ 比對、AI 回覆與 reply_message 由背景工作執行緒處理，避免 AI 回覆過慢
+導致 LINE 逾時重送，也不會佔住 web worker。
+
+注意：事件在處理前就已回覆 200，且只存在於該行程的記憶體佇列中。行程重啟
+或被終止時，尚未處理的事件會直接遺失，LINE 也不會重送（已收到 200）。
+
+- 分片佇列：依事件來源（userId / groupId / roomId）雜湊到固定的工作執行緒，
+  同一用戶的事件依收到順序處理，不同用戶之間可以並行
+- 去重：以 cache.add 記錄 webhookEventId，LINE 重送（isRedelivery）的事件只處理一次；
+  多個行程之間去重需要共用的快取後端（設定 REDIS_URL），否則只在同一行程內有效
+- 佇列已滿時最多等待 LINE_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS 秒；仍然已滿則釋放
+  該事件與其後事件的去重記錄，由端點回傳 503 讓 LINE 重送（需在 LINE Developers
+  啟用 Webhook redelivery），不在請求中直接處理也不丟棄
+
+reply token 約一分鐘後失效，佇列長度與工作執行緒數需讓事件在時限內被處理。
+"""
+import logging
+import queue
+import threading
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+DEDUP_CACHE_PREFIX = 'line_webhook_event'
+
+
+def event_source_key(event):
+    """事件來源識別（同一來源的事件需依序處理）。"""
+    source = event.get('source') or {}
+    return source.get('userId') or source.get('groupId') or source.get('roomId') or ''
+
+
+def claim_event(event, channel_key=''):
+    """
+    第一次收到此 webhookEventId 時回傳 True；重複收到回傳 False
+
+    沒有 webhookEventId 的事件（舊版格式）一律視為新事件。
+    """
+    event_id = event.get('webhookEventId')
+    if not event_id:
+        return True
+    return cache.add(
+        f'{DEDUP_CACHE_PREFIX}:{channel_key}:{event_id}',
+        1,
+        settings.LINE_WEBHOOK_DEDUP_TTL_SECONDS,
+    )
+
+
+def release_event(event, channel_key=''):
+    """撤銷 claim_event 的記錄，讓 LINE 重送的同一事件可以再被處理。"""
+    event_id = event.get('webhookEventId')
+    if event_id:
+        cache.delete(f'{DEDUP_CACHE_PREFIX}:{channel_key}:{event_id}')
+
+
+def _process(handler, event, store_id):
+    try:
+        handler(event, store_id)
+    except Exception:
+        logger.exception(
+            '[LINE Webhook] failed to handle %s event %s',
+            event.get('type'),
+            event.get('webhookEventId', ''),
+        )
+
+
+class WebhookEventQueue:
+    """
+    依來源分片的事件佇列與工作執行緒
+
+    Args:
+        workers: 工作執行緒數（分片數）
+        max_size: 每個分片的佇列長度上限
+    """
+
+    def __init__(self, workers=None, max_size=None):
+        self.workers = max(1, workers or settings.LINE_WEBHOOK_WORKERS)
+        self.max_size = max_size or settings.LINE_WEBHOOK_QUEUE_SIZE
+        self.queues = [queue.Queue(maxsize=self.max_size) for _ in range(self.workers)]
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.threads:
+                return
+            for index, shard in enumerate(self.queues):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    args=(shard,),
+                    name=f'line-webhook-worker-{index}',
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def _shard_for(self, event):
+        return self.queues[zlib.crc32(event_source_key(event).encode('utf-8')) % self.workers]
+
+    def submit(self, handler, event, store_id=None, timeout=0):
+        """放入事件所屬分片，佇列已滿時最多等待 timeout 秒；仍然已滿時回傳 False。"""
+        self.start()
+        try:
+            if timeout > 0:
+                self._shard_for(event).put((handler, event, store_id), timeout=timeout)
+            else:
+                self._shard_for(event).put_nowait((handler, event, store_id))
+        except queue.Full:
+            return False
+        return True
+
+    def _worker_loop(self, shard):
+        while True:
+            handler, event, store_id = shard.get()
+            close_old_connections()
+            try:
+                _process(handler, event, store_id)
+            finally:
+                close_old_connections()
+                shard.task_done()
+
+    def join(self):
+        """等待目前佇列中的事件全部處理完畢（測試與關閉時使用）。"""
+        for shard in self.queues:
+            shard.join()
+
+    def pending_count(self):
+        return sum(shard.qsize() for shard in self.queues)
+
+
+_event_queue = None
+_event_queue_lock = threading.Lock()
+
+
+def get_webhook_queue():
+    global _event_queue
+
+    with _event_queue_lock:
+        if _event_queue is None:
+            _event_queue = WebhookEventQueue()
+        return _event_queue
+
+
+def enqueue_events(handler, events, store_id=None, channel_key=''):
+    """
+    去重後將事件交給背景工作執行緒處理（LINE_WEBHOOK_ASYNC_ENABLED=False 時直接處理）
+
+    佇列已滿時停止排入：該事件與其後的事件都不處理並釋放去重記錄（保持同一用戶的
+    事件順序），呼叫端應在 rejected 不為 0 時回傳 503，讓 LINE 重送整個請求；
+    已排入的事件重送時會被去重略過。
+
+    Returns:
+        dict: {'accepted': 排入佇列數, 'inline': 直接處理數, 'duplicates': 略過的重複事件數,
+               'rejected': 佇列已滿而未處理的事件數}
+    """
+    summary = {'accepted': 0, 'inline': 0, 'duplicates': 0, 'rejected': 0}
+    event_queue = get_webhook_queue() if settings.LINE_WEBHOOK_ASYNC_ENABLED else None
+
+    events = list(events)
+    for index, event in enumerate(events):
+        if not claim_event(event, channel_key):
+            summary['duplicates'] += 1
+            continue
+        if event_queue is None:
+            _process(handler, event, store_id)
+            summary['inline'] += 1
+            continue
+        if event_queue.submit(handler, event, store_id, timeout=settings.LINE_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS):
+            summary['accepted'] += 1
+            continue
+
+        release_event(event, channel_key)
+        summary['rejected'] = len(events) - index
+        logger.warning(
+            '[LINE Webhook] queue full, rejecting %s event(s) for redelivery',
+            summary['rejected'],
+        )
+        break
+    return summary
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.loyalty.models import MembershipLevel
+from apps.orders.models import DineInOrder, TakeoutOrder
+from apps.products.models import Product, ProductCategory, ProductSpecification, SpecificationGroup
+from apps.reservations.models import TimeSlot
+from apps.stores.models import Store
+
+from .models import StoreFAQ, StoreLineBotConfig
+from .services.audience_segments import mark_customer_features_stale
+from .services.channel_credentials import invalidate_store_credentials
+from .services.faq_matcher import invalidate_faq_index
+from .services.membership_summary import invalidate_level_ladder
+from .services.store_context import invalidate_store_context
+
+
+@receiver(post_save, sender=TakeoutOrder)
+@receiver(post_save, sender=DineInOrder)
+def order_created_mark_customer_features(sender, instance, created, **kwargs):
+    """新訂單標記該顧客在店家的受眾特徵待更新，由排程批次重建（交易提交後才執行）。"""
+    if not created or not instance.user_id:
+        return
+    store_id = instance.store_id
+    user_id = instance.user_id
+    transaction.on_commit(lambda: mark_customer_features_stale(store_id, user_id))
+
+
+def _store_id_for(sender, instance):
+    if sender is Store:
+        return instance.id
+    if sender is ProductSpecification:
+        return SpecificationGroup.objects.filter(id=instance.group_id).values_list('product__store_id', flat=True).first()
+    if sender is SpecificationGroup:
+        return Product.objects.filter(id=instance.product_id).values_list('store_id', flat=True).first()
+    return instance.store_id
+
+
+@receiver(post_save, sender=Store)
+@receiver(post_save, sender=StoreLineBotConfig)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+@receiver(post_save, sender=SpecificationGroup)
+@receiver(post_delete, sender=SpecificationGroup)
+@receiver(post_save, sender=ProductSpecification)
+@receiver(post_delete, sender=ProductSpecification)
+@receiver(post_save, sender=TimeSlot)
+@receiver(post_delete, sender=TimeSlot)
+def store_data_changed_invalidate_store_context(sender, instance, **kwargs):
+    """店家資料、菜單、規格或訂位時段變更時清除 LINE BOT 的店家資料快取。"""
+    store_id = _store_id_for(sender, instance)
+    if store_id:
+        transaction.on_commit(lambda: invalidate_store_context(store_id))
+
+
+@receiver(post_save, sender=StoreFAQ)
+@receiver(post_delete, sender=StoreFAQ)
+def faq_changed_invalidate_faq_index(sender, instance, update_fields=None, **kwargs):
+    """FAQ 新增、修改或刪除時重建店家的比對索引（只更新使用次數時不需要）。"""
+    if update_fields and set(update_fields) <= {'usage_count'}:
+        return
+    store_id = instance.store_id
+    transaction.on_commit(lambda: invalidate_faq_index(store_id))
+
+
+@receiver(post_save, sender=MembershipLevel)
+@receiver(post_delete, sender=MembershipLevel)
+def membership_level_changed_invalidate_ladder(sender, instance, **kwargs):
+    """會員等級變更時重建店家的等級階梯。"""
+    store_id = instance.store_id
+    transaction.on_commit(lambda: invalidate_level_ladder(store_id))
+
+
+@receiver(post_save, sender=Store)
+@receiver(post_delete, sender=Store)
+@receiver(post_save, sender=StoreLineBotConfig)
+@receiver(post_delete, sender=StoreLineBotConfig)
+def channel_config_changed_invalidate_credentials(sender, instance, **kwargs):
+    """店家或 LINE BOT 設定變更時重新載入 webhook 使用的 Channel 設定。"""
+    store_id = instance.id if sender is Store else instance.store_id
+    transaction.on_commit(lambda: invalidate_store_credentials(store_id))
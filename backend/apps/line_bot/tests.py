@@ -0,0 +1,1006 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.intelligence.models import PersonalizedRecommendationPushLog, PlatformSettings
+from apps.line_bot.models import BroadcastJob, ConversationLog, LineUserBinding, MerchantLineBinding, StoreLineBotConfig, StoreUserPushLog, PlatformBroadcast, StoreCustomerFeature, StoreCustomerFeatureRefresh, StoreFAQ
+from apps.line_bot.services.answer_cache import normalize_question
+from apps.line_bot.services.audience_segments import (
+    build_segment_queryset,
+    iter_segment_line_user_ids,
+    refresh_stale_customer_features,
+    refresh_store_customer_features,
+)
+from apps.line_bot.services.broadcast_jobs import (
+    create_broadcast_job,
+    request_cancel,
+    resume_job,
+    run_broadcast_job,
+)
+from apps.line_bot.services.channel_credentials import compute_signature, get_active_bot_config
+from apps.line_bot.services.conversation_log import (
+    ConversationLogWriter,
+    get_recent_history,
+    log_conversation,
+    prune_conversation_logs,
+)
+from apps.line_bot.services.faq_matcher import FAQUsageCounter, KeywordAutomaton, get_faq_index
+from apps.line_bot.services.line_api import LineMessagingAPI, line_api_metrics
+from apps.line_bot.services.log_writer import BufferedLogWriter, prune_push_logs
+from apps.line_bot.services.message_handler import MessageHandler
+from apps.line_bot.services.push_dispatcher import PushDispatcher, TokenBucket
+from apps.line_bot.services.store_context import build_store_context, get_store_context
+from apps.line_bot.services.store_recommendation_push_service import StoreRecommendationPushService
+from apps.line_bot.services.webhook_queue import WebhookEventQueue, enqueue_events
+from apps.line_bot.views import build_membership_level_reply, build_merchant_operations_reply
+from apps.loyalty.models import CustomerLoyaltyAccount, MembershipLevel
+from apps.orders.models import TakeoutOrder, TakeoutOrderItem
+from apps.products.models import Product, ProductCategory, ProductSpecification, SpecificationGroup
+from apps.stores.models import Store
+from apps.users.models import Merchant, User
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text=''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+
+
+class FakeSession:
+    """依序回傳預設回應，並記錄每次請求的標頭。"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.calls = []
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.requests.append(headers)
+        self.calls.append((url, json.loads(data)))
+        return self.responses.pop(0)
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        return self.post(url, headers=headers, data=data, timeout=timeout)
+
+
+def make_store(slug, **store_fields):
+    """建立商家用戶、商家與店家（slug 區分各測試的 email 與 firebase_uid）。"""
+    merchant_user = User.objects.create_user(
+        email=f'{slug}@example.com',
+        password='password',
+        firebase_uid=f'{slug}-merchant-uid',
+        username=f'{slug} merchant',
+        user_type='merchant',
+    )
+    merchant = Merchant.objects.create(user=merchant_user, company_account=f'{merchant_user.id:08d}', plan='basic')
+    store_fields.setdefault('cuisine_type', 'other')
+    store_fields.setdefault('address', 'Test Address')
+    store_fields.setdefault('phone', '0212345678')
+    return Store.objects.create(merchant=merchant, **store_fields)
+
+
+class PushDispatcherTests(SimpleTestCase):
+    def _dispatcher(self, responses, sleeps):
+        session = FakeSession(responses)
+        dispatcher = PushDispatcher(
+            'token',
+            max_workers=2,
+            max_retries=3,
+            session=session,
+            bucket=TokenBucket(1000, sleep=sleeps.append),
+            sleep=sleeps.append,
+        )
+        return dispatcher, session
+
+    def test_retries_after_429_with_same_retry_key(self):
+        sleeps = []
+        dispatcher, session = self._dispatcher(
+            [FakeResponse(429, {'Retry-After': '2'}), FakeResponse(200)],
+            sleeps,
+        )
+
+        results, metrics = dispatcher.dispatch([('binding', 'U1', [{'type': 'text', 'text': 'hi'}])])
+
+        self.assertTrue(results[0].success)
+        self.assertEqual(results[0].attempts, 2)
+        self.assertEqual(sleeps, [2.0])
+        self.assertEqual(session.requests[0]['X-Line-Retry-Key'], session.requests[1]['X-Line-Retry-Key'])
+        self.assertEqual(metrics['rate_limited'], 1)
+        self.assertEqual(metrics['retried'], 1)
+
+    def test_accepted_conflict_counts_as_success(self):
+        dispatcher, _ = self._dispatcher(
+            [FakeResponse(409, {'X-Line-Accepted-Request-Id': 'abc'})],
+            [],
+        )
+
+        result = dispatcher.send('U1', [])
+
+        self.assertTrue(result.success)
+        self.assertEqual(result.status_code, 409)
+
+    def test_client_error_is_not_retried(self):
+        dispatcher, session = self._dispatcher([FakeResponse(400, text='bad request')], [])
+
+        result = dispatcher.send('U1', [])
+
+        self.assertFalse(result.success)
+        self.assertEqual(len(session.requests), 1)
+        self.assertIn('status=400', result.error)
+
+    def test_identical_payloads_are_grouped_into_multicast(self):
+        dispatcher, session = self._dispatcher([FakeResponse(200), FakeResponse(200)], [])
+        shared = [{'type': 'text', 'text': 'promo'}]
+        personal = [{'type': 'text', 'text': 'just for U2'}]
+
+        results, metrics = dispatcher.dispatch_grouped([
+            ('a', 'U1', shared),
+            ('b', 'U2', personal),
+            ('c', 'U3', [dict(shared[0])]),
+        ])
+
+        self.assertEqual([result.key for result in results], ['a', 'b', 'c'])
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(metrics['http_requests'], 2)
+        self.assertEqual(metrics['multicast_groups'], 1)
+        calls = dict(session.calls)
+        self.assertEqual(calls[dispatcher.multicast_url]['to'], ['U1', 'U3'])
+        self.assertEqual(calls[dispatcher.push_url]['to'], 'U2')
+
+    @override_settings(LINE_API_BASE_URL='http://127.0.0.1:8080/v2/bot')
+    def test_endpoints_follow_api_base_url(self):
+        dispatcher, session = self._dispatcher([FakeResponse(200)], [])
+
+        dispatcher.send('U1', [])
+
+        self.assertEqual(session.calls[0][0], 'http://127.0.0.1:8080/v2/bot/message/push')
+
+    def test_background_push_exceptions_are_logged(self):
+        dispatcher, _ = self._dispatcher([], [])
+
+        with mock.patch.object(dispatcher, 'send', side_effect=RuntimeError('boom')):
+            with self.assertLogs('apps.line_bot.services.push_dispatcher', level='ERROR') as logs:
+                future = dispatcher.submit('U1', [])
+                with self.assertRaises(RuntimeError):
+                    future.result()
+                # done callback 在 result() 返回前後都可能執行，等待背景執行緒完成
+                dispatcher._background.shutdown(wait=True)
+
+        self.assertIn('background push to=U1 raised', logs.output[0])
+
+    def test_token_bucket_waits_when_empty(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(2, capacity=1, clock=lambda: now[0], sleep=sleep)
+
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        self.assertEqual(len(sleeps), 1)
+
+
+class LineMessagingAPITests(SimpleTestCase):
+    def _api(self, responses):
+        session = FakeSession(responses)
+        line_api = LineMessagingAPI(session=session)
+        line_api.channel_access_token = 'token'
+        return line_api, session
+
+    @mock.patch('apps.line_bot.services.line_api.time.sleep')
+    def test_push_retries_server_errors_with_same_retry_key(self, sleep):
+        line_api_metrics.reset()
+        line_api, session = self._api([FakeResponse(503), FakeResponse(200)])
+
+        self.assertTrue(line_api.push_message('U1', [line_api.create_text_message('hi')]))
+
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(session.requests[0]['X-Line-Retry-Key'], session.requests[1]['X-Line-Retry-Key'])
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(line_api_metrics.snapshot()['push']['retries'], 1)
+
+    @mock.patch('apps.line_bot.services.line_api.time.sleep')
+    def test_reply_is_not_resent_after_server_error(self, sleep):
+        line_api, session = self._api([FakeResponse(500), FakeResponse(200)])
+
+        self.assertFalse(line_api.reply_message('reply-token', []))
+
+        self.assertEqual(len(session.requests), 1)
+        self.assertNotIn('X-Line-Retry-Key', session.requests[0])
+        sleep.assert_not_called()
+
+
+class PushLogWriterTests(TestCase):
+    def _add_logs(self, writer, status, count):
+        for index in range(count):
+            writer.add(line_user_id=f'U{index}', push_type='popular', status=status)
+
+    def test_flushes_in_batches(self):
+        writer = BufferedLogWriter(PersonalizedRecommendationPushLog, batch_size=3)
+
+        with self.assertNumQueries(1):
+            self._add_logs(writer, 'success', 4)
+        self.assertEqual(PersonalizedRecommendationPushLog.objects.count(), 3)
+
+        writer.flush()
+        self.assertEqual(PersonalizedRecommendationPushLog.objects.count(), 4)
+        self.assertEqual(writer.written_count, 4)
+        self.assertFalse(PersonalizedRecommendationPushLog.objects.filter(created_at__isnull=True).exists())
+
+    def test_prune_compacts_skipped_and_drops_expired(self):
+        with BufferedLogWriter(PersonalizedRecommendationPushLog) as writer:
+            self._add_logs(writer, 'skipped', 2)
+            self._add_logs(writer, 'success', 2)
+
+        now = timezone.now()
+        logs = PersonalizedRecommendationPushLog.objects.order_by('id')
+        ids = list(logs.values_list('id', flat=True))
+        # 一筆略過、一筆成功落在壓縮區間，一筆成功已過保存期限
+        PersonalizedRecommendationPushLog.objects.filter(id=ids[0]).update(created_at=now - timedelta(days=40))
+        PersonalizedRecommendationPushLog.objects.filter(id=ids[2]).update(created_at=now - timedelta(days=40))
+        PersonalizedRecommendationPushLog.objects.filter(id=ids[3]).update(created_at=now - timedelta(days=200))
+
+        summary = prune_push_logs(
+            PersonalizedRecommendationPushLog,
+            retention_days=180,
+            compact_after_days=30,
+            now=now,
+        )
+
+        self.assertEqual(summary, {'compacted': 1, 'expired': 1})
+        self.assertEqual(sorted(logs.values_list('id', flat=True)), [ids[1], ids[2]])
+
+        with self.assertRaises(ValueError):
+            prune_push_logs(PersonalizedRecommendationPushLog, retention_days=3)
+
+
+class AudienceSegmentTests(TestCase):
+    def setUp(self):
+        self.store = make_store('merchant', name='Test Store')
+        merchant = self.store.merchant
+        self.gold = MembershipLevel.objects.create(store=self.store, name='金卡', threshold_points=100)
+        spicy = Product.objects.create(
+            merchant=merchant,
+            store=self.store,
+            name='麻辣鍋',
+            price=Decimal('300'),
+            food_tags=['麻辣'],
+        )
+
+        self.customers = {}
+        for index, (name, ordered_days_ago) in enumerate((('regular', 2), ('lapsed', 40), ('new', None))):
+            customer = User.objects.create_user(
+                email=f'{name}@example.com',
+                password='password',
+                firebase_uid=f'{name}-uid',
+                username=name,
+            )
+            CustomerLoyaltyAccount.objects.create(
+                user=customer,
+                store=self.store,
+                current_level=self.gold if name == 'regular' else None,
+            )
+            LineUserBinding.objects.create(user=customer, line_user_id=f'U-{name}', display_name=name)
+            if ordered_days_ago is not None:
+                order = TakeoutOrder.objects.create(
+                    store=self.store,
+                    user=customer,
+                    customer_name=name,
+                    customer_phone='0912345678',
+                    pickup_at=timezone.now(),
+                    payment_method='cash',
+                    pickup_number=f'T{index:04d}',
+                )
+                TakeoutOrderItem.objects.create(order=order, product=spicy, quantity=2, unit_price=Decimal('300'))
+                TakeoutOrder.objects.filter(id=order.id).update(
+                    created_at=timezone.now() - timedelta(days=ordered_days_ago),
+                )
+            self.customers[name] = customer
+
+        refresh_store_customer_features(self.store.id)
+
+    def _targets(self, **filters):
+        return sorted(iter_segment_line_user_ids(build_segment_queryset(self.store, **filters)))
+
+    def test_filters_compose_into_single_query(self):
+        self.assertEqual(StoreCustomerFeature.objects.filter(store=self.store).count(), 3)
+
+        with self.assertNumQueries(1):
+            targets = self._targets(food_tags=['麻辣'], days_inactive=30)
+        self.assertEqual(targets, ['U-lapsed'])
+
+        self.assertEqual(self._targets(days_inactive=30), ['U-lapsed', 'U-new'])
+        self.assertEqual(self._targets(min_spent=Decimal('600')), ['U-lapsed', 'U-regular'])
+        self.assertEqual(self._targets(level_ids=[self.gold.id]), ['U-regular'])
+
+    def test_respects_notification_preference(self):
+        LineUserBinding.objects.filter(user=self.customers['new']).update(notify_personalized_recommendation=False)
+
+        self.assertEqual(self._targets(), ['U-lapsed', 'U-regular'])
+        self.assertEqual(
+            sorted(iter_segment_line_user_ids(build_segment_queryset(self.store, require_personalized=False))),
+            ['U-lapsed', 'U-new', 'U-regular'],
+        )
+
+    def test_new_order_marks_customer_for_batch_refresh(self):
+        spicy = Product.objects.get(store=self.store)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = TakeoutOrder.objects.create(
+                store=self.store,
+                user=self.customers['new'],
+                customer_name='new',
+                customer_phone='0912345678',
+                pickup_at=timezone.now(),
+                payment_method='cash',
+                pickup_number='T0100',
+            )
+            TakeoutOrderItem.objects.create(order=order, product=spicy, quantity=1, unit_price=Decimal('300'))
+
+        # 下單時只標記，特徵由排程更新
+        self.assertEqual(self._targets(days_inactive=30), ['U-lapsed', 'U-new'])
+        self.assertTrue(StoreCustomerFeatureRefresh.objects.filter(user=self.customers['new']).exists())
+
+        summary = refresh_stale_customer_features()
+
+        self.assertEqual(summary['users_count'], 1)
+        self.assertFalse(StoreCustomerFeatureRefresh.objects.exists())
+        self.assertEqual(self._targets(days_inactive=30), ['U-lapsed'])
+
+
+class BroadcastJobTests(TestCase):
+    def setUp(self):
+        platform_settings = PlatformSettings.get_settings()
+        platform_settings.line_bot_channel_access_token = 'token'
+        platform_settings.line_bot_channel_secret = 'secret'
+        platform_settings.save()
+
+        self.broadcast = PlatformBroadcast.objects.create(
+            broadcast_type='platform_announcement',
+            title='公告',
+            message_content='系統維護通知',
+        )
+        self.line_user_ids = [f'U{index}' for index in range(5)]
+        self.session = FakeSession([FakeResponse(200) for _ in range(10)])
+
+    def _run(self, job, **kwargs):
+        dispatcher = PushDispatcher(
+            'token',
+            session=self.session,
+            bucket=TokenBucket(1000, sleep=lambda seconds: None),
+            max_retries=0,
+            sleep=lambda seconds: None,
+        )
+        with mock.patch('apps.line_bot.services.broadcast_jobs.PushDispatcher', return_value=dispatcher):
+            return run_broadcast_job(job.id, **kwargs)
+
+    def _recipients(self):
+        recipients = []
+        for _, body in self.session.calls:
+            recipients.extend(body['to'] if isinstance(body['to'], list) else [body['to']])
+        return sorted(recipients)
+
+    def test_runs_in_checkpointed_batches(self):
+        job = create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast)
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.status, 'sending')
+
+        job = self._run(job, batch_size=2)
+
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual((job.success_count, job.failure_count, job.batches_done), (5, 0, 3))
+        self.assertFalse(job.deliveries.filter(status='pending').exists())
+        self.assertEqual(self._recipients(), self.line_user_ids)
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.success_count), ('sent', 5))
+
+    def test_resume_skips_delivered_recipients(self):
+        job = create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast)
+        job.deliveries.filter(line_user_id__in=['U0', 'U1']).update(status='sent')
+        BroadcastJob.objects.filter(id=job.id).update(status='failed', success_count=2)
+        job.refresh_from_db()
+
+        job = self._run(resume_job(job))
+
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.success_count, 5)
+        self.assertEqual(self._recipients(), ['U2', 'U3', 'U4'])
+        with self.assertRaises(ValueError):
+            resume_job(job)
+
+    def test_resume_retries_transient_failures_only(self):
+        job = create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast)
+        # 第一批成功、第二批 400（不可重送）、第三批 503（可重送）
+        self.session = FakeSession([FakeResponse(200), FakeResponse(400), FakeResponse(503)])
+        job = self._run(job, batch_size=2)
+        self.assertEqual((job.status, job.success_count, job.failure_count), ('completed', 2, 3))
+
+        job = resume_job(job)
+        self.assertEqual((job.status, job.failure_count), ('queued', 2))
+        self.session = FakeSession([FakeResponse(200)])
+        job = self._run(job, batch_size=2)
+
+        self.assertEqual((job.status, job.success_count, job.failure_count), ('completed', 3, 2))
+        self.assertEqual(self._recipients(), ['U4'])
+        self.assertEqual(
+            sorted(job.deliveries.filter(status='failed').values_list('line_user_id', flat=True)),
+            ['U2', 'U3'],
+        )
+        with self.assertRaises(ValueError):
+            resume_job(job)
+
+    def test_cancel_before_start(self):
+        job = request_cancel(create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast))
+
+        self.assertEqual(job.status, 'cancelled')
+        self.assertIsNone(self._run(job))
+        self.assertEqual(self.session.calls, [])
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.status, 'cancelled')
+
+    def test_stops_when_job_is_taken_over(self):
+        job = create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast)
+
+        def take_over(*args, **kwargs):
+            BroadcastJob.objects.filter(id=job.id).update(worker='other')
+            return original(*args, **kwargs)
+
+        original = PushDispatcher.dispatch_grouped
+        with mock.patch.object(PushDispatcher, 'dispatch_grouped', autospec=True, side_effect=take_over):
+            job = self._run(job, worker='stale', batch_size=2)
+
+        self.assertEqual((job.status, job.worker), ('running', 'other'))
+        self.assertEqual((job.success_count, job.batches_done), (0, 0))
+        self.assertEqual(job.deliveries.filter(status='pending').count(), 5)
+        self.assertEqual(len(self.session.calls), 1)
+
+    def test_retry_keys_are_stable_across_runs(self):
+        job = create_broadcast_job(self.line_user_ids, platform_broadcast=self.broadcast)
+        self._run(job, batch_size=2)
+        first = [headers['X-Line-Retry-Key'] for headers in self.session.requests]
+
+        job.deliveries.update(status='pending')
+        BroadcastJob.objects.filter(id=job.id).update(status='queued')
+        self.session = FakeSession([FakeResponse(200) for _ in range(10)])
+        self._run(job, batch_size=2)
+
+        self.assertEqual([headers['X-Line-Retry-Key'] for headers in self.session.requests], first)
+        self.assertEqual(len(set(first)), 3)
+
+
+class WebhookEventQueueTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _event(self, event_id, user_id, text):
+        return {
+            'type': 'message',
+            'webhookEventId': event_id,
+            'source': {'type': 'user', 'userId': user_id},
+            'message': {'type': 'text', 'text': text},
+        }
+
+    def test_preserves_per_user_order_across_workers(self):
+        handled = []
+        event_queue = WebhookEventQueue(workers=3, max_size=100)
+        events = [self._event(f'E{index}', f'U{index % 4}', str(index)) for index in range(40)]
+
+        for event in events:
+            self.assertTrue(event_queue.submit(lambda event, store_id: handled.append(event), event))
+        event_queue.join()
+
+        self.assertEqual(len(handled), 40)
+        for user_id in ('U0', 'U1', 'U2', 'U3'):
+            texts = [event['message']['text'] for event in handled if event['source']['userId'] == user_id]
+            self.assertEqual(texts, sorted(texts, key=int))
+
+    @override_settings(LINE_WEBHOOK_ASYNC_ENABLED=False)
+    def test_redelivered_events_are_handled_once(self):
+        handled = []
+        events = [self._event('E1', 'U1', 'hi'), self._event('E2', 'U1', 'hello')]
+
+        first = enqueue_events(lambda event, store_id: handled.append(event['webhookEventId']), events)
+        second = enqueue_events(lambda event, store_id: handled.append(event['webhookEventId']), events[:1])
+        other_channel = enqueue_events(lambda event, store_id: None, events[:1], channel_key='store:1')
+
+        self.assertEqual(handled, ['E1', 'E2'])
+        self.assertEqual(first, {'accepted': 0, 'inline': 2, 'duplicates': 0, 'rejected': 0})
+        self.assertEqual(second['duplicates'], 1)
+        self.assertEqual(other_channel['inline'], 1)
+
+    @override_settings(LINE_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS=0.05)
+    def test_full_queue_rejects_events_for_redelivery(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(event, store_id):
+            release.wait(5)
+            handled.append(event['webhookEventId'])
+
+        event_queue = WebhookEventQueue(workers=1, max_size=1)
+        events = [self._event(f'E{index}', 'U1', str(index)) for index in range(4)]
+        with mock.patch('apps.line_bot.services.webhook_queue.get_webhook_queue', return_value=event_queue):
+            first = enqueue_events(handler, events)
+            release.set()
+            event_queue.join()
+            redelivered = enqueue_events(handler, events)
+            event_queue.join()
+
+        self.assertEqual(first['rejected'], 2)
+        self.assertEqual(redelivered, {'accepted': 2, 'inline': 0, 'duplicates': 2, 'rejected': 0})
+        self.assertEqual(handled, ['E0', 'E1', 'E2', 'E3'])
+
+
+class StoreContextTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = make_store('context', name='Context Store')
+        self.merchant = self.store.merchant
+        for category_index in range(3):
+            category = ProductCategory.objects.create(
+                store=self.store,
+                name=f'分類{category_index}',
+                display_order=category_index,
+            )
+            for product_index in range(3):
+                product = Product.objects.create(
+                    merchant=self.merchant,
+                    store=self.store,
+                    category=category,
+                    name=f'商品{category_index}-{product_index}',
+                    price=Decimal('100'),
+                )
+                group = SpecificationGroup.objects.create(product=product, name='辣度')
+                ProductSpecification.objects.create(group=group, name='小辣')
+                ProductSpecification.objects.create(group=group, name='大辣', price_adjustment=Decimal('10'))
+        self.product = product
+
+    def test_menu_is_built_with_fixed_query_count(self):
+        with self.assertNumQueries(6):
+            store_info = build_store_context(self.store)
+
+        self.assertEqual([category['category'] for category in store_info['menu']], ['分類0', '分類1', '分類2'])
+        self.assertEqual(store_info['menu'][0]['products'][0]['specifications'], ['辣度: 小辣, 大辣(+$10.00)'])
+        self.assertIn('商品2-2', store_info['system_prompt'])
+
+    def test_cache_is_invalidated_when_menu_changes(self):
+        get_store_context(self.store)
+        with self.assertNumQueries(0):
+            get_store_context(self.store)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = '新商品'
+            self.product.save()
+
+        self.assertIn('新商品', get_store_context(self.store)['system_prompt'])
+
+    def test_repeated_questions_reuse_ai_answer_until_context_changes(self):
+        ai_calls = []
+
+        class FakeAI:
+            model = 'fake-model'
+
+            def generate_reply(self, user_message, store_info, conversation_history=None):
+                ai_calls.append(user_message)
+                return f'回答 {len(ai_calls)}'
+
+        handler = MessageHandler(None)
+        handler.ai_service = FakeAI()
+
+        def ask(message):
+            return handler.handle_text_message('U1', message, self.store.id, get_store_context(self.store))
+
+        self.assertEqual(normalize_question('請問，推薦什麼？'), normalize_question('推薦什麼呢'))
+        self.assertEqual(normalize_question('那這個呢'), '')
+
+        self.assertEqual(ask('請問推薦什麼？')['reply'], '回答 1')
+        second = ask('推薦什麼呢')
+        self.assertEqual((second['reply'], second.get('cache_hit')), ('回答 1', True))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.food_tags = ['素食']
+            self.product.save()
+
+        self.assertEqual(ask('推薦什麼')['reply'], '回答 2')
+        self.assertIn('商品2-2', ask('有素食嗎？')['reply'])
+        self.assertEqual(len(ai_calls), 2)
+
+    def test_answers_generated_with_history_are_not_cached(self):
+        ai_calls = []
+
+        class FakeAI:
+            model = 'fake-model'
+
+            def generate_reply(self, user_message, store_info, conversation_history=None):
+                ai_calls.append(conversation_history)
+                return f'回答 {len(ai_calls)}'
+
+        handler = MessageHandler(None)
+        handler.ai_service = FakeAI()
+        history = [{'role': 'user', 'content': '我想訂明天晚上'}]
+
+        with mock.patch('apps.line_bot.services.message_handler.get_recent_history', return_value=history):
+            handler.handle_text_message('U1', '那要怎麼付款', self.store.id, get_store_context(self.store))
+        with mock.patch('apps.line_bot.services.message_handler.get_recent_history', return_value=[]):
+            second = handler.handle_text_message('U2', '那要怎麼付款', self.store.id, get_store_context(self.store))
+
+        self.assertEqual(second['reply'], '回答 2')
+        self.assertIsNone(second.get('cache_hit'))
+
+    def test_address_reply_requires_address_question(self):
+        handler = MessageHandler(None)
+        store_info = get_store_context(self.store)
+
+        self.assertIn('地址', handler._build_direct_fact_reply('你們店在哪裡？', store_info))
+        self.assertIsNone(handler._build_direct_fact_reply('我的訂單在哪', store_info))
+        self.assertIsNone(handler._build_direct_fact_reply('今天還有位置嗎', store_info))
+
+
+class FAQMatcherTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = make_store('faq', name='FAQ Store')
+
+    def _faq(self, question, keywords, priority=0):
+        return StoreFAQ.objects.create(
+            store=self.store,
+            question=question,
+            answer=f'{question} 的回答',
+            keywords=keywords,
+            priority=priority,
+        )
+
+    def test_automaton_finds_overlapping_patterns(self):
+        automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+
+        self.assertEqual(automaton.find('ushers'), {0, 1, 3})
+        self.assertEqual(automaton.find('ahishe'), {0, 1, 2})
+        self.assertEqual(automaton.find('xyz'), set())
+
+    def test_scores_keywords_and_question_like_before(self):
+        parking = self._faq('停車', ['停車場', 'Parking'])
+        self._faq('外送', ['外送'], priority=5)
+        hours = self._faq('營業時間', ['幾點開', '幾點關'], priority=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self._faq('訂位', ['訂位'])
+
+        index = get_faq_index(self.store.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_faq_index(self.store.id).best_match('請問有 parking 嗎'), parking)
+        self.assertEqual(index.best_match('幾點開？幾點關？'), hours)
+        # 關鍵字 1 分加上問題全文 2 分，高於兩個關鍵字
+        self.assertEqual(index.best_match('幾點開？幾點關？停車場呢'), parking)
+        self.assertEqual(index.best_match('你們有停車嗎'), parking)
+        self.assertIsNone(index.best_match('你好'))
+
+    def test_index_is_rebuilt_after_max_age(self):
+        parking = self._faq('停車', ['停車場'])
+        self.assertEqual(get_faq_index(self.store.id).best_match('停車場在哪'), parking)
+
+        # 其他行程停用 FAQ，版本號通知未送達
+        StoreFAQ.objects.filter(pk=parking.pk).update(is_active=False)
+        self.assertEqual(get_faq_index(self.store.id).best_match('停車場在哪'), parking)
+        with override_settings(LINE_BOT_FAQ_INDEX_CACHE_SECONDS=0):
+            self.assertIsNone(get_faq_index(self.store.id).best_match('停車場在哪'))
+
+    def test_usage_counts_are_flushed_in_batches(self):
+        first = self._faq('停車', ['停車'])
+        second = self._faq('外送', ['外送'])
+        counter = FAQUsageCounter(flush_interval=60, flush_threshold=1000)
+        counter._ensure_thread = lambda: None
+
+        for faq_id in (first.id, first.id, second.id):
+            counter.record(faq_id)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(counter.flush(), 3)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.usage_count, second.usage_count), (2, 1))
+
+
+class ConversationLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = make_store('conversation', name='Conversation Store')
+
+    @override_settings(CONVERSATION_LOG_ASYNC_ENABLED=False, CONVERSATION_HISTORY_SIZE=4)
+    def test_history_ring_buffer_keeps_latest_turns(self):
+        for turn in range(3):
+            log_conversation(self.store, 'U1', f'問題{turn}', f'回答{turn}')
+
+        with self.assertNumQueries(0):
+            history = get_recent_history(self.store.id, 'U1')
+        self.assertEqual(
+            [entry['content'] for entry in history],
+            ['問題1', '回答1', '問題2', '回答2'],
+        )
+        self.assertEqual(ConversationLog.objects.filter(store=self.store, line_user_id='U1').count(), 6)
+
+        # 快取不存在時從資料庫載入相同內容
+        cache.clear()
+        self.assertEqual(get_recent_history(self.store.id, 'U1'), history)
+
+    def test_writer_bulk_creates_buffered_records(self):
+        writer = ConversationLogWriter(flush_interval=60, batch_size=100)
+        writer._ensure_thread = lambda: None
+        sent_at = timezone.now() - timedelta(minutes=5)
+        writer.add([
+            ConversationLog(store=self.store, line_user_id='U1', sender_type='user',
+                            message_content='你好', created_at=sent_at),
+            ConversationLog(store=self.store, line_user_id='U1', sender_type='bot',
+                            message_content='您好', created_at=sent_at),
+        ])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(writer.flush(), 2)
+        self.assertEqual(writer.flush(), 0)
+        # 延後寫入仍保留收到訊息的時間
+        self.assertTrue(all(
+            created_at == sent_at
+            for created_at in ConversationLog.objects.values_list('created_at', flat=True)
+        ))
+
+    def test_prune_deletes_expired_logs_by_month(self):
+        now = timezone.now()
+        for days in (400, 370, 10):
+            ConversationLog.objects.create(
+                store=self.store,
+                line_user_id='U1',
+                sender_type='user',
+                message_content='舊訊息',
+                created_at=now - timedelta(days=days),
+            )
+
+        dry_run = prune_conversation_logs(retention_days=365, dry_run=True, now=now)
+        self.assertEqual(dry_run['total'], 2)
+        self.assertEqual(ConversationLog.objects.count(), 3)
+
+        summary = prune_conversation_logs(retention_days=365, now=now)
+        self.assertEqual(summary, dry_run)
+        self.assertEqual(ConversationLog.objects.count(), 1)
+        with self.assertRaises(ValueError):
+            prune_conversation_logs(retention_days=0)
+
+
+class MerchantReplyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = make_store('ops', name='Ops Store', enable_loyalty=True)
+        merchant = self.store.merchant
+        merchant_user = merchant.user
+        MerchantLineBinding.objects.create(merchant=merchant, line_user_id='U-merchant')
+        LineUserBinding.objects.create(user=merchant_user, line_user_id='U-merchant', current_mode='merchant')
+
+        MembershipLevel.objects.create(store=self.store, name='銀卡', threshold_points=50)
+        MembershipLevel.objects.create(store=self.store, name='金卡', threshold_points=100)
+        customer = User.objects.create_user(
+            email='member@example.com',
+            password='password',
+            firebase_uid='member-uid',
+            username='member',
+        )
+        CustomerLoyaltyAccount.objects.create(user=customer, store=self.store, total_points=60, available_points=40)
+        LineUserBinding.objects.create(user=customer, line_user_id='U-member')
+
+    def _order(self, number, status='pending'):
+        return TakeoutOrder.objects.create(
+            store=self.store,
+            customer_name='顧客',
+            customer_phone='0912345678',
+            pickup_at=timezone.now(),
+            payment_method='cash',
+            pickup_number=number,
+            status=status,
+        )
+
+    def test_operations_reply_reads_rollups(self):
+        self._order('T0001')
+        accepted = self._order('T0002')
+        accepted.status = 'accepted'
+        accepted.save()
+        self._order('T0003', status='rejected')
+        self._order('T0004').delete()
+
+        with self.assertNumQueries(3):
+            reply = build_merchant_operations_reply('U-merchant')
+        self.assertIn('今日訂單：外帶 2、內用 0、惜食 0', reply)
+        self.assertIn('待處理訂單：外帶 1、內用 0、惜食 0', reply)
+        self.assertIn('本月訂單：外帶 2、內用 0、惜食 0', reply)
+        self.assertIn('會員人數：1', reply)
+
+    def test_membership_reply_uses_level_ladder(self):
+        build_membership_level_reply(self.store, 'U-member')
+        with self.assertNumQueries(1):
+            reply = build_membership_level_reply(self.store, 'U-member')
+        self.assertIn('累積點數：60', reply)
+        self.assertIn('下一級：金卡（再 40 點）', reply)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MembershipLevel.objects.create(store=self.store, name='白金卡', threshold_points=80)
+        self.assertIn('下一級：白金卡（再 20 點）', build_membership_level_reply(self.store, 'U-member'))
+        self.assertIn('請先在 DineVerse 綁定', build_membership_level_reply(self.store, 'U-unknown'))
+
+
+class ChannelCredentialsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = make_store('channel', name='Channel Store')
+        self.config = StoreLineBotConfig.objects.create(
+            store=self.store,
+            line_channel_access_token='token',
+            line_channel_secret='secret',
+            is_active=True,
+        )
+        self.url = reverse('line-webhook-by-store', args=[self.store.id])
+
+    def _post(self, body, secret='secret'):
+        return self.client.post(
+            self.url,
+            data=body,
+            content_type='application/json',
+            HTTP_X_LINE_SIGNATURE=compute_signature(body, secret),
+        )
+
+    def test_signature_matches_line_spec(self):
+        body = b'{"events": []}'
+        expected = base64.b64encode(hmac.new(b'secret', body, hashlib.sha256).digest()).decode('utf-8')
+        self.assertEqual(compute_signature(body, 'secret'), expected)
+        # 預先建立的 HMAC 物件每次複製使用，不會累積前一次的內容
+        compute_signature(b'other body', 'secret')
+        self.assertEqual(compute_signature(body, 'secret'), expected)
+
+    @override_settings(LINE_WEBHOOK_ASYNC_ENABLED=False)
+    def test_webhook_batch_resolves_config_once(self):
+        events = [
+            {
+                'type': 'message',
+                'webhookEventId': f'E{index}',
+                'source': {'type': 'user', 'userId': 'U1'},
+                'message': {'type': 'sticker'},
+            }
+            for index in range(5)
+        ]
+        body = json.dumps({'events': events}).encode('utf-8')
+
+        self.assertEqual(self._post(body).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._post(json.dumps({'events': []}).encode('utf-8')).status_code, 200)
+            self.assertEqual(get_active_bot_config(self.store.id).store.name, 'Channel Store')
+        self.assertEqual(self._post(body, secret='wrong').status_code, 403)
+
+    def test_config_changes_are_picked_up(self):
+        self.assertIsNotNone(get_active_bot_config(self.store.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.config.line_channel_secret = 'rotated'
+            self.config.is_active = False
+            self.config.save()
+
+        self.assertIsNone(get_active_bot_config(self.store.id))
+        body = json.dumps({'events': []}).encode('utf-8')
+        self.assertEqual(self._post(body).status_code, 403)
+        self.assertEqual(self._post(body, secret='rotated').status_code, 200)
+
+
+class StoreRecommendationPushTests(TestCase):
+    def setUp(self):
+        platform_settings = PlatformSettings.get_settings()
+        platform_settings.is_line_bot_enabled = True
+        platform_settings.save()
+
+        self.store = make_store('push', name='Push Store')
+        self.merchant = self.store.merchant
+        StoreLineBotConfig.objects.create(
+            store=self.store,
+            line_channel_access_token='token',
+            line_channel_secret='secret',
+            is_active=True,
+        )
+        self.spicy = Product.objects.create(
+            merchant=self.merchant,
+            store=self.store,
+            name='麻辣鍋',
+            price=Decimal('300'),
+            food_tags=['麻辣'],
+        )
+        self.session = FakeSession([FakeResponse(200) for _ in range(50)])
+
+    def _customer(self, name, notify=True, ordered=True):
+        customer = User.objects.create_user(
+            email=f'{name}@example.com',
+            password='password',
+            firebase_uid=f'{name}-uid',
+            username=name,
+        )
+        CustomerLoyaltyAccount.objects.create(user=customer, store=self.store)
+        LineUserBinding.objects.create(
+            user=customer,
+            line_user_id=f'U-{name}',
+            notify_personalized_recommendation=notify,
+        )
+        if ordered:
+            order = TakeoutOrder.objects.create(
+                store=self.store,
+                user=customer,
+                customer_name=name,
+                customer_phone='0912345678',
+                pickup_at=timezone.now(),
+                payment_method='cash',
+                pickup_number=f'P-{name}',
+            )
+            TakeoutOrderItem.objects.create(order=order, product=self.spicy, quantity=1, unit_price=Decimal('300'))
+        return customer
+
+    def _run(self):
+        session = self.session
+        with mock.patch(
+            'apps.line_bot.services.store_recommendation_push_service.PushDispatcher',
+            side_effect=lambda token: PushDispatcher(token, session=session, sleep=lambda seconds: None),
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                summary = StoreRecommendationPushService().run_auto_cycle()
+        return summary, len(queries)
+
+    def test_cycle_pushes_popular_and_new_products(self):
+        regular = self._customer('regular')
+        self._customer('quiet', notify=False)
+        self._customer('fresh', ordered=False)
+        StoreUserPushLog.objects.create(
+            store=self.store,
+            user=regular,
+            line_user_id='U-regular',
+            push_type='store_popular',
+            status='success',
+        )
+        Product.objects.create(
+            merchant=self.merchant,
+            store=self.store,
+            name='麻辣臭豆腐',
+            price=Decimal('120'),
+            food_tags=['麻辣'],
+        )
+
+        summary, _ = self._run()
+
+        self.assertEqual(summary['recipient_count'], 3)
+        self.assertEqual(summary['success_count'], 2)
+        self.assertEqual(summary['popular_success_count'], 1)
+        self.assertEqual(summary['new_product_success_count'], 1)
+        sent = {
+            (log.line_user_id, log.push_type, log.status, log.reason)
+            for log in StoreUserPushLog.objects.exclude(reason='')
+        }
+        self.assertIn(('U-regular', 'store_popular', 'skipped', 'min_interval_not_reached'), sent)
+        self.assertIn(('U-regular', 'store_new_product', 'success', 'auto_cycle'), sent)
+        self.assertIn(('U-fresh', 'store_popular', 'success', 'auto_cycle'), sent)
+        self.assertIn(('U-fresh', 'store_new_product', 'skipped', 'no_similar_new_products'), sent)
+        self.assertIn(('U-quiet', 'store_popular', 'skipped', 'user_personalized_disabled'), sent)
+
+    def test_query_count_does_not_grow_with_recipients(self):
+        self._customer('first')
+        _, first_queries = self._run()
+
+        StoreUserPushLog.objects.all().delete()
+        for index in range(5):
+            self._customer(f'more{index}')
+        summary, second_queries = self._run()
+
+        self.assertEqual(summary['recipient_count'], 6)
+        self.assertEqual(first_queries, second_queries)
@@ -1,25 +1,22 @@
-import hmac
-import hashlib
 import json
-import base64
 import re
 from decimal import Decimal
 from urllib.parse import parse_qs
 from typing import Optional
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
-from django.db.models import Count
 from django.utils import timezone
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from apps.stores.models import Store
-from apps.products.models import Product, ProductCategory, SpecificationGroup, ProductSpecification
-from apps.reservations.models import TimeSlot
+from apps.products.models import Product
+from apps.users.middleware import get_request_store
 from apps.users.models import Merchant
+from apps.orders.order_stats import get_store_order_summary
 from .models import LineUserBinding, StoreFAQ, ConversationLog, BroadcastMessage, StoreLineBotConfig, MerchantLineBinding, PlatformBroadcast
 from .serializers import (
     LineUserBindingSerializer,
@@ -34,7 +31,24 @@ from .serializers import (
     PlatformBroadcastSerializer
 )
 from .services.line_api import LineMessagingAPI
+from .services.broadcast_jobs import (
+    create_broadcast_job,
+    execute_broadcast_job,
+    request_cancel,
+    resume_job,
+    serialize_job,
+)
 from .services.message_handler import MessageHandler, AIReplyService
+from .services.channel_credentials import (
+    get_active_bot_config,
+    get_fallback_credentials,
+    get_store_credentials,
+    verify_channel_signature,
+)
+from .services.conversation_log import log_conversation
+from .services.membership_summary import find_loyalty_account, get_level_ladder
+from .services.store_context import get_store_context
+from .services.webhook_queue import enqueue_events
 import os
 
 
@@ -50,14 +64,7 @@ def verify_signature(request_body: bytes, signature: str, channel_secret: str) -
     Returns:
         bool: 簽名是否有效
     """
-    secret_bytes = channel_secret.encode('utf-8')
-    hash_digest = hmac.new(
-        secret_bytes,
-        request_body,
-        hashlib.sha256
-    ).digest()
-    expected_signature = base64.b64encode(hash_digest).decode('utf-8')
-    return signature == expected_signature
+    return verify_channel_signature(request_body, signature, channel_secret)
 
 
 @csrf_exempt
@@ -79,9 +86,9 @@ def webhook(request):
         
         if not channel_secret:
             # Fallback: 從第一個啟用的店家配置取得
-            bot_config = StoreLineBotConfig.objects.filter(is_active=True).first()
-            if bot_config and bot_config.line_channel_secret:
-                channel_secret = bot_config.line_channel_secret
+            fallback = get_fallback_credentials()
+            if fallback and fallback.channel_secret:
+                channel_secret = fallback.channel_secret
                 if settings.DEBUG:
                     print(f"[LINE Webhook] Using channel secret from store config (length: {len(channel_secret)})")
             else:
@@ -115,12 +122,15 @@ def webhook(request):
         body = json.loads(request.body.decode('utf-8'))
         events = body.get('events', [])
         
-        if settings.DEBUG:
-            print(f"[LINE Webhook] Events: {len(events)}")
+        # 事件排入背景佇列後立即回應，AI 回覆等耗時處理不佔用本次請求
+        summary = enqueue_events(handle_event, events, channel_key='platform')
         
-        for event in events:
-            handle_event(event)
+        if settings.DEBUG:
+            print(f"[LINE Webhook] Events: {len(events)} {summary}")
         
+        # 佇列已滿：回傳 503 讓 LINE 稍後重送
+        if summary['rejected']:
+            return HttpResponse(status=503)
         return HttpResponse(status=200)
     
     except Exception as e:
@@ -190,28 +200,10 @@ def build_membership_level_reply(store, line_user_id: str) -> Optional[str]:
     if not getattr(store, 'enable_loyalty', False):
         return None
 
-    from apps.loyalty.models import CustomerLoyaltyAccount, MembershipLevel
-
-    binding = (
-        LineUserBinding.objects.filter(
-            line_user_id=line_user_id,
-            is_active=True,
-        )
-        .select_related('user')
-        .first()
-    )
-    if not binding:
-        return f"若要查詢 {store.name} 的會員等級，請先在 DineVerse 綁定目前這個 LINE 帳號。"
-
-    account = (
-        CustomerLoyaltyAccount.objects.filter(
-            user=binding.user,
-            store=store,
-        )
-        .select_related('current_level')
-        .first()
-    )
+    account = find_loyalty_account(store.id, line_user_id)
     if not account:
+        if not LineUserBinding.objects.filter(line_user_id=line_user_id, is_active=True).exists():
+            return f"若要查詢 {store.name} 的會員等級，請先在 DineVerse 綁定目前這個 LINE 帳號。"
         return f"您目前還沒有 {store.name} 的會員紀錄，完成消費累積點數後就能查看會員等級。"
 
     current_level = account.current_level
@@ -228,18 +220,11 @@ def build_membership_level_reply(store, line_user_id: str) -> Optional[str]:
     if current_level and current_level.benefits:
         lines.append(f"會員權益：{current_level.benefits}")
 
-    next_level = (
-        MembershipLevel.objects.filter(
-            store=store,
-            active=True,
-            threshold_points__gt=account.total_points,
-        )
-        .order_by('threshold_points', 'rank')
-        .first()
-    )
+    next_level = get_level_ladder(store.id).next_level(account.total_points)
     if next_level:
-        needed_points = max(next_level.threshold_points - account.total_points, 0)
-        lines.append(f"下一級：{next_level.name}（再 {needed_points} 點）")
+        threshold_points, next_level_name = next_level
+        needed_points = max(threshold_points - account.total_points, 0)
+        lines.append(f"下一級：{next_level_name}（再 {needed_points} 點）")
 
     return '\n'.join(lines)
 
@@ -280,21 +265,20 @@ def build_merchant_operations_reply(line_user_id: str) -> Optional[str]:
             line_user_id=line_user_id,
             is_active=True,
         )
-        .select_related('merchant__user')
+        .select_related('merchant__user', 'merchant__store')
         .first()
     )
+    if not merchant_binding:
+        return None
+
     user_binding = (
         LineUserBinding.objects.filter(
             line_user_id=line_user_id,
             is_active=True,
         )
-        .select_related('user')
+        .only('current_mode')
         .first()
     )
-
-    if not merchant_binding:
-        return None
-
     if not user_binding or user_binding.current_mode != 'merchant':
         return '目前不是店家模式，先輸入「切換」切到店家模式後，就可以查詢營運資訊。'
 
@@ -304,41 +288,23 @@ def build_merchant_operations_reply(line_user_id: str) -> Optional[str]:
 
     store = merchant.store
 
-    from apps.orders.models import TakeoutOrder, DineInOrder
-    from apps.surplus_food.models import SurplusFoodOrder
-    from apps.loyalty.models import CustomerLoyaltyAccount
-
-    now = timezone.now()
-    today = now.date()
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    takeout_qs = TakeoutOrder.objects.filter(store=store)
-    dinein_qs = DineInOrder.objects.filter(store=store)
-    surplus_qs = SurplusFoodOrder.objects.filter(store=store)
-
-    today_takeout = takeout_qs.filter(created_at__date=today).exclude(status='rejected').count()
-    today_dinein = dinein_qs.filter(created_at__date=today).exclude(status='rejected').count()
-    today_surplus = surplus_qs.filter(created_at__date=today).exclude(status__in=['rejected', 'cancelled', 'expired']).count()
-
-    pending_takeout = takeout_qs.filter(status='pending').count()
-    pending_dinein = dinein_qs.filter(status='pending').count()
-    pending_surplus = surplus_qs.filter(status='pending').count()
-
-    monthly_takeout = takeout_qs.filter(created_at__gte=month_start).exclude(status='rejected').count()
-    monthly_dinein = dinein_qs.filter(created_at__gte=month_start).exclude(status='rejected').count()
-    monthly_surplus = surplus_qs.filter(created_at__gte=month_start).exclude(status__in=['rejected', 'cancelled', 'expired']).count()
+    # 訂單數來自每日統計（訂單 signals 增量維護），會員人數來自店家計數欄位
+    order_summary = get_store_order_summary(store.id)
+    today_counts = order_summary['today']
+    pending_counts = order_summary['pending']
+    monthly_counts = order_summary['month']
 
     completed_surplus_orders = store.surplus_completed_order_count_total or 0
     completed_surplus_revenue = Decimal(str(store.surplus_completed_revenue_total or 0))
     donation_amount = (completed_surplus_revenue * Decimal('0.6')).quantize(Decimal('0.01'))
-    active_members = CustomerLoyaltyAccount.objects.filter(store=store).count() if getattr(store, 'enable_loyalty', False) else 0
+    active_members = store.loyalty_member_count if getattr(store, 'enable_loyalty', False) else 0
 
     return (
         f"{store.name} 營運摘要\n\n"
         f"店家狀態：{'營業中' if store.is_open else '休息中'} / {'已上架' if store.is_published else '未上架'}\n"
-        f"今日訂單：外帶 {today_takeout}、內用 {today_dinein}、惜食 {today_surplus}\n"
-        f"待處理訂單：外帶 {pending_takeout}、內用 {pending_dinein}、惜食 {pending_surplus}\n"
-        f"本月訂單：外帶 {monthly_takeout}、內用 {monthly_dinein}、惜食 {monthly_surplus}\n"
+        f"今日訂單：外帶 {today_counts['takeout']}、內用 {today_counts['dinein']}、惜食 {today_counts['surplus']}\n"
+        f"待處理訂單：外帶 {pending_counts['takeout']}、內用 {pending_counts['dinein']}、惜食 {pending_counts['surplus']}\n"
+        f"本月訂單：外帶 {monthly_counts['takeout']}、內用 {monthly_counts['dinein']}、惜食 {monthly_counts['surplus']}\n"
         f"惜食完成單：{completed_surplus_orders}\n"
         f"累積惜食營收：NT$ {completed_surplus_revenue:,.0f}\n"
         f"累積捐款金額：NT$ {donation_amount:,.0f}\n"
@@ -416,7 +382,7 @@ def handle_message_event(event: dict, store_id: int = None):
     try:
         if store_id:
             # 店家專屬 webhook：使用指定店家的設定
-            bot_config = StoreLineBotConfig.objects.filter(store_id=store_id, is_active=True).first()
+            bot_config = get_active_bot_config(store_id)
             if not bot_config:
                 raise StoreLineBotConfig.DoesNotExist
         else:
@@ -563,22 +529,7 @@ def handle_message_event(event: dict, store_id: int = None):
             membership_reply = build_membership_level_reply(store, line_user_id)
 
         if membership_reply:
-            ConversationLog.objects.create(
-                store=store,
-                line_user_id=line_user_id,
-                sender_type='user',
-                message_type='text',
-                message_content=user_message,
-                reply_token=reply_token
-            )
-            ConversationLog.objects.create(
-                store=store,
-                line_user_id=line_user_id,
-                sender_type='bot',
-                message_type='text',
-                message_content=membership_reply,
-                used_ai=False,
-            )
+            log_conversation(store, line_user_id, user_message, membership_reply, reply_token=reply_token)
             line_api = LineMessagingAPI(bot_config)
             line_api.reply_message(reply_token, [line_api.create_text_message(membership_reply)])
             return
@@ -587,137 +538,8 @@ def handle_message_event(event: dict, store_id: int = None):
         line_api = LineMessagingAPI(bot_config)
         message_handler = MessageHandler(bot_config)
         
-        max_menu_categories = 6
-        max_products_per_category = 8
-        max_spec_groups_per_product = 3
-        max_spec_options_per_group = 6
-        max_description_length = 80
-
-        # 整理可供 AI 使用的訂位資訊（限制筆數避免 prompt 過長）
-        day_order = {
-            'monday': 0,
-            'tuesday': 1,
-            'wednesday': 2,
-            'thursday': 3,
-            'friday': 4,
-            'saturday': 5,
-            'sunday': 6,
-        }
-        reservation_slots = []
-        try:
-            active_slots = list(
-                TimeSlot.objects.filter(store=store, is_active=True)
-            )
-            active_slots.sort(
-                key=lambda s: (
-                    day_order.get(s.day_of_week, 99),
-                    s.start_time,
-                )
-            )
-            for slot in active_slots[:20]:
-                reservation_slots.append({
-                    'day': slot.get_day_of_week_display(),
-                    'start_time': slot.start_time.strftime('%H:%M'),
-                    'end_time': slot.end_time.strftime('%H:%M') if slot.end_time else '',
-                    'max_party_size': slot.max_party_size,
-                    'max_capacity': slot.max_capacity,
-                })
-        except Exception as e:
-            if settings.DEBUG:
-                print(f"[LINE Webhook] Error fetching reservation slots: {e}")
-
-        store_info = {
-            'id': store.id,
-            'name': store.name,
-            'cuisine_type': store.get_cuisine_type_display(),
-            'address': store.address,
-            'phone': store.phone,
-            'opening_hours': store.opening_hours,
-            'description': store.description,
-            'fixed_holidays': store.fixed_holidays,
-            'website': store.website,
-            'line_friend_url': store.line_friend_url,
-            'reservation': {
-                'enabled': store.enable_reservation,
-                'fixed_holidays': store.fixed_holidays,
-                'time_slots': reservation_slots,
-                'contact_phone': store.phone,
-            },
-        }
-        
-        # 取得菜單資料
-        menu_data = []
-        try:
-            categories = ProductCategory.objects.filter(store=store, is_active=True).order_by('display_order')[:max_menu_categories]
-            for category in categories:
-                products = Product.objects.filter(
-                    store=store, 
-                    category=category, 
-                    is_available=True
-                ).prefetch_related('specification_groups__options').order_by('id')[:max_products_per_category]
-                
-                category_products = []
-                for product in products:
-                    description = (product.description or '').strip()
-                    if len(description) > max_description_length:
-                        description = f"{description[:max_description_length]}..."
-
-                    product_info = {
-                        'name': product.name,
-                        'price': float(product.price),
-                        'description': description,
-                    }
-                    # 加入規格資訊
-                    specs = []
-                    for group in product.specification_groups.filter(is_active=True).order_by('display_order')[:max_spec_groups_per_product]:
-                        options = [
-                            f"{opt.name}(+${opt.price_adjustment})" if opt.price_adjustment > 0 
-                            else f"{opt.name}(-${abs(opt.price_adjustment)})" if opt.price_adjustment < 0 
-                            else opt.name
-                            for opt in group.options.filter(is_active=True).order_by('display_order')[:max_spec_options_per_group]
-                        ]
-                        if options:
-                            specs.append(f"{group.name}: {', '.join(options)}")
-                    if specs:
-                        product_info['specifications'] = specs
-                    category_products.append(product_info)
-                
-                if category_products:
-                    menu_data.append({
-                        'category': category.name,
-                        'products': category_products
-                    })
-            
-            # 也加入沒有分類的產品
-            uncategorized = Product.objects.filter(
-                store=store, 
-                category__isnull=True, 
-                is_available=True
-            ).prefetch_related('specification_groups__options').order_by('id')[:max_products_per_category]
-            
-            if uncategorized.exists():
-                uncategorized_products = []
-                for product in uncategorized:
-                    description = (product.description or '').strip()
-                    if len(description) > max_description_length:
-                        description = f"{description[:max_description_length]}..."
-
-                    product_info = {
-                        'name': product.name,
-                        'price': float(product.price),
-                        'description': description,
-                    }
-                    uncategorized_products.append(product_info)
-                menu_data.append({
-                    'category': '其他',
-                    'products': uncategorized_products
-                })
-                
-        except Exception as e:
-            if settings.DEBUG:
-                print(f"[LINE Webhook] Error fetching menu data: {e}")
-        
-        store_info['menu'] = menu_data
+        # 店家資料與系統提示詞已預先組好並快取，商品、時段等變更時由 signals 清除
+        store_info = get_store_context(store, bot_config)
         
         # 處理訊息並取得回覆
         result = message_handler.handle_text_message(
@@ -731,26 +553,16 @@ def handle_message_event(event: dict, store_id: int = None):
             print(f"[LINE Webhook] Reply: {result['reply']}")
             print(f"[LINE Webhook] Matched FAQ: {result.get('matched_faq_id')}")
         
-        # 記錄用戶訊息
-        ConversationLog.objects.create(
-            store=store,
-            line_user_id=line_user_id,
-            sender_type='user',
-            message_type='text',
-            message_content=user_message,
-            reply_token=reply_token
-        )
-        
-        # 記錄 BOT 回覆
-        ConversationLog.objects.create(
-            store=store,
-            line_user_id=line_user_id,
-            sender_type='bot',
-            message_type='text',
-            message_content=result['reply'],
+        # 記錄用戶訊息與 BOT 回覆（背景批次寫入，同時更新近期對話歷史）
+        log_conversation(
+            store,
+            line_user_id,
+            user_message,
+            result['reply'],
+            reply_token=reply_token,
             matched_faq_id=result.get('matched_faq_id'),
             used_ai=result.get('used_ai', False),
-            ai_model=result.get('ai_model')
+            ai_model=result.get('ai_model'),
         )
         
         # 發送回覆
@@ -792,7 +604,7 @@ def handle_follow_event(event: dict, store_id: int = None):
     try:
         if store_id:
             # 店家專屬 webhook：使用指定店家的設定
-            bot_config = StoreLineBotConfig.objects.filter(store_id=store_id, is_active=True).first()
+            bot_config = get_active_bot_config(store_id)
             
             if bot_config and bot_config.line_channel_access_token:
                 line_api = LineMessagingAPI(bot_config)
@@ -901,7 +713,7 @@ def handle_postback_event(event: dict, store_id: int = None):
         _, reply_text = claim_platform_coupon_for_line_user(line_user_id, coupon_token)
 
     if store_id:
-        bot_config = StoreLineBotConfig.objects.filter(store_id=store_id, is_active=True).first()
+        bot_config = get_active_bot_config(store_id)
         line_api = LineMessagingAPI(bot_config) if bot_config else LineMessagingAPI()
     else:
         from apps.intelligence.models import PlatformSettings
@@ -924,16 +736,16 @@ class StoreFAQViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的 FAQ"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            return StoreFAQ.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            return StoreFAQ.objects.filter(store=store)
         return StoreFAQ.objects.none()
     
     def perform_create(self, serializer):
         """建立 FAQ 時自動關聯店家"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            serializer.save(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            serializer.save(store=store)
     
     @action(detail=False, methods=['get'])
     def popular(self, request):
@@ -952,9 +764,9 @@ class ConversationLogViewSet(viewsets.ReadOnlyModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的對話記錄"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            return ConversationLog.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            return ConversationLog.objects.filter(store=store)
         return ConversationLog.objects.none()
     
     @action(detail=False, methods=['get'])
@@ -979,6 +791,35 @@ class ConversationLogViewSet(viewsets.ReadOnlyModelViewSet):
         return Response(serializer.data)
 
 
+def _cancel_broadcast_job(broadcast):
+    job = broadcast.jobs.first()
+    if not job or job.status not in ('queued', 'running'):
+        return Response(
+            {'error': '目前沒有發送中的工作'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    job = request_cancel(job)
+    return Response({'message': '已要求取消發送', 'job': serialize_job(job)})
+
+
+def _resume_broadcast_job(broadcast):
+    job = broadcast.jobs.first()
+    if not job:
+        return Response(
+            {'error': '此推播尚未發送'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        job = resume_job(job)
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    job, finished = execute_broadcast_job(job)
+    return Response({
+        'message': '推播已續傳完成' if finished else '推播已重新排入背景發送',
+        'job': serialize_job(job),
+    }, status=status.HTTP_200_OK if finished else status.HTTP_202_ACCEPTED)
+
+
 class BroadcastMessageViewSet(viewsets.ModelViewSet):
     """
     推播訊息 ViewSet
@@ -992,77 +833,38 @@ class BroadcastMessageViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的推播訊息"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            return BroadcastMessage.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            return BroadcastMessage.objects.filter(store=store)
         return BroadcastMessage.objects.none()
     
     def perform_create(self, serializer):
         """建立推播訊息時自動關聯店家和建立者"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(self.request)
+        if store:
             serializer.save(
-                store=user.merchant_profile.store,
-                created_by=user
+                store=store,
+                created_by=self.request.user
             )
     
     @action(detail=True, methods=['post'])
     def send(self, request, pk=None):
-        """發送推播訊息"""
+        """發送推播訊息（建立發送工作；大型推播於背景發送）"""
         broadcast = self.get_object()
         
-        if broadcast.status == 'sent':
+        if broadcast.status in ('sent', 'sending'):
             return Response(
-                {'error': '此訊息已發送'},
+                {'error': '此訊息已發送' if broadcast.status == 'sent' else '此訊息正在發送中'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # 取得店家的 LINE BOT 配置
-        try:
-            bot_config = StoreLineBotConfig.objects.get(store=broadcast.store, is_active=True)
-            temp_line_api = LineMessagingAPI(bot_config)
-        except StoreLineBotConfig.DoesNotExist:
+        # 確認店家的 LINE BOT 配置
+        if not StoreLineBotConfig.objects.filter(store=broadcast.store, is_active=True).exists():
             return Response(
                 {'error': '此店家尚未設定 LINE BOT'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # 準備訊息（包含標題和內容）
-        full_message = f"📢 {broadcast.title}\n\n{broadcast.message_content}"
-        messages = [temp_line_api.create_text_message(full_message)]
-        
-        if broadcast.image_url:
-            messages.insert(0, temp_line_api.create_image_message(broadcast.image_url))
-
-        if broadcast.coupon_id:
-            coupon = broadcast.coupon
-            coupon_summary = (
-                f"優惠券：{coupon.title}\n"
-                f"折抵方式：{coupon.get_discount_type_display()} {coupon.discount_value}\n"
-                f"最低消費：NT$ {coupon.min_order_amount}\n"
-                f"到期時間：{coupon.expires_at.strftime('%Y-%m-%d %H:%M')}"
-            )
-            if coupon.max_discount_amount:
-                coupon_summary += f"\n最高折抵：NT$ {coupon.max_discount_amount}"
-
-            messages.append(temp_line_api.create_text_message(coupon_summary))
-            messages.append(
-                temp_line_api.create_template_buttons(
-                    alt_text=f"{coupon.title} 領券通知",
-                    title='立即領券',
-                    text='點擊下方按鈕，將優惠券存入個人資料的優惠券存放處。',
-                    actions=[
-                        {
-                            'type': 'postback',
-                            'label': '領取優惠券',
-                            'data': f'action=claim_platform_coupon&token={coupon.claim_token}',
-                            'displayText': '我要領取這張優惠券',
-                        }
-                    ],
-                )
-            )
-        
-        # 發送訊息
         target_users = broadcast.target_users
         original_target_count = len(target_users)
 
@@ -1090,49 +892,45 @@ class BroadcastMessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        success_count = 0
-        failure_count = 0
-        
-        # 分批發送（每次最多 500 人）
-        batch_size = 500
-        for i in range(0, len(target_users), batch_size):
-            batch = target_users[i:i + batch_size]
-            result = temp_line_api.multicast_message(batch, messages)
-            
-            if result.get('success'):
-                success_count += len(batch)
-            else:
-                failure_count += len(batch)
-        
-        # 更新狀態
-        from django.utils import timezone
-        broadcast.status = 'sent'
-        broadcast.sent_at = timezone.now()
-        broadcast.recipient_count = len(target_users)
-        broadcast.success_count = success_count
-        broadcast.failure_count = failure_count
-        broadcast.save()
+        job = create_broadcast_job(target_users, broadcast_message=broadcast)
+        job, finished = execute_broadcast_job(job)
         
         return Response({
-            'message': '推播已發送',
-            'recipient_count': len(target_users),
-            'skipped_by_preference': max(0, original_target_count - len(target_users)),
-            'success_count': success_count,
-            'failure_count': failure_count
-        })
+            'message': '推播已發送' if finished else '推播已排入背景發送',
+            'recipient_count': job.total_count,
+            'skipped_by_preference': max(0, original_target_count - job.total_count),
+            'success_count': job.success_count,
+            'failure_count': job.failure_count,
+            'job': serialize_job(job),
+        }, status=status.HTTP_200_OK if finished else status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """查詢推播發送進度"""
+        broadcast = self.get_object()
+        return Response({'job': serialize_job(broadcast.jobs.first())})
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """取消發送中的推播（已送出的批次不受影響）"""
+        return _cancel_broadcast_job(self.get_object())
+
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """續傳已取消或失敗的推播，只發送尚未送達的用戶"""
+        return _resume_broadcast_job(self.get_object())
 
     @action(detail=False, methods=['get'], url_path='membership-levels')
     def membership_levels(self, request):
         from apps.loyalty.models import MembershipLevel
 
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response(
                 {'error': '只有商家可以查詢會員等級'},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        store = user.merchant_profile.store
         if not store.enable_loyalty:
             return Response({
                 'loyalty_enabled': False,
@@ -1162,14 +960,13 @@ class BroadcastMessageViewSet(viewsets.ModelViewSet):
     def membership_targets(self, request):
         from apps.loyalty.models import CustomerLoyaltyAccount
 
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response(
                 {'error': '只有商家可以查詢會員目標'},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        store = user.merchant_profile.store
         if not store.enable_loyalty:
             return Response({
                 'loyalty_enabled': False,
@@ -1231,133 +1028,93 @@ class BroadcastMessageViewSet(viewsets.ModelViewSet):
         Query Parameters:
             food_tags: 食物標籤列表（逗號分隔）
             days_inactive: 閒置天數（超過此天數未下單的用戶）
+            level_ids: 會員等級 ID 列表（逗號分隔）
+            min_spent: 累計消費金額下限
+            count_only: 設為 1 時只回傳人數
+            stream: 設為 1 時以串流回傳完整目標 LINE User ID 陣列（大型店家使用）
         """
-        from apps.orders.models import TakeoutOrder, DineInOrder
-        from apps.loyalty.models import CustomerLoyaltyAccount
-        from django.utils import timezone
-        from datetime import timedelta
-        from collections import Counter
+        from decimal import Decimal, InvalidOperation
+        from .services.audience_segments import (
+            build_segment_queryset,
+            ensure_store_customer_features,
+            iter_segment_line_user_ids,
+            preview_segment,
+        )
         
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response(
                 {'error': '您沒有店家權限'},
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        store = user.merchant_profile.store
-        
         # 解析篩選條件
         food_tags_param = request.query_params.get('food_tags', '')
         food_tags = [tag.strip() for tag in food_tags_param.split(',') if tag.strip()]
-        days_inactive = int(request.query_params.get('days_inactive', 0))
+        level_ids = [
+            int(level_id)
+            for level_id in request.query_params.get('level_ids', '').split(',')
+            if level_id.strip().isdigit()
+        ]
+        try:
+            days_inactive = int(request.query_params.get('days_inactive', 0) or 0)
+            min_spent_param = request.query_params.get('min_spent', '')
+            min_spent = Decimal(min_spent_param) if min_spent_param else None
+        except (ValueError, InvalidOperation):
+            return Response(
+                {'error': 'days_inactive 或 min_spent 格式錯誤'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # 取得此店家的所有已綁定 LINE 的顧客
-        # 透過 CustomerLoyaltyAccount 找到在此店家有消費記錄的用戶
-        customer_accounts = CustomerLoyaltyAccount.objects.filter(store=store)
+        ensure_store_customer_features(store)
+        segment = build_segment_queryset(
+            store,
+            food_tags=food_tags,
+            days_inactive=days_inactive,
+            level_ids=level_ids,
+            min_spent=min_spent,
+        )
         
-        target_users = []
-        user_details = []
+        filters_applied = {
+            'food_tags': food_tags,
+            'days_inactive': days_inactive,
+            'level_ids': level_ids,
+            'min_spent': str(min_spent) if min_spent is not None else None,
+        }
         
-        for account in customer_accounts:
-            customer = account.user
-            
-            # 檢查是否有綁定 LINE
-            try:
-                line_binding = LineUserBinding.objects.get(user=customer, is_active=True)
-            except LineUserBinding.DoesNotExist:
-                continue
-
-            if not line_binding.notify_personalized_recommendation:
-                continue
-            
-            # 檢查閒置天數篩選
-            if days_inactive > 0:
-                # 取得最近訂單時間
-                last_order_date = None
-                
-                takeout = TakeoutOrder.objects.filter(
-                    user=customer, store=store
-                ).order_by('-created_at').first()
-                
-                dinein = DineInOrder.objects.filter(
-                    user=customer, store=store
-                ).order_by('-created_at').first()
-                
-                if takeout:
-                    last_order_date = takeout.created_at
-                if dinein and (not last_order_date or dinein.created_at > last_order_date):
-                    last_order_date = dinein.created_at
-                
-                if last_order_date:
-                    days_since_order = (timezone.now() - last_order_date).days
-                    if days_since_order < days_inactive:
-                        continue  # 用戶還不夠閒置
-            
-            # 檢查食物標籤偏好篩選
-            if food_tags:
-                # 分析用戶的食物偏好（從訂單歷史）
-                from apps.orders.models import TakeoutOrderItem, DineInOrderItem
-                
-                user_tags = Counter()
-                
-                # 外帶訂單項目
-                takeout_items = TakeoutOrderItem.objects.filter(
-                    order__user=customer,
-                    order__store=store
-                ).select_related('product')
-                
-                for item in takeout_items:
-                    if item.product and item.product.food_tags:
-                        for tag in item.product.food_tags:
-                            user_tags[tag] += 1
-                
-                # 內用訂單項目
-                dinein_items = DineInOrderItem.objects.filter(
-                    order__user=customer,
-                    order__store=store
-                ).select_related('product')
-                
-                for item in dinein_items:
-                    if item.product and item.product.food_tags:
-                        for tag in item.product.food_tags:
-                            user_tags[tag] += 1
-                
-                # 檢查是否有匹配的標籤
-                if not any(tag in user_tags for tag in food_tags):
-                    continue  # 沒有匹配的標籤偏好
-            
-            # 通過所有篩選，加入目標用戶
-            target_users.append(line_binding.line_user_id)
-            user_details.append({
-                'line_user_id': line_binding.line_user_id,
-                'display_name': line_binding.display_name,
-                'username': customer.username,
-                'total_points': account.total_points,
+        # 只需要人數時以 COUNT 查詢回覆，不讀取目標清單
+        if request.query_params.get('count_only') in ('1', 'true'):
+            return Response({
+                'target_count': segment.count(),
+                'filters_applied': filters_applied,
             })
         
+        if request.query_params.get('stream') in ('1', 'true'):
+            def stream_ids():
+                yield '['
+                for index, line_user_id in enumerate(iter_segment_line_user_ids(segment)):
+                    yield ('' if index == 0 else ',') + json.dumps(line_user_id)
+                yield ']'
+            return StreamingHttpResponse(stream_ids(), content_type='application/json')
+        
+        target_users = list(iter_segment_line_user_ids(segment))
         return Response({
             'target_count': len(target_users),
             'target_users': target_users,
-            'user_details': user_details[:20],  # 只返回前 20 個用戶詳情作為預覽
-            'filters_applied': {
-                'food_tags': food_tags,
-                'days_inactive': days_inactive,
-            }
+            'user_details': preview_segment(segment),  # 只返回前 20 個用戶詳情作為預覽
+            'filters_applied': filters_applied,
         })
     
     @action(detail=False, methods=['get'])
     def available_food_tags(self, request):
         """取得店家商品的所有食物標籤"""
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response(
                 {'error': '您沒有店家權限'},
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        store = user.merchant_profile.store
-        
         # 從店家商品收集所有食物標籤
         products = Product.objects.filter(store=store, is_available=True)
         all_tags = set()
@@ -1524,20 +1281,19 @@ def webhook_by_store(request, store_id):
     指定店家的 LINE Webhook 端點
     用於接收來自特定店家 LINE Channel 的事件
     """
-    try:
-        store = Store.objects.get(pk=store_id)
-        config = StoreLineBotConfig.objects.get(store=store)
-    except (Store.DoesNotExist, StoreLineBotConfig.DoesNotExist):
+    # 店家設定由憑證登錄提供（行程內快取，設定變更時由 signals 通知重新載入）
+    credentials = get_store_credentials(store_id)
+    if credentials is None:
         # 即使沒有設定，也回傳 200 給 LINE 驗證
         return JsonResponse({'status': 'ok'})
     
     # 如果沒有設定 channel secret，直接回傳 200（用於 LINE 驗證）
-    if not config.line_channel_secret:
+    if not credentials.channel_secret:
         return JsonResponse({'status': 'ok'})
     
-    # 驗證簽名
+    # 驗證簽名（LINE 的請求一律帶有簽名，缺少簽名視為無效）
     signature = request.headers.get('X-Line-Signature', '')
-    if signature and not verify_signature(request.body, signature, config.line_channel_secret):
+    if not credentials.verify_signature(request.body, signature):
         return HttpResponse('Invalid signature', status=403)
     
     # 處理事件
@@ -1550,12 +1306,14 @@ def webhook_by_store(request, store_id):
             return JsonResponse({'status': 'ok'})
         
         # 檢查是否啟用
-        if not config.is_active:
+        if not credentials.is_active:
             return JsonResponse({'status': 'ok', 'message': 'Bot is disabled'})
         
-        for event in events:
-            handle_event(event, store_id)
+        summary = enqueue_events(handle_event, events, store_id=store_id, channel_key=f'store:{store_id}')
         
+        # 佇列已滿：回傳 503 讓 LINE 稍後重送
+        if summary['rejected']:
+            return JsonResponse({'status': 'busy'}, status=503)
         return JsonResponse({'status': 'ok'})
     except Exception as e:
         print(f"[LINE BOT] Error handling webhook for store {store_id}: {e}")
@@ -1757,60 +1515,6 @@ class PlatformBroadcastViewSet(viewsets.ModelViewSet):
         else:
             serializer.save(created_by=None)
 
-    def _get_popular_recommended_stores(self, limit=5):
-        """熱門店家：依惜福品累積捐款金額與完成訂單數排序。"""
-        return list(
-            Store.objects.filter(is_published=True)
-            .order_by('-surplus_completed_revenue_total', '-surplus_completed_order_count_total', '-created_at')[:limit]
-        )
-
-    def _get_personalized_recommended_stores(self, user, limit=5):
-        """個人化店家：依用戶歷史訂單店家偏好排序。"""
-        from apps.orders.models import DineInOrder, TakeoutOrder
-        from apps.surplus_food.models import SurplusFoodOrder
-
-        store_scores = {}
-
-        takeout_stats = TakeoutOrder.objects.filter(user=user).exclude(status='rejected').values('store_id').annotate(order_count=Count('id'))
-        dinein_stats = DineInOrder.objects.filter(user=user).exclude(status='rejected').values('store_id').annotate(order_count=Count('id'))
-        surplus_stats = SurplusFoodOrder.objects.filter(user=user).exclude(status__in=['rejected', 'cancelled', 'expired']).values('store_id').annotate(order_count=Count('id'))
-
-        for row in takeout_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-        for row in dinein_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-        for row in surplus_stats:
-            store_scores[row['store_id']] = store_scores.get(row['store_id'], 0) + row['order_count']
-
-        if not store_scores:
-            return []
-
-        ranked_store_ids = [
-            store_id
-            for store_id, _ in sorted(store_scores.items(), key=lambda item: item[1], reverse=True)
-        ]
-
-        stores = Store.objects.filter(id__in=ranked_store_ids, is_published=True)
-        store_by_id = {store.id: store for store in stores}
-        return [store_by_id[store_id] for store_id in ranked_store_ids if store_id in store_by_id][:limit]
-
-    def _build_recommendation_message(self, title, intro, stores, include_popularity_metrics=False):
-        if not stores:
-            return None
-
-        lines = [title, '', intro]
-        for store in stores:
-            if include_popularity_metrics:
-                donation_amount = float(store.surplus_completed_revenue_total or 0) * 0.6
-                completed_orders = store.surplus_completed_order_count_total or 0
-                lines.append(
-                    f"• {store.name}（捐款 NT$ {donation_amount:,.0f} / 完成單 {completed_orders}）"
-                )
-            else:
-                lines.append(f"• {store.name}")
-
-        return "\n".join(lines)
-    
     @action(detail=False, methods=['get'])
     def available_stores(self, request):
         """取得可推薦的店家列表"""
@@ -1845,14 +1549,14 @@ class PlatformBroadcastViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['post'])
     def send(self, request, pk=None):
-        """發送平台推播"""
+        """發送平台推播（建立發送工作；大型推播於背景發送）"""
         from apps.intelligence.models import PlatformSettings
         
         broadcast = self.get_object()
         
-        if broadcast.status == 'sent':
+        if broadcast.status in ('sent', 'sending'):
             return Response(
-                {'error': '此推播已發送'},
+                {'error': '此推播已發送' if broadcast.status == 'sent' else '此推播正在發送中'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
@@ -1871,18 +1575,13 @@ class PlatformBroadcastViewSet(viewsets.ModelViewSet):
             )
         
         # 取得目標用戶
-        if broadcast.target_all:
-            bindings = LineUserBinding.objects.filter(
-                is_active=True,
-                current_mode='customer',
-            )
-        else:
-            bindings = LineUserBinding.objects.filter(
-                line_user_id__in=broadcast.target_users,
-                is_active=True,
-                current_mode='customer',
-            )
-        target_users = [b.line_user_id for b in bindings]
+        bindings = LineUserBinding.objects.filter(
+            is_active=True,
+            current_mode='customer',
+        )
+        if not broadcast.target_all:
+            bindings = bindings.filter(line_user_id__in=broadcast.target_users)
+        target_users = list(bindings.order_by('id').values_list('line_user_id', flat=True))
         
         if not target_users:
             return Response(
@@ -1890,108 +1589,29 @@ class PlatformBroadcastViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # 使用平台 LINE API 發送
-        line_api = LineMessagingAPI()
-        line_api.channel_access_token = platform_settings.line_bot_channel_access_token
-        
-        success_count = 0
-        failure_count = 0
-
-        selected_stores = list(broadcast.recommended_stores.all())
-        popular_stores = selected_stores if selected_stores else self._get_popular_recommended_stores(limit=5)
-        coupon = broadcast.coupon
-        
-        for user_id in target_users:
-            try:
-                messages = []
-
-                if broadcast.broadcast_type == 'store_recommendation':
-                    line_binding = LineUserBinding.objects.filter(line_user_id=user_id, is_active=True).select_related('user').first()
-
-                    if (
-                        platform_settings.is_personalized_recommendation_enabled
-                        and line_binding
-                        and line_binding.notify_personalized_recommendation
-                    ):
-                        personalized_stores = self._get_personalized_recommended_stores(line_binding.user, limit=5)
-                        personalized_message = self._build_recommendation_message(
-                            title='🎯 個人化推薦店家',
-                            intro=broadcast.message_content or '根據你的訂單行為，我們推薦以下店家：',
-                            stores=personalized_stores,
-                            include_popularity_metrics=False,
-                        )
-                        if personalized_message:
-                            messages.append(line_api.create_text_message(personalized_message))
-
-                    popular_message = self._build_recommendation_message(
-                        title='🔥 熱門店家推薦',
-                        intro='以下是目前高捐款金額與高訂單量的熱門店家：',
-                        stores=popular_stores,
-                        include_popularity_metrics=True,
-                    )
-                    if popular_message:
-                        messages.append(line_api.create_text_message(popular_message))
-                elif broadcast.broadcast_type == 'promotion':
-                    promotion_message = f"🎁 {broadcast.title}\n\n{broadcast.message_content}"
-                    if coupon:
-                        promotion_message += (
-                            f"\n\n優惠券代碼：{coupon.code}"
-                            f"\n優惠內容：{coupon.get_discount_type_display()} {coupon.discount_value}"
-                            f"\n最低消費：NT$ {coupon.min_order_amount}"
-                            f"\n使用期限：{coupon.expires_at.strftime('%Y-%m-%d %H:%M')}"
-                        )
-                        if coupon.max_discount_amount:
-                            promotion_message += f"\n最高折抵：NT$ {coupon.max_discount_amount}"
-                    messages.append(line_api.create_text_message(promotion_message))
-
-                    if coupon:
-                        button_title = coupon.title[:40]
-                        button_text = '點擊下方按鈕即可直接領取，優惠券會自動存入 DineVerse 個人資料。'
-                        messages.append(
-                            line_api.create_template_buttons(
-                                alt_text=f"{coupon.title} 領券按鈕",
-                                title=button_title,
-                                text=button_text[:60],
-                                actions=[
-                                    {
-                                        'type': 'postback',
-                                        'label': '立即領券',
-                                        'data': f"action=claim_platform_coupon&token={coupon.claim_token}",
-                                        'displayText': '我要領取這張優惠券',
-                                    }
-                                ],
-                            )
-                        )
-
-                if not messages:
-                    fallback_message = f"📢 {broadcast.title}\n\n{broadcast.message_content}"
-                    if selected_stores:
-                        fallback_message += "\n\n🏪 推薦店家："
-                        for store in selected_stores[:5]:
-                            fallback_message += f"\n• {store.name}"
-                    messages = [line_api.create_text_message(fallback_message)]
-
-                result = line_api.push_message(user_id, messages[:5])
-                if result:
-                    success_count += 1
-                else:
-                    print(f"[Platform Broadcast] Failed to send to {user_id}: push_message returned False")
-                    failure_count += 1
-            except Exception as e:
-                print(f"[Platform Broadcast] Failed to send to {user_id}: {e}")
-                failure_count += 1
-        
-        # 更新推播狀態
-        broadcast.status = 'sent'
-        broadcast.sent_at = timezone.now()
-        broadcast.recipient_count = len(target_users)
-        broadcast.success_count = success_count
-        broadcast.failure_count = failure_count
-        broadcast.save()
+        job = create_broadcast_job(target_users, platform_broadcast=broadcast)
+        job, finished = execute_broadcast_job(job)
         
         return Response({
-            'message': '推播已發送',
-            'recipient_count': len(target_users),
-            'success_count': success_count,
-            'failure_count': failure_count
-        })
+            'message': '推播已發送' if finished else '推播已排入背景發送',
+            'recipient_count': job.total_count,
+            'success_count': job.success_count,
+            'failure_count': job.failure_count,
+            'job': serialize_job(job),
+        }, status=status.HTTP_200_OK if finished else status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """查詢推播發送進度"""
+        broadcast = self.get_object()
+        return Response({'job': serialize_job(broadcast.jobs.first())})
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """取消發送中的推播（已送出的批次不受影響）"""
+        return _cancel_broadcast_job(self.get_object())
+
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """續傳已取消或失敗的推播，只發送尚未送達的用戶"""
+        return _resume_broadcast_job(self.get_object())
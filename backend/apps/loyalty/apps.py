@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class LoyaltyConfig(AppConfig):
+	name = 'apps.loyalty'
+	verbose_name = '會員與點數'
+
+	def ready(self):
+		import apps.loyalty.signals
@@ -0,0 +1,22 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.stores.models import Store
+
+from .models import CustomerLoyaltyAccount
+
+
+@receiver(post_save, sender=CustomerLoyaltyAccount)
+def account_created_increment_member_count(sender, instance, created, raw=False, **kwargs):
+	"""新增會員帳戶時累加店家會員人數。"""
+	if not created or raw:
+		return
+	Store.objects.filter(pk=instance.store_id).update(loyalty_member_count=F('loyalty_member_count') + 1)
+
+
+@receiver(post_delete, sender=CustomerLoyaltyAccount)
+def account_deleted_decrement_member_count(sender, instance, **kwargs):
+	Store.objects.filter(pk=instance.store_id, loyalty_member_count__gt=0).update(
+		loyalty_member_count=F('loyalty_member_count') - 1
+	)
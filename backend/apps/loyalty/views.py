@@ -1,6 +1,7 @@
 from rest_framework import viewsets, permissions, serializers, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from apps.users.middleware import get_request_store
 from .models import (
 	PointRule, MembershipLevel, RedemptionProduct,
 	CustomerLoyaltyAccount, PointTransaction, Redemption,
@@ -24,13 +25,7 @@ class MerchantOnlyMixin:
 	"""Provide helper to filter queryset to the current merchant's store."""
 
 	def get_store(self):
-		user = self.request.user
-		if not hasattr(user, 'merchant_profile'):
-			return None
-		try:
-			return user.merchant_profile.store
-		except Exception:
-			return None
+		return get_request_store(self.request)
 
 
 class MerchantPointRuleViewSet(viewsets.ModelViewSet, MerchantOnlyMixin):
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+
+def backfill_store_order_daily_stats(apps, schema_editor):
+    StoreOrderDailyStats = apps.get_model('orders', 'StoreOrderDailyStats')
+    sources = (
+        ('takeout', apps.get_model('orders', 'TakeoutOrder'), ['rejected']),
+        ('dinein', apps.get_model('orders', 'DineInOrder'), ['rejected']),
+        ('surplus', apps.get_model('surplus_food', 'SurplusFoodOrder'), ['rejected', 'cancelled', 'expired']),
+    )
+
+    for order_type, model, excluded_statuses in sources:
+        # TruncDate 以 TIME_ZONE 換算日期，與 signals 使用的 timezone.localdate 一致
+        rows = model.objects.annotate(day=TruncDate('created_at')).values('store_id', 'day').annotate(
+            order_count=Count('id', filter=~Q(status__in=excluded_statuses)),
+            pending_count=Count('id', filter=Q(status='pending')),
+        ).order_by()
+        StoreOrderDailyStats.objects.bulk_create(
+            [
+                StoreOrderDailyStats(
+                    store_id=row['store_id'],
+                    order_type=order_type,
+                    date=row['day'],
+                    order_count=row['order_count'],
+                    pending_count=row['pending_count'],
+                )
+                for row in rows
+                if row['order_count'] or row['pending_count']
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0016_alter_dineinorder_table_label'),
+        ('stores', '0019_store_loyalty_member_count'),
+        ('surplus_food', '0022_surplusfoodorder_counted_in_store_surplus_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreOrderDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_type', models.CharField(choices=[('takeout', '外帶'), ('dinein', '內用'), ('surplus', '惜食')], max_length=10, verbose_name='訂單類型')),
+                ('date', models.DateField(verbose_name='訂單建立日期')),
+                ('order_count', models.IntegerField(default=0, help_text='不含已拒絕（惜食另不含已取消、已過期）的訂單', verbose_name='訂單數')),
+                ('pending_count', models.IntegerField(default=0, verbose_name='待處理訂單數')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_daily_stats', to='stores.store', verbose_name='店家')),
+            ],
+            options={
+                'verbose_name': '店家每日訂單統計',
+                'verbose_name_plural': '店家每日訂單統計',
+                'db_table': 'store_order_daily_stats',
+                'indexes': [models.Index(condition=models.Q(('pending_count__gt', 0)), fields=['store'], name='order_stats_pending_idx')],
+                'constraints': [models.UniqueConstraint(fields=('store', 'date', 'order_type'), name='unique_store_order_daily_stats')],
+            },
+        ),
+        migrations.RunPython(backfill_store_order_daily_stats, migrations.RunPython.noop),
+    ]
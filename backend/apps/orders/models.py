@@ -355,3 +355,46 @@ class Notification(models.Model):
     def __str__(self):
         return f"{self.user} - {self.title}"
 
+
+
+class StoreOrderDailyStats(models.Model):
+    """
+    店家每日訂單統計（依訂單建立日期彙總）
+
+    由訂單的 signals 依狀態變化增減（apps.orders.order_stats），
+    LINE 營運報表只需讀取當月與仍有待處理訂單的幾列，不必掃描訂單表。
+    """
+    ORDER_TYPE_CHOICES = (
+        ('takeout', '外帶'),
+        ('dinein', '內用'),
+        ('surplus', '惜食'),
+    )
+
+    store = models.ForeignKey(
+        Store,
+        on_delete=models.CASCADE,
+        related_name='order_daily_stats',
+        verbose_name='店家'
+    )
+    order_type = models.CharField(max_length=10, choices=ORDER_TYPE_CHOICES, verbose_name='訂單類型')
+    date = models.DateField(verbose_name='訂單建立日期')
+    order_count = models.IntegerField(default=0, verbose_name='訂單數', help_text='不含已拒絕（惜食另不含已取消、已過期）的訂單')
+    pending_count = models.IntegerField(default=0, verbose_name='待處理訂單數')
+
+    class Meta:
+        db_table = 'store_order_daily_stats'
+        verbose_name = '店家每日訂單統計'
+        verbose_name_plural = '店家每日訂單統計'
+        constraints = [
+            models.UniqueConstraint(fields=['store', 'date', 'order_type'], name='unique_store_order_daily_stats'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['store'],
+                condition=models.Q(pending_count__gt=0),
+                name='order_stats_pending_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.store_id} {self.date} {self.order_type}: {self.order_count}"
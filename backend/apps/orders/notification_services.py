@@ -3,6 +3,7 @@ import logging
 from apps.intelligence.models import PlatformSettings
 from apps.line_bot.models import LineUserBinding, MerchantLineBinding
 from apps.line_bot.services.line_api import LineMessagingAPI
+from apps.line_bot.services.push_dispatcher import get_push_dispatcher
 
 logger = logging.getLogger(__name__)
 
@@ -56,7 +57,10 @@ def send_platform_line_order_pickup_ready_notification(order, order_type_label,
     line_api.channel_access_token = settings.line_bot_channel_access_token
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send platform LINE pickup-ready notification: %s', exc)
 
@@ -105,7 +109,10 @@ def send_platform_line_order_cancelled_notification(order, order_type_label, ord
     line_api.channel_access_token = settings.line_bot_channel_access_token
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send platform LINE cancelled notification: %s', exc)
 
@@ -151,6 +158,9 @@ def send_platform_line_new_order_to_merchant_notification(order, order_type_labe
     line_api.channel_access_token = settings.line_bot_channel_access_token
 
     try:
-        line_api.push_message(merchant_binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            merchant_binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send merchant new-order LINE notification: %s', exc)
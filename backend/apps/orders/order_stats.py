@@ -0,0 +1,82 @@
+"""
+店家訂單統計的增量維護
+
+訂單新增、狀態變更與刪除時由 signals 呼叫 record_order_status_change，
+依前後狀態計算差值並以 F() 更新 StoreOrderDailyStats 對應的那一列
+（店家 + 訂單類型 + 訂單建立日期），不重新計算整張訂單表。
+
+舊狀態由各訂單 model 的 pre_save 記錄在 instance._previous_status。
+"""
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import StoreOrderDailyStats
+
+# 不列入訂單數的狀態
+EXCLUDED_STATUSES = {
+    'takeout': frozenset({'rejected'}),
+    'dinein': frozenset({'rejected'}),
+    'surplus': frozenset({'rejected', 'cancelled', 'expired'}),
+}
+ORDER_TYPES = ('takeout', 'dinein', 'surplus')
+
+
+def _contribution(order_type, status):
+    if status is None:
+        return 0, 0
+    counted = 0 if status in EXCLUDED_STATUSES[order_type] else 1
+    pending = 1 if status == 'pending' else 0
+    return counted, pending
+
+
+def record_order_status_change(order_type, store_id, created_at, old_status, new_status):
+    """
+    依訂單狀態變化更新每日統計
+
+    Args:
+        order_type: 'takeout' / 'dinein' / 'surplus'
+        old_status: 變更前狀態（新訂單為 None）
+        new_status: 變更後狀態（刪除訂單為 None）
+    """
+    old_counted, old_pending = _contribution(order_type, old_status)
+    new_counted, new_pending = _contribution(order_type, new_status)
+    count_delta = new_counted - old_counted
+    pending_delta = new_pending - old_pending
+    if not (count_delta or pending_delta) or not store_id or not created_at:
+        return
+
+    stats, _ = StoreOrderDailyStats.objects.get_or_create(
+        store_id=store_id,
+        order_type=order_type,
+        date=timezone.localdate(created_at),
+    )
+    StoreOrderDailyStats.objects.filter(pk=stats.pk).update(
+        order_count=F('order_count') + count_delta,
+        pending_count=F('pending_count') + pending_delta,
+    )
+
+
+def get_store_order_summary(store_id, today=None):
+    """
+    讀取店家今日、本月與待處理的訂單數（單一查詢，列數不隨歷史訂單增加）
+
+    Returns:
+        dict: {'today': {類型: 數量}, 'month': {...}, 'pending': {...}}
+    """
+    today = today or timezone.localdate()
+    month_start = today.replace(day=1)
+    summary = {key: dict.fromkeys(ORDER_TYPES, 0) for key in ('today', 'month', 'pending')}
+
+    rows = StoreOrderDailyStats.objects.filter(store_id=store_id).filter(
+        Q(date__gte=month_start) | Q(pending_count__gt=0)
+    ).values('order_type').annotate(
+        today_count=Sum('order_count', filter=Q(date=today)),
+        month_count=Sum('order_count', filter=Q(date__gte=month_start, date__lte=today)),
+        pending=Sum('pending_count'),
+    ).order_by()
+    for row in rows:
+        order_type = row['order_type']
+        summary['today'][order_type] = row['today_count'] or 0
+        summary['month'][order_type] = row['month_count'] or 0
+        summary['pending'][order_type] = row['pending'] or 0
+    return summary
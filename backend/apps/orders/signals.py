@@ -1,4 +1,4 @@
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from .models import TakeoutOrder, DineInOrder, Notification
 from .notification_services import (
@@ -6,14 +6,17 @@ from .notification_services import (
     send_platform_line_order_cancelled_notification,
     send_platform_line_order_pickup_ready_notification,
 )
+from .order_stats import record_order_status_change
 
 @receiver(pre_save, sender=TakeoutOrder)
 def takeout_order_status_change(sender, instance, **kwargs):
+    instance._previous_status = None
     if not instance.pk:
         return
     
     try:
         old_instance = TakeoutOrder.objects.get(pk=instance.pk)
+        instance._previous_status = old_instance.status
         if old_instance.status != instance.status and instance.user:
             Notification.objects.create(
                 user=instance.user,
@@ -41,11 +44,13 @@ def takeout_order_status_change(sender, instance, **kwargs):
 
 @receiver(pre_save, sender=DineInOrder)
 def dinein_order_status_change(sender, instance, **kwargs):
+    instance._previous_status = None
     if not instance.pk:
         return
     
     try:
         old_instance = DineInOrder.objects.get(pk=instance.pk)
+        instance._previous_status = old_instance.status
         if old_instance.status != instance.status and instance.user:
             Notification.objects.create(
                 user=instance.user,
@@ -94,3 +99,31 @@ def dinein_order_created_notify_merchant(sender, instance, created, **kwargs):
         order_type_label='內用',
         order_number=instance.order_number,
     )
+
+
+ORDER_STATS_TYPES = {
+    TakeoutOrder: 'takeout',
+    DineInOrder: 'dinein',
+}
+
+
+@receiver(post_save, sender=TakeoutOrder)
+@receiver(post_save, sender=DineInOrder)
+def order_saved_update_daily_stats(sender, instance, raw=False, **kwargs):
+    """依狀態變化更新店家每日訂單統計。"""
+    if raw:
+        return
+    record_order_status_change(
+        ORDER_STATS_TYPES[sender],
+        instance.store_id,
+        instance.created_at,
+        getattr(instance, '_previous_status', None),
+        instance.status,
+    )
+    instance._previous_status = instance.status
+
+
+@receiver(post_delete, sender=TakeoutOrder)
+@receiver(post_delete, sender=DineInOrder)
+def order_deleted_update_daily_stats(sender, instance, **kwargs):
+    record_order_status_change(ORDER_STATS_TYPES[sender], instance.store_id, instance.created_at, instance.status, None)
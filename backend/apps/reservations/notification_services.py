@@ -3,6 +3,7 @@ import logging
 from apps.intelligence.models import PlatformSettings
 from apps.line_bot.models import LineUserBinding
 from apps.line_bot.services.line_api import LineMessagingAPI
+from apps.line_bot.services.push_dispatcher import get_push_dispatcher
 from apps.users.models import User
 
 logger = logging.getLogger(__name__)
@@ -112,7 +113,10 @@ def send_platform_line_reservation_created_notification(reservation):
     )
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send reservation-created LINE notification: %s', exc)
 
@@ -143,7 +147,10 @@ def send_platform_line_reservation_confirmed_notification(reservation):
     message = "\n".join(message_lines)
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send reservation-confirmed LINE notification: %s', exc)
 
@@ -174,7 +181,10 @@ def send_platform_line_reservation_table_changed_notification(reservation):
     message = "\n".join(message_lines)
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send reservation-table-changed LINE notification: %s', exc)
 
@@ -202,6 +212,9 @@ def send_platform_line_reservation_cancelled_notification(reservation):
     message = "\n".join(message_lines)
 
     try:
-        line_api.push_message(binding.line_user_id, [line_api.create_text_message(message)])
+        get_push_dispatcher(line_api.channel_access_token).submit(
+            binding.line_user_id,
+            [line_api.create_text_message(message)],
+        )
     except Exception as exc:
         logger.warning('Failed to send reservation-cancelled LINE notification: %s', exc)
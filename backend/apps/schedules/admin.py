@@ -19,7 +19,7 @@ class ShiftAdmin(admin.ModelAdmin):
 
 @admin.register(JobRole)
 class JobRoleAdmin(admin.ModelAdmin):
-    list_display = ['name', 'store', 'description', 'created_at']
+    list_display = ['name', 'store', 'description', 'orders_per_staff_hour', 'min_staff', 'created_at']
     list_filter = ['store']
     search_fields = ['name', 'description', 'store__name']
 
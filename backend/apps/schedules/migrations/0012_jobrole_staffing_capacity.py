@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedules', '0011_employeeschedulerequest_employee_sc_store_i_ca39c1_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobrole',
+            name='min_staff',
+            field=models.PositiveIntegerField(default=0, help_text='預測有訂單的時段至少安排的人數', verbose_name='營業時段最少人數'),
+        ),
+        migrations.AddField(
+            model_name='jobrole',
+            name='orders_per_staff_hour',
+            field=models.PositiveIntegerField(default=10, help_text='用於將需求預測換算為排班人數', verbose_name='每人每小時可處理訂單數'),
+        ),
+    ]
@@ -56,6 +56,16 @@ class JobRole(models.Model):
     )
     name = models.CharField(max_length=100, verbose_name='職務名稱')
     description = models.CharField(max_length=255, blank=True, default='', verbose_name='職務說明')
+    orders_per_staff_hour = models.PositiveIntegerField(
+        default=10,
+        verbose_name='每人每小時可處理訂單數',
+        help_text='用於將需求預測換算為排班人數'
+    )
+    min_staff = models.PositiveIntegerField(
+        default=0,
+        verbose_name='營業時段最少人數',
+        help_text='預測有訂單的時段至少安排的人數'
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='建立時間')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新時間')
 
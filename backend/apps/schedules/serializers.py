@@ -35,6 +35,8 @@ class JobRoleSerializer(serializers.ModelSerializer):
             'store',
             'name',
             'description',
+            'orders_per_staff_hour',
+            'min_staff',
             'created_at',
             'updated_at',
         ]
@@ -42,6 +44,8 @@ class JobRoleSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'name': {'required': True},
             'description': {'required': False},
+            'orders_per_staff_hour': {'required': False, 'min_value': 1},
+            'min_staff': {'required': False},
         }
 
 
@@ -15,16 +15,15 @@ from .serializers import (
     EmployeeScheduleRequestSerializer,
     JobRoleSerializer,
 )
+from apps.users.authentication import get_user_store
 from apps.users.models import Company, User
 from apps.stores.models import Store
 from datetime import datetime, timedelta
 
 
 def get_merchant_store_id(user):
-    merchant = getattr(user, 'merchant_profile', None)
-    if not merchant:
-        return None
-    return Store.objects.filter(merchant=merchant).values_list('id', flat=True).first()
+    store = get_user_store(user)
+    return store.id if store else None
 
 
 class StaffViewSet(viewsets.ModelViewSet):
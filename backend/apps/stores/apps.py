@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class StoresConfig(AppConfig):
+    name = 'apps.stores'
+    verbose_name = '店家'
+
+    def ready(self):
+        import apps.stores.signals
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.stores.search import REBUILD_BATCH_SIZE, rebuild_store_search_documents
+
+
+class Command(BaseCommand):
+	help = '重建店家搜尋文件（以 queryset.update 等略過 signals 的方式修改資料後使用）'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--store-id',
+			type=int,
+			action='append',
+			dest='store_ids',
+			help='只重建指定店家，可重複指定',
+		)
+		parser.add_argument(
+			'--batch-size',
+			type=int,
+			default=REBUILD_BATCH_SIZE,
+			help='每批處理的店家數',
+		)
+
+	def handle(self, *args, **options):
+		if options['batch_size'] < 1:
+			raise CommandError('batch-size 必須至少為 1')
+
+		rebuilt = rebuild_store_search_documents(
+			store_ids=options['store_ids'],
+			batch_size=options['batch_size'],
+		)
+		self.stdout.write(self.style.SUCCESS(f'已重建 {rebuilt} 家店的搜尋文件'))
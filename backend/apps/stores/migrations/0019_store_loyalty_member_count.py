@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:42
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_loyalty_member_count(apps, schema_editor):
+    Store = apps.get_model('stores', 'Store')
+    CustomerLoyaltyAccount = apps.get_model('loyalty', 'CustomerLoyaltyAccount')
+
+    member_rows = CustomerLoyaltyAccount.objects.values('store_id').annotate(member_count=Count('id')).order_by()
+    for row in member_rows:
+        Store.objects.filter(id=row['store_id']).update(loyalty_member_count=row['member_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loyalty', '0003_platformcoupon_userplatformcoupon'),
+        ('stores', '0018_store_surplus_cumulative_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='loyalty_member_count',
+            field=models.PositiveIntegerField(default=0, help_text='顧客會員帳戶數，於帳戶新增與刪除時增減。', verbose_name='會員人數'),
+        ),
+        migrations.RunPython(backfill_loyalty_member_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,127 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:58
+
+import re
+import unicodedata
+
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+
+SEARCH_INDEXES = [
+    ('store_search_vector_gin', 'search_vector'),
+    ('store_search_content_trgm', 'content gin_trgm_ops'),
+    ('store_search_name_trgm', 'name_text gin_trgm_ops'),
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # GIN 索引（tsvector 與 pg_trgm）只適用於 PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('stores', 'StoreSearchDocument')._meta.db_table)
+    for name, expression in SEARCH_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({expression})')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in SEARCH_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+# 以下為建立文件時的欄位組成與加權（固定在 migration 內，不隨 apps.stores.search 之後的修改而改變）
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _normalize(value):
+    text = unicodedata.normalize('NFKC', str(value or '')).lower()
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _join(values):
+    return _normalize(' '.join(str(value) for value in values if value))
+
+
+def _document_fields(store, cuisine_labels, products):
+    product_words = []
+    product_descriptions = []
+    for name, description, food_tags in products:
+        product_words.append(name)
+        product_words.extend(food_tags or [])
+        product_descriptions.append(description)
+
+    fields = {
+        'name_text': _join([store.name]),
+        'tag_text': _join([cuisine_labels.get(store.cuisine_type, ''), *(store.tags or [])]),
+        'product_text': _join(product_words),
+        'body_text': _join([store.description, store.address, *product_descriptions]),
+    }
+    fields['content'] = '\n'.join(fields[name] for name in ('name_text', 'tag_text', 'product_text', 'body_text'))
+    return fields
+
+
+def _search_vector():
+    return (
+        SearchVector('name_text', weight='A', config='simple')
+        + SearchVector('tag_text', weight='B', config='simple')
+        + SearchVector('product_text', weight='C', config='simple')
+        + SearchVector('body_text', weight='D', config='simple')
+    )
+
+
+def backfill_search_documents(apps, schema_editor):
+    Store = apps.get_model('stores', 'Store')
+    Product = apps.get_model('products', 'Product')
+    StoreSearchDocument = apps.get_model('stores', 'StoreSearchDocument')
+    cuisine_labels = dict(Store._meta.get_field('cuisine_type').choices or [])
+
+    products_by_store = {}
+    for store_id, name, description, food_tags in Product.objects.order_by('id').values_list(
+        'store_id', 'name', 'description', 'food_tags',
+    ).iterator():
+        products_by_store.setdefault(store_id, []).append((name, description, food_tags))
+
+    documents = [
+        StoreSearchDocument(
+            store_id=store.id,
+            **_document_fields(store, cuisine_labels, products_by_store.get(store.id, [])),
+        )
+        for store in Store.objects.only('id', 'name', 'cuisine_type', 'tags', 'description', 'address').iterator()
+    ]
+    StoreSearchDocument.objects.bulk_create(documents, batch_size=500)
+    if schema_editor.connection.vendor == 'postgresql':
+        StoreSearchDocument.objects.update(search_vector=_search_vector())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0012_productingredient'),
+        ('stores', '0019_store_loyalty_member_count'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='StoreSearchDocument',
+            fields=[
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='stores.store', verbose_name='店家')),
+                ('name_text', models.TextField(blank=True, verbose_name='店名')),
+                ('tag_text', models.TextField(blank=True, verbose_name='料理類型與店家標籤')),
+                ('product_text', models.TextField(blank=True, verbose_name='商品名稱與食物標籤')),
+                ('body_text', models.TextField(blank=True, verbose_name='店家與商品描述、地址')),
+                ('content', models.TextField(blank=True, help_text='上述欄位正規化（小寫、全形轉半形）後合併，供部分字串比對。', verbose_name='搜尋內容')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(blank=True, null=True, verbose_name='全文檢索向量')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': '店家搜尋文件',
+                'verbose_name_plural': '店家搜尋文件',
+            },
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+        migrations.RunPython(backfill_search_documents, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,4 @@
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from apps.users.models import Merchant
 
@@ -261,6 +262,11 @@ class Store(models.Model):
         verbose_name='惜福品累積完成訂單收入',
         help_text='累積完成的惜福品訂單收入，不因訂單隱藏或刪除而遞減。'
     )
+    loyalty_member_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='會員人數',
+        help_text='顧客會員帳戶數，於帳戶新增與刪除時增減。'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -343,3 +349,36 @@ class MenuImage(models.Model):
     def __str__(self):
         return f"{self.store.name} - Menu Image {self.order}"
 
+
+
+class StoreSearchDocument(models.Model):
+    """
+    店家搜尋文件
+    將店家欄位、商品名稱 / 描述與食物標籤整理成一筆，由 apps.stores.search 維護。
+    PostgreSQL 上 search_vector 與 content、name_text 另有 GIN 索引（見 migration）。
+    """
+    store = models.OneToOneField(
+        Store,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name='店家'
+    )
+    name_text = models.TextField(blank=True, verbose_name='店名')
+    tag_text = models.TextField(blank=True, verbose_name='料理類型與店家標籤')
+    product_text = models.TextField(blank=True, verbose_name='商品名稱與食物標籤')
+    body_text = models.TextField(blank=True, verbose_name='店家與商品描述、地址')
+    content = models.TextField(
+        blank=True,
+        verbose_name='搜尋內容',
+        help_text='上述欄位正規化（小寫、全形轉半形）後合併，供部分字串比對。'
+    )
+    search_vector = SearchVectorField(null=True, blank=True, verbose_name='全文檢索向量')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = '店家搜尋文件'
+        verbose_name_plural = '店家搜尋文件'
+
+    def __str__(self):
+        return f"{self.name_text} (search document)"
@@ -0,0 +1,179 @@
+"""
+店家搜尋
+
+公開店家列表的關鍵字搜尋原本以 icontains 比對店家欄位，再 JOIN 商品比對名稱、
+描述與食物標籤，最後 distinct：每次搜尋都是全表掃描且結果列數隨商品數放大。
+
+這裡為每家店維護一筆 StoreSearchDocument（店家或商品變更時由 signals 更新）：
+- content：所有可搜尋文字正規化後合併，以 LIKE 部分比對；PostgreSQL 上有 trigram
+  GIN 索引，3 個字元以上的關鍵字（包含中文等沒有空白分詞的文字）可以走索引。
+  1–2 個字元的關鍵字產生不了 trigram，這部分比對會掃描整個搜尋文件表
+  （每家店一列，不含商品 JOIN），前綴比對仍由 search_vector 的索引處理
+- search_vector：依欄位加權的 tsvector（店名 A、料理類型與標籤 B、商品 C、
+  描述與地址 D），以 GIN 索引比對前綴並計算排名
+
+排名為 ts_rank 加上店名的 trigram 相似度；非 PostgreSQL 資料庫（測試）只以
+content 比對，依命中的欄位排序。
+"""
+import re
+import unicodedata
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, F, IntegerField, Q, Value, When
+
+from apps.products.models import Product
+
+from .models import Store, StoreSearchDocument
+
+SEARCH_CONFIG = 'simple'
+REBUILD_BATCH_SIZE = 200
+MAX_QUERY_TERMS = 8
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+DOCUMENT_FIELDS = ['name_text', 'tag_text', 'product_text', 'body_text', 'content']
+
+
+def search_vector_expression():
+    return (
+        SearchVector('name_text', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('tag_text', weight='B', config=SEARCH_CONFIG)
+        + SearchVector('product_text', weight='C', config=SEARCH_CONFIG)
+        + SearchVector('body_text', weight='D', config=SEARCH_CONFIG)
+    )
+
+
+def normalize_search_text(value):
+    """全形轉半形、轉小寫並合併空白。"""
+    text = unicodedata.normalize('NFKC', str(value or '')).lower()
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _join(values):
+    return normalize_search_text(' '.join(str(value) for value in values if value))
+
+
+def build_document_fields(store, products):
+    """
+    組出搜尋文件的欄位
+
+    Args:
+        store: Store
+        products: [(name, description, food_tags), ...]
+    """
+    cuisine_label = dict(Store.CUISINE_TYPE_CHOICES).get(store.cuisine_type, '')
+    product_words = []
+    product_descriptions = []
+    for name, description, food_tags in products:
+        product_words.append(name)
+        product_words.extend(food_tags or [])
+        product_descriptions.append(description)
+
+    fields = {
+        'name_text': _join([store.name]),
+        'tag_text': _join([cuisine_label, *(store.tags or [])]),
+        'product_text': _join(product_words),
+        'body_text': _join([store.description, store.address, *product_descriptions]),
+    }
+    # 以換行分隔欄位，部分比對不會跨欄位命中
+    fields['content'] = '\n'.join(fields[name] for name in ('name_text', 'tag_text', 'product_text', 'body_text'))
+    return fields
+
+
+def _update_search_vectors(store_ids):
+    if connection.vendor != 'postgresql' or not store_ids:
+        return
+    StoreSearchDocument.objects.filter(store_id__in=store_ids).update(search_vector=search_vector_expression())
+
+
+def rebuild_store_search_documents(store_ids=None, batch_size=REBUILD_BATCH_SIZE):
+    """
+    重建搜尋文件（store_ids 為 None 時重建全部店家）
+
+    每批店家以一次查詢載入商品、一次 upsert 寫入文件，PostgreSQL 上再以一次
+    UPDATE 更新 search_vector。
+
+    Returns:
+        int: 重建的店家數
+    """
+    stores = Store.objects.order_by('id').only('id', 'name', 'cuisine_type', 'tags', 'description', 'address')
+    if store_ids is not None:
+        stores = stores.filter(id__in=store_ids)
+
+    rebuilt = 0
+    batch = []
+    for store in stores.iterator(chunk_size=batch_size):
+        batch.append(store)
+        if len(batch) >= batch_size:
+            rebuilt += _rebuild_batch(batch)
+            batch = []
+    if batch:
+        rebuilt += _rebuild_batch(batch)
+    return rebuilt
+
+
+def _rebuild_batch(stores):
+    products_by_store = {store.id: [] for store in stores}
+    rows = Product.objects.filter(store_id__in=products_by_store).order_by('id').values_list(
+        'store_id', 'name', 'description', 'food_tags',
+    )
+    for store_id, name, description, food_tags in rows:
+        products_by_store[store_id].append((name, description, food_tags))
+
+    documents = [
+        StoreSearchDocument(store_id=store.id, **build_document_fields(store, products_by_store[store.id]))
+        for store in stores
+    ]
+    StoreSearchDocument.objects.bulk_create(
+        documents,
+        update_conflicts=True,
+        unique_fields=['store'],
+        update_fields=DOCUMENT_FIELDS + ['updated_at'],
+    )
+    _update_search_vectors(list(products_by_store))
+    return len(documents)
+
+
+def refresh_store_search_document(store_id):
+    """重建單一店家的搜尋文件，店家已刪除時不做任何事。"""
+    return rebuild_store_search_documents(store_ids=[store_id])
+
+
+def _prefix_query(terms):
+    # 各詞以前綴比對（麻辣 -> 麻辣:*），詞只含 \w 字元，不會組出不合法的 tsquery
+    return SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG)
+
+
+def search_stores(queryset, search):
+    """
+    以關鍵字篩選店家並加上 search_rank，依相關程度（再依建立時間）排序
+
+    每家店只對應一筆搜尋文件，不需要 distinct。
+    """
+    normalized = normalize_search_text(search)
+    if not normalized:
+        return queryset
+
+    if connection.vendor == 'postgresql':
+        terms = _TERM_RE.findall(normalized)[:MAX_QUERY_TERMS]
+        match = Q(search_document__content__contains=normalized)
+        rank = TrigramSimilarity('search_document__name_text', normalized)
+        if terms:
+            query = _prefix_query(terms)
+            match |= Q(search_document__search_vector=query)
+            rank = SearchRank(F('search_document__search_vector'), query) + rank
+        return queryset.filter(match).annotate(
+            search_rank=rank,
+        ).order_by('-search_rank', '-created_at')
+
+    return queryset.filter(search_document__content__contains=normalized).annotate(
+        search_rank=Case(
+            When(search_document__name_text__contains=normalized, then=Value(4)),
+            When(search_document__tag_text__contains=normalized, then=Value(3)),
+            When(search_document__product_text__contains=normalized, then=Value(2)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+    ).order_by('-search_rank', '-created_at')
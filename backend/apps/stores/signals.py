@@ -0,0 +1,26 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.products.models import Product
+
+from .models import Store
+from .search import refresh_store_search_document
+
+
+@receiver(post_save, sender=Store)
+def store_saved_refresh_search_document(sender, instance, raw=False, **kwargs):
+    """店家資料變更後重建搜尋文件（交易提交後才執行）。"""
+    if raw:
+        return
+    store_id = instance.id
+    transaction.on_commit(lambda: refresh_store_search_document(store_id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed_refresh_search_document(sender, instance, raw=False, **kwargs):
+    if raw or not instance.store_id:
+        return
+    store_id = instance.store_id
+    transaction.on_commit(lambda: refresh_store_search_document(store_id))
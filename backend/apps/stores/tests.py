@@ -0,0 +1,114 @@
+from decimal import Decimal
+from io import StringIO
+
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+
+from apps.products.models import Product
+from apps.stores.models import Store, StoreSearchDocument
+from apps.stores.search import normalize_search_text
+from apps.users.models import Merchant, User
+
+
+class StoreSearchTests(TestCase):
+    def _store(self, name, cuisine_type='other', **kwargs):
+        user = User.objects.create_user(
+            email=f'{name}@example.com',
+            password='password',
+            firebase_uid=f'{name}-uid',
+            username=name,
+            user_type='merchant',
+        )
+        merchant = Merchant.objects.create(user=user, company_account=f'{user.id:08d}', plan='basic')
+        with self.captureOnCommitCallbacks(execute=True):
+            return Store.objects.create(
+                merchant=merchant,
+                name=name,
+                cuisine_type=cuisine_type,
+                address=kwargs.pop('address', 'Test Address'),
+                phone='0212345678',
+                is_published=True,
+                **kwargs,
+            )
+
+    def _product(self, store, name, food_tags=(), description=''):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Product.objects.create(
+                merchant=store.merchant,
+                store=store,
+                name=name,
+                description=description,
+                price=Decimal('100'),
+                food_tags=list(food_tags),
+            )
+
+    def _search(self, keyword):
+        response = self.client.get('/api/stores/published/', {'search': keyword})
+        self.assertEqual(response.status_code, 200)
+        return [store['name'] for store in response.json()]
+
+    def test_normalize_search_text(self):
+        self.assertEqual(normalize_search_text('  ＲＡＭＥＮ\t拉麵  '), 'ramen 拉麵')
+
+    def test_document_follows_store_and_product_changes(self):
+        store = self._store('Noodle House', description='Hand pulled noodles')
+        product = self._product(store, '紅燒牛肉麵', food_tags=['辣'])
+
+        document = StoreSearchDocument.objects.get(store=store)
+        self.assertEqual(document.name_text, 'noodle house')
+        self.assertIn('紅燒牛肉麵 辣', document.product_text)
+        self.assertIn('hand pulled noodles', document.body_text)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(StoreSearchDocument.objects.get(store=store).product_text, '')
+
+    def test_published_search_matches_documents_and_ranks_name_first(self):
+        spicy_name = self._store('麻辣天堂')
+        spicy_product = self._store('Hot Pot Corner')
+        self._product(spicy_product, '鴛鴦鍋', food_tags=['麻辣'])
+        self._product(spicy_product, '麻辣豆腐')
+        self._store('Quiet Cafe', description='咖啡與甜點')
+
+        self.assertEqual(self._search('麻辣'), ['麻辣天堂', 'Hot Pot Corner'])
+        self.assertEqual(self._search('咖啡'), ['Quiet Cafe'])
+        self.assertEqual(self._search('HOT pot'), ['Hot Pot Corner'])
+        self.assertEqual(self._search('不存在'), [])
+
+    def test_rebuild_command_restores_documents(self):
+        store = self._store('Rebuild Diner', address='台北市信義區')
+        StoreSearchDocument.objects.all().delete()
+        Product.objects.bulk_create([
+            Product(merchant=store.merchant, store=store, name='Omelette', price=Decimal('80')),
+        ])
+
+        call_command('rebuild_store_search', stdout=StringIO())
+
+        document = StoreSearchDocument.objects.get(store=store)
+        self.assertIn('omelette', document.product_text)
+        self.assertEqual(self._search('信義區'), ['Rebuild Diner'])
+
+
+@skipUnless(connection.vendor == 'postgresql', '全文檢索與 trigram 排名只在 PostgreSQL 上執行')
+class PostgresStoreSearchTests(StoreSearchTests):
+    """PostgreSQL 路徑（tsvector 前綴比對、ts_rank 與 trigram 排名），也會重跑上面的共用案例。"""
+
+    def test_terms_match_by_prefix_across_fields(self):
+        kitchen = self._store('Spicy Kitchen')
+        self._product(kitchen, 'Beef Noodles')
+        self._store('Noodle Bar')
+
+        # 兩個詞不相鄰，content 的部分比對不會命中，由 tsvector 前綴比對找到
+        self.assertEqual(self._search('noodle spic'), ['Spicy Kitchen'])
+        self.assertEqual(self._search('kitch'), ['Spicy Kitchen'])
+
+    def test_rank_prefers_name_over_products_and_descriptions(self):
+        described = self._store('Corner Diner', description='best ramen in town')
+        product_match = self._store('Market Stall')
+        self._product(product_match, 'Tonkotsu Ramen')
+        self._store('Ramen House')
+
+        self.assertEqual(self._search('ramen'), ['Ramen House', 'Market Stall', described.name])
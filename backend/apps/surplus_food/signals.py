@@ -2,7 +2,7 @@ from decimal import Decimal
 
 from django.db import transaction
 from django.db.models import F
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
 from apps.orders.models import Notification
@@ -11,6 +11,7 @@ from apps.orders.notification_services import (
     send_platform_line_new_order_to_merchant_notification,
     send_platform_line_order_pickup_ready_notification,
 )
+from apps.orders.order_stats import record_order_status_change
 from apps.stores.models import Store
 
 from .models import SurplusFoodOrder
@@ -19,6 +20,7 @@ from .models import SurplusFoodOrder
 @receiver(pre_save, sender=SurplusFoodOrder)
 def surplus_order_status_change(sender, instance, **kwargs):
     """當惜福品訂單狀態變更時，寫入用戶通知。"""
+    instance._previous_status = None
     if not instance.pk:
         return
 
@@ -27,6 +29,7 @@ def surplus_order_status_change(sender, instance, **kwargs):
     except SurplusFoodOrder.DoesNotExist:
         return
 
+    instance._previous_status = old_instance.status
     if old_instance.status == instance.status:
         return
 
@@ -91,3 +94,23 @@ def accumulate_store_surplus_completed_stats(sender, instance, **kwargs):
             surplus_completed_order_count_total=F('surplus_completed_order_count_total') + 1,
             surplus_completed_revenue_total=F('surplus_completed_revenue_total') + revenue,
         )
+
+
+@receiver(post_save, sender=SurplusFoodOrder)
+def surplus_order_saved_update_daily_stats(sender, instance, raw=False, **kwargs):
+    """依狀態變化更新店家每日訂單統計。"""
+    if raw:
+        return
+    record_order_status_change(
+        'surplus',
+        instance.store_id,
+        instance.created_at,
+        getattr(instance, '_previous_status', None),
+        instance.status,
+    )
+    instance._previous_status = instance.status
+
+
+@receiver(post_delete, sender=SurplusFoodOrder)
+def surplus_order_deleted_update_daily_stats(sender, instance, **kwargs):
+    record_order_status_change('surplus', instance.store_id, instance.created_at, instance.status, None)
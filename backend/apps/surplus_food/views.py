@@ -23,6 +23,7 @@ from .serializers import (
     PointRedemptionRuleSerializer
 )
 from django.db import transaction
+from apps.users.middleware import get_request_store
 
 
 logger = logging.getLogger(__name__)
@@ -61,10 +62,10 @@ class SurplusFoodCategoryViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的類別"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(self.request)
+        if store:
             return SurplusFoodCategory.objects.filter(
-                store=user.merchant_profile.store
+                store=store
             ).annotate(
                 food_count=Count('foods', filter=Q(foods__status='active'), distinct=True)
             )
@@ -72,9 +73,9 @@ class SurplusFoodCategoryViewSet(viewsets.ModelViewSet):
     
     def perform_create(self, serializer):
         """創建時自動關聯到商家的店鋪"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            serializer.save(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            serializer.save(store=store)
         else:
             raise ValueError("使用者沒有關聯的店鋪")
 
@@ -88,16 +89,16 @@ class SurplusTimeSlotViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的時段"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            return SurplusTimeSlot.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            return SurplusTimeSlot.objects.filter(store=store)
         return SurplusTimeSlot.objects.none()
     
     def perform_create(self, serializer):
         """創建時自動關聯到商家的店鋪"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            serializer.save(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            serializer.save(store=store)
         else:
             raise ValueError("使用者沒有關聯的店鋪")
 
@@ -116,9 +117,9 @@ class SurplusFoodViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的惜福食品"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            queryset = SurplusFood.objects.filter(store=user.merchant_profile.store).select_related(
+        store = get_request_store(self.request)
+        if store:
+            queryset = SurplusFood.objects.filter(store=store).select_related(
                 'store', 'category', 'product', 'time_slot'
             ).prefetch_related(
                 'product__ingredient_links__ingredient'
@@ -139,10 +140,10 @@ class SurplusFoodViewSet(viewsets.ModelViewSet):
     
     def perform_create(self, serializer):
         """創建時自動關聯到商家的店鋪"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(self.request)
+        if store:
             serializer.save(
-                store=user.merchant_profile.store,
+                store=store,
                 status='active'  # 預設為上架狀態
             )
         else:
@@ -186,14 +187,19 @@ class SurplusFoodViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def statistics(self, request):
         """獲取惜福食品統計資料"""
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response({'error': '無權限'}, status=status.HTTP_403_FORBIDDEN)
         
-        store = user.merchant_profile.store
         queryset = SurplusFood.objects.filter(store=store)
-        completed_orders = store.surplus_completed_order_count_total or 0
-        completed_revenue = Decimal(str(store.surplus_completed_revenue_total or 0))
+        # 完成訂單計數欄位由訂單 signals 以 update() 增量維護，不會觸發 post_save，
+        # 因此不能使用隨身分快取的 store，需由資料庫讀取最新值
+        counters = Store.objects.filter(pk=store.id).values(
+            'surplus_completed_order_count_total',
+            'surplus_completed_revenue_total',
+        ).first() or {}
+        completed_orders = counters.get('surplus_completed_order_count_total') or 0
+        completed_revenue = Decimal(str(counters.get('surplus_completed_revenue_total') or 0))
         donation_amount = (completed_revenue * Decimal('0.6')).quantize(Decimal('0.01'))
         
         stats = {
@@ -295,10 +301,10 @@ class SurplusFoodOrderViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的訂單，優化查詢效能"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(self.request)
+        if store:
             queryset = SurplusFoodOrder.objects.filter(
-                store=user.merchant_profile.store,
+                store=store,
                 is_hidden_from_merchant=False
             ).select_related(
                 'store', 'user'
@@ -358,8 +364,8 @@ class SurplusFoodOrderViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         """創建訂單時生成取餐號碼並寫入 Firestore"""
         # 獲取店家資訊
-        user = request.user
-        if not (hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store')):
+        store = get_request_store(request)
+        if not store:
             # 如果不是商家，從 items 或 surplus_food 取得 store
             items = request.data.get('items')
             surplus_food_id = request.data.get('surplus_food')
@@ -391,8 +397,6 @@ class SurplusFoodOrderViewSet(viewsets.ModelViewSet):
                     {'error': '必須提供訂單品項（items）或惜福品（surplus_food）'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-        else:
-            store = user.merchant_profile.store
         
         # 創建訂單
         serializer = self.get_serializer(data=request.data)
@@ -594,9 +598,9 @@ class GreenPointRuleViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的綠色點數規則"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            queryset = GreenPointRule.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            queryset = GreenPointRule.objects.filter(store=store)
             
             # 支援狀態篩選
             is_active = self.request.query_params.get('is_active', None)
@@ -613,9 +617,9 @@ class GreenPointRuleViewSet(viewsets.ModelViewSet):
     
     def perform_create(self, serializer):
         """創建時自動關聯到商家的店鋪"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            serializer.save(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            serializer.save(store=store)
         else:
             raise ValueError("使用者沒有關聯的店鋪")
     
@@ -632,11 +636,10 @@ class GreenPointRuleViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def statistics(self, request):
         """獲取綠色點數規則統計"""
-        user = request.user
-        if not hasattr(user, 'merchant_profile') or not hasattr(user.merchant_profile, 'store'):
+        store = get_request_store(request)
+        if not store:
             return Response({'error': '無權限'}, status=status.HTTP_403_FORBIDDEN)
         
-        store = user.merchant_profile.store
         queryset = GreenPointRule.objects.filter(store=store)
         
         stats = {
@@ -655,16 +658,16 @@ class PointRedemptionRuleViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """只返回當前商家的兌換規則"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            return PointRedemptionRule.objects.filter(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            return PointRedemptionRule.objects.filter(store=store)
         return PointRedemptionRule.objects.none()
     
     def perform_create(self, serializer):
         """創建時自動關聯到商家的店鋪"""
-        user = self.request.user
-        if hasattr(user, 'merchant_profile') and hasattr(user.merchant_profile, 'store'):
-            serializer.save(store=user.merchant_profile.store)
+        store = get_request_store(self.request)
+        if store:
+            serializer.save(store=store)
         else:
             raise ValueError("使用者沒有關聯的店鋪")
     
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class UsersConfig(AppConfig):
+    name = 'apps.users'
+    verbose_name = '用戶'
+
+    def ready(self):
+        import apps.users.signals
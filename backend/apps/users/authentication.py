@@ -0,0 +1,119 @@
+"""
+JWT 驗證與請求身分（用戶、商家、店家）
+
+商家端 API 幾乎每個請求都要由 request.user 找到 merchant_profile 與 store，
+各 view 各自以 hasattr 與多次查詢解析。CachedJWTAuthentication 在驗證時以一次
+select_related 查詢載入用戶、商家與店家，並以 JWT 的 jti 為鍵放入共用快取
+（保存 JWT_IDENTITY_CACHE_SECONDS 秒且不超過 token 到期時間），同一個 token 的
+後續請求不必再查詢資料庫。
+
+User、Merchant、Store 變更時由 signals 更新該用戶的身分版本號，快取的身分
+與版本號以同一次 get_many 取得，版本不符時重新載入。版本號必須在所有行程間共用，
+未設定共用快取（REDIS_URL）時 JWT_IDENTITY_CACHE_SECONDS 預設為 0，不快取身分。
+
+以 update() 維護的店家計數欄位（surplus_completed_*、loyalty_member_count 等）
+不會送出 post_save，快取中的 Store 可能是舊值；需要這些欄位時請由資料庫重新讀取。
+
+view 以 get_user_store(user) 或 request.store（見 apps.users.middleware）取得店家。
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+IDENTITY_CACHE_PREFIX = 'jwt_identity'
+IDENTITY_VERSION_CACHE_PREFIX = 'jwt_identity_version'
+
+
+def identity_version_key(user_id):
+    return f'{IDENTITY_VERSION_CACHE_PREFIX}:{user_id}'
+
+
+def invalidate_user_identity(user_id):
+    """讓此用戶所有 token 的快取身分在下次請求時重新載入。"""
+    cache.set(identity_version_key(user_id), uuid.uuid4().hex, None)
+
+
+def get_user_store(user):
+    """
+    取得用戶（商家）的店家，不是商家或沒有店家時回傳 None
+
+    經 CachedJWTAuthentication 驗證的用戶已載入商家與店家，不會再查詢。
+    """
+    if user is None or not user.is_authenticated:
+        return None
+    try:
+        return user.merchant_profile.store
+    except ObjectDoesNotExist:
+        return None
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """以 select_related 載入用戶、商家與店家，並依 jti 快取的 JWTAuthentication。"""
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is not None:
+            request.store = get_user_store(result[0])
+        return result
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        ttl = min(settings.JWT_IDENTITY_CACHE_SECONDS, int(validated_token.get('exp', 0) - time.time()))
+        if user_id is None or ttl <= 0:
+            return self._load_user(validated_token)
+
+        version_key = identity_version_key(user_id)
+        identity_key = self._identity_key(user_id, validated_token)
+        cached = cache.get_many([identity_key, version_key])
+        version = cached.get(version_key)
+        entry = cached.get(identity_key)
+        if entry is not None and version is not None and entry[0] == version:
+            return entry[1]
+
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(version_key, version, None):
+                version = cache.get(version_key, version)
+        user = self._load_user(validated_token)
+        cache.set(identity_key, (version, user), ttl)
+        return user
+
+    def _load_user(self, validated_token):
+        """與 JWTAuthentication.get_user 相同的檢查，只改為一次載入商家與店家。"""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as exc:
+            raise InvalidToken(_('Token contained no recognizable user identification')) from exc
+
+        try:
+            user = self.user_model.objects.select_related('merchant_profile__store').get(
+                **{api_settings.USER_ID_FIELD: user_id}
+            )
+        except self.user_model.DoesNotExist as exc:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found') from exc
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM
+        ) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
+
+    @staticmethod
+    def _identity_key(user_id, validated_token):
+        token_id = validated_token.get(api_settings.JTI_CLAIM)
+        if not token_id:
+            token_id = hashlib.sha256(str(validated_token).encode('utf-8')).hexdigest()
+        return f'{IDENTITY_CACHE_PREFIX}:{user_id}:{token_id}'
+
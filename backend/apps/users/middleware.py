@@ -0,0 +1,28 @@
+"""
+request.store：目前登入商家的店家
+
+DRF 在 view 內才驗證 JWT：經 CachedJWTAuthentication 驗證的請求會直接設定
+request.store（已隨用戶一起載入，不需查詢）。其他請求（例如 Django admin 的
+session 登入）由這個 middleware 放入延遲求值的物件，第一次使用時才解析。
+不是商家或未登入時為 None。
+"""
+from django.utils.functional import SimpleLazyObject
+
+from .authentication import get_user_store
+
+
+def get_request_store(request):
+    """取得請求的店家（Store 或 None），未設定 request.store 時由 request.user 解析。"""
+    store = getattr(request, 'store', None)
+    if store is None or isinstance(store, SimpleLazyObject):
+        return get_user_store(getattr(request, 'user', None))
+    return store
+
+
+class RequestStoreMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.store = SimpleLazyObject(lambda: get_user_store(getattr(request, 'user', None)))
+        return self.get_response(request)
@@ -0,0 +1,290 @@
+"""
+Firebase ID Token 驗證
+
+firebase_auth.verify_id_token 每次登入都要取得 Google 公開憑證並完整驗證，
+憑證更新時登入會卡在對外請求上。此處改為：
+- 公開憑證依回應的 Cache-Control max-age 保存在行程記憶體，到期前
+  FIREBASE_CERT_PREFETCH_SECONDS 秒由背景執行緒預先更新，登入不必等待
+- 憑證過期才同步更新（同時只有一個執行緒發出請求）；更新失敗時暫時沿用舊憑證
+- 出現未知的 kid（Google 已輪替金鑰）時立即更新，但限制更新頻率，
+  避免偽造的 token 讓每次請求都打到 Google
+- 驗證通過的 claims 以 token 雜湊為鍵放入共用快取，保存到 token 到期為止
+
+錯誤沿用 firebase_admin 的例外（InvalidIdTokenError、ExpiredIdTokenError、
+CertificateFetchError），呼叫端不需改變錯誤處理。
+命中率、憑證更新次數與登入耗時記錄在行程內的 firebase_auth_metrics。
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+import jwt
+import requests
+from cryptography.x509 import load_pem_x509_certificate
+
+from django.conf import settings
+from django.core.cache import cache
+from firebase_admin import auth as firebase_auth
+
+logger = logging.getLogger(__name__)
+
+CLAIMS_CACHE_PREFIX = 'firebase_claims'
+ISSUER_PREFIX = 'https://securetoken.google.com/'
+# 回應沒有 max-age 時的憑證保存秒數
+DEFAULT_CERT_MAX_AGE_SECONDS = 60 * 60
+# 更新失敗時沿用舊憑證，這段時間後再重試
+CERT_RETRY_SECONDS = 30
+# 遇到未知 kid 時兩次更新之間的最短間隔
+UNKNOWN_KID_REFRESH_SECONDS = 60
+MAX_UID_LENGTH = 128
+LATENCY_SAMPLE_SIZE = 1000
+
+_MAX_AGE_RE = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def parse_max_age(cache_control):
+    """取出 Cache-Control 的 max-age 秒數，沒有時回傳 None。"""
+    match = _MAX_AGE_RE.search(cache_control or '')
+    return int(match.group(1)) if match else None
+
+
+class FirebaseAuthMetrics:
+    """行程內的驗證統計與登入耗時（執行緒安全）。"""
+
+    COUNTERS = ('claims_hits', 'claims_misses', 'key_fetches', 'key_fetch_failures', 'prefetches')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for name in self.COUNTERS:
+                setattr(self, name, 0)
+            self.login_count = 0
+            self._latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def observe_login(self, seconds):
+        with self._lock:
+            self.login_count += 1
+            self._latencies.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            data = {name: getattr(self, name) for name in self.COUNTERS}
+            lookups = self.claims_hits + self.claims_misses
+            data['claims_hit_rate'] = round(self.claims_hits / lookups, 3) if lookups else 0.0
+            latencies = sorted(self._latencies)
+            data['login_count'] = self.login_count
+            if latencies:
+                data['login_avg_ms'] = round(sum(latencies) / len(latencies) * 1000, 1)
+                data['login_p95_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+                data['login_max_ms'] = round(latencies[-1] * 1000, 1)
+            else:
+                data['login_avg_ms'] = data['login_p95_ms'] = data['login_max_ms'] = 0.0
+            return data
+
+
+firebase_auth_metrics = FirebaseAuthMetrics()
+
+
+class PublicKeyStore:
+    """
+    Google 公開憑證（kid -> 公鑰）
+
+    Args:
+        cert_url: 憑證 JSON 的網址（測試時指向本機伺服器）
+        session: requests.Session
+        prefetch_seconds: 到期前多少秒開始背景更新
+    """
+
+    def __init__(self, cert_url=None, session=None, prefetch_seconds=None, clock=time.monotonic):
+        self.cert_url = cert_url or settings.FIREBASE_CERT_URL
+        self.session = session or requests.Session()
+        self.prefetch_seconds = (
+            settings.FIREBASE_CERT_PREFETCH_SECONDS if prefetch_seconds is None else prefetch_seconds
+        )
+        self._clock = clock
+        self._keys = {}
+        self._fetched_at = None
+        self._expires_at = 0.0
+        self._refresh_lock = threading.Lock()
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_thread = None
+
+    def get_key(self, kid):
+        now = self._clock()
+        if now >= self._expires_at:
+            self.refresh(requested_at=now)
+        elif kid not in self._keys:
+            if self._fetched_at is None or now - self._fetched_at >= UNKNOWN_KID_REFRESH_SECONDS:
+                self.refresh(requested_at=now)
+        elif self._expires_at - now <= self.prefetch_seconds:
+            self.prefetch()
+
+        key = self._keys.get(kid)
+        if key is None:
+            raise firebase_auth.InvalidIdTokenError(f'ID token 的 kid 不在 Google 公開憑證中: {kid}')
+        return key
+
+    def refresh(self, requested_at=None):
+        """
+        重新取得公開憑證
+
+        requested_at 之後已有其他執行緒完成更新時直接返回，
+        同時到期的多個請求只會發出一次對外請求。
+        """
+        with self._refresh_lock:
+            if requested_at is not None and self._fetched_at is not None and self._fetched_at >= requested_at:
+                return
+            now = self._clock()
+            try:
+                response = self.session.get(self.cert_url, timeout=settings.FIREBASE_CERT_TIMEOUT_SECONDS)
+                response.raise_for_status()
+                keys = {
+                    kid: load_pem_x509_certificate(pem.encode('utf-8')).public_key()
+                    for kid, pem in response.json().items()
+                }
+            except Exception as exc:
+                firebase_auth_metrics.incr('key_fetch_failures')
+                if not self._keys:
+                    raise firebase_auth.CertificateFetchError(f'無法取得 Firebase 公開憑證: {exc}', exc)
+                logger.warning('[FirebaseAuth] failed to refresh public certs, keep using cached certs: %s', exc)
+                self._fetched_at = now
+                self._expires_at = max(self._expires_at, now + CERT_RETRY_SECONDS)
+                return
+
+            max_age = parse_max_age(response.headers.get('Cache-Control'))
+            self._keys = keys
+            self._fetched_at = now
+            self._expires_at = now + (DEFAULT_CERT_MAX_AGE_SECONDS if max_age is None else max_age)
+            firebase_auth_metrics.incr('key_fetches')
+
+    def prefetch(self):
+        """在背景更新憑證；已有更新進行中時不重複啟動。"""
+        with self._prefetch_lock:
+            if self._prefetch_thread and self._prefetch_thread.is_alive():
+                return self._prefetch_thread
+            requested_at = self._clock()
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch,
+                args=(requested_at,),
+                name='firebase-cert-prefetch',
+                daemon=True,
+            )
+            self._prefetch_thread.start()
+            firebase_auth_metrics.incr('prefetches')
+            return self._prefetch_thread
+
+    def _prefetch(self, requested_at):
+        try:
+            self.refresh(requested_at=requested_at)
+        except Exception:
+            logger.exception('[FirebaseAuth] public cert prefetch failed')
+
+
+_key_store = None
+_key_store_lock = threading.Lock()
+
+
+def get_public_key_store():
+    global _key_store
+
+    with _key_store_lock:
+        if _key_store is None:
+            _key_store = PublicKeyStore()
+        return _key_store
+
+
+def get_project_id():
+    if settings.FIREBASE_PROJECT_ID:
+        return settings.FIREBASE_PROJECT_ID
+    import firebase_admin
+
+    try:
+        project_id = firebase_admin.get_app().project_id
+    except ValueError:
+        project_id = None
+    if not project_id:
+        raise ValueError('未設定 FIREBASE_PROJECT_ID，且 Firebase Admin SDK 未提供 project_id')
+    return project_id
+
+
+def _claims_cache_key(id_token):
+    return f"{CLAIMS_CACHE_PREFIX}:{hashlib.sha256(id_token.encode('utf-8')).hexdigest()}"
+
+
+def decode_id_token(id_token, *, key_store=None, project_id=None, clock_skew_seconds=0):
+    """以公開憑證驗證 ID token 的簽章與 claims，回傳 claims（含 uid）。"""
+    try:
+        header = jwt.get_unverified_header(id_token)
+    except jwt.PyJWTError as exc:
+        raise firebase_auth.InvalidIdTokenError(f'ID token 格式錯誤: {exc}', cause=exc)
+    if header.get('alg') != 'RS256' or not header.get('kid'):
+        raise firebase_auth.InvalidIdTokenError('ID token 必須以 RS256 簽署並帶有 kid')
+
+    project_id = project_id or get_project_id()
+    key = (key_store or get_public_key_store()).get_key(header['kid'])
+    try:
+        claims = jwt.decode(
+            id_token,
+            key=key,
+            algorithms=['RS256'],
+            audience=project_id,
+            issuer=f'{ISSUER_PREFIX}{project_id}',
+            leeway=clock_skew_seconds,
+            options={'require': ['exp', 'iat', 'aud', 'iss', 'sub']},
+        )
+    except jwt.ExpiredSignatureError as exc:
+        raise firebase_auth.ExpiredIdTokenError('ID token 已過期', exc)
+    except jwt.PyJWTError as exc:
+        raise firebase_auth.InvalidIdTokenError(f'ID token 驗證失敗: {exc}', cause=exc)
+
+    uid = claims.get('sub')
+    if not isinstance(uid, str) or not uid or len(uid) > MAX_UID_LENGTH:
+        raise firebase_auth.InvalidIdTokenError('ID token 的 sub 必須為 1 到 128 字元的字串')
+    auth_time = claims.get('auth_time')
+    if auth_time is not None and auth_time > time.time() + clock_skew_seconds:
+        raise firebase_auth.InvalidIdTokenError('ID token 的 auth_time 不可晚於目前時間')
+    claims['uid'] = uid
+    return claims
+
+
+def verify_id_token(id_token, *, clock_skew_seconds=0, key_store=None, project_id=None):
+    """
+    驗證 Firebase ID token（取代 firebase_auth.verify_id_token，不檢查撤銷狀態）
+
+    FIREBASE_TOKEN_CACHE_ENABLED=False 時直接交給 Firebase Admin SDK。
+
+    Returns:
+        dict: token 的 claims，uid 為 Firebase 用戶 ID
+    """
+    if not settings.FIREBASE_TOKEN_CACHE_ENABLED:
+        return firebase_auth.verify_id_token(id_token, check_revoked=False, clock_skew_seconds=clock_skew_seconds)
+    if not isinstance(id_token, str) or not id_token:
+        raise firebase_auth.InvalidIdTokenError('ID token 必須為非空字串')
+
+    key = _claims_cache_key(id_token)
+    claims = cache.get(key)
+    if claims is not None and claims['exp'] + clock_skew_seconds > time.time():
+        firebase_auth_metrics.incr('claims_hits')
+        return dict(claims)
+
+    firebase_auth_metrics.incr('claims_misses')
+    claims = decode_id_token(
+        id_token,
+        key_store=key_store,
+        project_id=project_id,
+        clock_skew_seconds=clock_skew_seconds,
+    )
+    timeout = int(claims['exp'] - time.time())
+    if timeout > 0:
+        cache.set(key, claims, timeout)
+    return dict(claims)
@@ -0,0 +1,21 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.stores.models import Store
+
+from .authentication import invalidate_user_identity
+from .models import Merchant, User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Merchant)
+@receiver(post_delete, sender=Merchant)
+@receiver(post_save, sender=Store)
+@receiver(post_delete, sender=Store)
+def identity_changed_invalidate_cache(sender, instance, **kwargs):
+    """用戶、商家或店家變更後，該用戶快取的 JWT 身分在下次請求時重新載入。"""
+    # Merchant 以 user 為主鍵，Store.merchant_id 即為用戶 ID
+    user_id = instance.merchant_id if sender is Store else instance.pk
+    transaction.on_commit(lambda: invalidate_user_identity(user_id))
@@ -0,0 +1,299 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from firebase_admin import auth as firebase_auth
+from rest_framework_simplejwt.tokens import AccessToken
+from unittest import mock
+
+from apps.line_bot.models import StoreFAQ
+from apps.stores.models import Store
+from apps.users.middleware import RequestStoreMiddleware, get_request_store
+from apps.users.models import Merchant, User
+from apps.users.services import firebase_tokens
+from apps.users.services.firebase_tokens import (
+    PublicKeyStore,
+    firebase_auth_metrics,
+    parse_max_age,
+    verify_id_token,
+)
+
+PROJECT_ID = 'test-project'
+
+
+def _make_key_pair(common_name):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(dt_timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+    return private_key, certificate.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+
+class FakeKeyServer:
+    """在本機回應 Google 公開憑證 JSON 的 HTTP 伺服器。"""
+
+    def __init__(self, certs, max_age=3600):
+        self.certs = certs
+        self.max_age = max_age
+        self.status_code = 200
+        self.request_count = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.request_count += 1
+                body = json.dumps(server.certs).encode('utf-8')
+                self.send_response(server.status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', f'public, max-age={server.max_age}, must-revalidate')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/certs'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(FIREBASE_PROJECT_ID=PROJECT_ID, FIREBASE_TOKEN_CACHE_ENABLED=True)
+class FirebaseTokenVerificationTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key, cls.certificate = _make_key_pair('key-1')
+        cls.rotated_key, cls.rotated_certificate = _make_key_pair('key-2')
+
+    def setUp(self):
+        cache.clear()
+        firebase_auth_metrics.reset()
+        self.server = FakeKeyServer({'key-1': self.certificate})
+        self.addCleanup(self.server.close)
+        self.clock = FakeClock()
+        self.key_store = PublicKeyStore(cert_url=self.server.url, prefetch_seconds=300, clock=self.clock)
+
+    def _token(self, uid='firebase-uid', kid='key-1', private_key=None, expires_in=3600, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://securetoken.google.com/{PROJECT_ID}',
+            'aud': PROJECT_ID,
+            'sub': uid,
+            'iat': now,
+            'auth_time': now,
+            'exp': now + expires_in,
+            'email': f'{uid}@example.com',
+        }
+        payload.update(claims)
+        return jwt.encode(payload, private_key or self.private_key, algorithm='RS256', headers={'kid': kid})
+
+    def test_parse_max_age(self):
+        self.assertEqual(parse_max_age('public, max-age=19302, must-revalidate'), 19302)
+        self.assertIsNone(parse_max_age('no-cache'))
+        self.assertIsNone(parse_max_age(None))
+
+    def test_verifies_token_and_caches_certs_and_claims(self):
+        token = self._token()
+
+        claims = verify_id_token(token, key_store=self.key_store)
+        self.assertEqual(claims['uid'], 'firebase-uid')
+        self.assertEqual(verify_id_token(token, key_store=self.key_store)['uid'], 'firebase-uid')
+        verify_id_token(self._token(uid='other-uid'), key_store=self.key_store)
+
+        self.assertEqual(self.server.request_count, 1)
+        metrics = firebase_auth_metrics.snapshot()
+        self.assertEqual(metrics['claims_hits'], 1)
+        self.assertEqual(metrics['claims_misses'], 2)
+        self.assertEqual(metrics['key_fetches'], 1)
+
+    def test_certs_follow_cache_control_and_prefetch_before_expiry(self):
+        self.key_store.get_key('key-1')
+        self.assertEqual(self.server.request_count, 1)
+
+        self.clock.now += 3600 - 600
+        self.key_store.get_key('key-1')
+        self.assertEqual(self.server.request_count, 1)
+
+        # 進入到期前的預先更新區間：仍回傳目前的公鑰，並由背景執行緒更新
+        self.clock.now += 400
+        self.key_store.get_key('key-1')
+        self.key_store.prefetch().join(timeout=5)
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(firebase_auth_metrics.snapshot()['prefetches'], 1)
+
+        # 過期後同步更新
+        self.clock.now += 3600
+        self.key_store.get_key('key-1')
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_unknown_kid_refreshes_certs_at_limited_rate(self):
+        self.key_store.get_key('key-1')
+        self.server.certs = {'key-1': self.certificate, 'key-2': self.rotated_certificate}
+
+        self.clock.now += 30
+        with self.assertRaises(firebase_auth.InvalidIdTokenError):
+            self.key_store.get_key('key-2')
+        self.assertEqual(self.server.request_count, 1)
+
+        self.clock.now += 60
+        token = self._token(kid='key-2', private_key=self.rotated_key)
+        self.assertEqual(verify_id_token(token, key_store=self.key_store)['uid'], 'firebase-uid')
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_refresh_failure_keeps_cached_certs(self):
+        self.key_store.get_key('key-1')
+        self.server.status_code = 500
+
+        self.clock.now += 7200
+        self.assertIsNotNone(self.key_store.get_key('key-1'))
+        self.assertEqual(firebase_auth_metrics.snapshot()['key_fetch_failures'], 1)
+
+        empty_store = PublicKeyStore(cert_url=self.server.url, clock=self.clock)
+        with self.assertRaises(firebase_auth.CertificateFetchError):
+            empty_store.get_key('key-1')
+
+    def test_rejects_invalid_tokens(self):
+        with self.assertRaises(firebase_auth.ExpiredIdTokenError):
+            verify_id_token(self._token(expires_in=-60), key_store=self.key_store)
+        with self.assertRaises(firebase_auth.InvalidIdTokenError):
+            verify_id_token(self._token(aud='another-project'), key_store=self.key_store)
+        with self.assertRaises(firebase_auth.InvalidIdTokenError):
+            verify_id_token(self._token(private_key=self.rotated_key), key_store=self.key_store)
+        with self.assertRaises(firebase_auth.InvalidIdTokenError):
+            verify_id_token('not-a-token', key_store=self.key_store)
+
+    def test_login_view_returns_jwt_and_records_latency(self):
+        User.objects.create_user(
+            email='login@example.com',
+            password='password',
+            firebase_uid='login-uid',
+            username='Login User',
+        )
+        with mock.patch.object(firebase_tokens, '_key_store', self.key_store):
+            response = self.client.post(
+                reverse('token_obtain_pair'),
+                {'id_token': self._token(uid='login-uid')},
+                content_type='application/json',
+            )
+            invalid = self.client.post(
+                reverse('token_obtain_pair'),
+                {'id_token': self._token(uid='login-uid', expires_in=-60)},
+                content_type='application/json',
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.json())
+        self.assertEqual(response.json()['user']['firebase_uid'], 'login-uid')
+        self.assertEqual(invalid.status_code, 401)
+        self.assertEqual(firebase_auth_metrics.snapshot()['login_count'], 2)
+
+
+@override_settings(JWT_IDENTITY_CACHE_SECONDS=60)
+class RequestIdentityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='identity@example.com',
+            password='password',
+            firebase_uid='identity-uid',
+            username='Identity Merchant',
+            user_type='merchant',
+        )
+        merchant = Merchant.objects.create(user=self.user, company_account='55667788', plan='basic')
+        self.store = Store.objects.create(
+            merchant=merchant,
+            name='Identity Store',
+            cuisine_type='other',
+            address='Test Address',
+            phone='0212345678',
+        )
+        StoreFAQ.objects.create(store=self.store, question='營業時間', answer='11:00-21:00')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def _list_faqs(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/line-bot/faqs/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_identity_is_loaded_once_and_cached_per_token(self):
+        first_response, first_queries = self._list_faqs()
+        _, second_queries = self._list_faqs()
+
+        self.assertEqual(len(first_response.json()), 1)
+        # 第一次：用戶 + 商家 + 店家一次查詢，再加上 FAQ 查詢
+        self.assertEqual(first_queries, second_queries + 1)
+
+    def test_store_change_invalidates_cached_identity(self):
+        self._list_faqs()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.store.delete()
+
+        response = self.client.get('/api/line-bot/faqs/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+    def test_surplus_statistics_read_fresh_counters(self):
+        self._list_faqs()
+        Store.objects.filter(pk=self.store.pk).update(
+            surplus_completed_order_count_total=3,
+            surplus_completed_revenue_total=Decimal('100'),
+        )
+
+        response = self.client.get('/api/merchant/surplus/foods/statistics/', **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['completed_orders'], 3)
+        self.assertEqual(response.json()['donation_amount'], 60.0)
+
+    def test_middleware_resolves_store_for_session_requests(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.user.pk)
+        RequestStoreMiddleware(lambda req: None)(request)
+
+        self.assertEqual(get_request_store(request), self.store)
+        customer = User.objects.create_user(
+            email='identity-customer@example.com',
+            password='password',
+            firebase_uid='identity-customer-uid',
+            username='Customer',
+        )
+        request.user = customer
+        request.store = None
+        self.assertIsNone(get_request_store(request))
@@ -6,6 +6,14 @@ from .models import User
 from rest_framework_simplejwt.tokens import RefreshToken
 from firebase_admin import auth as firebase_auth
 from rest_framework.permissions import AllowAny, IsAuthenticated # 引入 AllowAny
+import logging
+import time
+
+from django.conf import settings
+
+from .services.firebase_tokens import firebase_auth_metrics, verify_id_token
+
+logger = logging.getLogger(__name__)
 
 class FirebaseTokenLoginView(APIView):
     authentication_classes = [] # 豁免此視圖的全域 JWT 驗證
@@ -15,15 +23,25 @@ class FirebaseTokenLoginView(APIView):
     Receives a Firebase ID token and returns a pair of JWT tokens.
     """
     def post(self, request, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return self._login(request)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            firebase_auth_metrics.observe_login(elapsed)
+            if elapsed >= settings.FIREBASE_LOGIN_SLOW_SECONDS:
+                logger.warning('[FirebaseAuth] slow login: %.3fs', elapsed)
+
+    def _login(self, request):
         id_token = request.data.get('id_token')
         if not id_token:
             return Response({'error': 'ID token is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            # Verify the ID token with Firebase Admin SDK
+            # 以快取的 Google 公開憑證驗證 ID token，驗證結果快取至 token 到期
 
             # 增加時間容錯，允許 5 秒的時間差異
-            decoded_token = firebase_auth.verify_id_token(id_token, check_revoked=False, clock_skew_seconds=5)
+            decoded_token = verify_id_token(id_token, clock_skew_seconds=5)
 
             uid = decoded_token['uid']
 
@@ -31,7 +49,7 @@ class FirebaseTokenLoginView(APIView):
             # 注意：如果用戶不存在，會使用預設值 'customer' 創建
             # 這意味著用戶必須先通過註冊流程才能正確設定 user_type
             try:
-                user = User.objects.get(firebase_uid=uid)
+                user = User.objects.select_related('merchant_profile').get(firebase_uid=uid)
             except User.DoesNotExist:
                 # 如果用戶不存在，創建新用戶（預設為 customer）
                 # 這種情況應該很少見，因為正常流程是先註冊再登入
@@ -76,6 +94,8 @@ class FirebaseTokenLoginView(APIView):
                 'user': user_data  # 將使用者資料一起回傳
             })
 
+        except firebase_auth.CertificateFetchError as e:
+            return Response({'error': 'Unable to verify Firebase ID token', 'detail': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except firebase_auth.InvalidIdTokenError as e:
             # 更具體的錯誤，方便前端判斷
             return Response({'error': 'Invalid Firebase ID token', 'detail': str(e)}, status=status.HTTP_401_UNAUTHORIZED)
@@ -28,6 +28,16 @@ def env_int(name, default=0):
         return default
 
 
+def env_float(name, default=0.0):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
 def env_list(name, default=''):
     raw = os.getenv(name, default)
     return [item.strip() for item in raw.split(',') if item.strip()]
@@ -53,6 +63,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'apps.users',
@@ -78,6 +89,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apps.users.middleware.RequestStoreMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -118,6 +130,29 @@ DATABASES = {
     }
 }
 
+# Cache
+# ------------------------------------------------------------------------------
+# 設定版本號、FAQ 索引、店家資料、對話歷史、webhook 去重與 JWT 身分等快取都需要
+# 所有行程（gunicorn worker、run_scheduler）共用同一個快取。正式環境請設定 REDIS_URL；
+# 未設定時改用各行程獨立的記憶體快取，並將行程內副本的保存秒數縮短，限制資料過期時間。
+REDIS_URL = os.getenv('REDIS_URL', '')
+SHARED_CACHE_ENABLED = bool(REDIS_URL)
+if SHARED_CACHE_ENABLED:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': os.getenv('CACHE_KEY_PREFIX', 'catering'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    logger.warning('未設定 REDIS_URL：快取不會在行程間共用，多個 worker 之間的快取失效通知無法送達。')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -199,9 +234,102 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Django REST Framework 的設定
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.users.authentication.CachedJWTAuthentication',
     ),
 }
 
-
-
+# 離線推薦模型產物（版本化目錄，由 train_item_cf 指令輸出）
+ML_MODELS_ROOT = os.getenv('ML_MODELS_ROOT', os.path.join(BASE_DIR, 'ml_artifacts'))
+# 協同過濾分數混入標籤推薦分數的權重，設為 0 可停用
+ITEM_CF_BLEND_WEIGHT = env_float('ITEM_CF_BLEND_WEIGHT', 1.0)
+
+# LINE 推播派送（LINE push API 每頻道上限約 2,000 req/s，預設保守使用一半）
+LINE_PUSH_MAX_WORKERS = env_int('LINE_PUSH_MAX_WORKERS', 8)
+LINE_PUSH_RATE_PER_SECOND = env_int('LINE_PUSH_RATE_PER_SECOND', 1000)
+LINE_PUSH_MAX_RETRIES = env_int('LINE_PUSH_MAX_RETRIES', 3)
+LINE_PUSH_TIMEOUT_SECONDS = env_int('LINE_PUSH_TIMEOUT_SECONDS', 10)
+
+# 推播記錄：批次寫入筆數與保存期限（prune_push_logs 指令）
+PUSH_LOG_BULK_BATCH_SIZE = env_int('PUSH_LOG_BULK_BATCH_SIZE', 500)
+PUSH_LOG_RETENTION_DAYS = env_int('PUSH_LOG_RETENTION_DAYS', 180)
+PUSH_LOG_COMPACT_AFTER_DAYS = env_int('PUSH_LOG_COMPACT_AFTER_DAYS', 30)
+
+# 排程（以 SchedulerLease 租約協調，多行程同時執行也只有一個行程會執行同一工作）
+RECOMMENDATION_SCHEDULER_INTERVAL_SECONDS = env_int('RECOMMENDATION_SCHEDULER_INTERVAL_SECONDS', 60)
+SCHEDULER_POLL_SECONDS = env_int('SCHEDULER_POLL_SECONDS', 5)
+SCHEDULER_LEASE_SECONDS = env_int('SCHEDULER_LEASE_SECONDS', 300)
+SCHEDULER_JITTER_RATIO = env_float('SCHEDULER_JITTER_RATIO', 0.1)
+SCHEDULER_RUN_RETENTION_DAYS = env_int('SCHEDULER_RUN_RETENTION_DAYS', 30)
+# runserver 開發時在背景執行緒啟動排程；正式環境改以 manage.py run_scheduler 獨立執行
+EMBEDDED_SCHEDULER_ENABLED = env_bool('EMBEDDED_SCHEDULER_ENABLED', True)
+
+# 推播發送工作：每批人數、請求內直接發送的人數上限、心跳逾時後由排程接手的秒數
+BROADCAST_JOB_BATCH_SIZE = env_int('BROADCAST_JOB_BATCH_SIZE', 500)
+BROADCAST_INLINE_MAX_RECIPIENTS = env_int('BROADCAST_INLINE_MAX_RECIPIENTS', 1000)
+BROADCAST_JOB_STALE_SECONDS = env_int('BROADCAST_JOB_STALE_SECONDS', 300)
+
+# LINE Webhook 事件：排入背景工作執行緒處理（依用戶分片保證順序），webhookEventId 去重保留秒數
+LINE_WEBHOOK_ASYNC_ENABLED = env_bool('LINE_WEBHOOK_ASYNC_ENABLED', True)
+LINE_WEBHOOK_WORKERS = env_int('LINE_WEBHOOK_WORKERS', 4)
+LINE_WEBHOOK_QUEUE_SIZE = env_int('LINE_WEBHOOK_QUEUE_SIZE', 1000)
+# 分片佇列已滿時等待的秒數，逾時則回傳 503 讓 LINE 重送
+LINE_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS = env_float('LINE_WEBHOOK_ENQUEUE_TIMEOUT_SECONDS', 2.0)
+LINE_WEBHOOK_DEDUP_TTL_SECONDS = env_int('LINE_WEBHOOK_DEDUP_TTL_SECONDS', 24 * 60 * 60)
+
+# LINE BOT 回覆用的店家資料快取秒數（相關資料變更時會立即清除，此為保險上限）；
+# 未設定共用快取時清除只作用於發生變更的行程，其他行程最多沿用舊資料到此秒數
+LINE_BOT_STORE_CONTEXT_CACHE_SECONDS = env_int(
+    'LINE_BOT_STORE_CONTEXT_CACHE_SECONDS',
+    6 * 60 * 60 if SHARED_CACHE_ENABLED else 5 * 60,
+)
+
+# FAQ 使用次數：背景寫回間隔秒數與提早寫回的累積次數
+FAQ_USAGE_FLUSH_SECONDS = env_int('FAQ_USAGE_FLUSH_SECONDS', 10)
+FAQ_USAGE_FLUSH_THRESHOLD = env_int('FAQ_USAGE_FLUSH_THRESHOLD', 200)
+
+# LINE Messaging API（回覆、推播、用戶資料）：連線池大小、連線 / 讀取逾時與重試次數
+LINE_API_BASE_URL = os.getenv('LINE_API_BASE_URL', 'https://api.line.me/v2/bot')
+LINE_API_POOL_SIZE = env_int('LINE_API_POOL_SIZE', 16)
+LINE_API_CONNECT_TIMEOUT_SECONDS = env_float('LINE_API_CONNECT_TIMEOUT_SECONDS', 3.05)
+LINE_API_READ_TIMEOUT_SECONDS = env_float('LINE_API_READ_TIMEOUT_SECONDS', 10.0)
+LINE_API_MAX_RETRIES = env_int('LINE_API_MAX_RETRIES', 2)
+
+# LINE BOT 相同問題的 AI 回覆快取秒數（店家資料變更時自動失效）
+LINE_BOT_ANSWER_CACHE_SECONDS = env_int('LINE_BOT_ANSWER_CACHE_SECONDS', 6 * 60 * 60)
+
+# LINE BOT 對話記錄：背景批次寫入間隔與筆數、近期對話歷史快取則數與秒數、保存天數（prune_conversation_logs 指令）
+CONVERSATION_LOG_ASYNC_ENABLED = env_bool('CONVERSATION_LOG_ASYNC_ENABLED', True)
+CONVERSATION_LOG_FLUSH_SECONDS = env_int('CONVERSATION_LOG_FLUSH_SECONDS', 2)
+CONVERSATION_LOG_BATCH_SIZE = env_int('CONVERSATION_LOG_BATCH_SIZE', 200)
+CONVERSATION_HISTORY_SIZE = env_int('CONVERSATION_HISTORY_SIZE', 10)
+# 未設定共用快取時各行程各自保存對話歷史，彼此看不到對方新增的訊息，縮短保存時間改由資料庫重新載入
+CONVERSATION_HISTORY_CACHE_SECONDS = env_int(
+    'CONVERSATION_HISTORY_CACHE_SECONDS',
+    24 * 60 * 60 if SHARED_CACHE_ENABLED else 10 * 60,
+)
+CONVERSATION_LOG_RETENTION_DAYS = env_int('CONVERSATION_LOG_RETENTION_DAYS', 365)
+
+# LINE Channel 設定（Secret / Token）在行程內的保存秒數上限（設定變更時會立即通知重新載入）
+LINE_CHANNEL_CREDENTIALS_CACHE_SECONDS = env_int('LINE_CHANNEL_CREDENTIALS_CACHE_SECONDS', 300)
+
+# Firebase ID Token 驗證：專案 ID（未設定時取自 Firebase Admin SDK）、公開憑證網址與逾時、到期前背景更新秒數、
+# 是否在本機驗證並快取 claims（False 時改用 firebase_auth.verify_id_token）、登入耗時超過此秒數時記錄警告
+FIREBASE_PROJECT_ID = os.getenv('FIREBASE_PROJECT_ID', '')
+FIREBASE_CERT_URL = os.getenv(
+    'FIREBASE_CERT_URL',
+    'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com',
+)
+FIREBASE_CERT_TIMEOUT_SECONDS = env_float('FIREBASE_CERT_TIMEOUT_SECONDS', 5.0)
+FIREBASE_CERT_PREFETCH_SECONDS = env_int('FIREBASE_CERT_PREFETCH_SECONDS', 300)
+FIREBASE_TOKEN_CACHE_ENABLED = env_bool('FIREBASE_TOKEN_CACHE_ENABLED', True)
+FIREBASE_LOGIN_SLOW_SECONDS = env_float('FIREBASE_LOGIN_SLOW_SECONDS', 1.0)
+
+# JWT 驗證後的用戶、商家與店家在共用快取保存的秒數（資料變更時會立即失效，此為保險上限）；
+# 失效通知需要共用快取才能送達其他行程，未設定 REDIS_URL 時預設為 0（不快取）
+JWT_IDENTITY_CACHE_SECONDS = env_int('JWT_IDENTITY_CACHE_SECONDS', 60 if SHARED_CACHE_ENABLED else 0)
+
+# 平台設定在行程內副本的保存秒數上限（設定變更時會透過共用快取通知重新載入）
+PLATFORM_SETTINGS_CACHE_SECONDS = env_int('PLATFORM_SETTINGS_CACHE_SECONDS', 300 if SHARED_CACHE_ENABLED else 30)
+
+# FAQ 比對索引在行程內的保存秒數上限（FAQ 變更時會透過共用快取通知重建）
+LINE_BOT_FAQ_INDEX_CACHE_SECONDS = env_int('LINE_BOT_FAQ_INDEX_CACHE_SECONDS', 300 if SHARED_CACHE_ENABLED else 30)